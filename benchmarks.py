@@ -0,0 +1,145 @@
+"""
+Mediciones de rendimiento de main.py sobre libros de ejemplo.
+
+Uso:
+    python benchmarks.py lectores modernizacion archivo1.xlsx [archivo2.xlsx ...] [--repeticiones 3]
+    python benchmarks.py normalizadores [--filas 100000] [--distintos 300]
+
+`lectores` procesa los archivos con cada lector de Excel instalado (LECTORES_EXCEL), informa
+el mejor tiempo de cada uno y verifica que todos den el mismo resultado que el primero.
+
+`normalizadores` mide el costo por fila de normalizar una columna de barrios y de extraer
+cantidades: la implementación anterior fila a fila frente a la actual (caché LRU y un cálculo
+por valor distinto).
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+import pandas as pd
+from fastapi import UploadFile
+
+import main
+
+PARSERS = {
+    'modernizacion': main.procesar_archivo_modernizacion,
+    'proyecto': main.procesar_archivo_proyecto,
+    'mantenimiento': main.procesar_archivo_mantenimiento,
+}
+
+
+def procesar(tipo_archivo, nombre, contenido):
+    """Resultado del parser en formato largo (como lo devuelve el pool) y sus DataFrames originales."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        resultado = PARSERS[tipo_archivo](UploadFile(file=io.BytesIO(contenido), filename=nombre))
+    if tipo_archivo == 'mantenimiento':
+        resultado = resultado, main.materiales_por_barrio(), {}
+    datos, datos_por_barrio, dfs_originales = resultado
+    return main.tablas_resultado(datos, datos_por_barrio), dfs_originales
+
+
+def comparar_resultados(esperado, obtenido):
+    """Lanza AssertionError si los dos resultados de `procesar` no coinciden."""
+    (tablas_a, dfs_a), (tablas_b, dfs_b) = esperado, obtenido
+    for nombre in main.COLUMNAS_TABLAS:
+        pd.testing.assert_frame_equal(tablas_a[nombre], tablas_b[nombre], obj=nombre)
+    for clave in ('ots', 'barrios', 'n_ordenes'):
+        assert tablas_a[clave] == tablas_b[clave], clave
+    assert list(dfs_a) == list(dfs_b), 'hojas'
+    for hoja in dfs_a:
+        pd.testing.assert_frame_equal(dfs_a[hoja], dfs_b[hoja], obj=hoja)
+
+
+def medir_lectores(tipo_archivo, rutas, repeticiones):
+    archivos = [(ruta, open(ruta, 'rb').read()) for ruta in rutas]
+    referencia = None
+    for lector in main.LECTORES_EXCEL:
+        main.LECTOR_EXCEL = lector
+        if main.lector_excel_activo() != lector:
+            print(f"{lector:16} no instalado")
+            continue
+        tiempos = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            resultados = [procesar(tipo_archivo, nombre, contenido) for nombre, contenido in archivos]
+            tiempos.append(time.perf_counter() - inicio)
+        if referencia is None:
+            referencia = lector, resultados
+        else:
+            for esperado, obtenido in zip(referencia[1], resultados):
+                comparar_resultados(esperado, obtenido)
+        igual = "" if referencia[0] == lector else f" (mismo resultado que {referencia[0]})"
+        print(f"{lector:16} {min(tiempos):8.3f} s{igual}")
+
+
+def normalizar_barrio_anterior(barrio):
+    """normalizar_barrio antes de las cachés, como referencia (el kwarg mal escrito hacía fallar siempre el try)."""
+    barrio_str = str(barrio).strip()
+    try:
+        pd.to_datetime(barrio_str, dayfirts=True)
+        return 'Sin barrio'
+    except Exception:
+        pass
+    if barrio_str in ['0', '0.0']:
+        return 'Sin barrio'
+    return barrio_str.title().strip()
+
+
+def medir(funcion, filas, repeticiones=3):
+    """Mejor tiempo por fila de `funcion()` en nanosegundos."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos) / filas * 1e9
+
+
+def medir_normalizadores(filas, distintos):
+    aleatorio = random.Random(0)
+    barrios_distintos = [f"barrio {i} de la ciudad" for i in range(distintos - 3)] + ['0', float('nan'), '12/05/2023']
+    barrios = pd.DataFrame({"3.Barrio": [aleatorio.choice(barrios_distintos) for _ in range(filas)]})
+    cantidades_distintas = [
+        aleatorio.choice([f"CABLE {i} ({i % 7 + 1})", f"CINTA AISLANTE {i % 9 + 1} UND", f"TORNILLO {i}"])
+        for i in range(distintos)
+    ]
+    cantidades = [aleatorio.choice(cantidades_distintas) for _ in range(filas)]
+
+    def barrios_actual():
+        main.normalizar_texto_barrio.cache_clear()
+        main.barrios_por_fila(barrios)
+
+    def cantidades_actual():
+        main.extraer_cantidad.cache_clear()
+        for texto in cantidades:
+            main.extraer_cantidad(texto)
+
+    for nombre, anterior, actual in (
+        ('normalizar_barrio', lambda: [normalizar_barrio_anterior(b) for b in barrios["3.Barrio"]], barrios_actual),
+        ('extraer_cantidad', lambda: [main.extraer_cantidad.__wrapped__(t) for t in cantidades], cantidades_actual),
+    ):
+        antes, despues = medir(anterior, filas), medir(actual, filas)
+        print(f"{nombre:18} anterior {antes:10.0f} ns/fila   actual {despues:8.0f} ns/fila   ({antes / despues:.0f}x)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='medicion', required=True)
+    lectores = sub.add_parser('lectores', help='Compara los lectores de Excel')
+    lectores.add_argument('tipo_archivo', choices=list(PARSERS))
+    lectores.add_argument('archivos', nargs='+')
+    lectores.add_argument('--repeticiones', type=int, default=3)
+    normalizadores = sub.add_parser('normalizadores', help='Costo por fila de los normalizadores')
+    normalizadores.add_argument('--filas', type=int, default=100000)
+    normalizadores.add_argument('--distintos', type=int, default=300)
+    args = parser.parse_args()
+    if args.medicion == 'lectores':
+        medir_lectores(args.tipo_archivo, args.archivos, args.repeticiones)
+    elif args.medicion == 'normalizadores':
+        medir_normalizadores(args.filas, args.distintos)
+
+
+if __name__ == '__main__':
+    main_cli()
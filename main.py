@@ -1,16 +1,196 @@
 import os
+import sys
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ERROR_CODES
 from openpyxl.utils import column_index_from_string, get_column_letter
 from openpyxl.styles import Font, Border, Side, Alignment, PatternFill
-from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Response
+from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
 import pandas as pd
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+import numpy as np
 from io import BytesIO
 import logging
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 import re
+import time
+import hashlib
+import importlib.util
+import pickle
+import zlib
+import asyncio
+import tempfile
+import threading
+import uuid
+import contextvars
+import datetime
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import resource
+import zipfile
 
 app = FastAPI()
+
+# Registro: nivel configurable (DEBUG muestra el detalle por nodo y por fila; con INFO esos
+# mensajes no se formatean) y cada línea lleva el id de la solicitud que la originó
+NIVEL_LOG = os.environ.get("NIVEL_LOG", "INFO").upper()
+ID_SOLICITUD = contextvars.ContextVar("id_solicitud", default="-")
+
+
+class FiltroIdSolicitud(logging.Filter):
+    """Agrega a cada registro el id de la solicitud en curso (`%(id_solicitud)s`)."""
+
+    def filter(self, record):
+        record.id_solicitud = ID_SOLICITUD.get()
+        return True
+
+
 logger = logging.getLogger(__name__)
+logger.setLevel(NIVEL_LOG)
+if not logger.handlers:
+    manejador_log = logging.StreamHandler()
+    manejador_log.addFilter(FiltroIdSolicitud())
+    manejador_log.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(id_solicitud)s] %(message)s"))
+    logger.addHandler(manejador_log)
+    logger.propagate = False
+
+
+# ======== MÉTRICAS POR ETAPA ========
+# Duración de cada etapa del procesamiento (histograma) y volúmenes que procesó (contadores),
+# acumulados desde que arrancó el proceso y publicados en formato Prometheus en /metrics.
+# Las etapas de la solicitud en curso se juntan además en ETAPAS_SOLICITUD para el
+# encabezado Server-Timing de la respuesta.
+BUCKETS_DURACION = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+VOLUMENES_ETAPA = ('filas', 'ots', 'nodos', 'bytes')
+METRICAS_ETAPAS = {}
+BLOQUEO_METRICAS = threading.Lock()
+ETAPAS_SOLICITUD = contextvars.ContextVar("etapas_solicitud", default=None)
+
+
+def registrar_etapa(nombre, segundos, volumenes=None):
+    """
+    Suma una ejecución de la etapa `nombre` a las métricas y a las etapas de la solicitud en curso.
+
+    Args:
+        nombre: Nombre de la etapa (etiqueta `etapa` en /metrics)
+        segundos: Duración de la ejecución
+        volumenes: Diccionario opcional con filas, ots, nodos y bytes procesados
+    """
+    with BLOQUEO_METRICAS:
+        metrica = METRICAS_ETAPAS.get(nombre)
+        if metrica is None:
+            metrica = METRICAS_ETAPAS[nombre] = {
+                'buckets': [0] * len(BUCKETS_DURACION), 'suma': 0.0, 'conteo': 0,
+                'volumenes': dict.fromkeys(VOLUMENES_ETAPA, 0),
+            }
+        for i, limite in enumerate(BUCKETS_DURACION):
+            if segundos <= limite:
+                metrica['buckets'][i] += 1
+                break
+        metrica['suma'] += segundos
+        metrica['conteo'] += 1
+        for volumen, cantidad in (volumenes or {}).items():
+            metrica['volumenes'][volumen] += cantidad
+    etapas = ETAPAS_SOLICITUD.get()
+    if etapas is not None:
+        etapas.append((nombre, segundos))
+
+
+@contextmanager
+def etapa(nombre):
+    """
+    Mide el bloque como una ejecución de la etapa `nombre`.
+
+    Entrega un diccionario donde el bloque anota los volúmenes procesados (filas, ots, nodos,
+    bytes); si el bloque falla, la ejecución no se registra.
+    """
+    volumenes = {}
+    inicio = time.perf_counter()
+    yield volumenes
+    registrar_etapa(nombre, time.perf_counter() - inicio, volumenes)
+
+
+def etapas_por_nombre(etapas):
+    """Agrupa (etapa, segundos) por etapa, en orden de primera aparición: {etapa: (veces, segundos)}."""
+    agrupadas = {}
+    for nombre, segundos in etapas:
+        veces, total = agrupadas.get(nombre, (0, 0.0))
+        agrupadas[nombre] = (veces + 1, total + segundos)
+    return agrupadas
+
+
+def encabezado_server_timing(etapas, total):
+    """Valor del encabezado Server-Timing: una entrada por etapa con su duración sumada en ms."""
+    entradas = []
+    for nombre, (veces, segundos) in etapas_por_nombre(etapas).items():
+        descripcion = f';desc="{veces} veces"' if veces > 1 else ''
+        entradas.append(f"{nombre}{descripcion};dur={segundos * 1000:.1f}")
+    entradas.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entradas)
+
+
+def texto_metricas():
+    """Métricas de las etapas en el formato de texto de Prometheus (versión 0.0.4)."""
+    with BLOQUEO_METRICAS:
+        metricas = {
+            nombre: {**metrica, 'buckets': list(metrica['buckets']), 'volumenes': dict(metrica['volumenes'])}
+            for nombre, metrica in METRICAS_ETAPAS.items()
+        }
+    lineas = [
+        "# HELP analisis_etapa_segundos Duración de cada etapa del procesamiento.",
+        "# TYPE analisis_etapa_segundos histogram",
+    ]
+    for nombre, metrica in metricas.items():
+        acumulado = 0
+        for limite, conteo in zip(BUCKETS_DURACION, metrica['buckets']):
+            acumulado += conteo
+            lineas.append(f'analisis_etapa_segundos_bucket{{etapa="{nombre}",le="{limite:g}"}} {acumulado}')
+        lineas.append(f'analisis_etapa_segundos_bucket{{etapa="{nombre}",le="+Inf"}} {metrica["conteo"]}')
+        lineas.append(f'analisis_etapa_segundos_sum{{etapa="{nombre}"}} {metrica["suma"]:.6f}')
+        lineas.append(f'analisis_etapa_segundos_count{{etapa="{nombre}"}} {metrica["conteo"]}')
+    for volumen in VOLUMENES_ETAPA:
+        lineas.append(f"# HELP analisis_etapa_{volumen}_total Volumen procesado por cada etapa ({volumen}).")
+        lineas.append(f"# TYPE analisis_etapa_{volumen}_total counter")
+        for nombre, metrica in metricas.items():
+            if metrica['volumenes'][volumen]:
+                lineas.append(f'analisis_etapa_{volumen}_total{{etapa="{nombre}"}} {metrica["volumenes"][volumen]}')
+    return "\n".join(lineas) + "\n"
+
+# Procesamiento de archivos en paralelo: procesos del pool y tiempo máximo por solicitud (segundos)
+MAX_PROCESOS_ARCHIVOS = int(os.environ.get("MAX_PROCESOS_ARCHIVOS", os.cpu_count() or 1))
+TIEMPO_LIMITE_ARCHIVOS = float(os.environ.get("TIEMPO_LIMITE_ARCHIVOS", 300))
+# Generación de Excel fuera del event loop: generaciones simultáneas, solicitudes en espera
+# y segundos sugeridos en Retry-After cuando no hay cupo
+MAX_GENERACIONES_EXCEL = int(os.environ.get("MAX_GENERACIONES_EXCEL", 2))
+MAX_COLA_EXCEL = int(os.environ.get("MAX_COLA_EXCEL", 4))
+REINTENTAR_EXCEL_SEGUNDOS = int(os.environ.get("REINTENTAR_EXCEL_SEGUNDOS", 30))
+# Trabajos asíncronos (/jobs): carpeta de resultados y segundos que se conservan una vez terminados
+DIRECTORIO_TRABAJOS = os.environ.get("DIRECTORIO_TRABAJOS", os.path.join(tempfile.gettempdir(), "analisis_trabajos"))
+TTL_TRABAJOS_SEGUNDOS = float(os.environ.get("TTL_TRABAJOS_SEGUNDOS", 3600))
+# Caché en disco de archivos ya procesados: carpeta y tamaño máximo en MB (0 la desactiva)
+DIRECTORIO_CACHE_ARCHIVOS = os.environ.get("DIRECTORIO_CACHE_ARCHIVOS", os.path.join(tempfile.gettempdir(), "analisis_cache"))
+MAX_CACHE_ARCHIVOS_MB = float(os.environ.get("MAX_CACHE_ARCHIVOS_MB", 512))
+# Caché en memoria de la mano de obra por huella de nodo: huellas distintas que se conservan (0 la desactiva)
+MAX_CACHE_MANO_OBRA = int(os.environ.get("MAX_CACHE_MANO_OBRA", 4096))
+# Archivos subidos: se copian por bloques a esta carpeta y se rechazan con 413 los que superan
+# el tamaño máximo por archivo o por solicitud (MB)
+DIRECTORIO_SUBIDAS = os.environ.get("DIRECTORIO_SUBIDAS", os.path.join(tempfile.gettempdir(), "analisis_subidas"))
+MAX_TAMANO_ARCHIVO_MB = float(os.environ.get("MAX_TAMANO_ARCHIVO_MB", 100))
+MAX_TAMANO_SOLICITUD_MB = float(os.environ.get("MAX_TAMANO_SOLICITUD_MB", 300))
+# Presupuesto de memoria por solicitud (MB), estimado antes de procesar a partir del tamaño
+# descomprimido de los archivos, y límite de memoria de cada proceso del pool (MB, 0 sin límite)
+MAX_MEMORIA_SOLICITUD_MB = float(os.environ.get("MAX_MEMORIA_SOLICITUD_MB", 2048))
+MAX_MEMORIA_PROCESO_MB = float(os.environ.get("MAX_MEMORIA_PROCESO_MB", MAX_MEMORIA_SOLICITUD_MB))
+# Lector de los xlsx subidos: calamine (requiere python-calamine), openpyxl_stream u openpyxl.
+# Si el preferido no está instalado se usa el siguiente disponible
+LECTOR_EXCEL = os.environ.get("LECTOR_EXCEL", "calamine")
+# Cambiar cuando cambie el resultado de procesar_archivo_* para invalidar la caché existente
+VERSION_PROCESADOR_ARCHIVOS = "7"
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,7 +199,372 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
+
+# ======== MODELO DE DATOS DE LAS OT ========
+# Los contenedores se crean con funciones del módulo (no lambdas) para que los datos se puedan
+# serializar con pickle: así viajan entre procesos del pool y se guardan en la caché de archivos.
+
+def conteos():
+    return defaultdict(int)
+
+
+def conjuntos():
+    return defaultdict(set)
+
+
+class ClaveMaterial(namedtuple('ClaveMaterial', ['tipo', 'nombre', 'detalle'])):
+    """
+    Clave de un material ya separada en sus partes.
+
+    `tipo` es MATERIAL, MATERIAL_RETIRADO o POSTE; `detalle` solo lo usan los postes
+    (la altura, p. ej. POSTE / CONCRETO / 12M). `str(clave)` devuelve el texto
+    'TIPO|NOMBRE[|DETALLE]' con el que se identificaba antes el material.
+    """
+    __slots__ = ()
+
+    @property
+    def etiqueta(self):
+        """Nombre del material tal como se muestra en el reporte (con el detalle, si lo hay)."""
+        return f"{self.nombre}|{self.detalle}" if self.detalle else self.nombre
+
+    def __str__(self):
+        return f"{self.tipo}|{self.etiqueta}"
+
+    def __reduce__(self):
+        # Al deserializar (pool de procesos, caché) se vuelve a internar la clave
+        return clave_material, tuple(self)
+
+
+# Materiales distintos cuya ClaveMaterial se conserva internada (LRU): el servidor y los procesos
+# del pool viven mucho y no deben guardar para siempre cada material de cada archivo subido
+MAX_CLAVES_MATERIAL = int(os.environ.get("MAX_CLAVES_MATERIAL", 16384))
+
+
+@lru_cache(maxsize=MAX_CLAVES_MATERIAL)
+def internar_clave_material(tipo, nombre, detalle):
+    return ClaveMaterial(sys.intern(tipo), sys.intern(nombre), sys.intern(detalle))
+
+
+def clave_material(tipo, nombre, detalle=''):
+    """
+    Devuelve la ClaveMaterial internada: una sola instancia (y un solo texto) por material
+    mientras siga en la caché; una clave descartada se compara igual que la nueva.
+    """
+    return internar_clave_material(tipo, nombre, detalle)
+
+
+def arreglo_claves(claves):
+    """Arreglo 1-D de ClaveMaterial (np.array separaría cada tupla en columnas)."""
+    arreglo = np.empty(len(claves), dtype=object)
+    for posicion, clave in enumerate(claves):
+        arreglo[posicion] = clave
+    return arreglo
+
+
+class Nodo:
+    """
+    Datos informados para un nodo de la OT; None indica que ningún archivo lo informó.
+
+    `fecha_sync` es un pd.Timestamp (pd.NaT si la fecha del archivo no se pudo leer); el texto
+    que se muestra en el reporte sale de formatear_fecha_sync.
+    """
+    __slots__ = ('fecha_sync', 'tipo_suelo', 'tipo_instalacion', 'pintado')
+
+    def __init__(self):
+        self.fecha_sync = None
+        self.tipo_suelo = None
+        self.tipo_instalacion = None
+        self.pintado = None
+
+
+class OrdenTrabajo:
+    """
+    Materiales, códigos y nodos de una OT.
+
+    `nodos` es nodo -> Nodo en el orden en que aparecieron los nodos en los archivos. Los
+    materiales se guardan como ClaveMaterial -> {nodo: cantidad}, los aspectos como
+    ClaveMaterial -> {nodo: set(textos)} y los códigos N1/N2 como clave -> {nodo: set(códigos)}.
+    """
+    __slots__ = (
+        'nodos', 'codigos_n1', 'codigos_n2', 'materiales', 'materiales_retirados',
+        'aspectos_materiales', 'aspectos_retirados', 'orden_nodos',
+    )
+
+    def __init__(self):
+        self.nodos = {}
+        # Órdenes de los nodos por fecha ya calculados (ver nodos_por_fecha)
+        self.orden_nodos = {}
+        self.codigos_n1 = defaultdict(conjuntos)
+        self.codigos_n2 = defaultdict(conjuntos)
+        self.materiales = defaultdict(conteos)
+        self.materiales_retirados = defaultdict(conteos)
+        self.aspectos_materiales = defaultdict(conjuntos)
+        self.aspectos_retirados = defaultdict(conjuntos)
+
+    def nodo(self, nodo):
+        """Datos del nodo, registrándolo en la OT si todavía no existe."""
+        datos = self.nodos.get(nodo)
+        if datos is None:
+            datos = self.nodos[nodo] = Nodo()
+            self.orden_nodos.clear()
+        return datos
+
+    def agregar_nodos(self, nodos):
+        for nodo in nodos:
+            if nodo not in self.nodos:
+                self.nodos[nodo] = Nodo()
+                self.orden_nodos.clear()
+
+    def dato_nodo(self, nodo, campo, defecto=None):
+        """Valor de `campo` para el nodo, o `defecto` si no fue informado."""
+        datos = self.nodos.get(nodo)
+        valor = None if datos is None else getattr(datos, campo)
+        return defecto if valor is None else valor
+
+    def datos_por_nodo(self, campo):
+        """Diccionario nodo -> valor con los nodos que tienen `campo` informado."""
+        return {
+            nodo: getattr(datos, campo) for nodo, datos in self.nodos.items()
+            if getattr(datos, campo) is not None
+        }
+
+    def registrar_datos_nodo(self, campo, pares):
+        """Asigna `campo` a cada (nodo, valor); si un nodo se repite, prevalece el último valor."""
+        for nodo, valor in pares:
+            setattr(self.nodo(nodo), campo, valor)
+        if campo == 'fecha_sync':
+            self.orden_nodos.clear()
+
+    def nodos_por_fecha(self, incluir_sin_fecha):
+        """
+        Nodos ordenados por fecha de sincronización; el orden se calcula una vez por OT.
+
+        Con `incluir_sin_fecha` los nodos sin fecha informada van con fecha 01/01/1900; si no, se
+        omiten. Las fechas ilegibles (NaT) no son menores ni mayores que ninguna otra, igual que
+        al comparar con pandas, así que se quedan junto a los nodos entre los que aparecieron.
+        """
+        orden = self.orden_nodos.get(incluir_sin_fecha)
+        if orden is None:
+            if incluir_sin_fecha:
+                fechas = [
+                    (nodo, FECHA_SYNC_AUSENTE if datos.fecha_sync is None else datos.fecha_sync)
+                    for nodo, datos in self.nodos.items()
+                ]
+            else:
+                fechas = [(nodo, datos.fecha_sync) for nodo, datos in self.nodos.items() if datos.fecha_sync is not None]
+            fechas.sort(key=lambda nodo_fecha: nodo_fecha[1])
+            orden = self.orden_nodos[incluir_sin_fecha] = [nodo for nodo, _ in fechas]
+        return orden
+
+    def columnas_nodos(self):
+        """
+        Índice nodo -> columna (base 0) del nodo en la hoja de la OT, en el orden de
+        nodos_por_fecha(incluir_sin_fecha=True); se calcula una vez por OT, con el orden.
+
+        Reemplaza las búsquedas en la lista ordenada: pertenencia y posición en O(1).
+        """
+        columnas = self.orden_nodos.get('columnas')
+        if columnas is None:
+            columnas = self.orden_nodos['columnas'] = {
+                nodo: PRIMERA_COLUMNA_NODO + posicion
+                for posicion, nodo in enumerate(self.nodos_por_fecha(incluir_sin_fecha=True))
+            }
+        return columnas
+
+
+# Fecha con la que se ordenan los nodos sin fecha de sincronización
+FECHA_SYNC_AUSENTE = pd.Timestamp(1900, 1, 1)
+# Columnas fijas de las hojas de OT (OT, Unidad, Cantidad Total, Fecha) antes del primer nodo
+PRIMERA_COLUMNA_NODO = 4
+
+
+def formatear_fecha_sync(fecha):
+    """Texto '%d/%m/%Y %H:%M:%S' de la fecha de sincronización ("Sin fecha" si no hay)."""
+    if fecha is None or pd.isna(fecha):
+        return "Sin fecha"
+    return f"{fecha.day:02d}/{fecha.month:02d}/{fecha.year:04d} {fecha.hour:02d}:{fecha.minute:02d}:{fecha.second:02d}"
+
+
+class MaterialesBarrio:
+    """Materiales instalados y retirados de un barrio: ClaveMaterial -> {ot: cantidad}."""
+    __slots__ = ('materiales_instalados', 'materiales_retirados')
+
+    def __init__(self):
+        self.materiales_instalados = defaultdict(conteos)
+        self.materiales_retirados = defaultdict(conteos)
+
+
+def ordenes_trabajo():
+    """Diccionario OT -> OrdenTrabajo que crea la OT al primer acceso."""
+    return defaultdict(OrdenTrabajo)
+
+
+def materiales_por_barrio():
+    """Diccionario barrio -> MaterialesBarrio que crea el barrio al primer acceso."""
+    return defaultdict(MaterialesBarrio)
+
+
+# ======== FORMATO LARGO DE LOS RESULTADOS ========
+# Cada archivo se devuelve del pool (y se guarda en la caché) como tablas largas, una fila
+# por valor; las de todos los archivos de una subida se combinan de una sola vez con
+# materializar_tablas en lugar de fusionar OT por OT y nodo por nodo.
+CAMPOS_CANTIDADES = ('materiales', 'materiales_retirados')
+CAMPOS_CONJUNTOS = ('codigos_n1', 'codigos_n2', 'aspectos_materiales', 'aspectos_retirados')
+COLUMNAS_TABLAS = {
+    'nodos': {'ot': np.intp, 'nodo': object},
+    'datos_nodo': {'ot': np.intp, 'nodo': object, 'campo': np.intp, 'valor': object},
+    'cantidades': {'ot': np.intp, 'campo': np.intp, 'clave': object, 'nodo': object, 'cantidad': float, 'entera': bool},
+    'conjuntos': {'ot': np.intp, 'campo': np.intp, 'clave': object, 'nodo': object, 'valor': object},
+    'por_barrio': {'barrio': np.intp, 'campo': np.intp, 'clave': object, 'ot': np.intp, 'cantidad': float, 'entera': bool},
+}
+
+
+def tabla_larga(nombre, filas):
+    """DataFrame de la tabla `nombre` a partir de sus filas (tuplas en el orden de COLUMNAS_TABLAS)."""
+    columnas = COLUMNAS_TABLAS[nombre]
+    valores = list(zip(*filas)) if filas else [()] * len(columnas)
+    return pd.DataFrame({
+        # Las columnas de objetos se arman elemento a elemento para no desarmar las ClaveMaterial
+        columna: arreglo_claves(valores_columna) if tipo is object else np.asarray(valores_columna, dtype=tipo)
+        for (columna, tipo), valores_columna in zip(columnas.items(), valores)
+    })
+
+
+def es_entera(cantidad):
+    """Indica si la cantidad es entera (int de Python o de numpy)."""
+    return isinstance(cantidad, (int, np.integer))
+
+
+def tablas_resultado(datos, datos_por_barrio):
+    """
+    Pasa el resultado de un archivo (OrdenTrabajo y MaterialesBarrio) a tablas largas.
+
+    Las OT y los barrios se guardan como códigos sobre las listas 'ots' y 'barrios'; las
+    primeras 'n_ordenes' OT son las del archivo y el resto solo aparecen en los barrios.
+    Las filas siguen el orden de inserción de los diccionarios de origen.
+
+    Returns:
+        dict: listas 'ots' y 'barrios', 'n_ordenes' y un DataFrame por tabla de COLUMNAS_TABLAS
+    """
+    ots = list(datos)
+    indice_ots = {ot: codigo for codigo, ot in enumerate(ots)}
+    filas = defaultdict(list)
+    for codigo, orden in enumerate(datos.values()):
+        for nodo, datos_nodo in orden.nodos.items():
+            filas['nodos'].append((codigo, nodo))
+            for campo, atributo in enumerate(Nodo.__slots__):
+                valor = getattr(datos_nodo, atributo)
+                if valor is not None:
+                    filas['datos_nodo'].append((codigo, nodo, campo, valor))
+        for campo, atributo in enumerate(CAMPOS_CANTIDADES):
+            for clave, por_nodo in getattr(orden, atributo).items():
+                for nodo, cantidad in por_nodo.items():
+                    filas['cantidades'].append((codigo, campo, clave, nodo, cantidad, es_entera(cantidad)))
+        for campo, atributo in enumerate(CAMPOS_CONJUNTOS):
+            for clave, por_nodo in getattr(orden, atributo).items():
+                for nodo, valores in por_nodo.items():
+                    filas['conjuntos'].extend((codigo, campo, clave, nodo, valor) for valor in valores)
+
+    barrios = list(datos_por_barrio)
+    for codigo, materiales in enumerate(datos_por_barrio.values()):
+        for campo, atributo in enumerate(MaterialesBarrio.__slots__):
+            for clave, por_ot in getattr(materiales, atributo).items():
+                for ot, cantidad in por_ot.items():
+                    if ot not in indice_ots:
+                        indice_ots[ot] = len(ots)
+                        ots.append(ot)
+                    filas['por_barrio'].append((codigo, campo, clave, indice_ots[ot], cantidad, es_entera(cantidad)))
+
+    tablas = {nombre: tabla_larga(nombre, filas[nombre]) for nombre in COLUMNAS_TABLAS}
+    tablas.update(ots=ots, n_ordenes=len(datos), barrios=barrios)
+    return tablas
+
+
+def sumar_tabla(tabla, *columnas):
+    """
+    Suma la columna 'cantidad' por combinación de `columnas`, en orden de primera aparición.
+
+    Igual que sumar_por_grupo, pero el total es `int` solo si todas las cantidades del
+    grupo lo eran (como al sumar con `+=` cantidades de archivos distintos).
+    """
+    grupo = codigos_de_grupo(*(tabla[columna].to_numpy() for columna in columnas))
+    primeras = primeras_apariciones(grupo)
+    totales = np.bincount(grupo, weights=tabla['cantidad'].to_numpy()).tolist()
+    no_enteras = np.bincount(grupo, weights=~tabla['entera'].to_numpy()).tolist()
+    return primeras, [int(t) if not f else t for t, f in zip(totales, no_enteras)]
+
+
+def materializar_tablas(partes):
+    """
+    Combina las tablas largas de varios archivos y arma las OT y los barrios una sola vez.
+
+    Las tablas se concatenan en el orden de subida y se agrupan en orden de primera
+    aparición, así que OT, nodos y claves quedan en el mismo orden que al combinar
+    archivo por archivo; en los datos de nodo prevalece el último archivo que los informa.
+
+    Returns:
+        tuple: (datos, datos_por_barrio) de ordenes_trabajo y materiales_por_barrio
+    """
+    datos = ordenes_trabajo()
+    datos_por_barrio = materiales_por_barrio()
+    indice_ots, indice_barrios = {}, {}
+    tablas = defaultdict(list)
+    for parte in partes:
+        mapa_ots = np.array([indice_ots.setdefault(ot, len(indice_ots)) for ot in parte['ots']], dtype=np.intp)
+        mapa_barrios = np.array([indice_barrios.setdefault(b, len(indice_barrios)) for b in parte['barrios']], dtype=np.intp)
+        # Crear las OT y los barrios en el orden en que aparecen en los archivos
+        for ot in parte['ots'][:parte['n_ordenes']]:
+            datos[ot]
+        for barrio in parte['barrios']:
+            datos_por_barrio[barrio]
+        for nombre in COLUMNAS_TABLAS:
+            tabla = parte[nombre]
+            if not len(tabla):
+                continue
+            codigos = {'ot': mapa_ots[tabla['ot'].to_numpy()]}
+            if nombre == 'por_barrio':
+                codigos['barrio'] = mapa_barrios[tabla['barrio'].to_numpy()]
+            tablas[nombre].append(tabla.assign(**codigos))
+    ots, barrios = list(indice_ots), list(indice_barrios)
+    tablas = {nombre: pd.concat(lista, ignore_index=True) for nombre, lista in tablas.items()}
+
+    if 'nodos' in tablas:
+        nodos = tablas['nodos']
+        primeras = primeras_apariciones(codigos_de_grupo(nodos['ot'].to_numpy(), nodos['nodo'].to_numpy()))
+        for ot, nodo in zip(nodos['ot'].to_numpy()[primeras].tolist(), nodos['nodo'].to_numpy()[primeras].tolist()):
+            datos[ots[ot]].nodos[nodo] = Nodo()
+
+    if 'datos_nodo' in tablas:
+        ultimos = tablas['datos_nodo'].drop_duplicates(['ot', 'nodo', 'campo'], keep='last')
+        for ot, nodo, campo, valor in ultimos.itertuples(index=False, name=None):
+            setattr(datos[ots[ot]].nodos[nodo], Nodo.__slots__[campo], valor)
+
+    if 'cantidades' in tablas:
+        cantidades = tablas['cantidades']
+        primeras, totales = sumar_tabla(cantidades, 'ot', 'campo', 'clave', 'nodo')
+        for ot, campo, clave, nodo, total in zip(*(cantidades[columna].to_numpy()[primeras].tolist()
+                                                   for columna in ('ot', 'campo', 'clave', 'nodo')), totales):
+            getattr(datos[ots[ot]], CAMPOS_CANTIDADES[campo])[clave][nodo] = total
+
+    if 'conjuntos' in tablas:
+        conjuntos_largos = tablas['conjuntos']
+        primeras = primeras_apariciones(codigos_de_grupo(
+            *(conjuntos_largos[columna].to_numpy() for columna in ('ot', 'campo', 'clave', 'nodo', 'valor'))
+        ))
+        for ot, campo, clave, nodo, valor in conjuntos_largos.iloc[primeras].itertuples(index=False, name=None):
+            getattr(datos[ots[ot]], CAMPOS_CONJUNTOS[campo])[clave][nodo].add(valor)
+
+    if 'por_barrio' in tablas:
+        por_barrio = tablas['por_barrio']
+        primeras, totales = sumar_tabla(por_barrio, 'barrio', 'campo', 'clave', 'ot')
+        for barrio, campo, clave, ot, total in zip(*(por_barrio[columna].to_numpy()[primeras].tolist()
+                                                     for columna in ('barrio', 'campo', 'clave', 'ot')), totales):
+            getattr(datos_por_barrio[barrios[barrio]], MaterialesBarrio.__slots__[campo])[clave][ots[ot]] = total
+
+    return datos, datos_por_barrio
+
+
+def generate_resumen_tecnicos(libro, datos_combinados, df_originales):
 
     instalados_por_tecnico = {}
     retirados_por_tecnico = {}
@@ -83,7 +628,7 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
     # Ahora procesar datos combinados
     for ot, info in datos_combinados.items():
         # Proceso para códigos N1
-        for key, nodos_data in info.get('codigos_n1', {}).items():
+        for key, nodos_data in info.codigos_n1.items():
             nombre = f"LUMINARIA {key}"
             
             for nodo, codigos in nodos_data.items():
@@ -106,7 +651,7 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
                 luminarias_por_tecnico[tecnico][nombre]['ots'][ot] += codigos_count
         
         # Proceso para códigos N2
-        for key, nodos_data in info.get('codigos_n2', {}).items():
+        for key, nodos_data in info.codigos_n2.items():
             nombre = f"LUMINARIA {key}"
             
             for nodo, codigos in nodos_data.items():
@@ -129,8 +674,8 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
                 luminarias_por_tecnico[tecnico][nombre]['ots'][ot] += codigos_count
             
         # Procesar materiales instalados
-        for mat_key, nodo_quantities in info['materiales'].items():
-            _, nombre = mat_key.split('|', 1)
+        for mat_key, nodo_quantities in info.materiales.items():
+            nombre = mat_key.etiqueta
             
             if nombre.strip().upper() == "NINGUNO":
                 continue
@@ -152,8 +697,8 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
                 instalados_por_tecnico[tecnico][nombre]['ots'][ot] += cantidad
         
         # Procesar materiales retirados
-        for mat_key, nodo_quantities in info.get('materiales_retirados', {}).items():
-            _, nombre = mat_key.split('|', 1)
+        for mat_key, nodo_quantities in info.materiales_retirados.items():
+            nombre = mat_key.etiqueta
             
             if nombre.strip().upper() == "NINGUNO":
                 continue
@@ -185,7 +730,7 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
     
     # Crear la hoja para el resumen de técnicos
     sheet_name = 'Resumen_tecnicos'
-    worksheet = writer.book.create_sheet(sheet_name)
+    worksheet = libro.create_sheet(sheet_name)
     
     # Configuración de estilos
     header_font = Font(bold=True)
@@ -200,23 +745,25 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
     if not (luminarias_por_tecnico or instalados_por_tecnico or retirados_por_tecnico):
         return
     
+    # En modo write-only los anchos y la congelación de paneles van antes de la primera fila
+    for idx, col in enumerate(columns, 1):
+        col_width = max(len(str(col)), 15) + 2
+        # Para la primera columna, usar un ancho mayor
+        if idx == 1:
+            col_width = 40
+        worksheet.column_dimensions[get_column_letter(idx)].width = col_width
+    worksheet.freeze_panes = 'D2'
+    
     # Escribir encabezados de columnas
-    for col, header in enumerate(columns, 1):
-        cell = worksheet.cell(row=1, column=col, value=header)
-        cell.font = header_font
+    worksheet.append([celda_excel(worksheet, header, font=header_font) for header in columns])
     
     current_row = 2
     
     # Función para escribir una sección
     def write_section(title, data_by_tecnico, row):
-        # Encabezado de sección
-        cell = worksheet.cell(row=row, column=1, value=title)
-        cell.font = section_font
-        cell.fill = section_fill
-        cell.alignment = center_alignment
-        
-        # Combinar celdas para el encabezado
-        worksheet.merge_cells(start_row=row, start_column=1, end_row=row, end_column=len(columns))
+        # Encabezado de sección, combinado a lo ancho de la tabla
+        worksheet.append([celda_excel(worksheet, title, font=section_font, fill=section_fill, alignment=center_alignment)])
+        worksheet.merged_cells.add(f"A{row}:{get_column_letter(len(columns))}{row}")
         
         row += 1
         
@@ -228,20 +775,18 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
         
         # Escribir datos por material
         for material in sorted(all_materials):
-            worksheet.cell(row=row, column=1, value=material)
-            worksheet.cell(row=row, column=2, value='UND')
-            
             # Calcular el total sumando de todos los técnicos
             total = sum(
                 data_by_tecnico.get(tecnico, {}).get(material, {}).get('total', 0)
                 for tecnico in tecnicos_ordenados
             )
-            worksheet.cell(row=row, column=3, value=total)
             
             # Cantidades por técnico
-            for i, tecnico in enumerate(tecnicos_ordenados, 4):
-                cantidad = data_by_tecnico.get(tecnico, {}).get(material, {}).get('total', 0)
-                worksheet.cell(row=row, column=i, value=cantidad)
+            cantidades = [
+                data_by_tecnico.get(tecnico, {}).get(material, {}).get('total', 0)
+                for tecnico in tecnicos_ordenados
+            ]
+            worksheet.append([material, 'UND', total] + cantidades)
             
             row += 1
             
@@ -250,28 +795,30 @@ def generate_resumen_tecnicos(writer, datos_combinados, df_originales):
     # Escribir sección de luminarias
     if luminarias_por_tecnico:
         current_row = write_section("LUMINARIAS INSTALADAS", luminarias_por_tecnico, current_row)
-        current_row += 1  # Espacio entre secciones
+        worksheet.append([])  # Espacio entre secciones
+        current_row += 1
     
     # Escribir sección de materiales instalados
     if instalados_por_tecnico:
         current_row = write_section("MATERIALES INSTALADOS", instalados_por_tecnico, current_row)
-        current_row += 1  # Espacio entre secciones
+        worksheet.append([])  # Espacio entre secciones
+        current_row += 1
     
     # Escribir sección de materiales retirados
     if retirados_por_tecnico:
         current_row = write_section("MATERIALES RETIRADOS", retirados_por_tecnico, current_row)
-    
-    # Ajustar anchos de columna
-    for idx, col in enumerate(columns, 1):
-        col_width = max(len(str(col)), 15) + 2
-        # Para la primera columna, usar un ancho mayor
-        if idx == 1:
-            col_width = 40
-        worksheet.column_dimensions[get_column_letter(idx)].width = col_width
-    
-    # Configurar congelación de paneles
-    worksheet.freeze_panes = 'D2'
 
+# ======== NORMALIZADORES ========
+# Funciones puras sobre textos que se repiten muchísimo (unos cientos de barrios distintos en
+# miles de filas): cada una tiene una caché LRU acotada y los parsers las aplican una vez por
+# valor distinto de la columna.
+MAX_CACHE_NORMALIZADORES = int(os.environ.get("MAX_CACHE_NORMALIZADORES", 4096))
+
+UNIDADES_CANTIDAD = {"UND", "UN", "ML", "M", "KG", "MT", "MTS"}
+PATRON_NUMERO = re.compile(r'\d+(?:\.\d+)?')
+
+
+@lru_cache(maxsize=MAX_CACHE_NORMALIZADORES)
 def extraer_cantidad(texto):
     """
     Extrae la cantidad numérica de un texto.
@@ -290,78 +837,482 @@ def extraer_cantidad(texto):
     try:
         # Caso 1: Formato 'Descripción (cantidad)'
         if '(' in texto and ')' in texto:
-            cantidad_str = texto.split('(')[-1].rstrip(')')
-            return float(cantidad_str)
-        
+            return float(texto.split('(')[-1].rstrip(')'))
+
         # Caso 2: Buscar patrón de número seguido de UND
         palabras = texto.split()
-        for i, palabra in enumerate(palabras):
-            if palabra.upper() in ["UND", "UN", "ML", "M", "KG", "MT", "MTS"]:
-                if i > 0 and palabras[i-1].replace(',', '.').replace('-', '').isdigit():
-                    return float(palabras[i-1].replace(',', '.'))
-                elif i > 0:
-                    try:
-                        return float(palabras[i-1].replace(',', '.'))
-                    except ValueError:
-                        pass
-        
+        for i in range(1, len(palabras)):
+            if palabras[i].upper() in UNIDADES_CANTIDAD:
+                anterior = palabras[i - 1].replace(',', '.')
+                if anterior.replace('-', '').isdigit():
+                    return float(anterior)
+                try:
+                    return float(anterior)
+                except ValueError:
+                    pass
+
         # Caso 3: Intentar encontrar cualquier número en el texto
-        import re
-        numeros = re.findall(r'\d+(?:\.\d+)?', texto.replace(',', '.'))
-        if numeros:
-            return float(numeros[0])
-            
-        return 0
+        numero = PATRON_NUMERO.search(texto.replace(',', '.'))
+        return float(numero.group()) if numero else 0
     except ValueError:
         return 0  # En caso de error, devolver 0
 
+
+# Barrios vacíos, en cero o con una fecha (celdas mal diligenciadas) se agrupan como 'Sin barrio'
+BARRIOS_VACIOS = {'', '0', '0.0', 'nan', 'none', 'nat'}
+PATRON_FECHA_BARRIO = re.compile(
+    r'^(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}[/.-]\d{1,2}[/.-]\d{1,2})([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?$'
+)
+
+
 def normalizar_barrio(barrio):
-    barrio_str = str(barrio).strip()
-    try:
-        pd.to_datetime(barrio_str, dayfirts=True)
-        return 'Sin barrio'
-    except Exception:
-        pass
-    if barrio_str in ['0', '0.0']:
+    return normalizar_texto_barrio(str(barrio).strip())
+
+
+@lru_cache(maxsize=MAX_CACHE_NORMALIZADORES)
+def normalizar_texto_barrio(barrio_str):
+    if barrio_str.lower() in BARRIOS_VACIOS or PATRON_FECHA_BARRIO.match(barrio_str):
         return 'Sin barrio'
     return barrio_str.title().strip()
-           
+
+
+# Cachés LRU cuyas estadísticas publica /cache/normalizadores
+CACHES_NORMALIZADORES = {
+    'extraer_cantidad': extraer_cantidad,
+    'normalizar_barrio': normalizar_texto_barrio,
+    'clave_material': internar_clave_material,
+}
+
+
+def uso_normalizadores():
+    """Aciertos y fallos acumulados por cada caché de CACHES_NORMALIZADORES en este proceso."""
+    return {nombre: funcion.cache_info()[:2] for nombre, funcion in CACHES_NORMALIZADORES.items()}
+
+
+# ======== LECTURA DE LIBROS EXCEL, CSV Y PARQUET ========
+# Los parsers leen los archivos a través de un lector con la misma interfaz para todos los
+# formatos y motores: `hojas`, `encabezado(hoja)` y `leer(hoja, posiciones=None)`. Los
+# lectores reciben el `origen` del archivo: su ruta en disco o un archivo binario con seek.
+
+def rebobinar(origen):
+    """Devuelve el origen listo para leerlo desde el principio."""
+    if not isinstance(origen, str):
+        origen.seek(0)
+    return origen
+
+
+def primeros_bytes(origen, cantidad):
+    """Primeros `cantidad` bytes del archivo, sin mover la posición de lectura."""
+    if isinstance(origen, str):
+        with open(origen, 'rb') as f:
+            return f.read(cantidad)
+    datos = rebobinar(origen).read(cantidad)
+    origen.seek(0)
+    return datos
+
+
+class LectorPandas:
+    """Lector sobre pd.ExcelFile con el motor indicado (openpyxl o calamine)."""
+
+    def __init__(self, origen, motor):
+        self.xls = pd.ExcelFile(rebobinar(origen), engine=motor)
+        self.hojas = self.xls.sheet_names
+
+    def encabezado(self, hoja):
+        """Nombres de columna de la hoja, leyendo solo la fila de encabezados."""
+        return list(self.xls.parse(hoja, nrows=0).columns)
+
+    def leer(self, hoja, posiciones=None):
+        """DataFrame de la hoja; `posiciones` limita las columnas cargadas."""
+        return self.xls.parse(hoja, usecols=posiciones)
+
+
+class LectorOpenpyxlStream:
+    """
+    Lector que recorre las hojas en modo read-only pidiendo a openpyxl solo los valores.
+
+    No crea un objeto celda por valor (como hace el motor openpyxl de pandas) y descarta
+    las columnas no pedidas fila a fila; los valores se convierten igual que en pandas y
+    el DataFrame se arma con el mismo TextParser, así que el resultado es el mismo.
+    """
+
+    def __init__(self, origen):
+        self.libro = load_workbook(rebobinar(origen), read_only=True, data_only=True, keep_links=False)
+        self.hojas = self.libro.sheetnames
+
+    def filas(self, hoja):
+        hoja = self.libro[hoja]
+        hoja.reset_dimensions()
+        return hoja.iter_rows(values_only=True)
+
+    def encabezado(self, hoja):
+        """Nombres de columna de la hoja, leyendo solo la fila de encabezados."""
+        fila = next(self.filas(hoja), ())
+        datos = recortar_filas([valores_celdas(fila)])
+        if not datos:
+            return []
+        return list(TextParser(datos, header=0, skip_blank_lines=False).read().columns)
+
+    def leer(self, hoja, posiciones=None):
+        """DataFrame de la hoja; `posiciones` limita las columnas cargadas."""
+        datos = []
+        ultima_con_datos = -1
+        for numero, fila in enumerate(self.filas(hoja)):
+            if any(valor is not None and valor != "" for valor in fila):
+                ultima_con_datos = numero
+            if posiciones is not None:
+                fila = [fila[i] if i < len(fila) else None for i in posiciones]
+            datos.append(valores_celdas(fila))
+        datos = datos[:ultima_con_datos + 1]
+        if posiciones is None:
+            datos = recortar_filas(datos)
+        if not datos:
+            return pd.DataFrame()
+        try:
+            return TextParser(datos, header=0, skip_blank_lines=False).read()
+        except EmptyDataError:
+            return pd.DataFrame()
+
+
+def valores_celdas(fila):
+    """Convierte los valores de openpyxl como el lector de pandas ('' para vacías, NaN para errores)."""
+    return [
+        "" if valor is None
+        else (int(valor) if valor.is_integer() else valor) if type(valor) is float
+        else np.nan if type(valor) is str and valor in ERROR_CODES
+        else valor
+        for valor in fila
+    ]
+
+
+def recortar_filas(datos):
+    """Quita las celdas vacías del final de cada fila y completa todas al ancho de la más larga."""
+    for fila in datos:
+        while fila and fila[-1] == "":
+            fila.pop()
+    ancho = max((len(fila) for fila in datos), default=0)
+    if not ancho:
+        return []
+    return [fila + [""] * (ancho - len(fila)) for fila in datos]
+
+
+LECTORES_EXCEL = {
+    'calamine': lambda origen: LectorPandas(origen, 'calamine'),
+    'openpyxl_stream': LectorOpenpyxlStream,
+    'openpyxl': lambda origen: LectorPandas(origen, 'openpyxl'),
+}
+# Módulo del que depende cada lector opcional
+DEPENDENCIAS_LECTORES_EXCEL = {'calamine': 'python_calamine'}
+
+
+def lector_excel_activo():
+    """Nombre del lector a usar: LECTOR_EXCEL si está disponible, si no el siguiente de LECTORES_EXCEL."""
+    nombres = list(LECTORES_EXCEL)
+    if LECTOR_EXCEL in LECTORES_EXCEL:
+        nombres = nombres[nombres.index(LECTOR_EXCEL):]
+    else:
+        logger.warning("Lector de Excel desconocido: %s", LECTOR_EXCEL)
+    for nombre in nombres:
+        modulo = DEPENDENCIAS_LECTORES_EXCEL.get(nombre)
+        if modulo is None or importlib.util.find_spec(modulo) is not None:
+            return nombre
+    return 'openpyxl'
+
+
+# Columnas de texto de los formularios que en CSV se leen como str en lugar de inferir su
+# tipo (en los xlsx exportados son celdas de texto); el resto se infiere igual que en Excel
+COLUMNAS_TEXTO_CSV = {
+    "FechaSincronizacion", "3.Barrio", "4.Nombre del Técnico Instalador",
+    "1. Describa Aspectos que Considere se deben tener en cuenta.",
+    "4.Describa Aspectos que Considere se deben tener en cuenta.",
+    "2.Tipo de Suelo", "1.Tipo de suelo.", "2.Tipo de Instalacion", "3.Pintado de Nodo?",
+}
+PATRON_NOMBRE_MATERIAL = re.compile(r'^(\d+\.)?MATERIAL\b', re.IGNORECASE)
+
+
+def es_columna_texto_csv(col):
+    """Indica si la columna se lee como str al cargar un CSV."""
+    return col in COLUMNAS_TEXTO_CSV or bool(PATRON_NOMBRE_MATERIAL.match(str(col)))
+
+
+class LectorCSV:
+    """Lector de un CSV exportado de la plataforma; tiene una sola hoja con el nombre del archivo."""
+
+    def __init__(self, origen, nombre):
+        self.origen = origen
+        self.hojas = [os.path.splitext(os.path.basename(nombre))[0]]
+        primera_linea = primeros_bytes(origen, 65536).split(b"\n", 1)[0]
+        try:
+            primera_linea = primera_linea.decode("utf-8-sig")
+            self.encoding = "utf-8-sig"
+        except UnicodeDecodeError:
+            primera_linea = primera_linea.decode("latin-1")
+            self.encoding = "latin-1"
+        # Las exportaciones con configuración regional en español usan ';'
+        self.separador = max((",", ";", "\t"), key=primera_linea.count)
+
+    def leer_csv(self, **kwargs):
+        return pd.read_csv(rebobinar(self.origen), sep=self.separador, encoding=self.encoding, **kwargs)
+
+    def encabezado(self, hoja):
+        return list(self.leer_csv(nrows=0).columns)
+
+    def leer(self, hoja, posiciones=None):
+        encabezado = self.encabezado(hoja)
+        tipos = {
+            col: str for i, col in enumerate(encabezado)
+            if (posiciones is None or i in posiciones) and es_columna_texto_csv(col)
+        }
+        # low_memory=False infiere cada columna completa, como al leer un xlsx
+        return self.leer_csv(usecols=posiciones, dtype=tipos, low_memory=False)
+
+
+class LectorParquet:
+    """Lector de un Parquet exportado de la plataforma; tiene una sola hoja con el nombre del archivo."""
+
+    def __init__(self, origen, nombre):
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.origen = origen
+        # Desde disco el archivo se mapea en memoria y Arrow lee las columnas sin copiarlas
+        self.memory_map = isinstance(origen, str)
+        self.hojas = [os.path.splitext(os.path.basename(nombre))[0]]
+
+    def encabezado(self, hoja):
+        return list(self.pq.read_schema(rebobinar(self.origen), memory_map=self.memory_map).names)
+
+    def leer(self, hoja, posiciones=None):
+        columnas = None
+        if posiciones is not None:
+            encabezado = self.encabezado(hoja)
+            columnas = [encabezado[i] for i in posiciones]
+        tabla = self.pq.read_table(rebobinar(self.origen), columns=columnas, memory_map=self.memory_map)
+        # self_destruct libera cada columna de Arrow a medida que pasa a pandas
+        df = tabla.to_pandas(self_destruct=True, split_blocks=True)
+        # Arrow devuelve None en los textos vacíos; en Excel llegan como NaN
+        for col in df.columns[df.dtypes == object]:
+            valores = df[col].to_numpy(dtype=object).copy()
+            valores[pd.isna(valores)] = np.nan
+            df[col] = valores
+        return df
+
+
+def formato_archivo(nombre, cabecera):
+    """xlsx, parquet o csv según los primeros bytes del archivo (y la extensión para CSV)."""
+    if cabecera[:4] == b"PK\x03\x04":
+        return 'xlsx'
+    if cabecera[:4] == b"PAR1":
+        return 'parquet'
+    if os.path.splitext(nombre or "")[1].lower() in ('.csv', '.txt'):
+        return 'csv'
+    raise ValueError(f"Formato de archivo no soportado: {nombre}")
+
+
+def abrir_libro(nombre, archivo):
+    """
+    Abre el archivo subido con el lector de su formato (los xlsx con el lector de Excel activo).
+
+    El contenido no se carga completo en memoria: los xlsx se leen desde el archivo abierto y
+    los Parquet y CSV en disco, desde su ruta (openpyxl rechaza rutas sin extensión de Excel).
+    """
+    ruta = getattr(archivo, 'name', None)
+    origen = ruta if isinstance(ruta, str) and os.path.isfile(ruta) else archivo
+    formato = formato_archivo(nombre, primeros_bytes(origen, 4))
+    if formato == 'parquet':
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ValueError(f"Leer {nombre} requiere pyarrow instalado")
+        return LectorParquet(origen, nombre)
+    if formato == 'csv':
+        return LectorCSV(origen, nombre)
+    return LECTORES_EXCEL[lector_excel_activo()](rebobinar(archivo))
+
+
+# Columnas que generate_resumen_tecnicos lee de los DataFrames originales
+COLUMNAS_RESUMEN_TECNICOS = {"2.Nro de O.T.", "2.Nro de Proyecto.", "1.NODO DEL POSTE.", "4.Nombre del Técnico Instalador"}
+
+
+def leer_hoja(libro, hoja, encabezado, seleccion):
+    """
+    Carga de la hoja solo las columnas de `seleccion` (índices en `encabezado`).
+
+    Las columnas conservan los nombres que tendrían al cargar la hoja completa (incluido el
+    sufijo '.1', '.2'... de los encabezados repetidos).
+    """
+    df = libro.leer(hoja, list(seleccion))
+    df.columns = [encabezado[i] for i in seleccion]
+    return df
+
+
+# ======== PLAN DE COLUMNAS POR ESQUEMA DE HOJA ========
+# Qué columnas cargar y cómo se agrupan (OT, nodo, códigos, pares material/cantidad, bloque de
+# retirados) depende solo de los encabezados de la hoja. El plan se calcula una vez por tupla de
+# encabezados y queda en memoria del proceso: las hojas exportadas del mismo formulario lo reutilizan
+# entre archivos y solicitudes.
+MAX_PLANES_HOJA = 64
+
+COLUMNAS_REQUERIDAS_MANTENIMIENTO = {"6.Nro.Orden Energis", "5.Nodo"}
+PATRON_MATERIAL_MANTENIMIENTO = re.compile(r'^MATERIAL\s(\d+)$', re.IGNORECASE)
+PATRON_CANTIDAD_MANTENIMIENTO = re.compile(r'^CANTIDAD MATERIAL\s(\d+)$', re.IGNORECASE)
+
+COLUMNAS_REQUERIDAS_MODERNIZACION = {
+    "2.Nro de O.T.", "1.NODO DEL POSTE.",
+    "2.CODIGO DE LUMINARIA INSTALADA N1.", "3.POTENCIA DE LUMINARIA INSTALADA (W)",
+    "6.CODIGO DE LUMINARIA INSTALADA N2.", "7.POTENCIA DE LUMINARIA INSTALADA (W)",
+    "1. Describa Aspectos que Considere se deben tener en cuenta.",
+    "FechaSincronizacion"
+}
+COLUMNAS_USADAS_MODERNIZACION = COLUMNAS_REQUERIDAS_MODERNIZACION | COLUMNAS_RESUMEN_TECNICOS | {"2.Tipo de Suelo", "3.Barrio"}
+# Bloque de materiales retirados y postes, tomado por posición
+BLOQUE_RETIRADOS_MODERNIZACION = range(column_index_from_string("BH") - 1, column_index_from_string("BO"))
+PATRON_CODIGO_RETIRADO = re.compile(r'^\d+\.CODIGO DE (LUMINARIA|BOMBILLA|FOTOCELDA) RETIRADA (N\d+)\.?$', re.IGNORECASE)
+PATRON_POTENCIA_RETIRADA = re.compile(r'^\d+\.POTENCIA DE (LUMINARIA|BOMBILLA) RETIRADA (N\d+)\.?\(W\)$', re.IGNORECASE)
+PATRON_MATERIAL_MODERNIZACION = re.compile(r'^(MATERIAL|Material)\s\d+$')
+PATRON_CANTIDAD_MODERNIZACION = re.compile(r'^(CANTIDAD MATERIAL|CANTIDAD DE MATERIAL)\s\d+$')
+
+COLUMNAS_REQUERIDAS_PROYECTO = {
+    "2.Nro de Proyecto.", "1.NODO DEL POSTE.",
+    "2.CODIGO DE LUMINARIA INSTALADA N1.", "3.CODIGO DE LUMINARIA INSTALADA N2.",
+    "1.Tipo de suelo.", "2.Tipo de Instalacion", "3.Pintado de Nodo?",
+    "4.Describa Aspectos que Considere se deben tener en cuenta.",
+    "FechaSincronizacion"
+}
+COLUMNAS_USADAS_PROYECTO = COLUMNAS_REQUERIDAS_PROYECTO | COLUMNAS_RESUMEN_TECNICOS | {"3.Barrio"}
+PATRON_COLUMNA_MATERIAL_PROYECTO = re.compile(r'^\d+\.(CANTIDAD )?MATERIAL (DESMONTADO )?No\.\d+$')
+PATRON_MATERIAL_PROYECTO = re.compile(r'^(\d+)\.MATERIAL (DESMONTADO )?No\.(\d+)$')
+
+
+class PlanHoja:
+    """
+    Columnas de una hoja según sus encabezados.
+
+    `seleccion` son los índices de las columnas a cargar (None: la hoja completa). Las demás
+    entradas son nombres de columna ya resueltos: `pares` y `pares_retirados` son pares
+    (material, cantidad); `codigos_retirados` son tuplas (tipo, Nn, columna del código, columna
+    de la potencia), con None si la columna no existe; `bloque_retirados` son las columnas BH..BO.
+    """
+    __slots__ = ('valida', 'seleccion', 'pares', 'pares_retirados', 'codigos_retirados', 'bloque_retirados')
+
+    def __init__(self, valida, seleccion, pares=(), pares_retirados=(), codigos_retirados=(), bloque_retirados=()):
+        self.valida = valida
+        self.seleccion = seleccion
+        self.pares = pares
+        self.pares_retirados = pares_retirados
+        self.codigos_retirados = codigos_retirados
+        self.bloque_retirados = bloque_retirados
+
+
+@lru_cache(maxsize=MAX_PLANES_HOJA)
+def plan_mantenimiento(encabezado):
+    """Plan de una hoja de mantenimiento (los nombres de columna van sin espacios alrededor)."""
+    nombres = [str(col).strip() for col in encabezado]
+    materiales = {}
+    cantidades = []
+    seleccion = []
+    for i, nombre in enumerate(nombres):
+        material = PATRON_MATERIAL_MANTENIMIENTO.match(nombre)
+        cantidad = PATRON_CANTIDAD_MANTENIMIENTO.match(nombre)
+        if material:
+            materiales.setdefault(material.group(1), nombre)
+        elif cantidad:
+            cantidades.append((cantidad.group(1), nombre))
+        if material or cantidad or nombre in COLUMNAS_REQUERIDAS_MANTENIMIENTO:
+            seleccion.append(i)
+    # Cada CANTIDAD MATERIAL n va con el MATERIAL del mismo número
+    pares = tuple((materiales[num], nombre) for num, nombre in cantidades if num in materiales)
+    return PlanHoja(COLUMNAS_REQUERIDAS_MANTENIMIENTO.issubset(nombres), tuple(seleccion), pares)
+
+
+@lru_cache(maxsize=MAX_PLANES_HOJA)
+def plan_modernizacion(encabezado):
+    """
+    Plan de una hoja de modernización.
+
+    Si los encabezados no llegan hasta BO, el bloque BH..BO no se puede seleccionar por posición
+    (las columnas sin encabezado también cuentan): el plan pide la hoja completa y se vuelve a
+    calcular con las columnas cargadas.
+    """
+    nombres = set(encabezado)
+    codigos, potencias, materiales, cantidades = {}, {}, [], []
+    seleccion = []
+    for i, col in enumerate(encabezado):
+        col_str = str(col)
+        codigo = PATRON_CODIGO_RETIRADO.match(col_str.strip())
+        potencia = None if codigo else PATRON_POTENCIA_RETIRADA.match(col_str.strip())
+        if codigo:
+            codigos[(codigo.group(1).upper(), codigo.group(2).upper())] = col_str.strip()
+        elif potencia:
+            potencias[(potencia.group(1).upper(), potencia.group(2).upper())] = col_str.strip()
+        es_material = isinstance(col, str) and PATRON_MATERIAL_MODERNIZACION.match(col)
+        es_cantidad = isinstance(col, str) and PATRON_CANTIDAD_MODERNIZACION.match(col)
+        if es_material:
+            materiales.append(col)
+        if es_cantidad:
+            cantidades.append(col)
+        if (codigo or potencia or es_material or es_cantidad or col in COLUMNAS_USADAS_MODERNIZACION
+                or i in BLOQUE_RETIRADOS_MODERNIZACION):
+            seleccion.append(i)
+
+    codigos_retirados = []
+    for (tipo, n), col_codigo in codigos.items():
+        col_potencia = potencias.get((tipo, n)) if tipo in ('LUMINARIA', 'BOMBILLA') else None
+        # Los nombres se comparan sin espacios alrededor: si la columna real los tiene, no se encuentra
+        codigos_retirados.append((
+            tipo, n,
+            col_codigo if col_codigo in nombres else None,
+            col_potencia if col_potencia in nombres else None,
+        ))
+    llega_a_bo = len(encabezado) > BLOQUE_RETIRADOS_MODERNIZACION[-1]
+    return PlanHoja(
+        COLUMNAS_REQUERIDAS_MODERNIZACION.issubset(encabezado),
+        tuple(seleccion) if llega_a_bo else None,
+        # Los pares MATERIAL n / CANTIDAD n van por orden de aparición
+        pares=tuple(zip(materiales, cantidades)),
+        codigos_retirados=tuple(codigos_retirados),
+        bloque_retirados=tuple(encabezado[i] for i in BLOQUE_RETIRADOS_MODERNIZACION) if llega_a_bo else (),
+    )
+
+
+@lru_cache(maxsize=MAX_PLANES_HOJA)
+def plan_proyecto(encabezado):
+    """Plan de una hoja de proyecto: pares n.MATERIAL [DESMONTADO] No.k / n+1.CANTIDAD MATERIAL [DESMONTADO] No.k."""
+    nombres = set(encabezado)
+    pares, pares_retirados = [], []
+    seleccion = []
+    for i, col in enumerate(encabezado):
+        if col in COLUMNAS_USADAS_PROYECTO or PATRON_COLUMNA_MATERIAL_PROYECTO.match(str(col)):
+            seleccion.append(i)
+        material = PATRON_MATERIAL_PROYECTO.match(col) if isinstance(col, str) else None
+        if material:
+            prefijo, desmontado, numero = material.groups()
+            col_cantidad = f"{int(prefijo) + 1}.CANTIDAD MATERIAL {desmontado or ''}No.{numero}"
+            if col_cantidad in nombres:
+                (pares_retirados if desmontado else pares).append((col, col_cantidad))
+    return PlanHoja(
+        COLUMNAS_REQUERIDAS_PROYECTO.issubset(encabezado), tuple(seleccion),
+        pares=tuple(pares), pares_retirados=tuple(pares_retirados),
+    )
+
 
 def procesar_archivo_mantenimiento(file: UploadFile):
     try:
-        contenido = file.file.read()
-        xls = pd.ExcelFile(BytesIO(contenido))
-        datos = defaultdict(lambda: {
-            'nodos': set(),
-            'materiales': defaultdict(lambda: defaultdict(int))
-        })
-
-        material_pattern = re.compile(r'^MATERIAL\s\d+$', re.IGNORECASE)
-        cantidad_pattern = re.compile(r'^CANTIDAD MATERIAL\s\d+$', re.IGNORECASE)
-
-        for hoja in xls.sheet_names:
-            df = xls.parse(hoja).rename(columns=lambda x: str(x).strip())
-            required_columns = {"6.Nro.Orden Energis", "5.Nodo"}
-            if not required_columns.issubset(df.columns):
+        libro = abrir_libro(file.filename, file.file)
+        datos = ordenes_trabajo()
+
+        for hoja in libro.hojas:
+            # Descartar la hoja mirando solo los encabezados, sin cargar sus filas
+            encabezado = libro.encabezado(hoja)
+            plan = plan_mantenimiento(tuple(encabezado))
+            if not plan.valida:
                 continue
+            df = leer_hoja(libro, hoja, encabezado, plan.seleccion).rename(columns=lambda x: str(x).strip())
 
             df["5.Nodo"] = df["5.Nodo"].astype(str)
             ot_nodos = df[["6.Nro.Orden Energis", "5.Nodo"]].drop_duplicates()
             for ot, nodo in ot_nodos.itertuples(index=False, name=None):
-                datos[ot]['nodos'].add(nodo)
-
-            material_cols = [col for col in df.columns if material_pattern.match(col)]
-            cantidad_cols = [col for col in df.columns if cantidad_pattern.match(col)]
-            paired_columns = []
-            material_nums = {re.search(r'\d+', col).group() for col in material_cols}
-            for col in cantidad_cols:
-                num = re.search(r'\d+', col).group()
-                if num in material_nums:
-                    mat_col = next(c for c in material_cols if num in c)
-                    paired_columns.append((mat_col, col))
+                datos[ot].agregar_nodos((nodo,))
 
             materiales_data = []
-            for mat_col, cant_col in paired_columns:
+            for mat_col, cant_col in plan.pares:
                 temp_df = df[["6.Nro.Orden Energis", "5.Nodo", mat_col, cant_col]].copy()
                 temp_df.columns = ["OT", "Nodo", "Material", "Cantidad"]
                 materiales_data.append(temp_df)
@@ -382,17 +1333,18 @@ def procesar_archivo_mantenimiento(file: UploadFile):
 
             for row in grouped.itertuples(index=False):
                 ot, nodo, material, cantidad = row
-                key = f"MATERIAL|{material}"
-                datos[ot]['materiales'][key][nodo] += cantidad
+                datos[ot].materiales[clave_material("MATERIAL", material)][nodo] += cantidad
 
         return datos
 
+    except MemoryError:
+        raise
     except Exception as e:
-        logger.error(f"Error procesando {file.filename}: {str(e)}")
+        logger.error("Error procesando %s: %s", file.filename, e)
         raise HTTPException(500, detail=f"Error en archivo {file.filename}")
 
 
-def generate_resumen_general(writer, datos_combinados):
+def generate_resumen_general(libro, datos_combinados):
 
     # Recolectar todos los materiales y OTs
     instalados = {}
@@ -410,7 +1362,7 @@ def generate_resumen_general(writer, datos_combinados):
     # Ahora procesar todos los datos para cada tipo de material
     for ot, info in datos_combinados.items():
         # Proceso para códigos N1
-        for key, nodos_data in info.get('codigos_n1', {}).items():
+        for key, nodos_data in info.codigos_n1.items():
             nombre = f"LUMINARIA {key}"
             if nombre not in luminarias:
                 luminarias[nombre] = {
@@ -426,7 +1378,7 @@ def generate_resumen_general(writer, datos_combinados):
             luminarias[nombre]['ots'][ot] += codigos_count
         
         # Proceso para códigos N2
-        for key, nodos_data in info.get('codigos_n2', {}).items():
+        for key, nodos_data in info.codigos_n2.items():
             nombre = f"LUMINARIA {key}"
             if nombre not in luminarias:
                 luminarias[nombre] = {
@@ -442,8 +1394,8 @@ def generate_resumen_general(writer, datos_combinados):
             luminarias[nombre]['ots'][ot] += codigos_count
             
         # Procesar materiales instalados
-        for mat_key, nodo_quantities in info['materiales'].items():
-            _, nombre = mat_key.split('|', 1)
+        for mat_key, nodo_quantities in info.materiales.items():
+            nombre = mat_key.etiqueta
             total = sum(nodo_quantities.values())
             
             if nombre not in instalados:
@@ -457,8 +1409,8 @@ def generate_resumen_general(writer, datos_combinados):
             instalados[nombre]['ots'][ot] += total
         
         # Procesar materiales retirados
-        for mat_key, nodo_quantities in info.get('materiales_retirados', {}).items():
-            _, nombre = mat_key.split('|', 1)
+        for mat_key, nodo_quantities in info.materiales_retirados.items():
+            nombre = mat_key.etiqueta
             total = sum(nodo_quantities.values())
             
             if nombre not in retirados:
@@ -475,38 +1427,36 @@ def generate_resumen_general(writer, datos_combinados):
         transporte_luminarias_por_ot = defaultdict(int)
 
         # Contar luminarias instaladas y retiradas para transporte
-        for nodo in info.get('nodos', []):
+        for nodo in info.nodos:
             # Contar códigos N1 y N2 válidos
             codigos_count = 0
-            for key_codigo, nodos_valores in info.get('codigos_n1', {}).items():
+            for key_codigo, nodos_valores in info.codigos_n1.items():
                 if nodo in nodos_valores:
                     codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                     codigos_count += len(codigos_validos)
 
-            for key_codigo, nodos_valores in info.get('codigos_n2', {}).items():
+            for key_codigo, nodos_valores in info.codigos_n2.items():
                 if nodo in nodos_valores:
                     codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                     codigos_count += len(codigos_validos)
 
             # Contar luminarias en materiales instalados
             luminarias_instaladas = 0
-            for mat_key, nodo_quantities in info['materiales'].items():
-                if "|" in mat_key:
-                    material_name = mat_key.split('|', 1)[1].upper()
-                    if ("LUMINARIA" in material_name or "LUM" in material_name or 
-                        "LED" in material_name or "LAMP" in material_name or 
-                        "FOCO" in material_name) and nodo in nodo_quantities:
-                        luminarias_instaladas += nodo_quantities[nodo]
+            for mat_key, nodo_quantities in info.materiales.items():
+                material_name = mat_key.etiqueta.upper()
+                if ("LUMINARIA" in material_name or "LUM" in material_name or 
+                    "LED" in material_name or "LAMP" in material_name or 
+                    "FOCO" in material_name) and nodo in nodo_quantities:
+                    luminarias_instaladas += nodo_quantities[nodo]
 
             # Contar luminarias en materiales retirados
             luminarias_retiradas = 0
-            for mat_key, nodo_quantities in info.get('materiales_retirados', {}).items():
-                if "|" in mat_key:
-                    material_name = mat_key.split('|', 1)[1].upper()
-                    if ("LUMINARIA" in material_name or "RETIRADA" in material_name or 
-                        "LUM" in material_name or "LED" in material_name or 
-                        "LAMP" in material_name or "FOCO" in material_name) and nodo in nodo_quantities:
-                        luminarias_retiradas += nodo_quantities[nodo]
+            for mat_key, nodo_quantities in info.materiales_retirados.items():
+                material_name = mat_key.etiqueta.upper()
+                if ("LUMINARIA" in material_name or "RETIRADA" in material_name or 
+                    "LUM" in material_name or "LED" in material_name or 
+                    "LAMP" in material_name or "FOCO" in material_name) and nodo in nodo_quantities:
+                    luminarias_retiradas += nodo_quantities[nodo]
 
             # Calcular total para este nodo (limitado a 5 por nodo)
             total_nodo = codigos_count + luminarias_instaladas + luminarias_retiradas
@@ -548,7 +1498,7 @@ def generate_resumen_general(writer, datos_combinados):
 
     # Escribir directamente al Excel sin usar pandas para mayor control
     sheet_name = 'Resumen_general'
-    worksheet = writer.book.create_sheet(sheet_name)
+    worksheet = libro.create_sheet(sheet_name)
     
     # Configuración de estilos
     header_font = Font(bold=True)
@@ -556,36 +1506,32 @@ def generate_resumen_general(writer, datos_combinados):
     section_fill = PatternFill(start_color="DDEBF7", end_color="DDEBF7", fill_type="solid")
     center_alignment = Alignment(horizontal='center', vertical='center')
     
+    # En modo write-only los anchos y la congelación de paneles van antes de la primera fila
+    for idx, col in enumerate(columns, 1):
+        col_width = len(str(col)) + 2
+        # Para la primera columna, usar un ancho mayor
+        if idx == 1:
+            col_width = 40
+        worksheet.column_dimensions[get_column_letter(idx)].width = col_width
+    worksheet.freeze_panes = 'D2'
+    
     # Escribir encabezados de columnas
-    for col, header in enumerate(columns, 1):
-        cell = worksheet.cell(row=1, column=col, value=header)
-        cell.font = header_font
+    worksheet.append([celda_excel(worksheet, header, font=header_font) for header in columns])
     
     current_row = 2
     
     # Función para escribir una sección
     def write_section(title, data, row):
-        # Encabezado de sección
-        cell = worksheet.cell(row=row, column=1, value=title)
-        cell.font = section_font
-        cell.fill = section_fill
-        cell.alignment = center_alignment
-        
-        # Combinar celdas para el encabezado
-        worksheet.merge_cells(start_row=row, start_column=1, end_row=row, end_column=len(columns))
+        # Encabezado de sección, combinado a lo ancho de la tabla
+        worksheet.append([celda_excel(worksheet, title, font=section_font, fill=section_fill, alignment=center_alignment)])
+        worksheet.merged_cells.add(f"A{row}:{get_column_letter(len(columns))}{row}")
         
         row += 1
         
         # Escribir datos
         for nombre, info in sorted(data.items()):
-            worksheet.cell(row=row, column=1, value=nombre)
-            worksheet.cell(row=row, column=2, value=info['unidad'])
-            worksheet.cell(row=row, column=3, value=info['total'])
-            
             # Cantidades por OT
-            for i, ot in enumerate(ots_ordenadas, 4):
-                worksheet.cell(row=row, column=i, value=info['ots'].get(ot, 0))
-            
+            worksheet.append([nombre, info['unidad'], info['total']] + [info['ots'].get(ot, 0) for ot in ots_ordenadas])
             row += 1
             
         return row
@@ -593,27 +1539,18 @@ def generate_resumen_general(writer, datos_combinados):
     # Escribir sección de luminarias
     if luminarias:
         current_row = write_section("LUMINARIAS INSTALADAS", luminarias, current_row)
-        current_row += 1  # Espacio entre secciones
+        worksheet.append([])  # Espacio entre secciones
+        current_row += 1
     
     # Escribir sección de materiales instalados
     if instalados:
         current_row = write_section("MATERIALES INSTALADOS", instalados, current_row)
-        current_row += 1  # Espacio entre secciones
+        worksheet.append([])  # Espacio entre secciones
+        current_row += 1
     
     # Escribir sección de materiales retirados
     if retirados:
         current_row = write_section("MATERIALES RETIRADOS", retirados, current_row)
-    
-    # Ajustar anchos de columna
-    for idx, col in enumerate(columns, 1):
-        col_width = len(str(col)) + 2
-        # Para la primera columna, usar un ancho mayor
-        if idx == 1:
-            col_width = 40
-        worksheet.column_dimensions[get_column_letter(idx)].width = col_width
-    
-    # Configurar congelación de paneles
-    worksheet.freeze_panes = 'D2'
         
 def generate_barrio_sheet(writer, barrio_data, barrio_name):
     
@@ -625,8 +1562,8 @@ def generate_barrio_sheet(writer, barrio_data, barrio_name):
     ots = set()
     
     # Procesar materiales instalados
-    for mat_key, ot_quantities in barrio_data['materiales_instalados'].items():
-        _, nombre = mat_key.split('|', 1)
+    for mat_key, ot_quantities in barrio_data.materiales_instalados.items():
+        nombre = mat_key.etiqueta
         for ot, cantidad in ot_quantities.items():
             ots.add(ot)
             key = (nombre, 'INSTALADO')
@@ -642,8 +1579,8 @@ def generate_barrio_sheet(writer, barrio_data, barrio_name):
             materials[key]['ots'][ot] += cantidad
     
     # Procesar materiales retirados
-    for mat_key, ot_quantities in barrio_data['materiales_retirados'].items():
-        _, nombre = mat_key.split('|', 1)
+    for mat_key, ot_quantities in barrio_data.materiales_retirados.items():
+        nombre = mat_key.etiqueta
         for ot, cantidad in ot_quantities.items():
             ots.add(ot)
             key = (f"{nombre} (RETIRADO)", 'RETIRADO')
@@ -797,14 +1734,13 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
         nodos_con_luminarias_codigo_brazo = []
     
         # Verificar si hay LUMINARIA CODIGO/BRAZO en materiales instalados
-        for material_key, nodos_qty in datos[ot]['materiales'].items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "LUMINARIA CODIGO/BRAZO" in material_name:
-                    for nodo, cantidad in nodos_qty.items():
-                        if cantidad > 0:
-                            hay_luminarias_codigo_brazo = True
-                            nodos_con_luminarias_codigo_brazo.append(nodo)
+        for material_key, nodos_qty in datos[ot].materiales.items():
+            material_name = material_key.nombre.upper()
+            if "LUMINARIA CODIGO/BRAZO" in material_name:
+                for nodo, cantidad in nodos_qty.items():
+                    if cantidad > 0:
+                        hay_luminarias_codigo_brazo = True
+                        nodos_con_luminarias_codigo_brazo.append(nodo)
     
         # MEJORA: Determinar si hay brazos grandes o pequeños en la OT para decidir el tipo de instalación
         hay_brazos_grandes = False
@@ -814,36 +1750,35 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
 
         # IMPORTANTE: Solo verificar brazos si hay LUMINARIA CODIGO/BRAZO
         if hay_luminarias_codigo_brazo:
-            for nodo in datos[ot]['nodos']:
-                for material_key, nodos_qty in datos[ot]['materiales'].items():
-                    if "|" in material_key:
-                        material_name = material_key.split("|")[1].upper()
-                        if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                            # Intentar extraer la longitud del brazo
-                            longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                            if longitud_match:
-                                try:
-                                    longitud = int(longitud_match.group(1))
-                                    # Considerar brazos de 3 metros o más como grandes (para canasta)
-                                    if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
-                                        hay_brazos_grandes = True
-                                        nodos_con_brazos_grandes.append(nodo)
-                                    else:
-                                        hay_brazos_pequenos = True
-                                        nodos_con_brazos_pequenos.append(nodo)
-                                except:
-                                    pass
-                            # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
-                            elif "2 1/2" in material_name or "2.5" in material_name:
-                                hay_brazos_grandes = True
-                                nodos_con_brazos_grandes.append(nodo)
-                            # Verificar explícitamente si es un brazo de 3 metros
-                            elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                hay_brazos_grandes = True
-                                nodos_con_brazos_grandes.append(nodo)
-                            else:
-                                hay_brazos_pequenos = True
-                                nodos_con_brazos_pequenos.append(nodo)
+            for nodo in datos[ot].nodos:
+                for material_key, nodos_qty in datos[ot].materiales.items():
+                    material_name = material_key.nombre.upper()
+                    if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                        # Intentar extraer la longitud del brazo
+                        longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
+                        if longitud_match:
+                            try:
+                                longitud = int(longitud_match.group(1))
+                                # Considerar brazos de 3 metros o más como grandes (para canasta)
+                                if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
+                                    hay_brazos_grandes = True
+                                    nodos_con_brazos_grandes.append(nodo)
+                                else:
+                                    hay_brazos_pequenos = True
+                                    nodos_con_brazos_pequenos.append(nodo)
+                            except:
+                                pass
+                        # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
+                        elif "2 1/2" in material_name or "2.5" in material_name:
+                            hay_brazos_grandes = True
+                            nodos_con_brazos_grandes.append(nodo)
+                        # Verificar explícitamente si es un brazo de 3 metros
+                        elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                            hay_brazos_grandes = True
+                            nodos_con_brazos_grandes.append(nodo)
+                        else:
+                            hay_brazos_pequenos = True
+                            nodos_con_brazos_pequenos.append(nodo)
     
         # FORZAR la aparición de instalación de luminarias SOLO si hay LUMINARIA CODIGO/BRAZO
         #if hay_luminarias_codigo_brazo:
@@ -857,7 +1792,7 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
         #        # Contar la cantidad real de LUMINARIA CODIGO/BRAZO en nodos con brazos grandes
         #        for nodo in nodos_con_brazos_grandes:
         #            cantidad_luminarias = 0
-        #            for material_key, nodos_qty in datos[ot]['materiales'].items():
+        #            for material_key, nodos_qty in datos[ot].materiales.items():
         #                if "|" in material_key:
         #                    material_name = material_key.split("|")[1].upper()
         #                    if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
@@ -885,11 +1820,10 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
                 # Contar la cantidad real de LUMINARIA CODIGO/BRAZO en nodos con brazos pequeños
                 for nodo in nodos_con_brazos_pequenos:
                     cantidad_luminarias = 0
-                    for material_key, nodos_qty in datos[ot]['materiales'].items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
-                                cantidad_luminarias += nodos_qty[nodo]
+                    for material_key, nodos_qty in datos[ot].materiales.items():
+                        material_name = material_key.nombre.upper()
+                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
+                            cantidad_luminarias += nodos_qty[nodo]
                     
                     if cantidad_luminarias > 0:
                         mo_acumulada[descripcion_forzada] += cantidad_luminarias
@@ -913,11 +1847,10 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
                 # Contar la cantidad real de LUMINARIA CODIGO/BRAZO en todos los nodos
                 for nodo in nodos_con_luminarias_codigo_brazo:
                     cantidad_luminarias = 0
-                    for material_key, nodos_qty in datos[ot]['materiales'].items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
-                                cantidad_luminarias += nodos_qty[nodo]
+                    for material_key, nodos_qty in datos[ot].materiales.items():
+                        material_name = material_key.nombre.upper()
+                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
+                            cantidad_luminarias += nodos_qty[nodo]
                     
                     if cantidad_luminarias > 0:
                         mo_acumulada[descripcion_forzada] += cantidad_luminarias
@@ -942,11 +1875,11 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
                         }
                     }
         
+        # Mano de obra de todas las partidas en todos los nodos de la OT, calculada de una vez
+        mano_obra_ot = calcular_mano_obra_ot(datos[ot], datos[ot].nodos, map(partida_mano_obra, plantilla_mo))
+        
         # Procesar cada nodo normalmente (esto puede agregar más información a la partida forzada)
-        for nodo in datos[ot]['nodos']:
-            # Obtener el tipo de suelo para este nodo si existe
-            tipo_suelo = datos[ot]['tipos_suelo'].get(nodo, "")
-            
+        for nodo in mano_obra_ot.nodos:
             # Procesar cada partida de mano de obra
             for partida in plantilla_mo:
                 descripcion = partida['DESCRIPCION MANO DE OBRA']
@@ -955,33 +1888,19 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
                 if "INSTALACION DE LUMINARIAS" in descripcion.upper():
                     # Verificar si hay LUMINARIA CODIGO/BRAZO en este nodo específico
                     tiene_luminaria_codigo_brazo = False
-                    for material_key, nodos_qty in datos[ot]['materiales'].items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                tiene_luminaria_codigo_brazo = True
-                                break
+                    for material_key, nodos_qty in datos[ot].materiales.items():
+                        material_name = material_key.nombre.upper()
+                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                            tiene_luminaria_codigo_brazo = True
+                            break
                     
                     # Si no hay LUMINARIA CODIGO/BRAZO en este nodo, saltar esta partida
                     if not tiene_luminaria_codigo_brazo:
                         continue
                 
-                # Calcular cantidad de mano de obra para esta partida en este nodo
-                # Pasar el tipo de suelo como nuevo parámetro
-                cantidad, materiales_relacionados, materiales_retirados = calcular_cantidad_mano_obra(
-                        descripcion,
-                        datos[ot]['materiales'],
-                        datos[ot]['materiales_retirados'],
-                        nodo,
-                        datos[ot].get('codigos_n1', {}),
-                        datos[ot].get('codigos_n2', {}),
-                        tipo_suelo,                                                 
-                        "Conexión a tierra" if any(kw in descripcion.upper() for kw in ["CONEXIÓN A CABLE A TIERRA", "INSTALACION KIT SPT", "INSTALACION DE ATERRIZAJES"]) 
-                        else "Postes" if any(kw in descripcion.upper() for kw in ["APERTURA", "APLOMADA", "CONCRETADA", "HINCADA", "ALQUILER"]) 
-                        else "Otros",
-                        datos[ot].get('tipos_instalacion', {}),  
-                        datos[ot].get('tipos_instalacion', {}).get(nodo, None)
-                )
+                # Cantidad de mano de obra de esta partida en este nodo
+                cantidad = mano_obra_ot.cantidad(nodo, descripcion)
+                materiales_relacionados, materiales_retirados = mano_obra_ot.materiales(nodo, descripcion)
                 
                 # Si hay cantidad, acumular y registrar nodo
                 if cantidad > 0:
@@ -1015,11 +1934,10 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
             # Contar la cantidad real de LUMINARIA CODIGO/BRAZO en todos los nodos
             for nodo in nodos_con_luminarias_codigo_brazo:
                 cantidad_luminarias = 0
-                for material_key, nodos_qty in datos[ot]['materiales'].items():
-                    if "|" in material_key:
-                        material_name = material_key.split("|")[1].upper()
-                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
-                            cantidad_luminarias += nodos_qty[nodo]
+                for material_key, nodos_qty in datos[ot].materiales.items():
+                    material_name = material_key.nombre.upper()
+                    if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
+                        cantidad_luminarias += nodos_qty[nodo]
                 
                 if cantidad_luminarias > 0:
                     mo_acumulada[descripcion_forzada] += cantidad_luminarias
@@ -1225,7 +2143,7 @@ def agregar_tabla_mano_obra(wb, datos, ot, plantilla_mo):
             ws.row_dimensions[cell.row].height = max(15, min(max_lines * 15, 409))  # Máximo permitido es 409
         
     except Exception as e:
-        logger.error(f"Error agregando tabla de mano de obra: {str(e)}")
+        logger.error("Error agregando tabla de mano de obra: %s", e)
         raise
 
 def agregar_hoja_asociaciones(writer, datos_combinados):
@@ -1240,30 +2158,6 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
     bold   = Font(bold=True)
     center = Alignment(horizontal='center', vertical='center')
 
-    # Cargo la plantilla (una sola vez)
-    plantilla = cargar_plantilla_mano_obra()
-
-    # Los cuatro bloques con sus keywords
-    bloques = [
-                    ("Postes",
-                    ["APERTURA", "APLOMADA", "CONCRETADA", "HINCADA", "ALQUILER"],  # Removido "BOTADO DE ESCOMBROS"
-                    ["POSTE"]),
-                    ("Instalación luminarias",
-                    ["INSTALACION LUMINARIAS"],
-                    ["LUMINARIA", "FOTOCELDA", "GRILLETE", "BRAZO"]),
-                    ("Conexión a tierra",
-                    ["CONEXIÓN A CABLE A TIERRA", "INSTALACION KIT SPT", "INSTALACION DE ATERRIZAJES", "BOTADO DE ESCOMBROS", "RECUPERACION ZONA DURA"],  # Específico para zona dura
-                    ["KIT DE PUESTA A TIERRA", "CONECT PERF", "CONECTOR BIME/COM", "ALAMBRE", "TUERCA", "TORNILLO", "VARILLA"]),
-                    ("Desmontaje / Transporte",
-                    ["DESMONTAJE", "TRANSPORTE", "TRANSP.", "TRANSPORTE COLLARINES"],
-                    ["ALAMBRE", "BRAZO", "CÓDIGO", "CABLE", "ABRAZADERA", "GRILLETE"]),
-                    ("Instalación de cables",
-                    ["INSTALACION CABLE"],
-                    ["CABLE", "TPX", "ALAMBRE"]),
-                    ("Otros trabajos",
-                    ["VESTIDA CONJUNTO 1 O 2 PERCHAS", "VESTIDA CONJUNTO 3 O MAS PERCHAS", "VESTIDA", "CAJA", "PINTADA", "EXCAVACION", "RECUPERACION ZONA", "SOLDADURA", "INSTALACION TRAMA", "INSTALACION CORAZA"],  # Solo "RECUPERACION ZONA" sin "DURA"
-                    ["PERCHA", "CAJA", "TUBO", "TUBERIA", "CONDUIT"])
-                ]
 
     row = 1
     for ot, info in datos_combinados.items():
@@ -1275,13 +2169,10 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
         row += 2
 
         # 2) Defino nodos ordenados por fecha de sincronización
-        nodos = sorted(
-            info.get('fechas_sync', {}).keys(),
-            key=lambda n: pd.to_datetime(
-                info['fechas_sync'].get(n, ""),
-                format='%d/%m/%Y %H:%M:%S',
-                errors='coerce'
-            )
+        nodos = info.nodos_por_fecha(incluir_sin_fecha=False)
+        # Mano de obra de todas las partidas de la plantilla en esos nodos, calculada de una vez
+        mano_obra_ot = calcular_mano_obra_ot(
+            info, nodos, (partida for bloque in PLANTILLA_MANO_OBRA for partida in bloque.partidas)
         )
 
         # 3) Por cada nodo...
@@ -1298,7 +2189,7 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
             hay_codigos = False
 
             # Verificar códigos N1 y N2 válidos (excluyendo NO, N/A, NA)
-            for _, nodos_valores in info.get('codigos_n1', {}).items():
+            for _, nodos_valores in info.codigos_n1.items():
                 if nodo in nodos_valores:
                     # Filtrar códigos NO, N/A, NA
                     codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
@@ -1307,7 +2198,7 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                         break
                     
             if not hay_codigos:
-                for _, nodos_valores in info.get('codigos_n2', {}).items():
+                for _, nodos_valores in info.codigos_n2.items():
                     if nodo in nodos_valores:
                         # Filtrar códigos NO, N/A, NA
                         codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
@@ -1316,17 +2207,16 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                             break
                         
             # Verificar materiales que podrían ser luminarias
-            for material_key, nodos_qty in info['materiales'].items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if ("LUMINARIA" in material_name or "LUM" in material_name or 
-                        "LED" in material_name or "LAMP" in material_name or 
-                        "FOCO" in material_name):
-                        if nodo in nodos_qty and nodos_qty[nodo] > 0:
-                            hay_luminarias = True
-                            break
+            for material_key, nodos_qty in info.materiales.items():
+                material_name = material_key.nombre.upper()
+                if ("LUMINARIA" in material_name or "LUM" in material_name or 
+                    "LED" in material_name or "LAMP" in material_name or 
+                    "FOCO" in material_name):
+                    if nodo in nodos_qty and nodos_qty[nodo] > 0:
+                        hay_luminarias = True
+                        break
             # 4) Los bloques
-            for titulo, kw_mo, kw_mat in bloques:
+            for titulo, kw_mo, kw_mat, partidas in PLANTILLA_MANO_OBRA:
                 # Encabezado de bloque
                 ws.merge_cells(start_row=row, start_column=1, end_row=row, end_column=7)
                 cb = ws.cell(row=row, column=1, value=titulo)
@@ -1349,46 +2239,39 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                         ch.fill = red
                 row += 1
 
-                # Filtrar partidas de la plantilla que pertenecen a este bloque
-                partidas = [
-                    item for item in plantilla
-                    if any(k in item['DESCRIPCION MANO DE OBRA'].upper() for k in kw_mo)
-                ]
-
                 # CASO ESPECIAL: Si es el bloque de instalación de luminarias y hay luminarias o códigos,
                 # forzar la aparición de al menos una partida
                 if titulo == "Instalación luminarias" and (hay_luminarias or hay_codigos):
                     # Buscar la partida de instalación en camioneta
                     partida_instalacion = next(
-                        (item for item in partidas if "INSTALACION DE LUMINARIAS EN CAMIONETA" in item['DESCRIPCION MANO DE OBRA']),
+                        (item for item in partidas if "INSTALACION DE LUMINARIAS EN CAMIONETA" in item.descripcion),
                         None
                     )
                     
                     if partida_instalacion:
-                        desc = partida_instalacion['DESCRIPCION MANO DE OBRA']
-                        und = partida_instalacion['UNIDAD']
+                        desc = partida_instalacion.descripcion
+                        und = partida_instalacion.unidad
                         
                         # Crear una lista de materiales relacionados
                         lst_inst = []
                         
                         # Agregar códigos si existen
-                        for key_codigo, nodos_valores in info.get('codigos_n1', {}).items():
+                        for key_codigo, nodos_valores in info.codigos_n1.items():
                             if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
                                 lst_inst.append(f"CÓDIGO N1: {', '.join(nodos_valores[nodo])}")
                         
-                        for key_codigo, nodos_valores in info.get('codigos_n2', {}).items():
+                        for key_codigo, nodos_valores in info.codigos_n2.items():
                             if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
                                 lst_inst.append(f"CÓDIGO N2: {', '.join(nodos_valores[nodo])}")
                         
                         # Agregar materiales de luminarias si existen
-                        for material_key, nodos_qty in info['materiales'].items():
-                            if "|" in material_key:
-                                material_name = material_key.split("|")[1].upper()
-                                if ("LUMINARIA" in material_name or "LUM" in material_name or 
-                                    "LED" in material_name or "LAMP" in material_name or 
-                                    "FOCO" in material_name):
-                                    if nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                        lst_inst.append(f"{material_name} ({nodos_qty[nodo]})")
+                        for material_key, nodos_qty in info.materiales.items():
+                            material_name = material_key.nombre.upper()
+                            if ("LUMINARIA" in material_name or "LUM" in material_name or 
+                                "LED" in material_name or "LAMP" in material_name or 
+                                "FOCO" in material_name):
+                                if nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                    lst_inst.append(f"{material_name} ({nodos_qty[nodo]})")
                         
                         # Si no se encontró nada específico, agregar un mensaje genérico
                         if not lst_inst:
@@ -1409,32 +2292,16 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
 
                 # Para cada partida, calcular la mano de obra necesaria
                 for item in partidas:
-                    desc = item['DESCRIPCION MANO DE OBRA']
-                    und = item['UNIDAD']
+                    desc = item.descripcion
+                    und = item.unidad
                     
                     # Saltar la partida de instalación en camioneta si ya la forzamos
                     if titulo == "Instalación luminarias" and (hay_luminarias or hay_codigos) and "INSTALACION DE LUMINARIAS EN CAMIONETA" in desc:
                         continue
                     
-                    # Obtener el tipo de suelo para este nodo si existe
-                    tipo_suelo = info['tipos_suelo'].get(nodo, "")
-                    
-                    # Usar la función mejorada para calcular cantidades de mano de obra
-                    # Pasar el tipo de suelo como parámetro
-                    total_mo, lst_inst, lst_ret = calcular_cantidad_mano_obra(
-                        desc, 
-                        info.get('materiales', {}), 
-                        info.get('materiales_retirados', {}),
-                        nodo,
-                        info.get('codigos_n1', {}),
-                        info.get('codigos_n2', {}),
-                        tipo_suelo,
-                        "Conexión a tierra" if any(kw in desc.upper() for kw in ["CONEXIÓN A CABLE A TIERRA", "INSTALACION KIT SPT", "INSTALACION DE ATERRIZAJES"]) 
-                        else "Postes" if any(kw in desc.upper() for kw in ["APERTURA", "APLOMADA", "CONCRETADA", "HINCADA", "ALQUILER"]) 
-                        else "Otros",
-                        info.get('tipos_instalacion', {}),  
-                        info.get('tipos_instalacion', {}).get(nodo, None) 
-                    )
+                    # Cantidad y materiales relacionados de la partida en este nodo
+                    total_mo = mano_obra_ot.cantidad(nodo, desc)
+                    lst_inst, lst_ret = mano_obra_ot.materiales(nodo, desc)
                     
                     # Si no hay mano de obra requerida, continuamos con la siguiente partida
                     if total_mo == 0:
@@ -1444,8 +2311,8 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                     # Para materiales instalados, obtener las cantidades reales
                     materiales_inst_con_qty = []
                     for mat_name in lst_inst:
-                        for material_key, nodos_qty in info.get('materiales', {}).items():
-                            if "|" in material_key and material_key.split("|")[1].upper() == mat_name and nodo in nodos_qty:
+                        for material_key, nodos_qty in info.materiales.items():
+                            if material_key.nombre.upper() == mat_name and nodo in nodos_qty:
                                 qty = nodos_qty[nodo]
                                 materiales_inst_con_qty.append(f"{mat_name} ({qty})")
                                 break
@@ -1455,8 +2322,8 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                     # Para materiales retirados, obtener las cantidades reales
                     materiales_ret_con_qty = []
                     for mat_name in lst_ret:
-                        for material_key, nodos_qty in info.get('materiales_retirados', {}).items():
-                            if "|" in material_key and material_key.split("|")[1].upper() == mat_name and nodo in nodos_qty:
+                        for material_key, nodos_qty in info.materiales_retirados.items():
+                            if material_key.nombre.upper() == mat_name and nodo in nodos_qty:
                                 qty = nodos_qty[nodo]
                                 materiales_ret_con_qty.append(f"{mat_name} ({qty})")
                                 break
@@ -1466,14 +2333,14 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
                     # Calcular sumas totales de materiales
                     sum_inst = sum(
                         nodos_qty[nodo] 
-                        for material_key, nodos_qty in info.get('materiales', {}).items() 
-                        if "|" in material_key and material_key.split("|")[1].upper() in lst_inst and nodo in nodos_qty
+                        for material_key, nodos_qty in info.materiales.items() 
+                        if material_key.nombre.upper() in lst_inst and nodo in nodos_qty
                     ) if lst_inst else 0
                     
                     sum_ret = sum(
                         nodos_qty[nodo] 
-                        for material_key, nodos_qty in info.get('materiales_retirados', {}).items() 
-                        if "|" in material_key and material_key.split("|")[1].upper() in lst_ret and nodo in nodos_qty
+                        for material_key, nodos_qty in info.materiales_retirados.items() 
+                        if material_key.nombre.upper() in lst_ret and nodo in nodos_qty
                     ) if lst_ret else 0
 
                     # Escribo la fila
@@ -1498,57 +2365,374 @@ def agregar_hoja_asociaciones(writer, datos_combinados):
     for col_idx in range(1, 8):
         ws.column_dimensions[get_column_letter(col_idx)].width = 30
 
-def procesar_archivo_modernizacion(file: UploadFile):
-    try:
-        contenido = file.file.read()
-        xls = pd.ExcelFile(BytesIO(contenido))
-        
-        datos = defaultdict(lambda: {
-            'nodos': [],
-            'nodo_counts': defaultdict(int),
-            'codigos_n1': defaultdict(lambda: defaultdict(set)),
-            'codigos_n2': defaultdict(lambda: defaultdict(set)),
-            'materiales': defaultdict(lambda: defaultdict(int)),    
-            'materiales_retirados': defaultdict(lambda: defaultdict(int)),
-            'aspectos_materiales': defaultdict(lambda: defaultdict(lambda: set())),
-            'aspectos_retirados': defaultdict(lambda: defaultdict(lambda: set())),
-            'fechas_sync': defaultdict(str),  # Fechas de sincronización
-            'tipos_suelo': defaultdict(str)   
-        })                 
-        
-        datos_por_barrio = defaultdict(lambda: {
-            'materiales_instalados': defaultdict(lambda: defaultdict(int)),
-            'materiales_retirados': defaultdict(lambda: defaultdict(int))
-                                                })
+ASPECTOS_NO_VALIDOS = ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']
+
+
+def factorizar_por_fila(serie):
+    """
+    Asigna a cada fila el código de su valor, en orden de primera aparición.
+
+    Se usa un diccionario para respetar exactamente la misma semántica que tenía
+    indexar `datos[valor]` fila a fila (por ejemplo, cada NaN es una clave distinta).
+
+    Returns:
+        tuple: (np.ndarray de códigos por fila, lista con el valor original de cada código)
+    """
+    indice = {}
+    valores = serie.tolist()
+    codigos = np.fromiter((indice.setdefault(v, len(indice)) for v in valores), dtype=np.intp, count=len(valores))
+    return codigos, list(indice)
+
+
+def grupos_por_codigo(codigos):
+    """Devuelve, para cada código en orden de aparición, las posiciones de sus filas (en orden)."""
+    if len(codigos) == 0:
+        return []
+    orden = np.argsort(codigos, kind='stable')
+    cortes = np.flatnonzero(np.diff(codigos[orden])) + 1
+    return np.split(orden, cortes)
+
+
+def factorizar_textos(valores):
+    """
+    Factoriza `str(valor)` de cada celda.
+
+    Permite normalizar una sola vez cada texto distinto (materiales, aspectos, códigos)
+    y expandir el resultado a todas las celdas con los códigos devueltos.
+
+    Returns:
+        tuple: (np.ndarray de códigos por celda, lista de textos distintos)
+    """
+    codigos, unicos = pd.factorize(np.array([str(v) for v in valores], dtype=object))
+    return codigos, unicos.tolist()
+
+
+def aplicar_por_valor(valores, funcion):
+    """Evalúa `funcion` una sola vez por valor distinto de la columna y expande el resultado a cada fila."""
+    codigos, unicos = pd.factorize(valores, use_na_sentinel=False)
+    resultados = np.empty(len(unicos), dtype=object)
+    resultados[:] = [funcion(valor) for valor in unicos]
+    return resultados[codigos]
+
+
+def codigos_de_grupo(*columnas):
+    """Código de grupo por combinación de columnas, numerado en orden de primera aparición."""
+    grupo = np.zeros(len(columnas[0]), dtype=np.int64)
+    for columna in columnas:
+        codigos, unicos = pd.factorize(columna)
+        grupo, _ = pd.factorize(grupo * max(len(unicos), 1) + codigos)
+    return grupo
+
+
+def primeras_apariciones(grupo):
+    """Posición de la primera fila de cada grupo (en orden de aparición)."""
+    return np.unique(grupo, return_index=True)[1]
+
+
+def sumar_por_grupo(cantidades, enteras, *columnas):
+    """
+    Suma cantidades por combinación de columnas, en orden de primera aparición.
+
+    `np.bincount` acumula en el orden de las filas, igual que el `+=` del recorrido
+    fila a fila; los grupos marcados como enteros se devuelven como `int`.
+
+    Returns:
+        tuple: (posiciones de la primera fila de cada grupo, lista de totales)
+    """
+    grupo = codigos_de_grupo(*columnas)
+    primeras = primeras_apariciones(grupo)
+    totales = np.bincount(grupo, weights=cantidades).tolist()
+    return primeras, [int(t) if entera else t for t, entera in zip(totales, enteras[primeras].tolist())]
+
+
+def limpiar_aspectos(serie):
+    """
+    Normaliza la columna de aspectos fila a fila.
+
+    Returns:
+        tuple: (np.ndarray con el código del aspecto de cada fila, -1 cuando está vacío
+        o no aplica; lista de aspectos en mayúsculas)
+    """
+    valores = serie.to_numpy(dtype=object)
+    codigos = np.full(len(valores), -1, dtype=np.intp)
+    presentes = np.flatnonzero(pd.notna(valores))
+    if not len(presentes):
+        return codigos, []
+    codigos_texto, textos = factorizar_textos(valores[presentes])
+    limpios = [texto.strip().upper() for texto in textos]
+    limpios = np.array([None if t in ASPECTOS_NO_VALIDOS else t for t in limpios], dtype=object)
+    codigos_limpios, aspectos = pd.factorize(limpios)
+    codigos[presentes] = codigos_limpios[codigos_texto]
+    return codigos, aspectos.tolist()
+
+
+def codigos_informados(serie):
+    """Máscara de códigos informados (no vacíos ni '0') y el código limpio de cada fila."""
+    valores = serie.to_numpy(dtype=object)
+    codigos, textos = factorizar_textos(valores)
+    limpios = np.array([texto.strip() for texto in textos], dtype=object)[codigos]
+    validos = pd.notna(valores) & ~np.isin(limpios, ['', '0', '0.0'])
+    return validos, limpios
+
+
+def cantidades_float(valores):
+    """`float(cantidad)` celda a celda para valores ya filtrados (no nulos)."""
+    try:
+        return valores.astype(float)
+    except (TypeError, ValueError):
+        return np.array([float(v) for v in valores], dtype=float)
+
+
+def cantidades_enteras(serie):
+    """`int(cantidad)` celda a celda, usando 0 para las celdas vacías."""
+    if pd.api.types.is_numeric_dtype(serie):
+        return np.trunc(serie.fillna(0).to_numpy(dtype=float)).astype(np.int64)
+    return np.array([0 if pd.isna(v) else int(v) for v in serie.tolist()], dtype=np.int64)
+
+
+def potencia_float(valor):
+    """`float(valor)` o NaN si la celda está vacía o no es numérica."""
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def potencias_float(serie, n_filas):
+    """Potencia en float por fila; NaN si la celda está vacía o no es numérica."""
+    if serie is None:
+        return np.full(n_filas, np.nan)
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.to_numpy(dtype=float)
+    return aplicar_por_valor(serie.to_numpy(dtype=object), potencia_float).astype(float)
+
+
+def potencia_instalada(valor):
+    """Potencia declarada para una luminaria instalada: float si es válida, 0 en caso contrario."""
+    if pd.notna(valor) and str(valor) != "0":
+        try:
+            return float(valor)
+        except (TypeError, ValueError):
+            pass
+    return 0
+
+
+def clave_codigo_instalado(prefijo, potencia_val):
+    """Clave de agrupación de códigos instalados, p. ej. 'CODIGO 1 LUMINARIA INSTALADA 70 W'."""
+    if potencia_val == 0:
+        return prefijo
+    if potencia_val.is_integer():
+        return f"{prefijo} {int(potencia_val)} W"
+    return f"{prefijo} {potencia_val} W"
+
+
+def formatear_potencia_retirada(potencia_float):
+    return f"{int(potencia_float)}W" if potencia_float.is_integer() else f"{potencia_float}W"
+
+
+def fechas_sync(fechas):
+    """Columna datetime64 como arreglo de pd.Timestamp al segundo (pd.NaT si falta), una por fila."""
+    return fechas.dt.floor('s').to_numpy(dtype=object)
+
+
+def entradas_largas(filas, ranuras, ots, nodos, claves, cantidades, enteras, barrios=None):
+    """
+    Arma las columnas del formato largo (una entrada por material y nodo) a partir de arreglos paralelos.
+
+    `fila`/`ranura` guardan la posición de la celda de origen para poder reproducir el
+    orden en que el recorrido fila a fila insertaba cada material. `barrio` es el código
+    del barrio normalizado de la fila (-1 para entradas que no se reportan por barrio).
+    """
+    return {
+        'fila': np.asarray(filas, dtype=np.intp),
+        'ranura': np.asarray(ranuras, dtype=np.intp),
+        'ot': np.asarray(ots, dtype=np.intp),
+        'nodo': np.asarray(nodos, dtype=object),
+        'clave': claves if isinstance(claves, np.ndarray) else arreglo_claves(claves),
+        'cantidad': np.asarray(cantidades, dtype=float),
+        'entera': np.full(len(filas), enteras, dtype=bool),
+        'barrio': np.full(len(filas), -1, dtype=np.intp) if barrios is None else np.asarray(barrios, dtype=np.intp),
+    }
+
+
+def ordenar_entradas(partes, nodo_ot):
+    """
+    Une las entradas en un frame largo ordenado como las visitaba el recorrido fila a fila.
+
+    `nodo_ot` es el código por fila de la combinación (OT, nodo); junto con el código
+    de la clave permite agrupar sobre enteros en lugar de volver a factorizar textos.
+    """
+    partes = [p for p in partes if len(p['fila'])]
+    if not partes:
+        return None
+    columnas = {nombre: np.concatenate([p[nombre] for p in partes]) for nombre in partes[0]}
+    orden = np.lexsort((columnas['ranura'], columnas['fila']))
+    largo = pd.DataFrame({nombre: valores[orden] for nombre, valores in columnas.items()})
+    largo['nodo_ot'] = nodo_ot[largo['fila'].to_numpy()]
+    largo['clave_codigo'] = pd.factorize(largo['clave'].to_numpy())[0]
+    return largo
+
+
+def acumular_cantidades(largo, ots, datos, campo):
+    """Suma las cantidades del frame largo por (ot, clave, nodo) y las acumula en el campo `campo` de cada OT."""
+    primeras, totales = sumar_por_grupo(
+        largo['cantidad'].to_numpy(), largo['entera'].to_numpy(),
+        largo['nodo_ot'].to_numpy(), largo['clave_codigo'].to_numpy()
+    )
+    for ot_codigo, clave, nodo, total in zip(largo['ot'].to_numpy()[primeras].tolist(),
+                                             largo['clave'].to_numpy()[primeras].tolist(),
+                                             largo['nodo'].to_numpy()[primeras].tolist(), totales):
+        getattr(datos[ots[ot_codigo]], campo)[clave][nodo] += total
+
+
+def acumular_aspectos(largo, aspecto_codigos, aspectos, ots, datos, campo):
+    """Agrega los aspectos válidos de cada entrada (sin repetir) en el campo `campo` de cada OT."""
+    aspecto_arr = aspecto_codigos[largo['fila'].to_numpy()]
+    con_aspecto = np.flatnonzero(aspecto_arr >= 0)
+    if not len(con_aspecto):
+        return
+    aspecto_arr = aspecto_arr[con_aspecto]
+    grupo = codigos_de_grupo(largo['nodo_ot'].to_numpy()[con_aspecto],
+                             largo['clave_codigo'].to_numpy()[con_aspecto], aspecto_arr)
+    primeras = con_aspecto[primeras_apariciones(grupo)]
+    for ot_codigo, clave, nodo, aspecto_codigo in zip(largo['ot'].to_numpy()[primeras].tolist(),
+                                                      largo['clave'].to_numpy()[primeras].tolist(),
+                                                      largo['nodo'].to_numpy()[primeras].tolist(),
+                                                      aspecto_codigos[largo['fila'].to_numpy()[primeras]].tolist()):
+        getattr(datos[ots[ot_codigo]], campo)[clave][nodo].add(aspectos[aspecto_codigo])
+
+
+def acumular_por_barrio(largo, barrios, ots, datos_por_barrio):
+    """
+    Suma las cantidades del frame largo por (barrio, clave, ot) en `datos_por_barrio`.
+
+    Las claves de tipo MATERIAL_RETIRADO se acumulan en 'materiales_retirados' y el resto en
+    'materiales_instalados'.
+    """
+    barrio_arr = largo['barrio'].to_numpy()
+    claves = largo['clave'].to_numpy()
+    ot_arr = largo['ot'].to_numpy()
+    primeras, totales = sumar_por_grupo(
+        largo['cantidad'].to_numpy(), largo['entera'].to_numpy(),
+        barrio_arr, largo['clave_codigo'].to_numpy(), ot_arr
+    )
+    for barrio_codigo, clave, ot_codigo, total in zip(barrio_arr[primeras].tolist(), claves[primeras].tolist(),
+                                                      ot_arr[primeras].tolist(), totales):
+        seccion = 'materiales_retirados' if clave.tipo == 'MATERIAL_RETIRADO' else 'materiales_instalados'
+        getattr(datos_por_barrio[barrios[barrio_codigo]], seccion)[clave][ots[ot_codigo]] += total
+
+
+def normalizar_nodos(serie, ot_codigos, ots, counter_0):
+    """
+    Normaliza el nodo de cada fila quitando espacios, guiones y sufijos '.0'.
+
+    Los nodos vacíos o en cero se reemplazan por '0_<OT>_<contador>', llevando la
+    cuenta por OT en `counter_0` (compartido entre hojas del mismo archivo).
+
+    Returns:
+        np.ndarray con el nodo de cada fila
+    """
+    originales = [
+        str(valor).strip().replace(' ', '').replace('-', '').upper()
+        for valor in serie.to_numpy(dtype=object)
+    ]
+    # Normalizar nodos con valor 0 o similares
+    es_cero = np.isin(
+        np.array(originales, dtype=object),
+        ['0', '0.0', '0.00', 'nan', 'NaN', 'None', '', 'NO', 'NO APLICA']
+    )
+    # Normalizar el formato del nodo para evitar duplicados por formato
+    nodos = np.array([original.replace('.0', '').replace('.00', '') for original in originales], dtype=object)
+    for pos in np.flatnonzero(es_cero).tolist():
+        # Usar un formato consistente para todos los nodos "0"
+        ot = ots[ot_codigos[pos]]
+        counter_0[ot] += 1
+        nodos[pos] = f"0_{ot}_{counter_0[ot]}"  # Formato: 0_OT_contador
+    return nodos
+
+
+def barrios_por_fila(df):
+    """
+    Normaliza cada barrio distinto una sola vez.
+
+    Returns:
+        tuple: (np.ndarray con el código de barrio de cada fila, lista de barrios normalizados)
+    """
+    if "3.Barrio" not in df.columns:
+        return np.zeros(len(df), dtype=np.intp), [normalizar_barrio("")]
+    # `normalizar_barrio` trabaja sobre str(barrio), así que basta con un cálculo por texto
+    barrio_codigos, textos = factorizar_textos(df["3.Barrio"].to_numpy(dtype=object))
+    return barrio_codigos, [normalizar_barrio(texto) for texto in textos]
+
+
+def derretir_pares(df, pares):
+    """
+    Pasa los pares (material, cantidad) a formato largo: una entrada por celda con
+    material y cantidad positiva, en orden fila a fila y par a par.
+
+    Returns:
+        tuple: (filas, posición del par, cantidades float, código del material de
+        cada entrada, nombres de material distintos en mayúsculas)
+    """
+    materiales_arr = df[[mat_col for mat_col, _ in pares]].to_numpy(dtype=object)
+    cantidades_arr = df[[cant_col for _, cant_col in pares]].to_numpy(dtype=object)
+    filas, cols = np.nonzero(pd.notna(materiales_arr) & pd.notna(cantidades_arr))
+    cantidades = cantidades_float(cantidades_arr[filas, cols])
+    positivas = cantidades > 0.0
+    filas, cols, cantidades = filas[positivas], cols[positivas], cantidades[positivas]
+    # Normalizar cada nombre de material distinto una sola vez
+    material_codigos, textos = factorizar_textos(materiales_arr[filas, cols])
+    return filas, cols, cantidades, material_codigos, [texto.strip().upper() for texto in textos]
+
+
+def registrar_codigos_instalados(partes_codigos, ots, datos, nodos_con_codigos):
+    """
+    Vuelca los códigos N1/N2 instalados en `OrdenTrabajo.codigos_n*` y en `nodos_con_codigos`.
+
+    Cada parte es un frame con las columnas fila, orden, posicion, ot, nodo, clave,
+    codigo y potencia; se recorren por (fila, orden) como lo hacía el bucle por filas.
+    """
+    codigos_largo = pd.concat(partes_codigos, ignore_index=True).sort_values(['fila', 'orden'], kind='stable')
+    for posicion, ot_codigo, nodo, clave, codigo_str, potencia_val in zip(
+        codigos_largo['posicion'].tolist(), codigos_largo['ot'].tolist(), codigos_largo['nodo'].tolist(),
+        codigos_largo['clave'].tolist(), codigos_largo['codigo'].tolist(), codigos_largo['potencia'].tolist()
+    ):
+        ot = ots[ot_codigo]
+        getattr(datos[ot], f'codigos_{posicion}')[clave][nodo].add(codigo_str)
+        # Guardar el código y potencia para este nodo (para usar más tarde)
+        nodos_con_codigos[ot][nodo][posicion] = {
+            'codigo': codigo_str,
+            'potencia': potencia_val
+        }
+
+
+def procesar_archivo_modernizacion(file: UploadFile):
+    try:
+        libro = abrir_libro(file.filename, file.file)
+        
+        datos = ordenes_trabajo()
+        datos_por_barrio = materiales_por_barrio()
         dfs_originales = {}
         counter_0 = defaultdict(int)
-        # Configurar columnas         
-        COL_INICIO = "BH"
-        COL_FIN = "BO"
-        idx_inicio = column_index_from_string(COL_INICIO) - 1
-        idx_fin = column_index_from_string(COL_FIN) - 1
-        
-        # Diccionario para normalizar nodos
-        nodos_normalizados = {}
-        
+
         # Diccionarios para rastrear nodos con códigos y brazos
         nodos_con_codigos = defaultdict(lambda: defaultdict(dict))  # Estructura: ot -> nodo -> {'n1': {'codigo': X, 'potencia': Y}, 'n2': {...}}
         nodos_con_brazos = defaultdict(dict)
-        
-        for hoja in xls.sheet_names:
-            df = xls.parse(hoja)
-            
-            # Validar columnas requeridas
-            required_columns = {
-                "2.Nro de O.T.", "1.NODO DEL POSTE.",
-                "2.CODIGO DE LUMINARIA INSTALADA N1.", "3.POTENCIA DE LUMINARIA INSTALADA (W)",
-                "6.CODIGO DE LUMINARIA INSTALADA N2.", "7.POTENCIA DE LUMINARIA INSTALADA (W)",
-                "1. Describa Aspectos que Considere se deben tener en cuenta.",
-                "FechaSincronizacion"
-            }
-            if not required_columns.issubset(df.columns):
-                continue          
-            
+
+        for hoja in libro.hojas:
+            # Validar columnas requeridas mirando solo los encabezados, sin cargar las filas
+            encabezado = libro.encabezado(hoja)
+            plan = plan_modernizacion(tuple(encabezado))
+            if not plan.valida:
+                continue
+            if plan.seleccion is not None:
+                df = leer_hoja(libro, hoja, encabezado, plan.seleccion)
+            else:
+                # El bloque BH..BO se toma por posición: si los encabezados no llegan hasta BO,
+                # se carga la hoja completa porque las columnas sin encabezado también cuentan
+                df = libro.leer(hoja)
+                plan = plan_modernizacion(tuple(df.columns))
+
             dfs_originales[hoja] = df
             # Parsear y ordenar por FechaSincronizacion
             df['FechaSincronizacion'] = (
@@ -1563,278 +2747,177 @@ def procesar_archivo_modernizacion(file: UploadFile):
                 errors='coerce'
             )
             df = df.sort_values(by='FechaSincronizacion', ascending=True)
-            # PROCESAR MATERIALES RETIRADOS
-            pattern_codigo = re.compile(r'^\d+\.CODIGO DE (LUMINARIA|BOMBILLA|FOTOCELDA) RETIRADA (N\d+)\.?$', re.IGNORECASE)
-            pattern_potencia = re.compile(r'^\d+\.POTENCIA DE (LUMINARIA|BOMBILLA) RETIRADA (N\d+)\.?\(W\)$', re.IGNORECASE)
-            
-            codigo_columns = {}
-            potencia_columns = {}
-            
-            for col in df.columns:
-                col_str = str(col).strip()
-                # PORECESAR CODIGOS RETIRADA
-                codigo_match = pattern_codigo.match(col_str)
-                if codigo_match:
-                    tipo = codigo_match.group(1).upper()
-                    n = codigo_match.group(2).upper()
-                    codigo_columns[(tipo, n)] = col_str
-                else:
-                    # PROCESAR COLUMNAS POTENCIA
-                    potencia_match = pattern_potencia.match(col_str)
-                    if potencia_match:
-                        tipo = potencia_match.group(1).upper()
-                        n = potencia_match.group(2).upper()
-                        potencia_columns[(tipo, n)] = col_str
-            
-            # ========== PROCESAR MATERIALES ORIGINALES (MATERIAL X - CANTIDAD X) ==========
-            material_cols = [col for col in df.columns if re.match(r'^(MATERIAL|Material)\s\d+$', col)]
-            cantidad_cols = [col for col in df.columns if re.match(r'^(CANTIDAD MATERIAL|CANTIDAD DE MATERIAL)\s\d+$', col)]
-            
-            columnas_bh_bo = []
-            if len(df.columns) > idx_fin:
-                columnas_bh_bo = df.columns[idx_inicio : idx_fin + 1]
-                        
-            for _, fila in df.iterrows():
-                ot = fila["2.Nro de O.T."]   
-                
-                barrio = fila.get("3.Barrio", "")
-                barrio_normalizado = normalizar_barrio(barrio)
-                                     
-                original_nodo = str(fila["1.NODO DEL POSTE."]).strip().replace(' ', '').replace('-', '').upper()
-                
-                # Guardar la fecha de sincronización para este nodo/registro
-                fecha_sincronizacion = fila["FechaSincronizacion"]
-    
-                # Normalizar nodos con valor 0 o similares
-                if original_nodo in ['0', '0.0', '0.00', 'nan', 'NaN', 'None', '', 'NO', 'NO APLICA']:
-                    # Usar un formato consistente para todos los nodos "0"
-                    counter_0[ot] += 1
-                    nodo = f"0_{ot}_{counter_0[ot]}"  # Formato: 0_OT_contador
-                else:
-                    # Normalizar el formato del nodo para evitar duplicados por formato
-                    nodo_normalizado = original_nodo.replace('.0', '').replace('.00', '')
-                    
-                    # Verificar si este nodo ya ha sido normalizado antes
-                    if (ot, nodo_normalizado) in nodos_normalizados:
-                        nodo = nodos_normalizados[(ot, nodo_normalizado)]
-                    else:
-                        count = datos[ot]['nodo_counts'][nodo_normalizado] + 1
-                        datos[ot]['nodo_counts'][nodo_normalizado] = count
-                        nodo = f"{nodo_normalizado}_{count}" if count > 1 else nodo_normalizado
-                        nodos_normalizados[(ot, nodo_normalizado)] = nodo
-                
-                datos[ot]['nodos'].append(nodo)
-                
-                # Guardar la fecha de sincronización para este nodo
-                if pd.notna(fecha_sincronizacion):
-                    datos[ot]['fechas_sync'][nodo] = fecha_sincronizacion.strftime('%d/%m/%Y %H:%M:%S')
-                else:
-                    datos[ot]['fechas_sync'][nodo] = "Sin fecha"
-                
-                # Capturar el tipo de suelo si existe la columna
-                if "2.Tipo de Suelo" in df.columns:
-                    tipo_suelo = fila.get("2.Tipo de Suelo", "")
-                    if pd.notna(tipo_suelo):
-                        datos[ot]['tipos_suelo'][nodo] = str(tipo_suelo).strip()
-                                    
-                codigo_n1 = fila["2.CODIGO DE LUMINARIA INSTALADA N1."]
-                potencia_n1 = fila["3.POTENCIA DE LUMINARIA INSTALADA (W)"]
-                
-                codigo_n2 = fila["6.CODIGO DE LUMINARIA INSTALADA N2."]
-                potencia_n2 = fila["7.POTENCIA DE LUMINARIA INSTALADA (W)"]
-                
-                for col in columnas_bh_bo:
-                    cantidad = fila[col]
-                    # Limpiar NaN y convertir a 0
-                    if pd.isna(cantidad):
-                        cantidad = 0
-                    else:
-                        cantidad = int(cantidad)  # Asegurar entero
-                    #if pd.notna(cantidad) and float(cantidad) > 0:
-                    if cantidad > 0:
-                        nombre_material = str(col).split('.', 1)[-1].strip().upper()
-                        key = f"MATERIAL_RETIRADO|{nombre_material}"
-                        datos[ot]['materiales_retirados'][key][nodo] += cantidad
-                
-                        # Capture aspect here
-                        aspecto = fila["1. Describa Aspectos que Considere se deben tener en cuenta."]
-                        if pd.notna(aspecto):
-                            aspecto_limpio = str(aspecto).strip().upper()
-                            if aspecto_limpio not in ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']:
-                                datos[ot]['aspectos_retirados'][key][nodo].add(aspecto_limpio)
-                    
-                    if pd.notna(cantidad) and float(cantidad) > 0:
-                        nombre_material = str(col).split('.', 1)[-1].strip().upper()
+            n_filas = len(df)
+            if n_filas == 0:
+                continue
+            columnas_bh_bo = plan.bloque_retirados
 
-                        # Capturar postes
-                        if "POSTE" in nombre_material:
-                            tipo_poste = "CONCRETO" if "CONCRETO" in nombre_material else \
-                                        "METALICO" if "METALICO" in nombre_material else \
-                                        "FIBRA" if "FIBRA" in nombre_material else "OTRO"
+            # ========== OT, NODO Y DATOS POR FILA ==========
+            ot_codigos, ots = factorizar_por_fila(df["2.Nro de O.T."])
 
-                            # Extraer altura usando regex
-                            altura_match = re.search(r'(\d+)\s*MTS?', nombre_material)
-                            altura = int(altura_match.group(1)) if altura_match else 0
+            nodos = normalizar_nodos(df["1.NODO DEL POSTE."], ot_codigos, ots, counter_0)
+            nodo_ot = codigos_de_grupo(ot_codigos, nodos)
 
-                            key = f"POSTE|{tipo_poste}|{altura}M"
-                            datos[ot]['materiales'][key][nodo] += cantidad
-                    
-                # SECCIÓN MEJORADA: Procesar códigos N1 y N2 para que sean accesibles para las funciones de mano de obra
-                # Procesar código N1
-                if pd.notna(codigo_n1) and str(codigo_n1).strip() not in ['', '0', '0.0']:
-                    try:
-                        potencia_val = 0
-                        if pd.notna(potencia_n1) and str(potencia_n1) != "0":
-                            try:
-                                potencia_val = float(potencia_n1)
-                            except:
-                                pass
-                        
-                        if potencia_val == 0:
-                            key = "CODIGO 1 LUMINARIA INSTALADA"
-                        else:
-                            if potencia_val.is_integer():
-                                key = f"CODIGO 1 LUMINARIA INSTALADA {int(potencia_val)} W"
-                            else:
-                                key = f"CODIGO 1 LUMINARIA INSTALADA {potencia_val} W"
-                        
-                        # Asegurar que el código se almacene como string y en mayúsculas
-                        codigo_str = str(codigo_n1).strip().upper()
-                        datos[ot]['codigos_n1'][key][nodo].add(codigo_str)
-                        
-                        # Guardar el código y potencia para este nodo (para usar más tarde)
-                        nodos_con_codigos[ot][nodo]['n1'] = {
-                            'codigo': codigo_str,
-                            'potencia': potencia_val
-                        }
-                        
-                    except Exception as e:
-                        # Registrar el error pero continuar con el procesamiento
-                        print(f"Error procesando código N1: {str(e)}")
-                
-                # Procesar código N2
-                if pd.notna(codigo_n2) and str(codigo_n2).strip() not in ['', '0', '0.0']:
-                    try:
-                        potencia_val = 0
-                        if pd.notna(potencia_n2) and str(potencia_n2) != "0":
-                            try:
-                                potencia_val = float(potencia_n2)
-                            except:
-                                pass
-                        
-                        if potencia_val == 0:
-                            key = "CODIGO 2 LUMINARIA INSTALADA"
-                        else:
-                            if potencia_val.is_integer():
-                                key = f"CODIGO 2 LUMINARIA INSTALADA {int(potencia_val)} W"
-                            else:
-                                key = f"CODIGO 2 LUMINARIA INSTALADA {potencia_val} W"
-                        
-                        # Asegurar que el código se almacene como string y en mayúsculas
-                        codigo_str = str(codigo_n2).strip().upper()
-                        datos[ot]['codigos_n2'][key][nodo].add(codigo_str)
-                        
-                        # Guardar el código y potencia para este nodo (para usar más tarde)
-                        nodos_con_codigos[ot][nodo]['n2'] = {
-                            'codigo': codigo_str,
-                            'potencia': potencia_val
-                        }
-                        
-                    except Exception as e:
-                        # Registrar el error pero continuar con el procesamiento
-                        print(f"Error procesando código N2: {str(e)}")
-                
-                # PROCESAR MATERIALES RETIRADOS
-                for (tipo, n), col_codigo in codigo_columns.items():
-                    codigo_val = fila.get(col_codigo)
-                    col_potencia = None
-                    potencia_val = None
-
-                    if tipo in ['LUMINARIA', 'BOMBILLA']:
-                        col_potencia = potencia_columns.get((tipo, n), None)
-                        if col_potencia:
-                            potencia_val = fila.get(col_potencia)
-                    
-                    codigo_es_valido = (
-                        pd.notna(codigo_val)
-                        and str(codigo_val).strip() not in ['', '0', '0.0']
-                    )
-                    
-                    potencia_es_valida = False
-                    if col_potencia and pd.notna(potencia_val):
-                        try: 
-                            potencia_float = float(potencia_val)
-                            potencia_es_valida = potencia_float > 0
-                        except:
-                            pass
-                    
-                    if codigo_es_valido or potencia_es_valida:
-                        if tipo == 'FOTOCELDA':
-                            entry_name = f"FOTOCELDA RETIRADA {n}"
-                        else:
-                            potencia_str = ""
-                            if potencia_es_valida:
-                                potencia_str = (
-                                    f"{int(potencia_float)}W"
-                                    if potencia_float.is_integer()
-                                    else f"{potencia_float}W"
-                                )                                               
-    
-                            if potencia_str:
-                                entry_name = f"{tipo} RETIRADA {n} {potencia_str}".strip()
-                            else:
-                                entry_name = f"{tipo} RETIRADA {n}".strip()
-                                
-                        key = f"MATERIAL_RETIRADO|{entry_name}"
-                        datos[ot]['materiales_retirados'][key][nodo] += 1
-                        aspecto = fila["1. Describa Aspectos que Considere se deben tener en cuenta."]
-                        if pd.notna(aspecto):
-                            aspecto_limpio = str(aspecto).strip().upper()
-                            if aspecto_limpio not in ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']:  # Filtrar valores no válidos
-                                datos[ot]['aspectos_retirados'][key][nodo].add(aspecto_limpio)  
-                
-                # Procesar materiales INSTALADOS
-                for mat_col, cant_col in zip(material_cols, cantidad_cols):
-                    material = fila[mat_col]
-                    cantidad = fila[cant_col]
-                    if pd.notna(material) and pd.notna(cantidad) and float(cantidad) > 0.0:
-                        material_str = str(material).strip().upper()
-                        key = f"MATERIAL|{material_str}"
-                        
-                        # Convertir cantidad a float y redondear si es necesario
-                        cantidad_float = float(cantidad)
-                        
-                        # Registrar brazos instalados para este nodo
-                        if "BRAZO" in material_str:
-                            # Extraer longitud del brazo si está disponible
-                            longitud_match = re.search(r'(\d+(?:\.\d+)?)\s*M', material_str)
-                            longitud = float(longitud_match.group(1)) if longitud_match else 0
-                            
-                            # Guardar información del brazo para este nodo
-                            if nodo not in nodos_con_brazos[ot]:
-                                nodos_con_brazos[ot][nodo] = []
-                            
-                            # Redondear la cantidad si no es un entero
-                            cantidad_redondeada = round(cantidad_float)
-                            
-                            # Guardar información del brazo (descripción, longitud, cantidad)
-                            nodos_con_brazos[ot][nodo].append({
-                                'descripcion': material_str,
-                                'longitud': longitud,
-                                'cantidad': cantidad_redondeada if cantidad_redondeada > 0 else 1  # Asegurar al menos 1
-                            })
-                        
-                        # Solo agregar materiales que no sean LUMINARIA N1 o N2
-                        if not (material_str.startswith("LUMINARIA N1") or material_str.startswith("LUMINARIA N2")):
-                            datos[ot]['materiales'][key][nodo] += cantidad_float
-                            datos_por_barrio[barrio_normalizado]['materiales_instalados'][key][ot] += cantidad_float
-                            aspecto = fila["1. Describa Aspectos que Considere se deben tener en cuenta."]
-                            if pd.notna(aspecto):
-                                aspecto_limpio = str(aspecto).strip().upper()
-                                if aspecto_limpio not in ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']:  # Filtrar valores no válidos
-                                    datos[ot]['aspectos_materiales'][key][nodo].add(aspecto_limpio)
+            fechas = fechas_sync(df["FechaSincronizacion"])
+            aspecto_codigos, aspectos = limpiar_aspectos(df["1. Describa Aspectos que Considere se deben tener en cuenta."])
+
+            barrio_codigos, barrios = barrios_por_fila(df)
+
+            tiene_suelo = "2.Tipo de Suelo" in df.columns
+            if tiene_suelo:
+                suelos = df["2.Tipo de Suelo"].to_numpy(dtype=object)
+                suelo_presente = pd.notna(suelos)
+                suelos = np.array([str(suelo).strip() for suelo in suelos], dtype=object)
+
+            for filas_ot in grupos_por_codigo(ot_codigos):
+                info = datos[ots[ot_codigos[filas_ot[0]]]]
+                nodos_ot = nodos[filas_ot].tolist()
+                info.agregar_nodos(nodos_ot)
+                # Guardar la fecha de sincronización para cada nodo (prevalece la última fila)
+                info.registrar_datos_nodo('fecha_sync', zip(nodos_ot, fechas[filas_ot].tolist()))
+                # Capturar el tipo de suelo si existe la columna
+                if tiene_suelo:
+                    con_suelo = filas_ot[suelo_presente[filas_ot]]
+                    info.registrar_datos_nodo('tipo_suelo', zip(nodos[con_suelo].tolist(), suelos[con_suelo].tolist()))
+
+            instalados = []
+            retirados = []
+
+            # ========== BLOQUE BH..BO (RETIRADOS Y POSTES) ==========
+            if len(columnas_bh_bo):
+                bloque = np.column_stack([cantidades_enteras(df[col]) for col in columnas_bh_bo])
+                filas, cols = np.nonzero(bloque > 0)
+                cantidades = bloque[filas, cols]
+                nombres = [str(col).split('.', 1)[-1].strip().upper() for col in columnas_bh_bo]
+                claves_ret = arreglo_claves([clave_material("MATERIAL_RETIRADO", nombre) for nombre in nombres])
+                retirados.append(entradas_largas(
+                    filas, cols, ot_codigos[filas], nodos[filas], claves_ret[cols], cantidades, enteras=True
+                ))
+
+                # Capturar postes
+                claves_poste = []
+                for nombre_material in nombres:
+                    if "POSTE" not in nombre_material:
+                        claves_poste.append(None)
+                        continue
+                    tipo_poste = "CONCRETO" if "CONCRETO" in nombre_material else \
+                                "METALICO" if "METALICO" in nombre_material else \
+                                "FIBRA" if "FIBRA" in nombre_material else "OTRO"
+                    # Extraer altura usando regex
+                    altura_match = re.search(r'(\d+)\s*MTS?', nombre_material)
+                    altura = int(altura_match.group(1)) if altura_match else 0
+                    claves_poste.append(clave_material("POSTE", tipo_poste, f"{altura}M"))
+                es_poste = np.array([clave is not None for clave in claves_poste], dtype=bool)[cols]
+                claves_poste = arreglo_claves(claves_poste)
+                instalados.append(entradas_largas(
+                    filas[es_poste], cols[es_poste], ot_codigos[filas[es_poste]], nodos[filas[es_poste]],
+                    claves_poste[cols[es_poste]], cantidades[es_poste], enteras=True
+                ))
+            ranura_base = len(columnas_bh_bo)
+
+            # ========== CÓDIGOS RETIRADOS ==========
+            for k, (tipo, n, col_codigo, col_potencia) in enumerate(plan.codigos_retirados):
+                if col_codigo is None:
+                    codigo_valido = np.zeros(n_filas, dtype=bool)
+                else:
+                    codigo_valido, _ = codigos_informados(df[col_codigo])
+                potencia_float = potencias_float(df[col_potencia] if col_potencia else None, n_filas)
+                potencia_valida = potencia_float > 0
+                filas = np.flatnonzero(codigo_valido | potencia_valida)
+                if not len(filas):
+                    continue
+                if tipo == 'FOTOCELDA':
+                    claves = [clave_material("MATERIAL_RETIRADO", f"FOTOCELDA RETIRADA {n}")] * len(filas)
+                else:
+                    claves = [
+                        clave_material("MATERIAL_RETIRADO", f"{tipo} RETIRADA {n} {formatear_potencia_retirada(p)}") if valida
+                        else clave_material("MATERIAL_RETIRADO", f"{tipo} RETIRADA {n}")
+                        for p, valida in zip(potencia_float[filas].tolist(), potencia_valida[filas].tolist())
+                    ]
+                retirados.append(entradas_largas(
+                    filas, np.full(len(filas), ranura_base + k), ot_codigos[filas], nodos[filas],
+                    claves, np.ones(len(filas)), enteras=True
+                ))
+
+            # ========== CÓDIGOS N1 Y N2 INSTALADOS ==========
+            # Procesar códigos N1 y N2 para que sean accesibles para las funciones de mano de obra
+            partes_codigos = []
+            for orden, (posicion, col_codigo, col_potencia, prefijo) in enumerate((
+                ('n1', "2.CODIGO DE LUMINARIA INSTALADA N1.", "3.POTENCIA DE LUMINARIA INSTALADA (W)", "CODIGO 1 LUMINARIA INSTALADA"),
+                ('n2', "6.CODIGO DE LUMINARIA INSTALADA N2.", "7.POTENCIA DE LUMINARIA INSTALADA (W)", "CODIGO 2 LUMINARIA INSTALADA"),
+            )):
+                validos, limpios = codigos_informados(df[col_codigo])
+                filas = np.flatnonzero(validos)
+                potencias = aplicar_por_valor(df[col_potencia].to_numpy(dtype=object)[filas], potencia_instalada)
+                partes_codigos.append(pd.DataFrame({
+                    'fila': filas,
+                    'orden': orden,
+                    'posicion': posicion,
+                    'ot': ot_codigos[filas],
+                    'nodo': nodos[filas],
+                    'clave': aplicar_por_valor(potencias, lambda p: clave_codigo_instalado(prefijo, p)),
+                    # Asegurar que el código se almacene como string y en mayúsculas
+                    'codigo': [codigo.upper() for codigo in limpios[filas].tolist()],
+                    'potencia': potencias,
+                }))
+            registrar_codigos_instalados(partes_codigos, ots, datos, nodos_con_codigos)
+
+            # ========== MATERIALES INSTALADOS (MATERIAL X - CANTIDAD X) ==========
+            pares = plan.pares
+            if pares:
+                # "Derretir" los pares MATERIAL/CANTIDAD a formato largo (fila, par)
+                filas, cols, cantidades, material_codigos, nombres = derretir_pares(df, pares)
+                material_str = np.array(nombres, dtype=object)[material_codigos]
+
+                # Registrar brazos instalados para cada nodo
+                es_brazo = np.array(["BRAZO" in nombre for nombre in nombres], dtype=bool)[material_codigos]
+                for fila, descripcion, cantidad_float in zip(
+                    filas[es_brazo].tolist(), material_str[es_brazo].tolist(), cantidades[es_brazo].tolist()
+                ):
+                    ot = ots[ot_codigos[fila]]
+                    nodo = nodos[fila]
+                    # Extraer longitud del brazo si está disponible
+                    longitud_match = re.search(r'(\d+(?:\.\d+)?)\s*M', descripcion)
+                    longitud = float(longitud_match.group(1)) if longitud_match else 0
+                    if nodo not in nodos_con_brazos[ot]:
+                        nodos_con_brazos[ot][nodo] = []
+                    # Redondear la cantidad si no es un entero
+                    cantidad_redondeada = round(cantidad_float)
+                    # Guardar información del brazo (descripción, longitud, cantidad)
+                    nodos_con_brazos[ot][nodo].append({
+                        'descripcion': descripcion,
+                        'longitud': longitud,
+                        'cantidad': cantidad_redondeada if cantidad_redondeada > 0 else 1  # Asegurar al menos 1
+                    })
+
+                # Solo agregar materiales que no sean LUMINARIA N1 o N2
+                incluir = np.array([
+                    not (nombre.startswith("LUMINARIA N1") or nombre.startswith("LUMINARIA N2")) for nombre in nombres
+                ], dtype=bool)[material_codigos]
+                claves = arreglo_claves([clave_material("MATERIAL", nombre) for nombre in nombres])[material_codigos]
+                filas, cols = filas[incluir], cols[incluir]
+                instalados.append(entradas_largas(
+                    filas, ranura_base + cols, ot_codigos[filas], nodos[filas], claves[incluir],
+                    cantidades[incluir], enteras=False, barrios=barrio_codigos[filas],
+                ))
+
+            # ========== VOLCADO AGRUPADO EN LAS ESTRUCTURAS DE SALIDA ==========
+            retirados = ordenar_entradas(retirados, nodo_ot)
+            if retirados is not None:
+                acumular_cantidades(retirados, ots, datos, 'materiales_retirados')
+                acumular_aspectos(retirados, aspecto_codigos, aspectos, ots, datos, 'aspectos_retirados')
+
+            instalados = ordenar_entradas(instalados, nodo_ot)
+            if instalados is not None:
+                acumular_cantidades(instalados, ots, datos, 'materiales')
+                # Solo los pares MATERIAL/CANTIDAD llevan barrio y aspectos (los postes del bloque BH..BO no)
+                pares_largo = instalados[instalados['barrio'].to_numpy() >= 0]
+                if len(pares_largo):
+                    acumular_por_barrio(pares_largo, barrios, ots, datos_por_barrio)
+                    acumular_aspectos(pares_largo, aspecto_codigos, aspectos, ots, datos, 'aspectos_materiales')
         
         # Procesar nodos con códigos y brazos para crear entradas de luminarias instaladas
+        nodos_sin_brazos = 0
         for ot in datos:
             # Obtener nodos con códigos para esta OT
             nodos_codigos = nodos_con_codigos.get(ot, {})
@@ -1858,11 +2941,11 @@ def procesar_archivo_modernizacion(file: UploadFile):
                         # Contar cuántos códigos hay en esta posición
                         # Necesitamos acceder a los códigos reales desde los datos originales
                         if posicion == 'n1':
-                            for key_codigo, nodos_valores in datos[ot]['codigos_n1'].items():
+                            for key_codigo, nodos_valores in datos[ot].codigos_n1.items():
                                 if nodo in nodos_valores:
                                     total_codigos_luminarias += len(nodos_valores[nodo])
                         elif posicion == 'n2':
-                            for key_codigo, nodos_valores in datos[ot]['codigos_n2'].items():
+                            for key_codigo, nodos_valores in datos[ot].codigos_n2.items():
                                 if nodo in nodos_valores:
                                     total_codigos_luminarias += len(nodos_valores[nodo])
 
@@ -1889,20 +2972,20 @@ def procesar_archivo_modernizacion(file: UploadFile):
                             # Crear descripción de la luminaria con la cantidad total
                             descripcion = f"LUMINARIA CODIGO/BRAZO {potencia_str}"
                             # Crear clave para el material
-                            key = f"MATERIAL|{descripcion}"
+                            key = clave_material("MATERIAL", descripcion)
 
                             # CORRECCIÓN PRINCIPAL: Usar la cantidad total de códigos
                             cantidad_a_instalar = total_codigos_luminarias
 
                             # Agregar la luminaria como material instalado
-                            datos[ot]['materiales'][key][nodo] = cantidad_a_instalar
+                            datos[ot].materiales[key][nodo] = cantidad_a_instalar
 
                             # Agregar aspecto con información detallada
                             todos_los_codigos = []
-                            for key_codigo, nodos_valores in datos[ot]['codigos_n1'].items():
+                            for key_codigo, nodos_valores in datos[ot].codigos_n1.items():
                                 if nodo in nodos_valores:
                                     todos_los_codigos.extend(list(nodos_valores[nodo]))
-                            for key_codigo, nodos_valores in datos[ot]['codigos_n2'].items():
+                            for key_codigo, nodos_valores in datos[ot].codigos_n2.items():
                                 if nodo in nodos_valores:
                                     todos_los_codigos.extend(list(nodos_valores[nodo]))
 
@@ -1911,81 +2994,62 @@ def procesar_archivo_modernizacion(file: UploadFile):
                             aspecto += f", cantidad total: {cantidad_a_instalar} luminaria(s)"
                             aspecto += f" (Total códigos en nodo: {total_codigos_luminarias}, Total brazos: {total_brazos})"
 
-                            datos[ot]['aspectos_materiales'][key][nodo].add(aspecto)
+                            datos[ot].aspectos_materiales[key][nodo].add(aspecto)
 
                             # Actualizar el contador por potencia para estadísticas
                             luminarias_por_potencia[potencia_str] += cantidad_a_instalar
 
                             # Imprimir información de depuración
-                            print(f"INFO: Nodo {nodo} en OT {ot} - Instaladas {cantidad_a_instalar} luminarias con potencia {potencia_str}")
+                            logger.debug("Nodo %s en OT %s - Instaladas %s luminarias con potencia %s", nodo, ot, cantidad_a_instalar, potencia_str)
                             #print(f"      Códigos: {', '.join(codigos_lista)}")
-                            print(f"      Total códigos en nodo: {total_codigos_luminarias}")
-                            print(f"      Total brazos disponibles: {total_brazos}")
+                            logger.debug("Total códigos en nodo: %s", total_codigos_luminarias)
+                            logger.debug("Total brazos disponibles: %s", total_brazos)
                     else:
-                        print(f"ADVERTENCIA: Nodo {nodo} en OT {ot} - Insuficientes brazos ({total_brazos}) para códigos ({total_codigos_luminarias})")
+                        nodos_sin_brazos += 1
+                        logger.debug("Nodo %s en OT %s - Insuficientes brazos (%s) para códigos (%s)", nodo, ot, total_brazos, total_codigos_luminarias)
 
                 # Imprimir resumen de luminarias por potencia para esta OT
-                if luminarias_por_potencia:
-                    print(f"\nResumen de luminarias instaladas para OT {ot}:")
-                    for potencia, cantidad in luminarias_por_potencia.items():
-                        print(f"  - LUMINARIA CODIGO/BRAZO {potencia}: {cantidad} unidad(es)")
-                        
+                if luminarias_por_potencia and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Resumen de luminarias instaladas para OT %s: %s", ot, ", ".join(
+                        f"LUMINARIA CODIGO/BRAZO {potencia}: {cantidad} unidad(es)"
+                        for potencia, cantidad in luminarias_por_potencia.items()
+                    ))
+
+        if nodos_sin_brazos:
+            logger.warning("%s: %s nodos con menos brazos que códigos de luminaria", file.filename, nodos_sin_brazos)
         return datos, datos_por_barrio, dfs_originales
 
+    except MemoryError:
+        raise
     except Exception as e:
-        logger.error(f"Error procesando {file.filename}: {str(e)}")
+        logger.error("Error procesando %s: %s", file.filename, e)
         raise HTTPException(500, detail=f"Error en archivo {file.filename}")
 
 
 def procesar_archivo_proyecto(file: UploadFile):
     try:
-        contenido = file.file.read()
-        xls = pd.ExcelFile(BytesIO(contenido))
+        libro = abrir_libro(file.filename, file.file)
         
-        datos = defaultdict(lambda: {
-            'nodos': [],
-            'nodo_counts': defaultdict(int),
-            'codigos_n1': defaultdict(lambda: defaultdict(set)),
-            'codigos_n2': defaultdict(lambda: defaultdict(set)),
-            'materiales': defaultdict(lambda: defaultdict(int)),    
-            'materiales_retirados': defaultdict(lambda: defaultdict(int)),
-            'aspectos_materiales': defaultdict(lambda: defaultdict(lambda: set())),
-            'aspectos_retirados': defaultdict(lambda: defaultdict(lambda: set())),
-            'fechas_sync': defaultdict(str),  
-            'tipos_suelo': defaultdict(str),
-            'tipos_instalacion': defaultdict(str),
-            'pintado_nodo': defaultdict(str)
-        })
-
-        datos_por_barrio = defaultdict(lambda: {
-            'materiales_instalados': defaultdict(lambda: defaultdict(int)),
-            'materiales_retirados': defaultdict(lambda: defaultdict(int))
-        })
+        datos = ordenes_trabajo()
+        datos_por_barrio = materiales_por_barrio()
         
         dfs_originales = {}
         counter_0 = defaultdict(int)
         
-        nodos_normalizados = {}
         nodos_con_codigos = defaultdict(lambda: defaultdict(dict))
-        
-        for hoja in xls.sheet_names:
-            df = xls.parse(hoja)
-            
-            required_columns = {
-                "2.Nro de Proyecto.", "1.NODO DEL POSTE.",
-                "2.CODIGO DE LUMINARIA INSTALADA N1.", "3.CODIGO DE LUMINARIA INSTALADA N2.",
-                "1.Tipo de suelo.", "2.Tipo de Instalacion", "3.Pintado de Nodo?",
-                "4.Describa Aspectos que Considere se deben tener en cuenta.",
-                "FechaSincronizacion"
-            }
-            
-            if not required_columns.issubset(df.columns):
-                print(f"Columnas faltantes en hoja {hoja}:")
-                print(f"Requeridas: {required_columns}")
-                print(f"Disponibles: {set(df.columns)}")
-                print(f"Faltantes: {required_columns - set(df.columns)}")
+
+        for hoja in libro.hojas:
+            # Validar columnas requeridas mirando solo los encabezados, sin cargar las filas
+            encabezado = libro.encabezado(hoja)
+            plan = plan_proyecto(tuple(encabezado))
+            if not plan.valida:
+                logger.warning(
+                    "Hoja %s omitida, faltan columnas: %s", hoja, sorted(COLUMNAS_REQUERIDAS_PROYECTO - set(encabezado))
+                )
+                logger.debug("Columnas disponibles en la hoja %s: %s", hoja, encabezado)
                 continue
-            
+            df = leer_hoja(libro, hoja, encabezado, plan.seleccion)
+
             dfs_originales[hoja] = df
             
             df['FechaSincronizacion'] = (
@@ -2001,152 +3065,107 @@ def procesar_archivo_proyecto(file: UploadFile):
             )
             df = df.sort_values(by='FechaSincronizacion', ascending=True)
                        
-            material_instalado_cols = [col for col in df.columns if re.match(r'^\d+\.MATERIAL No\.\d+$', col)]
-            cantidad_instalado_cols = [col for col in df.columns if re.match(r'^\d+\.CANTIDAD MATERIAL No\.\d+$', col)]
-
-            material_desmontado_cols = [col for col in df.columns if re.match(r'^\d+\.MATERIAL DESMONTADO No\.\d+$', col)]
-            cantidad_desmontado_cols = [col for col in df.columns if re.match(r'^\d+\.CANTIDAD MATERIAL DESMONTADO No\.\d+$', col)]
-                        
-            paired_instalado_columns = []
-            for mat_col in material_instalado_cols:
-                num_match = re.search(r'(\d+)\.MATERIAL No\.(\d+)', mat_col)
-                if num_match:
-                    prefix_num = num_match.group(1)
-                    material_num = num_match.group(2)
-                    
-                    expected_cant_col = f"{int(prefix_num)+1}.CANTIDAD MATERIAL No.{material_num}"
-                    if expected_cant_col in cantidad_instalado_cols:
-                        paired_instalado_columns.append((mat_col, expected_cant_col))
-            
-            paired_desmontado_columns = []
-            for mat_col in material_desmontado_cols:
-                num_match = re.search(r'(\d+)\.MATERIAL DESMONTADO No\.(\d+)', mat_col)
-                if num_match:
-                    prefix_num = num_match.group(1)
-                    material_num = num_match.group(2)
-                    
-                    expected_cant_col = f"{int(prefix_num)+1}.CANTIDAD MATERIAL DESMONTADO No.{material_num}"
-                    if expected_cant_col in cantidad_desmontado_cols:
-                        paired_desmontado_columns.append((mat_col, expected_cant_col))
-            
             nodos_con_codigos = defaultdict(lambda: defaultdict(dict))
             nodos_con_tipo_instalacion = defaultdict(dict)
             nodos_con_pintado = defaultdict(dict)
-            
-            for _, fila in df.iterrows():
-                proyecto = fila["2.Nro de Proyecto."]
-                barrio = fila.get("3.Barrio", "")
-                barrio_normalizado = normalizar_barrio(barrio)
-                original_nodo = str(fila["1.NODO DEL POSTE."]).strip().replace(' ', '').replace('-','').upper()
-                
-                fecha_sincronizacion = fila["FechaSincronizacion"]
-                
-                if original_nodo in ['0', '0.0', '0.00', 'nan', 'NaN', 'None', '', 'NO', 'NO APLICA']:
-                    counter_0[proyecto] += 1
-                    nodo = f"0_{proyecto}_{counter_0[proyecto]}"
-                else:
-                    nodo_normalizado = original_nodo.replace('.0', '').replace('.00', '')
-                    
-                    if (proyecto, nodo_normalizado) in nodos_normalizados:
-                        nodo = nodos_normalizados[(proyecto, nodo_normalizado)]
-                    else:
-                        count = datos[proyecto]['nodo_counts'][nodo_normalizado] + 1
-                        datos[proyecto]['nodo_counts'][nodo_normalizado] = count
-                        nodo = f"{nodo_normalizado}_{count}" if count > 1 else nodo_normalizado
-                        nodos_normalizados[(proyecto, nodo_normalizado)] = nodo
-                
-                datos[proyecto]['nodos'].append(nodo)
-                                
-                if pd.notna(fecha_sincronizacion):
-                    datos[proyecto]['fechas_sync'][nodo] = fecha_sincronizacion.strftime('%d/%m/%Y %H:%M:%S')
-                else:
-                    datos[proyecto]['fechas_sync'][nodo] = "Sin fecha"
-                
-                tipo_suelo = fila.get("1.Tipo de suelo.", "")
-                if pd.notna(tipo_suelo):
-                    datos[proyecto]['tipos_suelo'][nodo] = str(tipo_suelo).strip()
-                
-                # CORRECCIÓN: Procesar correctamente el tipo de instalación
-                tipo_instalacion = fila.get("2.Tipo de Instalacion", "")
-                if pd.notna(tipo_instalacion):
-                    tipo_instalacion_str = str(tipo_instalacion).strip().upper()
-                    datos[proyecto]['tipos_instalacion'][nodo] = tipo_instalacion_str
-                    nodos_con_tipo_instalacion[proyecto][nodo] = tipo_instalacion_str
-                    print(f"DEBUG: Guardando tipo instalación para nodo {nodo}: {tipo_instalacion_str}")
-                
-                pintado_nodo = fila.get("3.Pintado de Nodo?", "")
-                if pd.notna(pintado_nodo):
-                    datos[proyecto]['pintado_nodo'][nodo] = str(pintado_nodo).strip()
-                    nodos_con_pintado[proyecto][nodo] = str(pintado_nodo).strip()
-                
-                codigo_n1 = fila["2.CODIGO DE LUMINARIA INSTALADA N1."]
-                codigo_n2 = fila["3.CODIGO DE LUMINARIA INSTALADA N2."]
-                
-                if pd.notna(codigo_n1) and str(codigo_n1).strip() not in ['', '0', '0.0']:
-                    try:
-                        key = "CODIGO 1 LUMINARIA INSTALADA"
-                        codigo_str = str(codigo_n1).strip().upper()
-                        datos[proyecto]['codigos_n1'][key][nodo].add(codigo_str)
-                        
-                        nodos_con_codigos[proyecto][nodo]['n1'] = {
-                            'codigo': codigo_str,
-                            'potencia': 0
-                        }
-                        
-                    except Exception as e:
-                        print(f"Error procesando codigo N1: {str(e)}")
-                
-                if pd.notna(codigo_n2) and str(codigo_n2).strip() not in ['', '0', '0.0']:
-                    try:
-                        key = "CODIGO 2 LUMINARIA INSTALADA"
-                        codigo_str = str(codigo_n2).strip().upper()
-                        datos[proyecto]['codigos_n2'][key][nodo].add(codigo_str)
-                        
-                        nodos_con_codigos[proyecto][nodo]['n2'] = {
-                            'codigo': codigo_str,
-                            'potencia': 0
-                        }
-                        
-                    except Exception as e:
-                        print(f"Error procesando código N2: {str(e)}")
-                
-                # Procesar materiales instalados
-                for mat_col, cant_col in paired_instalado_columns:
-                    material = fila[mat_col]
-                    cantidad = fila[cant_col]
-                    if pd.notna(material) and pd.notna(cantidad) and float(cantidad) > 0.0:
-                        material_str = str(material).strip().upper()
-                        if material_str != "NINGUNO":
-                            key = f"MATERIAL|{material_str}"
-                            
-                            cantidad_float = float(cantidad)
-                            datos[proyecto]['materiales'][key][nodo] += cantidad_float
-                            datos_por_barrio[barrio_normalizado]['materiales_instalados'][key][proyecto] += cantidad_float
-                            
-                            aspecto = fila["4.Describa Aspectos que Considere se deben tener en cuenta."]
-                            if pd.notna(aspecto):
-                                aspecto_limpio = str(aspecto).strip().upper()
-                                if aspecto_limpio not in ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']:
-                                    datos[proyecto]['aspectos_materiales'][key][nodo].add(aspecto_limpio)
-                
-                # Procesar materiales desmontados
-                for mat_col, cant_col in paired_desmontado_columns:
-                    material = fila[mat_col]
-                    cantidad = fila[cant_col]
-                    if pd.notna(material) and pd.notna(cantidad) and float(cantidad) > 0.0:
-                        material_str = str(material).strip().upper()
-                        if material_str != "NO APLICA":
-                            key = f"MATERIAL_RETIRADO|{material_str}"
-                            
-                            cantidad_float = float(cantidad)
-                            datos[proyecto]['materiales_retirados'][key][nodo] += cantidad_float
-                            datos_por_barrio[barrio_normalizado]['materiales_retirados'][key][proyecto] += cantidad_float
-                            
-                            aspecto = fila["4.Describa Aspectos que Considere se deben tener en cuenta."]
-                            if pd.notna(aspecto):
-                                aspecto_limpio = str(aspecto).strip().upper()
-                                if aspecto_limpio not in ['', 'NA', 'NINGUNO', 'N/A', 'NO', 'NO APLICA']:
-                                    datos[proyecto]['aspectos_retirados'][key][nodo].add(aspecto_limpio)
+
+            # ========== PROYECTO, NODO Y DATOS POR FILA ==========
+            proyecto_codigos, proyectos = factorizar_por_fila(df["2.Nro de Proyecto."])
+            nodos = normalizar_nodos(df["1.NODO DEL POSTE."], proyecto_codigos, proyectos, counter_0)
+            nodo_proyecto = codigos_de_grupo(proyecto_codigos, nodos)
+
+            fechas = fechas_sync(df["FechaSincronizacion"])
+            aspecto_codigos, aspectos = limpiar_aspectos(df["4.Describa Aspectos que Considere se deben tener en cuenta."])
+            barrio_codigos, barrios = barrios_por_fila(df)
+
+            suelos = df["1.Tipo de suelo."].to_numpy(dtype=object)
+            suelo_presente = pd.notna(suelos)
+            suelos = np.array([str(suelo).strip() for suelo in suelos], dtype=object)
+            # CORRECCIÓN: Procesar correctamente el tipo de instalación
+            instalaciones = df["2.Tipo de Instalacion"].to_numpy(dtype=object)
+            instalacion_presente = pd.notna(instalaciones)
+            instalaciones = np.array([str(tipo).strip().upper() for tipo in instalaciones], dtype=object)
+            pintados = df["3.Pintado de Nodo?"].to_numpy(dtype=object)
+            pintado_presente = pd.notna(pintados)
+            pintados = np.array([str(pintado).strip() for pintado in pintados], dtype=object)
+
+            for filas_proyecto in grupos_por_codigo(proyecto_codigos):
+                proyecto = proyectos[proyecto_codigos[filas_proyecto[0]]]
+                info = datos[proyecto]
+                nodos_proyecto = nodos[filas_proyecto].tolist()
+                info.agregar_nodos(nodos_proyecto)
+                info.registrar_datos_nodo('fecha_sync', zip(nodos_proyecto, fechas[filas_proyecto].tolist()))
+
+                con_suelo = filas_proyecto[suelo_presente[filas_proyecto]]
+                info.registrar_datos_nodo('tipo_suelo', zip(nodos[con_suelo].tolist(), suelos[con_suelo].tolist()))
+
+                con_instalacion = filas_proyecto[instalacion_presente[filas_proyecto]]
+                tipos_nodo = list(zip(nodos[con_instalacion].tolist(), instalaciones[con_instalacion].tolist()))
+                info.registrar_datos_nodo('tipo_instalacion', tipos_nodo)
+                nodos_con_tipo_instalacion[proyecto].update(tipos_nodo)
+
+                con_pintado = filas_proyecto[pintado_presente[filas_proyecto]]
+                pintado_nodo = list(zip(nodos[con_pintado].tolist(), pintados[con_pintado].tolist()))
+                info.registrar_datos_nodo('pintado', pintado_nodo)
+                nodos_con_pintado[proyecto].update(pintado_nodo)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                for nodo, tipo_instalacion_str in zip(nodos[instalacion_presente].tolist(),
+                                                      instalaciones[instalacion_presente].tolist()):
+                    logger.debug("Guardando tipo instalación para nodo %s: %s", nodo, tipo_instalacion_str)
+
+            # ========== CÓDIGOS N1 Y N2 INSTALADOS ==========
+            partes_codigos = []
+            for orden, (posicion, col_codigo, clave) in enumerate((
+                ('n1', "2.CODIGO DE LUMINARIA INSTALADA N1.", "CODIGO 1 LUMINARIA INSTALADA"),
+                ('n2', "3.CODIGO DE LUMINARIA INSTALADA N2.", "CODIGO 2 LUMINARIA INSTALADA"),
+            )):
+                validos, limpios = codigos_informados(df[col_codigo])
+                filas = np.flatnonzero(validos)
+                partes_codigos.append(pd.DataFrame({
+                    'fila': filas,
+                    'orden': orden,
+                    'posicion': posicion,
+                    'ot': proyecto_codigos[filas],
+                    'nodo': nodos[filas],
+                    'clave': clave,
+                    'codigo': [codigo.upper() for codigo in limpios[filas].tolist()],
+                    'potencia': 0,
+                }))
+            registrar_codigos_instalados(partes_codigos, proyectos, datos, nodos_con_codigos)
+
+            # ========== MATERIALES INSTALADOS Y DESMONTADOS ==========
+            # Ambos grupos de pares van a un único frame largo: los desmontados ocupan
+            # las ranuras siguientes a los instalados dentro de cada fila
+            entradas = []
+            ranura_desmontado = len(plan.pares)
+            for pares, ranura_base, prefijo, excluido in (
+                (plan.pares, 0, "MATERIAL", "NINGUNO"),
+                (plan.pares_retirados, ranura_desmontado, "MATERIAL_RETIRADO", "NO APLICA"),
+            ):
+                if not pares:
+                    continue
+                filas, cols, cantidades, material_codigos, nombres = derretir_pares(df, pares)
+                incluir = np.array([nombre != excluido for nombre in nombres], dtype=bool)[material_codigos]
+                claves = arreglo_claves([clave_material(prefijo, nombre) for nombre in nombres])[material_codigos]
+                filas, cols = filas[incluir], cols[incluir]
+                entradas.append(entradas_largas(
+                    filas, ranura_base + cols, proyecto_codigos[filas], nodos[filas], claves[incluir],
+                    cantidades[incluir], enteras=False, barrios=barrio_codigos[filas],
+                ))
+
+            largo = ordenar_entradas(entradas, nodo_proyecto)
+            if largo is not None:
+                es_desmontado = largo['ranura'].to_numpy() >= ranura_desmontado
+                for seleccion, campo, campo_aspectos in (
+                    (~es_desmontado, 'materiales', 'aspectos_materiales'),
+                    (es_desmontado, 'materiales_retirados', 'aspectos_retirados'),
+                ):
+                    parte = largo[seleccion]
+                    if len(parte):
+                        acumular_cantidades(parte, proyectos, datos, campo)
+                        acumular_aspectos(parte, aspecto_codigos, aspectos, proyectos, datos, campo_aspectos)
+                acumular_por_barrio(largo, barrios, proyectos, datos_por_barrio)
         
         # CORRECCIÓN: Procesar luminarias instaladas basado en tipo de instalación
         for proyecto in datos:
@@ -2159,14 +3178,14 @@ def procesar_archivo_proyecto(file: UploadFile):
                 todos_los_codigos = []
                 # Contar códigos N1
                 if 'n1' in info_codigos:
-                    for key_codigo, nodos_valores in datos[proyecto]['codigos_n1'].items():
+                    for key_codigo, nodos_valores in datos[proyecto].codigos_n1.items():
                         if nodo in nodos_valores:
                             codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                             total_codigos_luminarias += len(codigos_validos)
                             todos_los_codigos.extend(codigos_validos)
                 # Contar códigos N2
                 if 'n2' in info_codigos:
-                    for key_codigo, nodos_valores in datos[proyecto]['codigos_n2'].items():
+                    for key_codigo, nodos_valores in datos[proyecto].codigos_n2.items():
                         if nodo in nodos_valores:
                             codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                             total_codigos_luminarias += len(codigos_validos)
@@ -2186,27 +3205,29 @@ def procesar_archivo_proyecto(file: UploadFile):
                         # Si no se puede determinar, usar escalera como default para proyectos
                         descripcion = "LUMINARIA INSTALADA EN ESCALERA"
                     # Crear la clave del material
-                    key = f"MATERIAL|{descripcion}"
+                    key = clave_material("MATERIAL", descripcion)
                     # Asignar la cantidad correcta de luminarias instaladas
-                    datos[proyecto]['materiales'][key][nodo] = total_codigos_luminarias
+                    datos[proyecto].materiales[key][nodo] = total_codigos_luminarias
                     # Crear aspecto detallado con información de códigos y tipo de instalación
                     aspecto = f"Luminarias instaladas con códigos: {','.join(todos_los_codigos)}"
                     aspecto += f", tipo instalación: {tipo_instalacion}"
                     aspecto += f", cantidad total: {total_codigos_luminarias} luminaria(s)"
                     # Agregar el aspecto a los materiales
-                    datos[proyecto]['aspectos_materiales'][key][nodo].add(aspecto)
+                    datos[proyecto].aspectos_materiales[key][nodo].add(aspecto)
             # Procesar pintado de nodos
             for nodo, pintado in nodos_pintado.items():
                 if "SI" in pintado.upper() or "1.SI" in pintado.upper() or "1.Si" in pintado.upper():
-                    key = f"MATERIAL|PINTADO DE NODO"
-                    datos[proyecto]['materiales'][key][nodo] = 1    
+                    key = clave_material("MATERIAL", "PINTADO DE NODO")
+                    datos[proyecto].materiales[key][nodo] = 1    
                     aspecto = f"Pintado de nodo realizado"
-                    datos[proyecto]['aspectos_materiales'][key][nodo].add(aspecto)
+                    datos[proyecto].aspectos_materiales[key][nodo].add(aspecto)
 
         return datos, datos_por_barrio, dfs_originales
 
+    except MemoryError:
+        raise
     except Exception as e:
-        logger.error(f"Error procesando {file.filename}: {str(e)}")
+        logger.error("Error procesando %s: %s", file.filename, e)
         raise HTTPException(500, detail=f"Error en archivo {file.filename}")
 
 
@@ -2508,593 +3529,850 @@ def cargar_plantilla_mano_obra():
             }
         ]
         
-        return plantilla_manual
+        return compilar_plantilla_mano_obra(plantilla_manual)
         
     except Exception as e:
-        logger.error(f"Error creando plantilla manual: {str(e)}")
+        logger.error("Error creando plantilla manual: %s", e)
         return []  
 
-def calcular_cantidad_mano_obra(descripcion, materiales_instalados, materiales_retirados, nodo, codigos_n1=None, codigos_n2=None, tipo_suelo=None, bloque_actual=None, tipos_instalacion=None, tipo_instalacion_nodo=None):
+# ======== REGLAS DE MANO DE OBRA ========
+# Cada descripción de mano de obra se resuelve una sola vez a la lista ordenada de reglas
+# cuyo texto coincide (`PLANES_MANO_OBRA`). Las reglas comparten un contexto: la primera
+# que devuelve un resultado termina el cálculo y las que no devuelven nada dejan la
+# cantidad y los materiales relacionados acumulados para las siguientes.
+#
+# Una regla puede declarar sus materiales disparadores (CATEGORIAS_DISPARADORAS): sin ningún
+# material instalado o retirado del nodo que los contenga, la regla no cambia la cantidad ni
+# devuelve una distinta de cero. Si todas las reglas del plan los declaran y el nodo no tiene
+# ninguno, la cantidad de la partida es 0 sin evaluarlas.
+#
+# Además de los materiales del nodo, una regla declara qué otros datos del nodo lee
+# (DATOS_NODO_MANO_OBRA): la caché por huella de nodo solo distingue los nodos por esos datos.
+REGLAS_MANO_OBRA = []
+PLANES_MANO_OBRA = {}
+# Llamadas y tiempo por regla acumulados en el proceso; cada generación junta los suyos aparte
+# en REGLAS_SOLICITUD (ver medir_reglas_mano_obra) y los suma aquí al terminar
+ESTADISTICAS_REGLAS_MANO_OBRA = defaultdict(lambda: {'llamadas': 0, 'segundos': 0.0})
+BLOQUEO_REGLAS_MANO_OBRA = threading.Lock()
+REGLAS_SOLICITUD = contextvars.ContextVar("reglas_solicitud", default=None)
+CATEGORIAS_DISPARADORAS = (
+    "POSTE", "BRAZO", "CABLE", "ABRAZADERA", "KIT DE PUESTA A TIERRA", "PERCHA GALV",
+    "VARILLA COOPERWELD", "EXCAVACION", "ZANJA", "TUBERIA CONDUFLEX", "PINTADO DE NODO",
+)
+MASCARAS_POR_NOMBRE = {}
+DATOS_NODO_MANO_OBRA = ('codigos', 'tipo_suelo', 'tipo_instalacion')
+PlanManoObra = namedtuple('PlanManoObra', ['reglas', 'disparadores', 'datos_nodo'])
+
+
+def mascara_categorias(categorias):
+    """Bits de CATEGORIAS_DISPARADORAS que corresponden a `categorias`."""
+    mascara = 0
+    for categoria in categorias:
+        mascara |= 1 << CATEGORIAS_DISPARADORAS.index(categoria)
+    return mascara
+
+
+def mascara_material(nombre):
+    """Bits de las categorías disparadoras que contiene el nombre de un material (en mayúsculas)."""
+    mascara = MASCARAS_POR_NOMBRE.get(nombre)
+    if mascara is None:
+        mascara = MASCARAS_POR_NOMBRE[nombre] = mascara_categorias(
+            categoria for categoria in CATEGORIAS_DISPARADORAS if categoria in nombre
+        )
+    return mascara
+
+
+def regla_mano_obra(nombre, coincide, disparadores=None, datos_nodo=()):
     """
-    Calcula la cantidad de mano de obra necesaria para una partida específica en un nodo.
-    
+    Registra una regla de mano de obra.
+
     Args:
-        descripcion: Descripción de la partida de mano de obra
-        materiales_instalados: Diccionario de materiales instalados
-        materiales_retirados: Diccionario de materiales retirados
-        nodo: Nodo actual
-        codigos_n1: Diccionario de códigos N1 (opcional)
-        codigos_n2: Diccionario de códigos N2 (opcional)
-    
-    Returns:
-        tuple: (cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados)
-    """    
-    
-    cantidad_mo = 0
-    materiales_instalados_relacionados = []
-    materiales_retirados_relacionados = []
-    
-    # Convertir descripción a mayúsculas para comparaciones insensibles a mayúsculas/minúsculas
-    descripcion_upper = descripcion.upper()
-    
-    # Verificamos si hay diccionarios válidos para evitar errores
-    if codigos_n1 is None:
-        codigos_n1 = {}
-    if codigos_n2 is None:
-        codigos_n2 = {}
-    mano_obra_por_nodo = {}
-    
-    es_proyecto = False
-    tipo_instalacion_detectado = ""
-    
-    print(f"DEBUG: Analizando nodo {nodo} - tipo_instalacion_nodo: {tipo_instalacion_nodo}")
-    print(f"DEBUG: tipos_instalacion dict: {tipos_instalacion}")
-    
-    # Método 1: Usar el parámetro tipo_instalacion_nodo si está disponible
-    if tipo_instalacion_nodo is not None and str(tipo_instalacion_nodo).strip() != "":
-        es_proyecto = True
-        tipo_instalacion_detectado = str(tipo_instalacion_nodo).strip().upper()
-        print(f"DEBUG: PROYECTO detectado por parámetro - Nodo: {nodo}, Tipo: {tipo_instalacion_detectado}")
-    
-    # Método 2: Usar el diccionario tipos_instalacion si está disponible
-    elif tipos_instalacion is not None and nodo in tipos_instalacion:
-        tipo_from_dict = tipos_instalacion.get(nodo, "")
-        if str(tipo_from_dict).strip() != "":
-            es_proyecto = True
-            tipo_instalacion_detectado = str(tipo_from_dict).strip().upper()
-            print(f"DEBUG: PROYECTO detectado por diccionario - Nodo: {nodo}, Tipo: {tipo_instalacion_detectado}")
-    
-    # Si no es proyecto, es modernización
-    if not es_proyecto:
-        print(f"DEBUG: MODERNIZACIÓN detectado - Nodo: {nodo}")
-    
-    # ======== CASO ESPECIAL: RECUPERACION ZONA DURA ========
-    if "RECUPERACION ZONA DURA" in descripcion_upper:
-        # Verificar si el tipo de suelo es "Zona Dura"
-        if tipo_suelo and "ZONA DURA" in tipo_suelo.upper():
-            # Verificar si hay trabajos que requieran recuperación de zona
-            hay_trabajo_con_postes = False
-            hay_excavacion = False
-            hay_kit_puesta_tierra = False
-
-            # Buscar KIT DE PUESTA A TIERRA en materiales instalados
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_kit_puesta_tierra = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # Buscar postes instalados en este nodo
-            for key, nodos_qty in materiales_instalados.items():
-                if "|" in key:
-                    material_name = key.split("|")[1].upper()
-                    if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_trabajo_con_postes = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # Si no hay postes instalados, buscar postes retirados
-            if not hay_trabajo_con_postes:
-                for key, nodos_qty in materiales_retirados.items():
-                    if "|" in key:
-                        material_name = key.split("|")[1].upper()
-                        if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                            hay_trabajo_con_postes = True
-                            materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                            break
-                        
-            # Buscar si hay excavación en este nodo
-            for key, nodos_qty in materiales_instalados.items():
-                if "|" in key:
-                    material_name = key.split("|")[1].upper()
-                    if ("EXCAVACION" in material_name or "ZANJA" in material_name) and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_excavacion = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # CORRECCIÓN: Si hay kit de puesta a tierra O trabajo con postes O excavación, asignar recuperación
-            if hay_kit_puesta_tierra or hay_trabajo_con_postes or hay_excavacion:
-                cantidad_mo = 1 * 0.3  # Asignar 1 unidad por nodo
-                materiales_instalados_relacionados.append(f"TIPO DE SUELO: ZONA DURA")
-                return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: RECUPERACION ZONA ========
-    if "RECUPERACION ZONA" in descripcion_upper and "DURA" not in descripcion_upper:
-        # Verificar si el tipo de suelo NO es "Zona Dura" (es decir, es zona blanda)
-        es_zona_blanda = False
-        if tipo_suelo:
-            if "ZONA BLANDA" in tipo_suelo.upper():
-                es_zona_blanda = True
-            elif "ZONA DURA" not in tipo_suelo.upper():
-                # Si no especifica "Zona Dura", asumir que es zona blanda
-                es_zona_blanda = True
-        else:
-            # Si no hay información de tipo de suelo, asumir que es zona blanda
+        nombre: Nombre de la regla (se usa en las estadísticas)
+        coincide: Función que recibe la descripción en mayúsculas e indica si la regla aplica
+        disparadores: Categorías de CATEGORIAS_DISPARADORAS sin las que la regla da 0; una tupla
+            vacía si nunca cambia la cantidad y None si puede dar cantidad sin materiales
+            (códigos, tipo de instalación)
+        datos_nodo: Datos de DATOS_NODO_MANO_OBRA que lee la regla, además de los materiales
+    """
+    mascara = None if disparadores is None else mascara_categorias(disparadores)
+
+    def registrar(funcion):
+        REGLAS_MANO_OBRA.append((nombre, coincide, funcion, mascara, frozenset(datos_nodo)))
+        return funcion
+    return registrar
+
+
+def plan_mano_obra(descripcion):
+    """
+    Reglas que aplican a una descripción, en orden de evaluación.
+
+    Returns:
+        PlanManoObra: `reglas` como tuplas (nombre, función), `disparadores`, la unión de las
+        máscaras de sus reglas (None si alguna no declara disparadores), y `datos_nodo`, los
+        datos del nodo que leen sus reglas en el orden de DATOS_NODO_MANO_OBRA
+    """
+    plan = PLANES_MANO_OBRA.get(descripcion)
+    if plan is None:
+        descripcion_upper = descripcion.upper()
+        reglas = [regla for regla in REGLAS_MANO_OBRA if regla[1](descripcion_upper)]
+        disparadores = 0
+        for _, _, _, mascara, _ in reglas:
+            disparadores = None if disparadores is None or mascara is None else disparadores | mascara
+        datos_nodo = tuple(dato for dato in DATOS_NODO_MANO_OBRA if any(dato in regla[4] for regla in reglas))
+        plan = PlanManoObra(tuple((nombre, funcion) for nombre, _, funcion, _, _ in reglas), disparadores, datos_nodo)
+        PLANES_MANO_OBRA[descripcion] = plan
+    return plan
+
+
+def compilar_plantilla_mano_obra(plantilla):
+    """Resuelve por adelantado las reglas de cada partida de la plantilla."""
+    for item in plantilla:
+        plan_mano_obra(item['DESCRIPCION MANO DE OBRA'])
+    return plantilla
+
+
+def estadisticas_reglas_mano_obra(estadisticas=None):
+    """
+    Llamadas y tiempo por regla, de la más costosa a la menos costosa.
+
+    Args:
+        estadisticas: Contadores a ordenar (por ejemplo, los de medir_reglas_mano_obra); por
+            defecto, los acumulados del proceso
+    """
+    if estadisticas is None:
+        with BLOQUEO_REGLAS_MANO_OBRA:
+            estadisticas = {nombre: dict(valores) for nombre, valores in ESTADISTICAS_REGLAS_MANO_OBRA.items()}
+    return {
+        nombre: dict(valores)
+        for nombre, valores in sorted(estadisticas.items(), key=lambda item: -item[1]['segundos'])
+    }
+
+
+def sumar_estadisticas_reglas(estadisticas):
+    """Suma contadores por regla a los acumulados del proceso."""
+    with BLOQUEO_REGLAS_MANO_OBRA:
+        for nombre, valores in estadisticas.items():
+            acumulado = ESTADISTICAS_REGLAS_MANO_OBRA[nombre]
+            acumulado['llamadas'] += valores['llamadas']
+            acumulado['segundos'] += valores['segundos']
+
+
+@contextmanager
+def medir_reglas_mano_obra():
+    """
+    Junta aparte las llamadas a reglas hechas dentro del bloque (también en los hilos que
+    reciben una copia del contexto) y al salir las suma a los acumulados del proceso.
+
+    Yields:
+        dict: nombre de la regla -> {'llamadas', 'segundos'} de este bloque
+    """
+    estadisticas = defaultdict(lambda: {'llamadas': 0, 'segundos': 0.0})
+    token = REGLAS_SOLICITUD.set(estadisticas)
+    try:
+        yield estadisticas
+    finally:
+        REGLAS_SOLICITUD.reset(token)
+        sumar_estadisticas_reglas(estadisticas)
+
+
+# Textos por los que las reglas filtran materiales; el índice guarda aparte las entradas de cada uno.
+CATEGORIAS_MATERIAL = (
+    "POSTE", "BRAZO", "LUMINARIA", "CABLE", "ABRAZADERA", "KIT DE PUESTA A TIERRA",
+    "PERCHA GALV", "VARILLA COOPERWELD", "AISLADOR", "CAJA",
+)
+CATEGORIAS_POR_NOMBRE = {}
+
+
+class IndiceMaterialesNodo:
+    """
+    Materiales instalados y retirados de una OT agrupados por nodo.
+
+    Cada entrada es (clave, nombre en mayúsculas, cantidad) y se conserva el orden de las
+    claves del diccionario original, así que recorrer las entradas de un nodo equivale a
+    recorrer todo el diccionario descartando los materiales que no tienen ese nodo.
+    También guarda, por nodo, la máscara de las categorías disparadoras de sus materiales.
+    """
+    __slots__ = ('instalados_por_nodo', 'retirados_por_nodo', 'mascaras')
+
+    def __init__(self, materiales_instalados, materiales_retirados, nodos=None):
+        """
+        Args:
+            materiales_instalados: Diccionario material -> {nodo: cantidad}
+            materiales_retirados: Diccionario material -> {nodo: cantidad}
+            nodos: Si se indica, solo se indexan esos nodos
+        """
+        self.mascaras = defaultdict(int)
+        self.instalados_por_nodo = self.agrupar(materiales_instalados, nodos, self.mascaras)
+        self.retirados_por_nodo = self.agrupar(materiales_retirados, nodos, self.mascaras)
+
+    @staticmethod
+    def agrupar(materiales, nodos, mascaras):
+        por_nodo = {}
+        for clave, nodos_qty in materiales.items():
+            nombre = clave.nombre.upper()
+            categorias = CATEGORIAS_POR_NOMBRE.get(nombre)
+            if categorias is None:
+                categorias = tuple(categoria for categoria in CATEGORIAS_MATERIAL if categoria in nombre)
+                CATEGORIAS_POR_NOMBRE[nombre] = categorias
+            mascara = mascara_material(nombre)
+            if nodos is None:
+                cantidades = nodos_qty.items()
+            else:
+                cantidades = [(nodo, nodos_qty[nodo]) for nodo in nodos if nodo in nodos_qty]
+            for nodo, cantidad in cantidades:
+                entrada = (clave, nombre, cantidad)
+                mascaras[nodo] |= mascara
+                grupos = por_nodo.get(nodo)
+                if grupos is None:
+                    grupos = por_nodo[nodo] = defaultdict(list)
+                grupos[None].append(entrada)
+                for categoria in categorias:
+                    grupos[categoria].append(entrada)
+        return por_nodo
+
+    @staticmethod
+    def buscar(por_nodo, nodo, categoria):
+        grupos = por_nodo.get(nodo)
+        if grupos is None:
+            return ()
+        return grupos.get(categoria, ())
+
+    def instalados(self, nodo, categoria=None):
+        """Materiales instalados del nodo; con `categoria`, solo los que contienen ese texto."""
+        return self.buscar(self.instalados_por_nodo, nodo, categoria)
+
+    def retirados(self, nodo, categoria=None):
+        """Materiales retirados del nodo; con `categoria`, solo los que contienen ese texto."""
+        return self.buscar(self.retirados_por_nodo, nodo, categoria)
+
+    def mascara(self, nodo):
+        """Categorías disparadoras presentes en los materiales instalados y retirados del nodo."""
+        return self.mascaras.get(nodo, 0)
+
+    def mascara_ot(self):
+        """Categorías disparadoras presentes en algún nodo indexado."""
+        mascara = 0
+        for mascara_nodo in self.mascaras.values():
+            mascara |= mascara_nodo
+        return mascara
+
+
+class ContextoManoObra:
+    """Datos del nodo y acumulados compartidos por las reglas de una partida."""
+    __slots__ = (
+        'descripcion', 'descripcion_upper', 'materiales_instalados', 'materiales_retirados', 'indice', 'nodo',
+        'codigos_n1', 'codigos_n2', 'tipo_suelo', 'es_proyecto', 'tipo_instalacion_detectado',
+        'cantidad_mo', 'materiales_instalados_relacionados', 'materiales_retirados_relacionados',
+    )
+
+    def __init__(self, descripcion, materiales_instalados, materiales_retirados, indice, nodo, codigos_n1, codigos_n2,
+                 tipo_suelo, es_proyecto, tipo_instalacion_detectado):
+        self.descripcion = descripcion
+        self.descripcion_upper = descripcion.upper()
+        self.materiales_instalados = materiales_instalados
+        self.materiales_retirados = materiales_retirados
+        self.indice = indice
+        self.nodo = nodo
+        self.codigos_n1 = codigos_n1
+        self.codigos_n2 = codigos_n2
+        self.tipo_suelo = tipo_suelo
+        self.es_proyecto = es_proyecto
+        self.tipo_instalacion_detectado = tipo_instalacion_detectado
+        self.cantidad_mo = 0
+        self.materiales_instalados_relacionados = []
+        self.materiales_retirados_relacionados = []
+
+    def resultado(self):
+        return self.cantidad_mo, self.materiales_instalados_relacionados, self.materiales_retirados_relacionados
+
+
+@regla_mano_obra('RECUPERACION ZONA DURA', lambda d: "RECUPERACION ZONA DURA" in d,
+                 disparadores=("KIT DE PUESTA A TIERRA", "POSTE", "EXCAVACION", "ZANJA"), datos_nodo=('tipo_suelo',))
+def regla_recuperacion_zona_dura(ctx):
+    """Partida RECUPERACION ZONA DURA."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    tipo_suelo = ctx.tipo_suelo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Verificar si el tipo de suelo es "Zona Dura"
+    if tipo_suelo and "ZONA DURA" in tipo_suelo.upper():
+        # Verificar si hay trabajos que requieran recuperación de zona
+        hay_trabajo_con_postes = False
+        hay_excavacion = False
+        hay_kit_puesta_tierra = False
+
+        # Buscar KIT DE PUESTA A TIERRA en materiales instalados
+        for material_key, material_name, qty in indice.instalados(nodo, "KIT DE PUESTA A TIERRA"):
+            if "KIT DE PUESTA A TIERRA" in material_name and qty > 0:
+                hay_kit_puesta_tierra = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
+
+        # Buscar postes instalados en este nodo
+        for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+            if "POSTE" in material_name and qty > 0:
+                hay_trabajo_con_postes = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
+
+        # Si no hay postes instalados, buscar postes retirados
+        if not hay_trabajo_con_postes:
+            for key, material_name, qty in indice.retirados(nodo, "POSTE"):
+                if "POSTE" in material_name and qty > 0:
+                    hay_trabajo_con_postes = True
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+                    break
+
+        # Buscar si hay excavación en este nodo
+        for key, material_name, qty in indice.instalados(nodo):
+            if ("EXCAVACION" in material_name or "ZANJA" in material_name) and qty > 0:
+                hay_excavacion = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
+
+        # CORRECCIÓN: Si hay kit de puesta a tierra O trabajo con postes O excavación, asignar recuperación
+        if hay_kit_puesta_tierra or hay_trabajo_con_postes or hay_excavacion:
+            ctx.cantidad_mo = 1 * 0.3  # Asignar 1 unidad por nodo
+            materiales_instalados_relacionados.append(f"TIPO DE SUELO: ZONA DURA")
+            return ctx.resultado()
+
+
+@regla_mano_obra('RECUPERACION ZONA', lambda d: "RECUPERACION ZONA" in d and "DURA" not in d,
+                 disparadores=("KIT DE PUESTA A TIERRA", "POSTE", "EXCAVACION", "ZANJA"), datos_nodo=('tipo_suelo',))
+def regla_recuperacion_zona_blanda(ctx):
+    """Partida RECUPERACION ZONA."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    tipo_suelo = ctx.tipo_suelo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Verificar si el tipo de suelo NO es "Zona Dura" (es decir, es zona blanda)
+    es_zona_blanda = False
+    if tipo_suelo:
+        if "ZONA BLANDA" in tipo_suelo.upper():
+            es_zona_blanda = True
+        elif "ZONA DURA" not in tipo_suelo.upper():
+            # Si no especifica "Zona Dura", asumir que es zona blanda
             es_zona_blanda = True
+    else:
+        # Si no hay información de tipo de suelo, asumir que es zona blanda
+        es_zona_blanda = True
+
+    if es_zona_blanda:
+        # Verificar si hay trabajos que requieran recuperación de zona
+        hay_trabajo_con_postes = False
+        hay_excavacion = False
+        hay_kit_puesta_tierra = False
+
+        # Buscar KIT DE PUESTA A TIERRA en materiales instalados
+        for material_key, material_name, qty in indice.instalados(nodo, "KIT DE PUESTA A TIERRA"):
+            if "KIT DE PUESTA A TIERRA" in material_name and qty > 0:
+                hay_kit_puesta_tierra = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
 
-        if es_zona_blanda:
-            # Verificar si hay trabajos que requieran recuperación de zona
-            hay_trabajo_con_postes = False
-            hay_excavacion = False
-            hay_kit_puesta_tierra = False
-
-            # Buscar KIT DE PUESTA A TIERRA en materiales instalados
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_kit_puesta_tierra = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # Buscar postes instalados en este nodo
-            for key, nodos_qty in materiales_instalados.items():
-                if "|" in key:
-                    material_name = key.split("|")[1].upper()
-                    if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_trabajo_con_postes = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # Si no hay postes instalados, buscar postes retirados
-            if not hay_trabajo_con_postes:
-                for key, nodos_qty in materiales_retirados.items():
-                    if "|" in key:
-                        material_name = key.split("|")[1].upper()
-                        if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                            hay_trabajo_con_postes = True
-                            materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                            break
-                        
-            # Buscar si hay excavación en este nodo
-            for key, nodos_qty in materiales_instalados.items():
-                if "|" in key:
-                    material_name = key.split("|")[1].upper()
-                    if ("EXCAVACION" in material_name or "ZANJA" in material_name) and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_excavacion = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-            # CORRECCIÓN: Si hay kit de puesta a tierra O trabajo con postes O excavación, asignar recuperación
-            if hay_kit_puesta_tierra or hay_trabajo_con_postes or hay_excavacion:
-                cantidad_mo = 1 * 0.3  # Asignar 1 unidad por nodo
-                materiales_instalados_relacionados.append(f"TIPO DE SUELO: ZONA BLANDA")
-                return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados       
-   
-    # ======== CASO ESPECIAL: CONEXIÓN A CABLE A TIERRA (INSTALACION CONECTOR DE SPT) ========
-    if "CONEXIÓN A CABLE A TIERRA" in descripcion_upper or "INSTALACION CONECTOR DE SPT" in descripcion_upper:
-        # Verificar si este nodo NO tiene un KIT SPT instalado
-        tiene_kit_spt = False
-        
-        # Buscar KIT DE PUESTA A TIERRA en materiales instalados para este nodo
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_kit_spt = True
+        # Buscar postes instalados en este nodo
+        for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+            if "POSTE" in material_name and qty > 0:
+                hay_trabajo_con_postes = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
+
+        # Si no hay postes instalados, buscar postes retirados
+        if not hay_trabajo_con_postes:
+            for key, material_name, qty in indice.retirados(nodo, "POSTE"):
+                if "POSTE" in material_name and qty > 0:
+                    hay_trabajo_con_postes = True
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
                     break
-        
-        # Si NO tiene KIT SPT, asignar esta partida
-        if not tiene_kit_spt:
-            # Verificar si hay algún material eléctrico que requiera conexión a tierra
-            hay_material_electrico = False
-            
-            # Buscar materiales eléctricos que típicamente requieren conexión a tierra
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    # Verificar si hay luminarias, cables, u otros componentes eléctricos
-                    if any(keyword in material_name for keyword in ["LUMINARIA", "CABLE", "LAMPARA", "LED", "FOCO", "CONECTOR"]) and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        hay_material_electrico = True
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-            
-            # Si hay material eléctrico o códigos N1/N2, asignar la partida
-            hay_codigos = False
-            for _, nodos_valores in codigos_n1.items():
+
+        # Buscar si hay excavación en este nodo
+        for key, material_name, qty in indice.instalados(nodo):
+            if ("EXCAVACION" in material_name or "ZANJA" in material_name) and qty > 0:
+                hay_excavacion = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                break
+
+        # CORRECCIÓN: Si hay kit de puesta a tierra O trabajo con postes O excavación, asignar recuperación
+        if hay_kit_puesta_tierra or hay_trabajo_con_postes or hay_excavacion:
+            ctx.cantidad_mo = 1 * 0.3  # Asignar 1 unidad por nodo
+            materiales_instalados_relacionados.append(f"TIPO DE SUELO: ZONA BLANDA")
+            return ctx.resultado()       
+
+
+@regla_mano_obra('CONEXIÓN A CABLE A TIERRA', lambda d: "CONEXIÓN A CABLE A TIERRA" in d or "INSTALACION CONECTOR DE SPT" in d,
+                 datos_nodo=('codigos',))
+def regla_conexion_cable_tierra(ctx):
+    """Partida CONEXIÓN A CABLE A TIERRA."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    codigos_n1 = ctx.codigos_n1
+    codigos_n2 = ctx.codigos_n2
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    # Verificar si este nodo NO tiene un KIT SPT instalado
+    tiene_kit_spt = False
+
+    # Buscar KIT DE PUESTA A TIERRA en materiales instalados para este nodo
+    for material_key, material_name, qty in indice.instalados(nodo, "KIT DE PUESTA A TIERRA"):
+        if "KIT DE PUESTA A TIERRA" in material_name and qty > 0:
+            tiene_kit_spt = True
+            break
+
+    # Si NO tiene KIT SPT, asignar esta partida
+    if not tiene_kit_spt:
+        # Verificar si hay algún material eléctrico que requiera conexión a tierra
+        hay_material_electrico = False
+
+        # Buscar materiales eléctricos que típicamente requieren conexión a tierra
+        for material_key, material_name, qty in indice.instalados(nodo):
+            # Verificar si hay luminarias, cables, u otros componentes eléctricos
+            if any(keyword in material_name for keyword in ["LUMINARIA", "CABLE", "LAMPARA", "LED", "FOCO", "CONECTOR"]) and qty > 0:
+                hay_material_electrico = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+        # Si hay material eléctrico o códigos N1/N2, asignar la partida
+        hay_codigos = False
+        for _, nodos_valores in codigos_n1.items():
+            if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
+                hay_codigos = True
+                break
+
+        if not hay_codigos:
+            for _, nodos_valores in codigos_n2.items():
                 if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
                     hay_codigos = True
                     break
-            
-            if not hay_codigos:
-                for _, nodos_valores in codigos_n2.items():
-                    if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
-                        hay_codigos = True
-                        break
-            
-            if hay_material_electrico or hay_codigos:
-                cantidad_mo = 1
-                if not materiales_instalados_relacionados:
-                    materiales_instalados_relacionados.append("CONEXIÓN A TIERRA SIN KIT SPT ESPECÍFICO")
-                return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: TRANSPORTE COLLARINES ========
-    if "TRANSPORTE COLLARINES" in descripcion_upper:
-        cantidad_total = 0
-        tiene_abrazadera = False
-        
-        # Buscar ABRAZADERAS (CIEGAS y SENCILLAS) en materiales instalados
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Verificar si es una abrazadera (ciega o sencilla) con diferentes tamaños
-                es_abrazadera = (
-                    ("ABRAZADERA" in material_name and "CIEGA" in material_name) or
-                    ("ABRAZADERA" in material_name and "SENCILLA" in material_name)
-                )
-                
-                # Verificar tamaños específicos (6, 7, 8, 10 pulgadas)
-                tiene_tamano_valido = any(size in material_name for size in ["6", "7", "8", "10"])
-                
-                if es_abrazadera and tiene_tamano_valido and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_abrazadera = True
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        # También buscar en materiales retirados
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Verificar si es una abrazadera (ciega o sencilla) con diferentes tamaños
-                es_abrazadera = (
-                    ("ABRAZADERA" in material_name and "CIEGA" in material_name) or
-                    ("ABRAZADERA" in material_name and "SENCILLA" in material_name)
-                )
-                
-                # Verificar tamaños específicos (6, 7, 8, 10 pulgadas)
-                tiene_tamano_valido = any(size in material_name for size in ["6", "7", "8", "10"])
-                
-                if es_abrazadera and tiene_tamano_valido and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_abrazadera = True
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        # Si se encontró al menos una abrazadera, asignar mano de obra
-        if tiene_abrazadera:
-            cantidad_mo = cantidad_total
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: INSTALACION KIT SPT CON CINTA METALICA ========
-    if "INSTALACION KIT SPT CON CINTA METALICA" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar específicamente KIT DE PUESTA A TIERRA en materiales instalados
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Verificar si es el kit de puesta a tierra
-                if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
-                    cantidad_total += qty
-                    materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: DESMONTAJE CABLE SECUNDARIO #4 A #2/0 ========
-    if "DESMONTAJE CABLE SECUNDARIO #4 A #2/0" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar específicamente CABLE AL #4 o CABLE TRENZADO 2x4 en materiales retirados
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Verificar si es uno de los cables específicos mencionados
-                es_cable_al4 = "CABLE AL #4" in material_name
-                es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
-                es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
-                es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
-                
-                if (es_cable_al4 or es_cable_trenzado_2x4 or es_cable_tpx or es_cable_al_tpx) and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
+
+        if hay_material_electrico or hay_codigos:
+            ctx.cantidad_mo = 1
+            if not materiales_instalados_relacionados:
+                materiales_instalados_relacionados.append("CONEXIÓN A TIERRA SIN KIT SPT ESPECÍFICO")
+            return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE COLLARINES', lambda d: "TRANSPORTE COLLARINES" in d,
+                 disparadores=("ABRAZADERA",))
+def regla_transporte_collarines(ctx):
+    """Partida TRANSPORTE COLLARINES."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    cantidad_total = 0
+    tiene_abrazadera = False
+
+    # Buscar ABRAZADERAS (CIEGAS y SENCILLAS) en materiales instalados
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # Verificar si es una abrazadera (ciega o sencilla) con diferentes tamaños
+        es_abrazadera = (
+            ("ABRAZADERA" in material_name and "CIEGA" in material_name) or
+            ("ABRAZADERA" in material_name and "SENCILLA" in material_name)
+        )
+
+        # Verificar tamaños específicos (6, 7, 8, 10 pulgadas)
+        tiene_tamano_valido = any(size in material_name for size in ["6", "7", "8", "10"])
+
+        if es_abrazadera and tiene_tamano_valido and qty > 0:
+            tiene_abrazadera = True
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # También buscar en materiales retirados
+    for material_key, material_name, qty in indice.retirados(nodo):
+
+        # Verificar si es una abrazadera (ciega o sencilla) con diferentes tamaños
+        es_abrazadera = (
+            ("ABRAZADERA" in material_name and "CIEGA" in material_name) or
+            ("ABRAZADERA" in material_name and "SENCILLA" in material_name)
+        )
+
+        # Verificar tamaños específicos (6, 7, 8, 10 pulgadas)
+        tiene_tamano_valido = any(size in material_name for size in ["6", "7", "8", "10"])
+
+        if es_abrazadera and tiene_tamano_valido and qty > 0:
+            tiene_abrazadera = True
+            cantidad_total += qty
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    # Si se encontró al menos una abrazadera, asignar mano de obra
+    if tiene_abrazadera:
+        ctx.cantidad_mo = cantidad_total
+        return ctx.resultado()
+
+
+@regla_mano_obra('INSTALACION KIT SPT CON CINTA METALICA', lambda d: "INSTALACION KIT SPT CON CINTA METALICA" in d,
+                 disparadores=("KIT DE PUESTA A TIERRA",))
+def regla_kit_spt_cinta_metalica(ctx):
+    """Partida INSTALACION KIT SPT CON CINTA METALICA."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar específicamente KIT DE PUESTA A TIERRA en materiales instalados
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # Verificar si es el kit de puesta a tierra
+        if "KIT DE PUESTA A TIERRA" in material_name:
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('DESMONTAJE CABLE SECUNDARIO', lambda d: "DESMONTAJE CABLE SECUNDARIO #4 A #2/0" in d,
+                 disparadores=("CABLE",))
+def regla_desmontaje_cable_secundario(ctx):
+    """Partida DESMONTAJE CABLE SECUNDARIO."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar específicamente CABLE AL #4 o CABLE TRENZADO 2x4 en materiales retirados
+    for material_key, material_name, qty in indice.retirados(nodo):
+
+        # Verificar si es uno de los cables específicos mencionados
+        es_cable_al4 = "CABLE AL #4" in material_name
+        es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
+        es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
+        es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
+
+        if (es_cable_al4 or es_cable_trenzado_2x4 or es_cable_tpx or es_cable_al_tpx):
+            cantidad_total += qty
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('INSTALACION CABLE SECUNDARIO AEREO', lambda d: "INSTALACION CABLE SECUNDARIO #4 A #2/0 AEREO" in d,
+                 disparadores=("CABLE",))
+def regla_instalacion_cable_secundario(ctx):
+    """Partida INSTALACION CABLE SECUNDARIO AEREO."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # CORRECCIÓN: Buscar EXCLUSIVAMENTE en materiales_instalados
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # Verificar si es uno de los cables específicos mencionados
+        es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
+        es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
+        es_cable_al4 = "CABLE AL #4" in material_name
+        es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
+        # AGREGAR: Detección para CABLE DE CU THHN NRO. 6
+        es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
+
+        if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6):
+            if qty > 0:  # Solo contar si la cantidad es mayor a 0
+                # Multiplicar por 3 la cantidad para cables TPX y AL TPX
+                if es_cable_tpx or es_cable_al_tpx:
+                    cantidad_total += qty * 3
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
+                else:
                     cantidad_total += qty
-                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
-        
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: INSTALACION CABLE SECUNDARIO #4 A #2/0 AEREO ========
-    if "INSTALACION CABLE SECUNDARIO #4 A #2/0 AEREO" in descripcion_upper:
-        cantidad_total = 0
-
-        # CORRECCIÓN: Buscar EXCLUSIVAMENTE en materiales_instalados
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-
-                # Verificar si es uno de los cables específicos mencionados
-                es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
-                es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
-                es_cable_al4 = "CABLE AL #4" in material_name
-                es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
-                # AGREGAR: Detección para CABLE DE CU THHN NRO. 6
-                es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
-
-                if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6) and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
-                    if qty > 0:  # Solo contar si la cantidad es mayor a 0
-                        # Multiplicar por 3 la cantidad para cables TPX y AL TPX
-                        if es_cable_tpx or es_cable_al_tpx:
-                            cantidad_total += qty * 3
-                            materiales_instalados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
-                        else:
-                            cantidad_total += qty
-                            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
 
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: VESTIDA CONJUNTO 1 O 2 PERCHAS ========
-    if "VESTIDA CONJUNTO" in descripcion_upper and "PERCHAS" in descripcion_upper and "1 O 2" in descripcion_upper:
-        # Verificar si hay PERCHA GALV 1 PUESTO o PERCHA GALV 2 PUESTOS en este nodo
-        tiene_percha = False
-        cantidad_perchas = 0
-        
-        # Lista para almacenar los tipos de perchas encontrados
-        perchas_encontradas = []
-    
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Buscar perchas de 1 o 2 puestos con diferentes variantes de escritura
-                es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
-                es_percha_2_puestos = ("PERCHA GALV 2 PUESTO" in material_name or 
-                                      "PERCHA GALV 2 PUESTOS" in material_name)
-                
-                if (es_percha_1_puesto or es_percha_2_puestos) and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_percha = True
-                    cantidad_perchas += nodos_qty[nodo]
-                    perchas_encontradas.append(material_name)
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-    
-        # También buscar en materiales retirados por si hay perchas que se están reemplazando
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Buscar perchas de 1 o 2 puestos con diferentes variantes de escritura
-                es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
-                es_percha_2_puestos = ("PERCHA GALV 2 PUESTO" in material_name or 
-                                      "PERCHA GALV 2 PUESTOS" in material_name)
-                
-                if (es_percha_1_puesto or es_percha_2_puestos) and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    # No sumamos a cantidad_perchas porque no queremos duplicar la mano de obra
-                    # Solo registramos para información
-                    materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-    
-        if tiene_percha:
-            cantidad_mo = cantidad_perchas
-            # Agregar resumen de lo encontrado
-            if perchas_encontradas:
-                materiales_instalados_relacionados.append(f"Total perchas 1-2 puestos: {cantidad_perchas}")
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: VESTIDA CONJUNTO 3 O MAS PERCHAS ========
-    if "VESTIDA CONJUNTO" in descripcion_upper and "PERCHAS" in descripcion_upper and "3 O MAS" in descripcion_upper:
-        # Verificar si hay perchas de 3 o más puestos en este nodo
-        tiene_percha_grande = False
-        cantidad_perchas = 0
-        
-        # Lista para almacenar los tipos de perchas encontrados
-        perchas_encontradas = []
-    
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Buscar perchas de 3 o más puestos
-                if "PERCHA GALV" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    # Intentar extraer el número de puestos
-                    puestos_match = re.search(r'(\d+)\s*PUESTO', material_name)
-                    if puestos_match:
-                        try:
-                            puestos = int(puestos_match.group(1))
-                            if puestos >= 3:
-                                tiene_percha_grande = True
-                                cantidad_perchas += nodos_qty[nodo]
-                                perchas_encontradas.append(material_name)
-                                materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        except:
-                            pass
-                    # Si no se puede extraer el número pero contiene "3" o más
-                    elif any(f"{i} PUESTO" in material_name or f"{i} PUESTOS" in material_name for i in range(3, 10)):
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('VESTIDA CONJUNTO 1 O 2 PERCHAS', lambda d: "VESTIDA CONJUNTO" in d and "PERCHAS" in d and "1 O 2" in d,
+                 disparadores=("PERCHA GALV",))
+def regla_vestida_1_o_2_perchas(ctx):
+    """Partida VESTIDA CONJUNTO 1 O 2 PERCHAS."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Verificar si hay PERCHA GALV 1 PUESTO o PERCHA GALV 2 PUESTOS en este nodo
+    tiene_percha = False
+    cantidad_perchas = 0
+
+    # Lista para almacenar los tipos de perchas encontrados
+    perchas_encontradas = []
+
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # Buscar perchas de 1 o 2 puestos con diferentes variantes de escritura
+        es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
+        es_percha_2_puestos = ("PERCHA GALV 2 PUESTO" in material_name or 
+                              "PERCHA GALV 2 PUESTOS" in material_name)
+
+        if (es_percha_1_puesto or es_percha_2_puestos) and qty > 0:
+            tiene_percha = True
+            cantidad_perchas += qty
+            perchas_encontradas.append(material_name)
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # También buscar en materiales retirados por si hay perchas que se están reemplazando
+    for material_key, material_name, qty in indice.retirados(nodo):
+
+        # Buscar perchas de 1 o 2 puestos con diferentes variantes de escritura
+        es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
+        es_percha_2_puestos = ("PERCHA GALV 2 PUESTO" in material_name or 
+                              "PERCHA GALV 2 PUESTOS" in material_name)
+
+        if (es_percha_1_puesto or es_percha_2_puestos) and qty > 0:
+            # No sumamos a cantidad_perchas porque no queremos duplicar la mano de obra
+            # Solo registramos para información
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    if tiene_percha:
+        ctx.cantidad_mo = cantidad_perchas
+        # Agregar resumen de lo encontrado
+        if perchas_encontradas:
+            materiales_instalados_relacionados.append(f"Total perchas 1-2 puestos: {cantidad_perchas}")
+        return ctx.resultado()
+
+
+@regla_mano_obra('VESTIDA CONJUNTO 3 O MAS PERCHAS', lambda d: "VESTIDA CONJUNTO" in d and "PERCHAS" in d and "3 O MAS" in d,
+                 disparadores=("PERCHA GALV",))
+def regla_vestida_3_o_mas_perchas(ctx):
+    """Partida VESTIDA CONJUNTO 3 O MAS PERCHAS."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Verificar si hay perchas de 3 o más puestos en este nodo
+    tiene_percha_grande = False
+    cantidad_perchas = 0
+
+    # Lista para almacenar los tipos de perchas encontrados
+    perchas_encontradas = []
+
+    for material_key, material_name, qty in indice.instalados(nodo, "PERCHA GALV"):
+
+        # Buscar perchas de 3 o más puestos
+        if "PERCHA GALV" in material_name and qty > 0:
+            # Intentar extraer el número de puestos
+            puestos_match = re.search(r'(\d+)\s*PUESTO', material_name)
+            if puestos_match:
+                try:
+                    puestos = int(puestos_match.group(1))
+                    if puestos >= 3:
                         tiene_percha_grande = True
-                        cantidad_perchas += nodos_qty[nodo]
+                        cantidad_perchas += qty
                         perchas_encontradas.append(material_name)
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-    
-        # También buscar en materiales retirados por si hay perchas que se están reemplazando
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Buscar perchas de 3 o más puestos
-                if "PERCHA GALV" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    # Intentar extraer el número de puestos
-                    puestos_match = re.search(r'(\d+)\s*PUESTO', material_name)
-                    if puestos_match:
-                        try:
-                            puestos = int(puestos_match.group(1))
-                            if puestos >= 3:
-                                # No sumamos a cantidad_perchas porque no queremos duplicar la mano de obra
-                                # Solo registramos para información
-                                materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        except:
-                            pass
-                    # Si no se puede extraer el número pero contiene "3" o más
-                    elif any(f"{i} PUESTO" in material_name or f"{i} PUESTOS" in material_name for i in range(3, 10)):
-                        materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-    
-        if tiene_percha_grande:
-            cantidad_mo = cantidad_perchas
-            # Agregar resumen de lo encontrado
-            if perchas_encontradas:
-                materiales_instalados_relacionados.append(f"Total perchas 3+ puestos: {cantidad_perchas}")
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CASO ESPECIAL: TRANSPORTE PERCHA CON AISLADOR ========
-    if "TRANSPORTE PERCHA" in descripcion_upper and "AISLADOR" in descripcion_upper:
-        # Verificar si hay AISLADOR CARR A.P ANSI 53-2- 3" y cualquier tipo de PERCHA GALV en este nodo
-        tiene_aislador = False
-        tiene_percha_galv = False
-        cantidad_aisladores = 0
-        cantidad_perchas = 0
-
-        # Lista para almacenar los tipos de perchas encontrados para mostrar en materiales relacionados
-        perchas_encontradas = []
-        aisladores_encontrados = []
-
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-
-                # Detectar aisladores
-                if "AISLADOR CARR A.P ANSI 53-2" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_aislador = True
-                    cantidad_aisladores += nodos_qty[nodo]
-                    aisladores_encontrados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-                # Detectar todos los tipos de perchas galvanizadas
-                if "PERCHA GALV" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_percha_galv = True
-                    cantidad_perchas += nodos_qty[nodo]
-                    perchas_encontradas.append(f"{material_name} ({nodos_qty[nodo]})")
-
-                    # Verificar específicamente los diferentes tipos de perchas
-                    es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
-                    es_percha_2_puestos = "PERCHA GALV 2 PUESTO" in material_name or "PERCHA GALV 2 PUESTOS" in material_name
-                    es_percha_3_puestos = "PERCHA GALV 3 PUESTO" in material_name or "PERCHA GALV 3 PUESTOS" in material_name
-
-                    # Registrar el tipo específico de percha encontrada
-                    if es_percha_1_puesto or es_percha_2_puestos or es_percha_3_puestos:
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-        # También buscar en materiales retirados por si hay perchas o aisladores que se están transportando
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-
-                # Detectar aisladores retirados
-                if "AISLADOR CARR A.P ANSI 53-2" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_aislador = True
-                    cantidad_aisladores += nodos_qty[nodo]
-                    aisladores_encontrados.append(f"{material_name} ({nodos_qty[nodo]})")
-                    materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-                # Detectar todos los tipos de perchas galvanizadas retiradas
-                if "PERCHA GALV" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_percha_galv = True
-                    cantidad_perchas += nodos_qty[nodo]
-                    perchas_encontradas.append(f"{material_name} ({nodos_qty[nodo]})")
-
-                    # Verificar específicamente los diferentes tipos de perchas
-                    es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
-                    es_percha_2_puestos = "PERCHA GALV 2 PUESTO" in material_name or "PERCHA GALV 2 PUESTOS" in material_name
-                    es_percha_3_puestos = "PERCHA GALV 3 PUESTO" in material_name or "PERCHA GALV 3 PUESTOS" in material_name
-
-                    # Registrar el tipo específico de percha encontrada
-                    if es_percha_1_puesto or es_percha_2_puestos or es_percha_3_puestos:
-                        materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-        # Si hay aisladores y perchas, asignar mano de obra para transporte
-        if tiene_aislador and tiene_percha_galv:
-            # La cantidad debe ser el mínimo entre aisladores y perchas
-            cantidad_mo = min(cantidad_aisladores, cantidad_perchas)
-
-            # Si no se encontraron materiales específicos pero sabemos que hay perchas y aisladores
-            if not materiales_instalados_relacionados and not materiales_retirados_relacionados:
-                materiales_instalados_relacionados.append("TRANSPORTE DE PERCHAS Y AISLADORES")
-
-            # Agregar resumen de lo encontrado
-            if aisladores_encontrados:
-                materiales_instalados_relacionados.append(f"Total aisladores: {cantidad_aisladores}")
-            if perchas_encontradas:
-                materiales_instalados_relacionados.append(f"Total perchas: {cantidad_perchas}")
-
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-        
-        elif tiene_percha_galv:
-            
-            cantidad_mo = cantidad_perchas
-            if perchas_encontradas:
-                materiales_instalados_relacionados.append(f"Total perchas: {cantidad_perchas}")
-            
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    if "INSTALACION DE ATERRIZAJES SECUNDARIOS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar VARILLA COOPERWELD en materiales instalados
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                # Verificar si es una varilla cooperweld
-                if ("VARILLA COOPERWELD" in material_name and "5/8" in material_name and 
-                    nodo in nodos_qty and nodos_qty[nodo] > 0):
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        # Si se encontró al menos una varilla, asignar mano de obra
-        if cantidad_total > 0:
-            cantidad_mo = cantidad_total
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                
-    # ======== CASO ESPECIAL: TRANSPORTE VARILLA TIERRA Y/O KIT TIERRA ACERO ========
-    if "TRASPORTE VARILLA TIERRA" in descripcion_upper or "TRANSPORTE VARILLA TIERRA" in descripcion_upper:
-        # Verificar si hay VARILLA COOPERWELD 5/8″ X 2.4 MT o KIT DE PUESTA A TIERRA en este nodo
-        tiene_varilla = False
-        tiene_kit_tierra = False
-        cantidad_varillas = 0
-        cantidad_kits = 0
-        
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                
-                if "VARILLA COOPERWELD" in material_name and "5/8" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_varilla = True
-                    cantidad_varillas += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                
-                if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_kit_tierra = True
-                    cantidad_kits += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        # Si hay varilla o kit de tierra, asignar la mano de obra
-        if tiene_varilla or tiene_kit_tierra:
-            # La cantidad debe ser la suma de varillas y kits
-            cantidad_mo = cantidad_varillas + cantidad_kits
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CÁLCULO COMÚN DE LUMINARIAS INSTALADAS ========
+                        materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                except:
+                    pass
+            # Si no se puede extraer el número pero contiene "3" o más
+            elif any(f"{i} PUESTO" in material_name or f"{i} PUESTOS" in material_name for i in range(3, 10)):
+                tiene_percha_grande = True
+                cantidad_perchas += qty
+                perchas_encontradas.append(material_name)
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # También buscar en materiales retirados por si hay perchas que se están reemplazando
+    for material_key, material_name, qty in indice.retirados(nodo, "PERCHA GALV"):
+
+        # Buscar perchas de 3 o más puestos
+        if "PERCHA GALV" in material_name and qty > 0:
+            # Intentar extraer el número de puestos
+            puestos_match = re.search(r'(\d+)\s*PUESTO', material_name)
+            if puestos_match:
+                try:
+                    puestos = int(puestos_match.group(1))
+                    if puestos >= 3:
+                        # No sumamos a cantidad_perchas porque no queremos duplicar la mano de obra
+                        # Solo registramos para información
+                        materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+                except:
+                    pass
+            # Si no se puede extraer el número pero contiene "3" o más
+            elif any(f"{i} PUESTO" in material_name or f"{i} PUESTOS" in material_name for i in range(3, 10)):
+                materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    if tiene_percha_grande:
+        ctx.cantidad_mo = cantidad_perchas
+        # Agregar resumen de lo encontrado
+        if perchas_encontradas:
+            materiales_instalados_relacionados.append(f"Total perchas 3+ puestos: {cantidad_perchas}")
+        return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE PERCHA CON AISLADOR', lambda d: "TRANSPORTE PERCHA" in d and "AISLADOR" in d,
+                 disparadores=("PERCHA GALV",))
+def regla_transporte_percha_aislador(ctx):
+    """Partida TRANSPORTE PERCHA CON AISLADOR."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Verificar si hay AISLADOR CARR A.P ANSI 53-2- 3" y cualquier tipo de PERCHA GALV en este nodo
+    tiene_aislador = False
+    tiene_percha_galv = False
+    cantidad_aisladores = 0
+    cantidad_perchas = 0
+
+    # Lista para almacenar los tipos de perchas encontrados para mostrar en materiales relacionados
+    perchas_encontradas = []
+    aisladores_encontrados = []
+
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # Detectar aisladores
+        if "AISLADOR CARR A.P ANSI 53-2" in material_name and qty > 0:
+            tiene_aislador = True
+            cantidad_aisladores += qty
+            aisladores_encontrados.append(f"{material_name} ({qty})")
+
+        # Detectar todos los tipos de perchas galvanizadas
+        if "PERCHA GALV" in material_name and qty > 0:
+            tiene_percha_galv = True
+            cantidad_perchas += qty
+            perchas_encontradas.append(f"{material_name} ({qty})")
+
+            # Verificar específicamente los diferentes tipos de perchas
+            es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
+            es_percha_2_puestos = "PERCHA GALV 2 PUESTO" in material_name or "PERCHA GALV 2 PUESTOS" in material_name
+            es_percha_3_puestos = "PERCHA GALV 3 PUESTO" in material_name or "PERCHA GALV 3 PUESTOS" in material_name
+
+            # Registrar el tipo específico de percha encontrada
+            if es_percha_1_puesto or es_percha_2_puestos or es_percha_3_puestos:
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # También buscar en materiales retirados por si hay perchas o aisladores que se están transportando
+    for material_key, material_name, qty in indice.retirados(nodo):
+
+        # Detectar aisladores retirados
+        if "AISLADOR CARR A.P ANSI 53-2" in material_name and qty > 0:
+            tiene_aislador = True
+            cantidad_aisladores += qty
+            aisladores_encontrados.append(f"{material_name} ({qty})")
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+        # Detectar todos los tipos de perchas galvanizadas retiradas
+        if "PERCHA GALV" in material_name and qty > 0:
+            tiene_percha_galv = True
+            cantidad_perchas += qty
+            perchas_encontradas.append(f"{material_name} ({qty})")
+
+            # Verificar específicamente los diferentes tipos de perchas
+            es_percha_1_puesto = "PERCHA GALV 1 PUESTO" in material_name
+            es_percha_2_puestos = "PERCHA GALV 2 PUESTO" in material_name or "PERCHA GALV 2 PUESTOS" in material_name
+            es_percha_3_puestos = "PERCHA GALV 3 PUESTO" in material_name or "PERCHA GALV 3 PUESTOS" in material_name
+
+            # Registrar el tipo específico de percha encontrada
+            if es_percha_1_puesto or es_percha_2_puestos or es_percha_3_puestos:
+                materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    # Si hay aisladores y perchas, asignar mano de obra para transporte
+    if tiene_aislador and tiene_percha_galv:
+        # La cantidad debe ser el mínimo entre aisladores y perchas
+        ctx.cantidad_mo = min(cantidad_aisladores, cantidad_perchas)
+
+        # Si no se encontraron materiales específicos pero sabemos que hay perchas y aisladores
+        if not materiales_instalados_relacionados and not materiales_retirados_relacionados:
+            materiales_instalados_relacionados.append("TRANSPORTE DE PERCHAS Y AISLADORES")
+
+        # Agregar resumen de lo encontrado
+        if aisladores_encontrados:
+            materiales_instalados_relacionados.append(f"Total aisladores: {cantidad_aisladores}")
+        if perchas_encontradas:
+            materiales_instalados_relacionados.append(f"Total perchas: {cantidad_perchas}")
+
+        return ctx.resultado()
+
+    elif tiene_percha_galv:
+
+        ctx.cantidad_mo = cantidad_perchas
+        if perchas_encontradas:
+            materiales_instalados_relacionados.append(f"Total perchas: {cantidad_perchas}")
+
+        return ctx.resultado()
+
+
+@regla_mano_obra('INSTALACION DE ATERRIZAJES SECUNDARIOS', lambda d: "INSTALACION DE ATERRIZAJES SECUNDARIOS" in d,
+                 disparadores=("VARILLA COOPERWELD",))
+def regla_aterrizajes_secundarios(ctx):
+    """Partida INSTALACION DE ATERRIZAJES SECUNDARIOS."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar VARILLA COOPERWELD en materiales instalados
+    for material_key, material_name, qty in indice.instalados(nodo, "VARILLA COOPERWELD"):
+
+        # Verificar si es una varilla cooperweld
+        if ("VARILLA COOPERWELD" in material_name and "5/8" in material_name and 
+            qty > 0):
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # Si se encontró al menos una varilla, asignar mano de obra
+    if cantidad_total > 0:
+        ctx.cantidad_mo = cantidad_total
+        return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE VARILLA TIERRA', lambda d: "TRASPORTE VARILLA TIERRA" in d or "TRANSPORTE VARILLA TIERRA" in d,
+                 disparadores=("VARILLA COOPERWELD", "KIT DE PUESTA A TIERRA"))
+def regla_transporte_varilla_tierra(ctx):
+    """Partida TRANSPORTE VARILLA TIERRA."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    # Verificar si hay VARILLA COOPERWELD 5/8″ X 2.4 MT o KIT DE PUESTA A TIERRA en este nodo
+    tiene_varilla = False
+    tiene_kit_tierra = False
+    cantidad_varillas = 0
+    cantidad_kits = 0
+
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        if "VARILLA COOPERWELD" in material_name and "5/8" in material_name and qty > 0:
+            tiene_varilla = True
+            cantidad_varillas += qty
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+        if "KIT DE PUESTA A TIERRA" in material_name and qty > 0:
+            tiene_kit_tierra = True
+            cantidad_kits += qty
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # Si hay varilla o kit de tierra, asignar la mano de obra
+    if tiene_varilla or tiene_kit_tierra:
+        # La cantidad debe ser la suma de varillas y kits
+        ctx.cantidad_mo = cantidad_varillas + cantidad_kits
+        return ctx.resultado()
+
+
+@regla_mano_obra('CONTEO COMUN DE LUMINARIAS', lambda d: True,
+                 disparadores=(), datos_nodo=('codigos',))
+def regla_conteo_luminarias(ctx):
+    """
+    Cálculo común de luminarias instaladas.
+
+    Aplica a toda partida que llega a este punto: agrega al detalle los códigos N1/N2
+    y las luminarias instaladas del nodo.
+    """
+    indice = ctx.indice
+    nodo = ctx.nodo
+    codigos_n1 = ctx.codigos_n1
+    codigos_n2 = ctx.codigos_n2
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
     # Calcular la cantidad total de luminarias instaladas (para usar en múltiples secciones)
     luminarias_instaladas_count = 0
     
@@ -3132,1175 +4410,1745 @@ def calcular_cantidad_mano_obra(descripcion, materiales_instalados, materiales_r
     
     # 2. Buscar luminarias instaladas en materiales
     luminarias_encontradas = False
-    for material_key, nodos_qty in materiales_instalados.items():
-        if "|" in material_key:
-            material_name = material_key.split("|")[1].upper()
-            
-            # Detección ampliada de luminarias con patrones más flexibles
-            es_luminaria = (
-                "LUMINARIA" in material_name or 
-                "LUM" in material_name or
-                "LED" in material_name or
-                "LAMP" in material_name or
-                "FOCO" in material_name or
-                re.search(r'LUMINARIA N[12]', material_name) is not None or
-                any(kw in material_name for kw in luminaria_keywords)
-            )
-            
-            if es_luminaria and nodo in nodos_qty:
-                qty = nodos_qty[nodo]
-                if qty > 0:
-                    luminarias_instaladas_count += qty
-                    luminarias_encontradas = True
-                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
-    
-    # ======== INSTALACIÓN DE LUMINARIAS ========                
-
-    # Verificar si la descripción corresponde a instalación de luminarias
-    if "INSTALACION DE LUMINARIAS" in descripcion_upper:        
-        print(f"DEBUG: Entrando en INSTALACION DE LUMINARIAS para nodo {nodo}")
-        print(f"DEBUG: Es proyecto: {es_proyecto}, Tipo instalación: {tipo_instalacion_detectado}")
-        
-        # CORRECCIÓN CRÍTICA: Calcular correctamente la cantidad total de luminarias
-        total_luminarias_a_instalar = 0
-        
-        if es_proyecto:
-            print(f"DEBUG: Procesando INSTALACIÓN PROYECTO - Nodo: {nodo}, Tipo: {tipo_instalacion_detectado}")
-            
-            tiene_codigo_n1 = False
-            tiene_codigo_n2 = False
-            
-            # 1. Verificar códigos N1 válidos (excluyendo NO, N/A, NA)
-            if codigos_n1:
-                for key_codigo, nodos_valores in codigos_n1.items():
-                    if nodo in nodos_valores:
-                        codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
-                        if len(codigos_validos) > 0:
-                            tiene_codigo_n1 = True
-                            materiales_instalados_relacionados.append(f"CÓDIGO N1: {', '.join(codigos_validos)}")
-                            print(f"DEBUG: Códigos N1 encontrados: {codigos_validos}")
-
-            # 2. Verificar códigos N2 válidos (excluyendo NO, N/A, NA)
-            if codigos_n2:
-                for key_codigo, nodos_valores in codigos_n2.items():
-                    if nodo in nodos_valores:
-                        codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
-                        if len(codigos_validos) > 0:
-                            tiene_codigo_n2 = True
-                            materiales_instalados_relacionados.append(f"CÓDIGO N2: {', '.join(codigos_validos)}")
-                            print(f"DEBUG: Códigos N2 encontrados: {codigos_validos}")
-
-            # 3. Buscar luminarias instaladas directamente
-            luminarias_instaladas_directas = 0
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        luminarias_instaladas_directas += nodos_qty[nodo]
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        print(f"DEBUG: Luminarias instaladas directas: {nodos_qty[nodo]}")
-
-            # CORRECCIÓN CRÍTICA: Para proyectos, si hay códigos N1 o N2 (o ambos), cuenta como 1 luminaria por nodo
-            # Solo sumar luminarias directas si las hay
-            if tiene_codigo_n1 or tiene_codigo_n2:
-                total_luminarias_a_instalar = 1  # Una luminaria por nodo que tenga códigos
-            
-            total_luminarias_a_instalar += luminarias_instaladas_directas
-            
-            print(f"DEBUG: Total luminarias proyecto: Códigos({1 if (tiene_codigo_n1 or tiene_codigo_n2) else 0}) + Directas({luminarias_instaladas_directas}) = {total_luminarias_a_instalar}")
+    for material_key, material_name, qty in indice.instalados(nodo):
             
-        else:
-            # LÓGICA PARA MODERNIZACIÓN (sin cambios)
-            print(f"DEBUG: Procesando INSTALACIÓN MODERNIZACIÓN - Nodo: {nodo}")
-            
-            # Para modernización, buscar LUMINARIA CODIGO/BRAZO
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        total_luminarias_a_instalar += nodos_qty[nodo]
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        print(f"DEBUG: Luminarias código/brazo: {nodos_qty[nodo]}")
-
-        print(f"DEBUG: Cantidad total luminarias a instalar: {total_luminarias_a_instalar}")
-        
-        if total_luminarias_a_instalar > 0:
-            if es_proyecto:
-                # CORRECCIÓN: Mapear correctamente para proyectos
-                if "CANASTA" in descripcion_upper:
-                    if ("CANASTA" in tipo_instalacion_detectado or 
-                        "1.CANASTA" in tipo_instalacion_detectado or 
-                        "1.Canasta" in tipo_instalacion_detectado):
-                        cantidad_mo = total_luminarias_a_instalar
-                        materiales_instalados_relacionados.append(f"INSTALACIÓN EN CANASTA (PROYECTO): {total_luminarias_a_instalar} luminarias")
-                        print(f"DEBUG: Asignando CANASTA (PROYECTO) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                        
-                elif "ESCALERA" in descripcion_upper:
-                    if ("ESCALERA" in tipo_instalacion_detectado or 
-                        "2.ESCALERA" in tipo_instalacion_detectado or 
-                        "2.Escalera" in tipo_instalacion_detectado):
-                        cantidad_mo = total_luminarias_a_instalar
-                        materiales_instalados_relacionados.append(f"INSTALACIÓN EN ESCALERA (PROYECTO): {total_luminarias_a_instalar} luminarias")
-                        print(f"DEBUG: Asignando ESCALERA (PROYECTO) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                        
-                elif "CAMIONETA" in descripcion_upper:
-                    if ("CAMIONETA" in tipo_instalacion_detectado or 
-                        "3.CAMIONETA" in tipo_instalacion_detectado or 
-                        "3.Camioneta" in tipo_instalacion_detectado):
-                        cantidad_mo = total_luminarias_a_instalar
-                        materiales_instalados_relacionados.append(f"INSTALACIÓN EN CAMIONETA (PROYECTO): {total_luminarias_a_instalar} luminarias")
-                        print(f"DEBUG: Asignando CAMIONETA (PROYECTO) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                        
-                print(f"DEBUG: No coincide tipo para PROYECTO - tipo: {tipo_instalacion_detectado}, descripción: {descripcion}")
-                return 0, [], []
+        # Detección ampliada de luminarias con patrones más flexibles
+        es_luminaria = (
+            "LUMINARIA" in material_name or 
+            "LUM" in material_name or
+            "LED" in material_name or
+            "LAMP" in material_name or
+            "FOCO" in material_name or
+            re.search(r'LUMINARIA N[12]', material_name) is not None or
+            any(kw in material_name for kw in luminaria_keywords)
+        )
             
-            else:
-                # LÓGICA PARA MODERNIZACIÓN (sin cambios)
-                print(f"DEBUG: Procesando INSTALACIÓN MODERNIZACIÓN - Nodo: {nodo}")
-                
-                if total_luminarias_a_instalar > 0:
-                    print(f"DEBUG: Hay LUMINARIA CODIGO/BRAZO: {total_luminarias_a_instalar}")
-                    
-                    # Verificar brazos para determinar tipo de instalación
-                    tiene_brazos_grandes = False
-                    brazos_info = []
-                    
-                    for material_key, nodos_qty in materiales_instalados.items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                brazos_info.append(f"{material_name} ({nodos_qty[nodo]})")
-                                
-                                # Determinar si es brazo grande (>= 3M)
-                                longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                                if longitud_match:
-                                    try:
-                                        longitud = int(longitud_match.group(1))
-                                        if longitud >= 3:
-                                            tiene_brazos_grandes = True
-                                            print(f"DEBUG: Brazo grande encontrado: {material_name}")
-                                    except:
-                                        pass
-                                elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                    tiene_brazos_grandes = True
-                                    print(f"DEBUG: Brazo 3M encontrado: {material_name}")
-
-                    print(f"DEBUG: Tiene brazos grandes: {tiene_brazos_grandes}")
-
-                    # Asignar según el tipo de instalación y brazos
-                    if "CANASTA" in descripcion_upper and tiene_brazos_grandes:
-                        cantidad_mo = total_luminarias_a_instalar
-                        materiales_instalados_relacionados.append(f"INSTALACIÓN EN CANASTA (MODERNIZACIÓN): {total_luminarias_a_instalar} luminarias con brazos >= 3M")
-                        materiales_instalados_relacionados.extend(brazos_info)
-                        print(f"DEBUG: Asignando CANASTA (MODERNIZACIÓN) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                    elif "CAMIONETA" in descripcion_upper and not tiene_brazos_grandes:
-                        cantidad_mo = total_luminarias_a_instalar
-                        materiales_instalados_relacionados.append(f"INSTALACIÓN EN CAMIONETA (MODERNIZACIÓN): {total_luminarias_a_instalar} luminarias con brazos < 3M")
-                        materiales_instalados_relacionados.extend(brazos_info)
-                        print(f"DEBUG: Asignando CAMIONETA (MODERNIZACIÓN) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-        print(f"DEBUG: No se asignó instalación de luminarias para nodo {nodo}")
-        return 0, [], []    
-    
-    # ======== DESMONTAJE DE LUMINARIAS ========
-    if "DESMONTAJE DE LUMINARIAS" in descripcion_upper and ("CAMIONETA" in descripcion_upper or "CANASTA" in descripcion_upper or "ESCALERA" in descripcion_upper):
-        print(f"DEBUG: Entrando en DESMONTAJE DE LUMINARIAS para nodo {nodo}")
-        print(f"DEBUG: Es proyecto: {es_proyecto}, Tipo instalación: {tipo_instalacion_detectado}")
-        
-        # Buscar luminarias retiradas
-        luminarias_retiradas_count = 0
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                es_luminaria_retirada = (
-                    "LUMINARIA" in material_name or
-                    "LUM" in material_name or
-                    "LED" in material_name or
-                    "LAMP" in material_name or
-                    "FOCO" in material_name
-                )
-                
-                if es_luminaria_retirada and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
-                    luminarias_retiradas_count += qty
-                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
-                    print(f"DEBUG: Luminarias retiradas encontradas: {material_name} ({qty})")
-
-        print(f"DEBUG: Total luminarias retiradas: {luminarias_retiradas_count}")
-
+        if es_luminaria:
+            if qty > 0:
+                luminarias_instaladas_count += qty
+                luminarias_encontradas = True
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+
+@regla_mano_obra('INSTALACION DE LUMINARIAS', lambda d: "INSTALACION DE LUMINARIAS" in d,
+                 datos_nodo=('codigos', 'tipo_instalacion'))
+def regla_instalacion_luminarias(ctx):
+    """Partida INSTALACION DE LUMINARIAS."""
+    indice = ctx.indice
+    descripcion = ctx.descripcion
+    descripcion_upper = ctx.descripcion_upper
+    nodo = ctx.nodo
+    codigos_n1 = ctx.codigos_n1
+    codigos_n2 = ctx.codigos_n2
+    es_proyecto = ctx.es_proyecto
+    tipo_instalacion_detectado = ctx.tipo_instalacion_detectado
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    logger.debug("Entrando en INSTALACION DE LUMINARIAS para nodo %s", nodo)
+    logger.debug("Es proyecto: %s, Tipo instalación: %s", es_proyecto, tipo_instalacion_detectado)
+
+    # CORRECCIÓN CRÍTICA: Calcular correctamente la cantidad total de luminarias
+    total_luminarias_a_instalar = 0
+
+    if es_proyecto:
+        logger.debug("Procesando INSTALACIÓN PROYECTO - Nodo: %s, Tipo: %s", nodo, tipo_instalacion_detectado)
+
+        tiene_codigo_n1 = False
+        tiene_codigo_n2 = False
+
+        # 1. Verificar códigos N1 válidos (excluyendo NO, N/A, NA)
+        if codigos_n1:
+            for key_codigo, nodos_valores in codigos_n1.items():
+                if nodo in nodos_valores:
+                    codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
+                    if len(codigos_validos) > 0:
+                        tiene_codigo_n1 = True
+                        materiales_instalados_relacionados.append(f"CÓDIGO N1: {', '.join(codigos_validos)}")
+                        logger.debug("Códigos N1 encontrados: %s", codigos_validos)
+
+        # 2. Verificar códigos N2 válidos (excluyendo NO, N/A, NA)
+        if codigos_n2:
+            for key_codigo, nodos_valores in codigos_n2.items():
+                if nodo in nodos_valores:
+                    codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
+                    if len(codigos_validos) > 0:
+                        tiene_codigo_n2 = True
+                        materiales_instalados_relacionados.append(f"CÓDIGO N2: {', '.join(codigos_validos)}")
+                        logger.debug("Códigos N2 encontrados: %s", codigos_validos)
+
+        # 3. Buscar luminarias instaladas directamente
+        luminarias_instaladas_directas = 0
+        for material_key, material_name, qty in indice.instalados(nodo, "LUMINARIA"):
+            if "LUMINARIA INSTALADA" in material_name and qty > 0:
+                luminarias_instaladas_directas += qty
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                logger.debug("Luminarias instaladas directas: %s", qty)
+
+        # CORRECCIÓN CRÍTICA: Para proyectos, si hay códigos N1 o N2 (o ambos), cuenta como 1 luminaria por nodo
+        # Solo sumar luminarias directas si las hay
+        if tiene_codigo_n1 or tiene_codigo_n2:
+            total_luminarias_a_instalar = 1  # Una luminaria por nodo que tenga códigos
+
+        total_luminarias_a_instalar += luminarias_instaladas_directas
+
+        logger.debug("Total luminarias proyecto: Códigos(%s) + Directas(%s) = %s", 1 if (tiene_codigo_n1 or tiene_codigo_n2) else 0, luminarias_instaladas_directas, total_luminarias_a_instalar)
+
+    else:
+        # LÓGICA PARA MODERNIZACIÓN (sin cambios)
+        logger.debug("Procesando INSTALACIÓN MODERNIZACIÓN - Nodo: %s", nodo)
+
+        # Para modernización, buscar LUMINARIA CODIGO/BRAZO
+        for material_key, material_name, qty in indice.instalados(nodo, "BRAZO"):
+            if "LUMINARIA CODIGO/BRAZO" in material_name and qty > 0:
+                total_luminarias_a_instalar += qty
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                logger.debug("Luminarias código/brazo: %s", qty)
+
+    logger.debug("Cantidad total luminarias a instalar: %s", total_luminarias_a_instalar)
+
+    if total_luminarias_a_instalar > 0:
         if es_proyecto:
-            print(f"DEBUG: Procesando DESMONTAJE PROYECTO - Nodo: {nodo}, Tipo: {tipo_instalacion_detectado}")
-            
-            # CORRECCIÓN: Para proyectos, usar EXACTAMENTE la cantidad de luminarias retiradas
-            if "DESMONTAJE DE LUMINARIAS EN CANASTA" in descripcion_upper:
+            # CORRECCIÓN: Mapear correctamente para proyectos
+            if "CANASTA" in descripcion_upper:
                 if ("CANASTA" in tipo_instalacion_detectado or 
                     "1.CANASTA" in tipo_instalacion_detectado or 
                     "1.Canasta" in tipo_instalacion_detectado):
-                    # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
-                    cantidad_mo = luminarias_retiradas_count  # Cambio aquí
-                    if cantidad_mo > 0:
-                        materiales_retirados_relacionados.append(f"DESMONTAJE EN CANASTA (PROYECTO): {cantidad_mo} luminarias")
-                        print(f"DEBUG: Asignando DESMONTAJE CANASTA (PROYECTO) - cantidad: {cantidad_mo}")
-                    return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                    
-            elif "DESMONTAJE DE LUMINARIAS EN ESCALERA" in descripcion_upper:
+                    ctx.cantidad_mo = total_luminarias_a_instalar
+                    materiales_instalados_relacionados.append(f"INSTALACIÓN EN CANASTA (PROYECTO): {total_luminarias_a_instalar} luminarias")
+                    logger.debug("Asignando CANASTA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+
+            elif "ESCALERA" in descripcion_upper:
                 if ("ESCALERA" in tipo_instalacion_detectado or 
                     "2.ESCALERA" in tipo_instalacion_detectado or 
                     "2.Escalera" in tipo_instalacion_detectado):
-                    # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
-                    cantidad_mo = luminarias_retiradas_count  # Cambio aquí
-                    if cantidad_mo > 0:
-                        materiales_retirados_relacionados.append(f"DESMONTAJE EN ESCALERA (PROYECTO): {cantidad_mo} luminarias")
-                        print(f"DEBUG: Asignando DESMONTAJE ESCALERA (PROYECTO) - cantidad: {cantidad_mo}")
-                    return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                    
-            elif "DESMONTAJE DE LUMINARIAS EN CAMIONETA" in descripcion_upper:
+                    ctx.cantidad_mo = total_luminarias_a_instalar
+                    materiales_instalados_relacionados.append(f"INSTALACIÓN EN ESCALERA (PROYECTO): {total_luminarias_a_instalar} luminarias")
+                    logger.debug("Asignando ESCALERA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+
+            elif "CAMIONETA" in descripcion_upper:
                 if ("CAMIONETA" in tipo_instalacion_detectado or 
                     "3.CAMIONETA" in tipo_instalacion_detectado or 
                     "3.Camioneta" in tipo_instalacion_detectado):
-                    # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
-                    cantidad_mo = luminarias_retiradas_count  # Cambio aquí
-                    if cantidad_mo > 0:
-                        materiales_retirados_relacionados.append(f"DESMONTAJE EN CAMIONETA (PROYECTO): {cantidad_mo} luminarias")
-                        print(f"DEBUG: Asignando DESMONTAJE CAMIONETA (PROYECTO) - cantidad: {cantidad_mo}")
-                    return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                    
-            print(f"DEBUG: No coincide tipo para DESMONTAJE PROYECTO - tipo: {tipo_instalacion_detectado}, descripción: {descripcion}")
+                    ctx.cantidad_mo = total_luminarias_a_instalar
+                    materiales_instalados_relacionados.append(f"INSTALACIÓN EN CAMIONETA (PROYECTO): {total_luminarias_a_instalar} luminarias")
+                    logger.debug("Asignando CAMIONETA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+
+            logger.debug("No coincide tipo para PROYECTO - tipo: %s, descripción: %s", tipo_instalacion_detectado, descripcion)
             return 0, [], []
-            
+
         else:
-            # LÓGICA PARA MODERNIZACIÓN (sin cambios en la lógica de brazos)
-            print(f"DEBUG: Procesando DESMONTAJE MODERNIZACIÓN - Nodo: {nodo}")
-            
-            if luminarias_retiradas_count > 0:
-                usar_canasta_para_desmontaje = False
-                brazos_grandes_retirados = []
-                brazos_pequenos_retirados = []
-
-                # Buscar brazos retirados y determinar su tamaño
-                for material_key, nodos_qty in materiales_retirados.items():
-                    if "|" in material_key:
-                        material_name = material_key.split("|")[1].upper()
-                        if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                            # Intentar extraer la longitud del brazo
-                            longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                            if longitud_match:
-                                try:
-                                    longitud = int(longitud_match.group(1))
-                                    if longitud >= 3:
-                                        usar_canasta_para_desmontaje = True
-                                        brazos_grandes_retirados.append(f"{material_name} ({nodos_qty[nodo]})")
-                                        print(f"DEBUG: Brazo grande retirado: {material_name}")
-                                    else:
-                                        brazos_pequenos_retirados.append(f"{material_name} ({nodos_qty[nodo]})")
-                                        print(f"DEBUG: Brazo pequeño retirado: {material_name}")
-                                except:
-                                    brazos_pequenos_retirados.append(f"{material_name} ({nodos_qty[nodo]})")
-                                    print(f"DEBUG: Brazo pequeño retirado (error parsing): {material_name}")
-                            elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                usar_canasta_para_desmontaje = True
-                                brazos_grandes_retirados.append(f"{material_name} ({nodos_qty[nodo]})")
-                                print(f"DEBUG: Brazo 3M retirado: {material_name}")
-                            else:
-                                brazos_pequenos_retirados.append(f"{material_name} ({nodos_qty[nodo]})")
-                                print(f"DEBUG: Brazo pequeño retirado (default): {material_name}")
-
-                print(f"DEBUG: Usar canasta para desmontaje: {usar_canasta_para_desmontaje}")
-
-                # Asignar la mano de obra según el tipo de desmontaje
-                if "DESMONTAJE DE LUMINARIAS EN CANASTA" in descripcion_upper:
-                    if usar_canasta_para_desmontaje:
-                        cantidad_mo = luminarias_retiradas_count
-                        materiales_retirados_relacionados.extend(brazos_grandes_retirados)
-                        print(f"DEBUG: Asignando DESMONTAJE CANASTA (MODERNIZACIÓN) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-                elif "DESMONTAJE DE LUMINARIAS EN CAMIONETA" in descripcion_upper:
-                    if not usar_canasta_para_desmontaje:
-                        cantidad_mo = luminarias_retiradas_count
-                        materiales_retirados_relacionados.extend(brazos_pequenos_retirados)
-                        print(f"DEBUG: Asignando DESMONTAJE CAMIONETA (MODERNIZACIÓN) - cantidad: {cantidad_mo}")
-                        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-        print(f"DEBUG: No se asignó desmontaje de luminarias para nodo {nodo}")
-        return 0, [], []
-    
-    # ======== TRANSP.LUMINARIAS, PROYECTORES ========    
-    if "TRANSP.LUMINARIAS, PROYECTORES" in descripcion_upper:        
-        # CORRECCIÓN: Usar la misma lógica unificada que en instalación
-        total_luminarias_instaladas = 0
-        total_luminarias_retiradas = 0
+            # LÓGICA PARA MODERNIZACIÓN (sin cambios)
+            logger.debug("Procesando INSTALACIÓN MODERNIZACIÓN - Nodo: %s", nodo)
 
-        if es_proyecto:
-            # CORRECCIÓN CRÍTICA: Para proyectos, usar el máximo entre códigos y luminarias explícitas, NO la suma
-            codigos_validos_n1 = 0
-            codigos_validos_n2 = 0
-            luminarias_explicitas = 0
-
-            # 1. Contar códigos N1 válidos
-            if codigos_n1:
-                for key_codigo, nodos_valores in codigos_n1.items():
-                    if nodo in nodos_valores:
-                        codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
-                        codigos_validos_n1 += len(codigos_validos)
-                        if len(codigos_validos) > 0:
-                            materiales_instalados_relacionados.append(f"CÓDIGO N1: {', '.join(codigos_validos)}")
+            if total_luminarias_a_instalar > 0:
+                logger.debug("Hay LUMINARIA CODIGO/BRAZO: %s", total_luminarias_a_instalar)
 
-            # 2. Contar códigos N2 válidos
-            if codigos_n2:
-                for key_codigo, nodos_valores in codigos_n2.items():
-                    if nodo in nodos_valores:
-                        codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
-                        codigos_validos_n2 += len(codigos_validos)
-                        if len(codigos_validos) > 0:
-                            materiales_instalados_relacionados.append(f"CÓDIGO N2: {', '.join(codigos_validos)}")
-
-            # 3. Contar luminarias instaladas directamente
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        luminarias_explicitas += nodos_qty[nodo]
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-            # CORRECCIÓN CRÍTICA: Usar el máximo entre códigos totales y luminarias explícitas
-            total_codigos = codigos_validos_n1 + codigos_validos_n2
-            total_luminarias_instaladas = max(total_codigos, luminarias_explicitas)
+                # Verificar brazos para determinar tipo de instalación
+                tiene_brazos_grandes = False
+                brazos_info = []
 
-        else:
-            # Para modernización, buscar LUMINARIA CODIGO/BRAZO
-            for material_key, nodos_qty in materiales_instalados.items():
-                if "|" in material_key:
-                    material_name = material_key.split("|")[1].upper()
-                    if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        total_luminarias_instaladas += nodos_qty[nodo]
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-        # 4. Contar luminarias retiradas
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "LUMINARIA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    total_luminarias_retiradas += nodos_qty[nodo]
-                    materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-        # 5. Asignar la cantidad final
-        cantidad_mo = total_luminarias_instaladas + total_luminarias_retiradas
-
-        # Agregar información de resumen
-        if total_luminarias_instaladas > 0:
-            materiales_instalados_relacionados.append(f"Total luminarias instaladas para transporte: {total_luminarias_instaladas}")
-
-        if total_luminarias_retiradas > 0:
-            materiales_retirados_relacionados.append(f"Total luminarias retiradas para transporte: {total_luminarias_retiradas}")
-
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # Transporte de brazos de 1 1/2" hasta 3 mts
-    if "TRANSPORTE DE BRAZOS 1 1/2\" HASTA 3 MTS" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar brazos instalados que coincidan con la descripción
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "BRAZO" in material_name and nodo in nodos_qty:
-                    # CORRECCIÓN: Mejorar la detección de brazos pequeños
-                    es_brazo_pequeno = (
-                        "1 1/2" in material_name or 
-                        "1.5" in material_name or 
-                        "1,5" in material_name or
-                        "3/4" in material_name or
-                        "EN L" in material_name
-                    )
+                for material_key, material_name, qty in indice.instalados(nodo, "BRAZO"):
+                    if "BRAZO" in material_name and qty > 0:
+                        brazos_info.append(f"{material_name} ({qty})")
 
-                    if es_brazo_pequeno:
-                        # CORRECCIÓN: Mejorar extracción de longitud
-                        longitud = 0
-
-                        # Patrón mejorado: buscar números seguidos de MT, MTS, M
-                        longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+                        # Determinar si es brazo grande (>= 3M)
+                        longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
                         if longitud_match:
-                            longitud_str = longitud_match.group(1).replace(',', '.')
                             try:
-                                longitud = float(longitud_str)
+                                longitud = int(longitud_match.group(1))
+                                if longitud >= 3:
+                                    tiene_brazos_grandes = True
+                                    logger.debug("Brazo grande encontrado: %s", material_name)
                             except:
-                                longitud = 0
-
-                        # CORRECCIÓN: Solo contar si la longitud es <= 3 metros O si es un brazo pequeño sin longitud específica
-                        if longitud == 0 or longitud <= 3:
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-
-        # Buscar brazos retirados
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "BRAZO" in material_name and nodo in nodos_qty:
-                    es_brazo_pequeno = (
-                        "1 1/2" in material_name or 
-                        "1.5" in material_name or 
-                        "1,5" in material_name or
-                        "3/4" in material_name or
-                        "EN L" in material_name
-                    )
+                                pass
+                        elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                            tiene_brazos_grandes = True
+                            logger.debug("Brazo 3M encontrado: %s", material_name)
+
+                logger.debug("Tiene brazos grandes: %s", tiene_brazos_grandes)
+
+                # Asignar según el tipo de instalación y brazos
+                if "CANASTA" in descripcion_upper and tiene_brazos_grandes:
+                    ctx.cantidad_mo = total_luminarias_a_instalar
+                    materiales_instalados_relacionados.append(f"INSTALACIÓN EN CANASTA (MODERNIZACIÓN): {total_luminarias_a_instalar} luminarias con brazos >= 3M")
+                    materiales_instalados_relacionados.extend(brazos_info)
+                    logger.debug("Asignando CANASTA (MODERNIZACIÓN) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+                elif "CAMIONETA" in descripcion_upper and not tiene_brazos_grandes:
+                    ctx.cantidad_mo = total_luminarias_a_instalar
+                    materiales_instalados_relacionados.append(f"INSTALACIÓN EN CAMIONETA (MODERNIZACIÓN): {total_luminarias_a_instalar} luminarias con brazos < 3M")
+                    materiales_instalados_relacionados.extend(brazos_info)
+                    logger.debug("Asignando CAMIONETA (MODERNIZACIÓN) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+
+    logger.debug("No se asignó instalación de luminarias para nodo %s", nodo)
+    return 0, [], []    
+
+
+@regla_mano_obra('DESMONTAJE DE LUMINARIAS', lambda d: "DESMONTAJE DE LUMINARIAS" in d and ("CAMIONETA" in d or "CANASTA" in d or "ESCALERA" in d),
+                 datos_nodo=('tipo_instalacion',))
+def regla_desmontaje_luminarias(ctx):
+    """Partida DESMONTAJE DE LUMINARIAS."""
+    indice = ctx.indice
+    descripcion = ctx.descripcion
+    descripcion_upper = ctx.descripcion_upper
+    nodo = ctx.nodo
+    es_proyecto = ctx.es_proyecto
+    tipo_instalacion_detectado = ctx.tipo_instalacion_detectado
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    logger.debug("Entrando en DESMONTAJE DE LUMINARIAS para nodo %s", nodo)
+    logger.debug("Es proyecto: %s, Tipo instalación: %s", es_proyecto, tipo_instalacion_detectado)
+
+    # Buscar luminarias retiradas
+    luminarias_retiradas_count = 0
+    for material_key, material_name, qty in indice.retirados(nodo):
+        es_luminaria_retirada = (
+            "LUMINARIA" in material_name or
+            "LUM" in material_name or
+            "LED" in material_name or
+            "LAMP" in material_name or
+            "FOCO" in material_name
+        )
 
-                    if es_brazo_pequeno:
-                        longitud = 0
-                        longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
-                        if longitud_match:
-                            longitud_str = longitud_match.group(1).replace(',', '.')
-                            try:
-                                longitud = float(longitud_str)
-                            except:
-                                longitud = 0
+        if es_luminaria_retirada:
+            luminarias_retiradas_count += qty
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+            logger.debug("Luminarias retiradas encontradas: %s (%s)", material_name, qty)
+
+    logger.debug("Total luminarias retiradas: %s", luminarias_retiradas_count)
+
+    if es_proyecto:
+        logger.debug("Procesando DESMONTAJE PROYECTO - Nodo: %s, Tipo: %s", nodo, tipo_instalacion_detectado)
+
+        # CORRECCIÓN: Para proyectos, usar EXACTAMENTE la cantidad de luminarias retiradas
+        if "DESMONTAJE DE LUMINARIAS EN CANASTA" in descripcion_upper:
+            if ("CANASTA" in tipo_instalacion_detectado or 
+                "1.CANASTA" in tipo_instalacion_detectado or 
+                "1.Canasta" in tipo_instalacion_detectado):
+                # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
+                ctx.cantidad_mo = luminarias_retiradas_count  # Cambio aquí
+                if ctx.cantidad_mo > 0:
+                    materiales_retirados_relacionados.append(f"DESMONTAJE EN CANASTA (PROYECTO): {ctx.cantidad_mo} luminarias")
+                    logger.debug("Asignando DESMONTAJE CANASTA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                return ctx.resultado()
+
+        elif "DESMONTAJE DE LUMINARIAS EN ESCALERA" in descripcion_upper:
+            if ("ESCALERA" in tipo_instalacion_detectado or 
+                "2.ESCALERA" in tipo_instalacion_detectado or 
+                "2.Escalera" in tipo_instalacion_detectado):
+                # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
+                ctx.cantidad_mo = luminarias_retiradas_count  # Cambio aquí
+                if ctx.cantidad_mo > 0:
+                    materiales_retirados_relacionados.append(f"DESMONTAJE EN ESCALERA (PROYECTO): {ctx.cantidad_mo} luminarias")
+                    logger.debug("Asignando DESMONTAJE ESCALERA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                return ctx.resultado()
+
+        elif "DESMONTAJE DE LUMINARIAS EN CAMIONETA" in descripcion_upper:
+            if ("CAMIONETA" in tipo_instalacion_detectado or 
+                "3.CAMIONETA" in tipo_instalacion_detectado or 
+                "3.Camioneta" in tipo_instalacion_detectado):
+                # CORRECCIÓN CRÍTICA: Usar exactamente la cantidad de luminarias retiradas, no max(count, 1)
+                ctx.cantidad_mo = luminarias_retiradas_count  # Cambio aquí
+                if ctx.cantidad_mo > 0:
+                    materiales_retirados_relacionados.append(f"DESMONTAJE EN CAMIONETA (PROYECTO): {ctx.cantidad_mo} luminarias")
+                    logger.debug("Asignando DESMONTAJE CAMIONETA (PROYECTO) - cantidad: %s", ctx.cantidad_mo)
+                return ctx.resultado()
+
+        logger.debug("No coincide tipo para DESMONTAJE PROYECTO - tipo: %s, descripción: %s", tipo_instalacion_detectado, descripcion)
+        return 0, [], []
 
-                        if longitud == 0 or longitud <= 3:
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
+    else:
+        # LÓGICA PARA MODERNIZACIÓN (sin cambios en la lógica de brazos)
+        logger.debug("Procesando DESMONTAJE MODERNIZACIÓN - Nodo: %s", nodo)
 
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+        if luminarias_retiradas_count > 0:
+            usar_canasta_para_desmontaje = False
+            brazos_grandes_retirados = []
+            brazos_pequenos_retirados = []
 
-    # ======== CORRECCIÓN: TRANSPORTE DE BRAZOS 2 1/2" HASTA 6 MTS ========
-    if "TRANSPORTE DE BRAZOS 2 1/2\" HASTA 6 MTS" in descripcion_upper:
-        cantidad_total = 0
-    
-        # Buscar brazos instalados que coincidan con la descripción
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "BRAZO" in material_name and nodo in nodos_qty:
-                    # CORRECCIÓN: Mejorar extracción de longitud
-                    longitud = 0
-    
-                    # Patrón mejorado para extraer longitud
-                    longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+            # Buscar brazos retirados y determinar su tamaño
+            for material_key, material_name, qty in indice.retirados(nodo, "BRAZO"):
+                if "BRAZO" in material_name and qty > 0:
+                    # Intentar extraer la longitud del brazo
+                    longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
                     if longitud_match:
-                        longitud_str = longitud_match.group(1).replace(',', '.')
                         try:
-                            longitud = float(longitud_str)
+                            longitud = int(longitud_match.group(1))
+                            if longitud >= 3:
+                                usar_canasta_para_desmontaje = True
+                                brazos_grandes_retirados.append(f"{material_name} ({qty})")
+                                logger.debug("Brazo grande retirado: %s", material_name)
+                            else:
+                                brazos_pequenos_retirados.append(f"{material_name} ({qty})")
+                                logger.debug("Brazo pequeño retirado: %s", material_name)
                         except:
-                            longitud = 0
-    
-                    # CORRECCIÓN: Solo contar brazos que REALMENTE sean grandes (> 3 metros)
-                    # Y que tengan indicación de ser brazos de 2 1/2" o similares
-                    es_brazo_grande_tipo = (
-                        "2 1/2" in material_name or 
-                        "2.5" in material_name or
-                        "2,5" in material_name
-                    )
-    
-                    # CORRECCIÓN: Contar solo si es un brazo grande Y tiene longitud > 3 metros
-                    if longitud > 3 and (es_brazo_grande_tipo or longitud >= 4):
-                        cantidad_total += nodos_qty[nodo]
-                        materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]}) - {longitud}M")
-                    # Si no se puede determinar longitud pero es explícitamente 2 1/2", verificar patrones de longitud
-                    elif longitud == 0 and es_brazo_grande_tipo:
-                        # Solo contar si hay indicación de que es un brazo largo
-                        if any(pattern in material_name for pattern in ["4", "5", "6"]):
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]}) - GRANDE")
-    
-        # Buscar brazos retirados
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "BRAZO" in material_name and nodo in nodos_qty:
+                            brazos_pequenos_retirados.append(f"{material_name} ({qty})")
+                            logger.debug("Brazo pequeño retirado (error parsing): %s", material_name)
+                    elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                        usar_canasta_para_desmontaje = True
+                        brazos_grandes_retirados.append(f"{material_name} ({qty})")
+                        logger.debug("Brazo 3M retirado: %s", material_name)
+                    else:
+                        brazos_pequenos_retirados.append(f"{material_name} ({qty})")
+                        logger.debug("Brazo pequeño retirado (default): %s", material_name)
+
+            logger.debug("Usar canasta para desmontaje: %s", usar_canasta_para_desmontaje)
+
+            # Asignar la mano de obra según el tipo de desmontaje
+            if "DESMONTAJE DE LUMINARIAS EN CANASTA" in descripcion_upper:
+                if usar_canasta_para_desmontaje:
+                    ctx.cantidad_mo = luminarias_retiradas_count
+                    materiales_retirados_relacionados.extend(brazos_grandes_retirados)
+                    logger.debug("Asignando DESMONTAJE CANASTA (MODERNIZACIÓN) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+            elif "DESMONTAJE DE LUMINARIAS EN CAMIONETA" in descripcion_upper:
+                if not usar_canasta_para_desmontaje:
+                    ctx.cantidad_mo = luminarias_retiradas_count
+                    materiales_retirados_relacionados.extend(brazos_pequenos_retirados)
+                    logger.debug("Asignando DESMONTAJE CAMIONETA (MODERNIZACIÓN) - cantidad: %s", ctx.cantidad_mo)
+                    return ctx.resultado()
+
+    logger.debug("No se asignó desmontaje de luminarias para nodo %s", nodo)
+    return 0, [], []
+
+
+@regla_mano_obra('TRANSP.LUMINARIAS, PROYECTORES', lambda d: "TRANSP.LUMINARIAS, PROYECTORES" in d,
+                 datos_nodo=('codigos', 'tipo_instalacion'))
+def regla_transporte_luminarias(ctx):
+    """Partida TRANSP.LUMINARIAS, PROYECTORES."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    codigos_n1 = ctx.codigos_n1
+    codigos_n2 = ctx.codigos_n2
+    es_proyecto = ctx.es_proyecto
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # CORRECCIÓN: Usar la misma lógica unificada que en instalación
+    total_luminarias_instaladas = 0
+    total_luminarias_retiradas = 0
+
+    if es_proyecto:
+        # CORRECCIÓN CRÍTICA: Para proyectos, usar el máximo entre códigos y luminarias explícitas, NO la suma
+        codigos_validos_n1 = 0
+        codigos_validos_n2 = 0
+        luminarias_explicitas = 0
+
+        # 1. Contar códigos N1 válidos
+        if codigos_n1:
+            for key_codigo, nodos_valores in codigos_n1.items():
+                if nodo in nodos_valores:
+                    codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
+                    codigos_validos_n1 += len(codigos_validos)
+                    if len(codigos_validos) > 0:
+                        materiales_instalados_relacionados.append(f"CÓDIGO N1: {', '.join(codigos_validos)}")
+
+        # 2. Contar códigos N2 válidos
+        if codigos_n2:
+            for key_codigo, nodos_valores in codigos_n2.items():
+                if nodo in nodos_valores:
+                    codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
+                    codigos_validos_n2 += len(codigos_validos)
+                    if len(codigos_validos) > 0:
+                        materiales_instalados_relacionados.append(f"CÓDIGO N2: {', '.join(codigos_validos)}")
+
+        # 3. Contar luminarias instaladas directamente
+        for material_key, material_name, qty in indice.instalados(nodo, "LUMINARIA"):
+            if "LUMINARIA INSTALADA" in material_name and qty > 0:
+                luminarias_explicitas += qty
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+        # CORRECCIÓN CRÍTICA: Usar el máximo entre códigos totales y luminarias explícitas
+        total_codigos = codigos_validos_n1 + codigos_validos_n2
+        total_luminarias_instaladas = max(total_codigos, luminarias_explicitas)
+
+    else:
+        # Para modernización, buscar LUMINARIA CODIGO/BRAZO
+        for material_key, material_name, qty in indice.instalados(nodo, "BRAZO"):
+            if "LUMINARIA CODIGO/BRAZO" in material_name and qty > 0:
+                total_luminarias_instaladas += qty
+                materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # 4. Contar luminarias retiradas
+    for material_key, material_name, qty in indice.retirados(nodo, "LUMINARIA"):
+        if "LUMINARIA" in material_name and qty > 0:
+            total_luminarias_retiradas += qty
+            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    # 5. Asignar la cantidad final
+    ctx.cantidad_mo = total_luminarias_instaladas + total_luminarias_retiradas
+
+    # Agregar información de resumen
+    if total_luminarias_instaladas > 0:
+        materiales_instalados_relacionados.append(f"Total luminarias instaladas para transporte: {total_luminarias_instaladas}")
+
+    if total_luminarias_retiradas > 0:
+        materiales_retirados_relacionados.append(f"Total luminarias retiradas para transporte: {total_luminarias_retiradas}")
+
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE DE BRAZOS HASTA 3 MTS', lambda d: "TRANSPORTE DE BRAZOS 1 1/2\" HASTA 3 MTS" in d,
+                 disparadores=("BRAZO",))
+def regla_transporte_brazos_3m(ctx):
+    """Transporte de brazos de 1 1/2" hasta 3 mts."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar brazos instalados que coincidan con la descripción
+    for material_key, material_name, qty in indice.instalados(nodo):
+        if "BRAZO" in material_name:
+            # CORRECCIÓN: Mejorar la detección de brazos pequeños
+            es_brazo_pequeno = (
+                "1 1/2" in material_name or 
+                "1.5" in material_name or 
+                "1,5" in material_name or
+                "3/4" in material_name or
+                "EN L" in material_name
+            )
+
+            if es_brazo_pequeno:
+                # CORRECCIÓN: Mejorar extracción de longitud
+                longitud = 0
+
+                # Patrón mejorado: buscar números seguidos de MT, MTS, M
+                longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+                if longitud_match:
+                    longitud_str = longitud_match.group(1).replace(',', '.')
+                    try:
+                        longitud = float(longitud_str)
+                    except:
+                        longitud = 0
+
+                # CORRECCIÓN: Solo contar si la longitud es <= 3 metros O si es un brazo pequeño sin longitud específica
+                if longitud == 0 or longitud <= 3:
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # Buscar brazos retirados
+    for material_key, material_name, qty in indice.retirados(nodo):
+        if "BRAZO" in material_name:
+            es_brazo_pequeno = (
+                "1 1/2" in material_name or 
+                "1.5" in material_name or 
+                "1,5" in material_name or
+                "3/4" in material_name or
+                "EN L" in material_name
+            )
+
+            if es_brazo_pequeno:
+                longitud = 0
+                longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+                if longitud_match:
+                    longitud_str = longitud_match.group(1).replace(',', '.')
+                    try:
+                        longitud = float(longitud_str)
+                    except:
+                        longitud = 0
+
+                if longitud == 0 or longitud <= 3:
+                    cantidad_total += qty
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE DE BRAZOS HASTA 6 MTS', lambda d: "TRANSPORTE DE BRAZOS 2 1/2\" HASTA 6 MTS" in d,
+                 disparadores=("BRAZO",))
+def regla_transporte_brazos_6m(ctx):
+    """Partida TRANSPORTE DE BRAZOS HASTA 6 MTS."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar brazos instalados que coincidan con la descripción
+    for material_key, material_name, qty in indice.instalados(nodo):
+        if "BRAZO" in material_name:
+            # CORRECCIÓN: Mejorar extracción de longitud
+            longitud = 0
+
+            # Patrón mejorado para extraer longitud
+            longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+            if longitud_match:
+                longitud_str = longitud_match.group(1).replace(',', '.')
+                try:
+                    longitud = float(longitud_str)
+                except:
                     longitud = 0
-                    longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
-                    if longitud_match:
-                        longitud_str = longitud_match.group(1).replace(',', '.')
-                        try:
-                            longitud = float(longitud_str)
-                        except:
-                            longitud = 0
-    
-                    es_brazo_grande_tipo = (
-                        "2 1/2" in material_name or 
-                        "2.5" in material_name or
-                        "2,5" in material_name
-                    )
-    
-                    if longitud > 3 and (es_brazo_grande_tipo or longitud >= 4):
-                        cantidad_total += nodos_qty[nodo]
-                        materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]}) - {longitud}M")
-                    elif longitud == 0 and es_brazo_grande_tipo:
-                        if any(pattern in material_name for pattern in ["4", "5", "6"]):
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]}) - GRANDE")
-    
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    # ======== TRANSPORTE DE CABLES ========
-    
-    if "TRANSPORTE DE CABLE" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar cables instalados (aplicando las mismas condiciones que en INSTALACION CABLE)
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-
-                # CORRECCIÓN: Usar exactamente la misma lógica que en instalación de cable
-                es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
-                es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
-                es_cable_al4 = "CABLE AL #4" in material_name
-                es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
-                es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
-
-                if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6) and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
-                    if qty > 0:  # Solo contar si la cantidad es mayor a 0
-                        # CORRECCIÓN: Multiplicar por 3 SOLO para cables TPX y AL TPX
-                        if es_cable_tpx or es_cable_al_tpx:
-                            cantidad_total += qty * 3
-                            materiales_instalados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
-                        else:
+
+            # CORRECCIÓN: Solo contar brazos que REALMENTE sean grandes (> 3 metros)
+            # Y que tengan indicación de ser brazos de 2 1/2" o similares
+            es_brazo_grande_tipo = (
+                "2 1/2" in material_name or 
+                "2.5" in material_name or
+                "2,5" in material_name
+            )
+
+            # CORRECCIÓN: Contar solo si es un brazo grande Y tiene longitud > 3 metros
+            if longitud > 3 and (es_brazo_grande_tipo or longitud >= 4):
+                cantidad_total += qty
+                materiales_instalados_relacionados.append(f"{material_name} ({qty}) - {longitud}M")
+            # Si no se puede determinar longitud pero es explícitamente 2 1/2", verificar patrones de longitud
+            elif longitud == 0 and es_brazo_grande_tipo:
+                # Solo contar si hay indicación de que es un brazo largo
+                if any(pattern in material_name for pattern in ["4", "5", "6"]):
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty}) - GRANDE")
+
+    # Buscar brazos retirados
+    for material_key, material_name, qty in indice.retirados(nodo):
+        if "BRAZO" in material_name:
+            longitud = 0
+            longitud_match = re.search(r'(\d+(?:[,\.]\d+)?)\s*M(?:TS?)?', material_name)
+            if longitud_match:
+                longitud_str = longitud_match.group(1).replace(',', '.')
+                try:
+                    longitud = float(longitud_str)
+                except:
+                    longitud = 0
+
+            es_brazo_grande_tipo = (
+                "2 1/2" in material_name or 
+                "2.5" in material_name or
+                "2,5" in material_name
+            )
+
+            if longitud > 3 and (es_brazo_grande_tipo or longitud >= 4):
+                cantidad_total += qty
+                materiales_retirados_relacionados.append(f"{material_name} ({qty}) - {longitud}M")
+            elif longitud == 0 and es_brazo_grande_tipo:
+                if any(pattern in material_name for pattern in ["4", "5", "6"]):
+                    cantidad_total += qty
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty}) - GRANDE")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE DE CABLE', lambda d: "TRANSPORTE DE CABLE" in d,
+                 disparadores=("CABLE",))
+def regla_transporte_cable(ctx):
+    """Partida TRANSPORTE DE CABLE."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar cables instalados (aplicando las mismas condiciones que en INSTALACION CABLE)
+    for material_key, material_name, qty in indice.instalados(nodo):
+
+        # CORRECCIÓN: Usar exactamente la misma lógica que en instalación de cable
+        es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
+        es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
+        es_cable_al4 = "CABLE AL #4" in material_name
+        es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
+        es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
+
+        if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6):
+            if qty > 0:  # Solo contar si la cantidad es mayor a 0
+                # CORRECCIÓN: Multiplicar por 3 SOLO para cables TPX y AL TPX
+                if es_cable_tpx or es_cable_al_tpx:
+                    cantidad_total += qty * 3
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
+                else:
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    # Buscar cables retirados (aplicando las mismas condiciones)
+    for material_key, material_name, qty in indice.retirados(nodo):
+
+        es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
+        es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
+        es_cable_al4 = "CABLE AL #4" in material_name
+        es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
+        es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
+
+        if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6):
+            if qty > 0:
+                # CORRECCIÓN: Multiplicar por 3 SOLO para cables TPX y AL TPX
+                if es_cable_tpx or es_cable_al_tpx:
+                    cantidad_total += qty * 3
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
+                else:
+                    cantidad_total += qty
+                    materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE POSTE METALICO 4 A 12 MT', lambda d: "TRANSP.POSTE.METALICO DE 4 A 12MT" in d,
+                 disparadores=("POSTE",))
+def regla_transporte_poste_metalico(ctx):
+    """Partida TRANSPORTE POSTE METALICO 4 A 12 MT."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes metálicos o de fibra en el rango de 4 a 12 metros
+    for key, material_name, qty in indice.instalados(nodo):
+        # Detectar postes metálicos o de fibra con criterios más amplios
+        if "POSTE" in material_name:
+            es_metalico_o_fibra = (
+                "METALICO" in material_name or 
+                "FIBRA" in material_name or
+                "METAL" in material_name
+            )
+
+            if es_metalico_o_fibra:
+                # Extraer altura del nombre del poste
+                altura_match = re.search(r'(\d+)\s*M', material_name)
+                if altura_match:
+                    try:
+                        altura = int(altura_match.group(1))
+                        if 4 <= altura <= 12:
                             cantidad_total += qty
                             materiales_instalados_relacionados.append(f"{material_name} ({qty})")
-
-        # Buscar cables retirados (aplicando las mismas condiciones)
-        for material_key, nodos_qty in materiales_retirados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-
-                es_cable_tpx = "CABLE TPX 2X4 AWG XLPE + 48.69 AAAC" in material_name
-                es_cable_al_tpx = "CABLE AL TPX 2X2+1X2 AWG" in material_name
-                es_cable_al4 = "CABLE AL #4" in material_name
-                es_cable_trenzado_2x4 = "CABLE TRENZADO 2X4" in material_name
-                es_cable_cu_thhn_6 = "CABLE DE CU THHN NRO. 6" in material_name or "CABLE CU THHN NRO. 6" in material_name or "CABLE DE AL THHN NRO. 6 (MTS)" in material_name
-
-                if (es_cable_tpx or es_cable_al_tpx or es_cable_al4 or es_cable_trenzado_2x4 or es_cable_cu_thhn_6) and nodo in nodos_qty:
-                    qty = nodos_qty[nodo]
-                    if qty > 0:
-                        # CORRECCIÓN: Multiplicar por 3 SOLO para cables TPX y AL TPX
-                        if es_cable_tpx or es_cable_al_tpx:
-                            cantidad_total += qty * 3
-                            materiales_retirados_relacionados.append(f"{material_name} ({qty} x 3 = {qty*3})")
-                        else:
+                    except:
+                        # Si no se puede extraer la altura pero contiene indicación de tamaño
+                        if any(f"{i}M" in material_name for i in range(4, 13)):
                             cantidad_total += qty
-                            materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+                            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                else:
+                    # Si no hay altura específica, asumir que está en el rango
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
 
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE POSTE CONCRETO 12 MT', lambda d: "TRANSP.POSTE.CONC.12MT.SITIO SIN INCREME" in d,
+                 disparadores=("POSTE",))
+def regla_transporte_poste_concreto_12m(ctx):
+    """Transporte de postes de concreto 12 metros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto de 12 metros instalados
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            # Verificar si es de 12 metros
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 12:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                except:
+                    # Si no se puede extraer la altura pero contiene "12M"
+                    if any(f"{i}M" in material_name for i in range(8, 13)):
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+            else:
+                # Si no hay altura específica pero es de concreto, verificar si podría ser de 12m
+                if any(str(i) in material_name for i in range(8, 13)):
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
 
-    # ======== TRANSPORTE DE POSTES ========
-    
-    # Transporte de postes metálicos (incluye postes de fibra) de 4 a 12 metros
-    if "TRANSP.POSTE.METALICO DE 4 A 12MT" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes metálicos o de fibra en el rango de 4 a 12 metros
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                # Detectar postes metálicos o de fibra con criterios más amplios
-                if "POSTE" in material_name and nodo in nodos_qty:
-                    es_metalico_o_fibra = (
-                        "METALICO" in material_name or 
-                        "FIBRA" in material_name or
-                        "METAL" in material_name
-                    )
+    # Si no se encontraron postes específicos pero hay postes de concreto, forzar al menos 1
+    #if cantidad_total == 0:
+    #    hay_postes_concreto = False
+    #    for key, nodos_qty in materiales_instalados.items():
+    #        if "POSTE" in key.nombre.upper() and "CONCRETO" in key.nombre.upper() and sum(nodos_qty.values()) > 0:
+    #            hay_postes_concreto = True
+    #            break
+    #        
+    #    if hay_postes_concreto:
+    #        cantidad_total = 1
+    #        materiales_instalados_relacionados.append("TRANSPORTE DE POSTE CONCRETO (FORZADO)")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('TRANSPORTE POSTE CONCRETO 18 MT', lambda d: "TRANSP.POSTE.CONC.18MT.SITIO SIN INCREME" in d,
+                 disparadores=("POSTE",))
+def regla_transporte_poste_concreto_18m(ctx):
+    """Transporte de postes de concreto 18 metros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto de 18 metros instalados
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            # Verificar si es de 18 metros
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if altura == 18 or (altura >= 15 and altura <= 20):  # Rango más amplio
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+                except:
+                    # Si no se puede extraer la altura pero contiene "18M"
+                    if any(f"{i}M" in material_name for i in range(18, 20)):
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+            else:
+                # Si no hay altura específica pero es de concreto, verificar si podría ser de 18m
+                if "18" in material_name:
+                    cantidad_total += qty
+                    materiales_instalados_relacionados.append(f"{material_name} ({qty})")
 
-                    if es_metalico_o_fibra:
-                        # Extraer altura del nombre del poste
-                        altura_match = re.search(r'(\d+)\s*M', material_name)
-                        if altura_match:
-                            try:
-                                altura = int(altura_match.group(1))
-                                if 4 <= altura <= 12:
-                                    cantidad_total += nodos_qty[nodo]
-                                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                            except:
-                                # Si no se puede extraer la altura pero contiene indicación de tamaño
-                                if any(f"{i}M" in material_name for i in range(4, 13)):
-                                    cantidad_total += nodos_qty[nodo]
-                                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        else:
-                            # Si no hay altura específica, asumir que está en el rango
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('APLOMADA POSTES DE CONCRETO 8 A 10', lambda d: "APLOMADA POSTES DE CONCRETO DE 8 A 10 MTS" in d,
+                 disparadores=("POSTE",))
+def regla_aplomada_concreto_8_10(ctx):
+    """Aplomada de postes de concreto (8 a 10 metros)."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 10:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "8M" o "10M"
+                    if "8M" in material_name or "9M" in material_name or "10M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('APLOMADA POSTES DE CONCRETO 11 A 14', lambda d: "APLOMADA POSTES DE CONCRETO DE 11 A 14 MTS" in d,
+                 disparadores=("POSTE",))
+def regla_aplomada_concreto_11_14(ctx):
+    """Aplomada de postes de concreto (11 a 14 metros)."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 11 <= altura <= 14:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "12M" o "14M"
+                    if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('APERTURA HUECOS 8 A 10', lambda d: "APERTURA HUECOS POSTES ANCLAS SECUNDARIAS DE 8 A 10 MTS" in d,
+                 disparadores=("POSTE",))
+def regla_apertura_huecos_8_10(ctx):
+    """Apertura de huecos para postes secundarias (8 a 10 metros)."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 10:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "8M" o "10M"
+                    if "8M" in material_name or "9M" in material_name or "10M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('APERTURA HUECOS 11 A 14', lambda d: "APERTURA HUECOS POSTES ANCLAS PRIMARIA DE 11 A 14 MTS" in d or "APERTURA HUECOS POSTES 11 MT A 14 MT Y ANCLAS" in d,
+                 disparadores=("POSTE",))
+def regla_apertura_huecos_11_14(ctx):
+    """Apertura de huecos para postes primaria (11 a 14 metros)."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 11 <= altura <= 14:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "12M" o "14M"
+                    if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('BASE DE CONCRETO PARA POSTE 9 MTS', lambda d: "BASE DE CONCRETO PARA POSTE 9 MTS" in d,
+                 disparadores=("POSTE",))
+def regla_base_concreto_9m(ctx):
+    """Base de concreto para poste 9 mts."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes cercanos a 9 metros
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 10:  # Considerar postes cercanos a 9 metros
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "9M"
+                    if "8M" in material_name or "9M" in material_name or "10M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('CONCRETADA DE POSTE CONCRETO', lambda d: "CONCRETADA DE POSTE CONCRETO DE 8 A 12 M INCLUYE MATERIALES Y MO" in d,
+                 disparadores=("POSTE",))
+def regla_concretada_poste_concreto(ctx):
+    """Concretada de poste de concreto de 8 a 12 metros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto en ese rango
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 12:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    pass
+
+    ctx.cantidad_mo += cantidad_total
+
+
+@regla_mano_obra('ALQUILER MACHINE COMPRESOR', lambda d: "ALQUILER DE EQUIPO \"MACHINE COMPRESOR\"" in d or "ALQUILER MACHINE NEUMATICO Y COMPRESOR" in d,
+                 disparadores=("POSTE",))
+def regla_alquiler_compresor(ctx):
+    """Alquiler machine neumático y compresor."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    # Determinar si se necesita compresor basado en trabajos en el nodo
+    requiere_compresor = False
+
+    # Buscar instalaciones que típicamente requieren compresor
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        # Postes de concreto típicamente requieren compresor
+        if "POSTE" in material_name and "CONCRETO" in material_name:
+            requiere_compresor = True
+            materiales_instalados_relacionados.append(material_name)
+            break
+
+    # Si se identifica la necesidad de compresor, contabilizar una vez por nodo
+    if requiere_compresor:
+        ctx.cantidad_mo = 1
+
+    return ctx.resultado()
+
+
+@regla_mano_obra('HINCADA DE POSTES CONCRETO DE 14 MTS', lambda d: "HINCADA DE POSTES CONCRETO DE 14 MTS" in d,
+                 disparadores=("POSTE",))
+def regla_hincada_concreto_14m(ctx):
+    """Hincada de postes de concreto de 14 metros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de concreto de 14 metros
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "CONCRETO" in material_name and "14" in str(key):
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(str(key).replace("MATERIAL|", ""))
+        # También considerar postes de concreto donde la altura sea exactamente 14
+        elif "CONCRETO" in material_name:
+            altura_match = re.search(r'(\d+)\s*M', str(key).upper())
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if altura == 14:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(str(key).replace("MATERIAL|", ""))
+                except:
+                    pass
+
+    ctx.cantidad_mo += cantidad_total
+
+
+@regla_mano_obra('BOTADO DE ESCOMBROS', lambda d: "BOTADO DE ESCOMBROS" in d,
+                 disparadores=("KIT DE PUESTA A TIERRA", "POSTE"))
+def regla_botado_escombros(ctx):
+    """Botado de escombros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+    materiales_retirados_relacionados = ctx.materiales_retirados_relacionados
+
+    # Variables para controlar qué tipo de trabajo requiere botado de escombros
+    tiene_kit_puesta_tierra = False
+    tiene_trabajo_con_postes = False
+
+    # 1. Verificar si hay KIT DE PUESTA A TIERRA
+    for material_key, material_name, qty in indice.instalados(nodo, "KIT DE PUESTA A TIERRA"):
+        if "KIT DE PUESTA A TIERRA" in material_name and qty > 0:
+            tiene_kit_puesta_tierra = True
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+            break  # Solo necesitamos saber que existe
+
+    # 2. Verificar si hay trabajo con postes (instalados o retirados)
+    # Buscar postes instalados
+    for key, material_name, qty in indice.instalados(nodo, "POSTE"):
+        if "POSTE" in material_name and qty > 0:
+            tiene_trabajo_con_postes = True
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+            break
+
+    # Si no hay postes instalados, buscar postes retirados
+    if not tiene_trabajo_con_postes:
+        for key, material_name, qty in indice.retirados(nodo, "POSTE"):
+            if "POSTE" in material_name and qty > 0:
+                tiene_trabajo_con_postes = True
+                materiales_retirados_relacionados.append(f"{material_name} ({qty})")
+                break
 
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # Transporte de postes de concreto 12 metros
-    if "TRANSP.POSTE.CONC.12MT.SITIO SIN INCREME" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto de 12 metros instalados
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    # Verificar si es de 12 metros
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 12:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        except:
-                            # Si no se puede extraer la altura pero contiene "12M"
-                            if any(f"{i}M" in material_name for i in range(8, 13)):
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                    else:
-                        # Si no hay altura específica pero es de concreto, verificar si podría ser de 12m
-                        if any(str(i) in material_name for i in range(8, 13)):
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        # Si no se encontraron postes específicos pero hay postes de concreto, forzar al menos 1
-        #if cantidad_total == 0:
-        #    hay_postes_concreto = False
-        #    for key, nodos_qty in materiales_instalados.items():
-        #        if "|" in key and "POSTE" in key.split("|")[1].upper() and "CONCRETO" in key.split("|")[1].upper() and sum(nodos_qty.values()) > 0:
-        #            hay_postes_concreto = True
-        #            break
-        #        
-        #    if hay_postes_concreto:
-        #        cantidad_total = 1
-        #        materiales_instalados_relacionados.append("TRANSPORTE DE POSTE CONCRETO (FORZADO)")
-        
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # Transporte de postes de concreto 18 metros
-    if "TRANSP.POSTE.CONC.18MT.SITIO SIN INCREME" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto de 18 metros instalados
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    # Verificar si es de 18 metros
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if altura == 18 or (altura >= 15 and altura <= 20):  # Rango más amplio
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        except:
-                            # Si no se puede extraer la altura pero contiene "18M"
-                            if any(f"{i}M" in material_name for i in range(18, 20)):
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                    else:
-                        # Si no hay altura específica pero es de concreto, verificar si podría ser de 18m
-                        if "18" in material_name:
-                            cantidad_total += nodos_qty[nodo]
-                            materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-        
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== POSTES Y OTROS ELEMENTOS ========
+    # 3. CORRECCIÓN: Asignar botado de escombros si hay kit de puesta a tierra O trabajo con postes
+    if tiene_kit_puesta_tierra or tiene_trabajo_con_postes:
+        ctx.cantidad_mo = 1 * 0.1
+        if tiene_kit_puesta_tierra:
+            materiales_instalados_relacionados.append("BOTADO DE ESCOMBROS POR: KIT PUESTA A TIERRA")
+        if tiene_trabajo_con_postes:
+            materiales_instalados_relacionados.append("BOTADO DE ESCOMBROS POR: TRABAJO CON POSTES")
+
+        return ctx.resultado()
+
+
+@regla_mano_obra('APLOMADA POSTES METALICOS/FIBRA 8 A 10', lambda d: "APLOMADA POSTES METALICOS Y/O FIBRA VIDRIO 8 A 10" in d,
+                 disparadores=("POSTE",))
+def regla_aplomada_fibra_8_10(ctx):
+    """Partida APLOMADA POSTES METALICOS/FIBRA 8 A 10."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de fibra en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo):
+        # Detectar postes de fibra o metálicos
+        if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name):
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 10:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "8M" o "10M"
+                    if "8M" in material_name or "9M" in material_name or "10M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('APLOMADA POSTES METALICOS/FIBRA 11 A 14', lambda d: "APLOMADA POSTES METALICOS Y/O FIBRA VIDRIO 11 A 14" in d,
+                 disparadores=("POSTE",))
+def regla_aplomada_fibra_11_14(ctx):
+    """Aplomada de postes metálicos o fibra (11 a 14 metros)."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de fibra en ese rango de altura
+    for key, material_name, qty in indice.instalados(nodo):
+        # Detectar postes de fibra o metálicos
+        if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name):
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 11 <= altura <= 14:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene alturas específicas
+                    if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('CONCRETADA DE POSTE FIBRA', lambda d: "CONCRETADA DE POSTE FIBRA 8 A 12 MT INCLUYE MATERIAL" in d,
+                 disparadores=("POSTE",))
+def regla_concretada_poste_fibra(ctx):
+    """Concretada de poste de fibra de 8 a 12 metros."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de fibra en ese rango
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE FIBRA" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 8 <= altura <= 12:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene dimensiones apropiadas
+                    if "8M" in material_name or "9M" in material_name or "10M" in material_name or "11M" in material_name or "12M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('HINCADA DE POSTE FIBRA DE 8M', lambda d: "HINCADA DE POSTE FIBRA DE 8M" in d,
+                 disparadores=("POSTE",))
+def regla_hincada_fibra_8m(ctx):
+    """Hincada de poste de fibra de 8M."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de fibra de 8 metros
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE FIBRA" in material_name and "8M" in material_name:
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(material_name)
+        elif "POSTE FIBRA" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if altura == 8:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    pass
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('HINCADA DE POSTE FIBRA DE 10 A 12M', lambda d: "HINCADA DE POSTE FIBRA DE 10 A 12M" in d,
+                 disparadores=("POSTE",))
+def regla_hincada_fibra_10_12m(ctx):
+    """Hincada de poste de fibra de 10 a 12M."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes de fibra de 10 a 12 metros
+    for key, material_name, qty in indice.instalados(nodo):
+        if "POSTE FIBRA" in material_name:
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 10 <= altura <= 12:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "10M" o "12M"
+                    if "10M" in material_name or "11M" in material_name or "12M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('CONCRETADA ENTRE POSTE Y CAJA', lambda d: "CONCRETADA ENTRE POSTE Y CAJA INCLUYE MATERIALES E INSTALACIÓN" in d,
+                 disparadores=("POSTE",))
+def regla_concretada_poste_caja(ctx):
+    """Concretada entre poste y caja."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Verificar si hay postes de fibra o metálicos instalados
+    postes_encontrados = False
+    for key, material_name, qty in indice.instalados(nodo):
+        if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name):
+            postes_encontrados = True
+            materiales_instalados_relacionados.append(material_name)
+            break
+
+    # Verificar si hay cajas instaladas
+    cajas_encontradas = False
+    for key, material_name, qty in indice.instalados(nodo):
+        if "CAJA" in material_name:
+            cajas_encontradas = True
+            materiales_instalados_relacionados.append(material_name)
+            break
+
+    # Si hay ambos elementos, asignar mano de obra
+    if postes_encontrados and cajas_encontradas:
+        ctx.cantidad_mo += 1
+
+    return ctx.resultado()
+
+
+@regla_mano_obra('BASE PARA POSTE METALICO TIPO KEISON', lambda d: "BASE PARA POSTE METALICO TIPO KEISON DE 10 A 12 MT" in d,
+                 disparadores=("POSTE",))
+def regla_base_keison(ctx):
+    """Base para poste metálico tipo Keison."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar postes metálicos o de fibra en el rango adecuado
+    for key, material_name, qty in indice.instalados(nodo):
+        if ("POSTE METALICO" in material_name or "POSTE FIBRA" in material_name):
+            # Extraer altura del nombre del poste
+            altura_match = re.search(r'(\d+)\s*M', material_name)
+            if altura_match:
+                try:
+                    altura = int(altura_match.group(1))
+                    if 10 <= altura <= 12:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+                except:
+                    # Si no se puede extraer la altura pero contiene "10M" o "12M"
+                    if "10M" in material_name or "11M" in material_name or "12M" in material_name:
+                        cantidad_total += qty
+                        materiales_instalados_relacionados.append(material_name)
+
+    ctx.cantidad_mo += cantidad_total
+    return ctx.resultado()
+
+
+@regla_mano_obra('CAJA DE A.P', lambda d: "CAJA DE A.P 0,4X0,4 MT INCLUYE MATERIALES E INSTALACION" in d,
+                 disparadores=("TUBERIA CONDUFLEX",))
+def regla_caja_ap(ctx):
+    """Partida CAJA DE A.P."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Verificar si hay tubería conduflex en el nodo
+    for key, material_name, qty in indice.instalados(nodo):
+        if "TUBERIA CONDUFLEX" in material_name:
+            # Contar una caja por nodo donde haya tubería
+            cantidad_total = 1
+            materiales_instalados_relacionados.append(str(key).replace("MATERIAL|", ""))
+            break
+
+    ctx.cantidad_mo += cantidad_total
+
+
+@regla_mano_obra('PINTADA DE NODOS', lambda d: "PINTADA DE NODOS" in d,
+                 disparadores=("PINTADO DE NODO",))
+def regla_pintada_nodos(ctx):
+    """Partida PINTADA DE NODOS."""
+    indice = ctx.indice
+    nodo = ctx.nodo
+    materiales_instalados_relacionados = ctx.materiales_instalados_relacionados
+
+    cantidad_total = 0
+
+    # Buscar PINTADO DE NODO en materiales instalados
+    for material_key, material_name, qty in indice.instalados(nodo):
+        if "PINTADO DE NODO" in material_name and qty > 0:
+            cantidad_total += qty
+            materiales_instalados_relacionados.append(f"{material_name} ({qty})")
+
+    ctx.cantidad_mo = cantidad_total
+    return ctx.resultado()
+
+
+def tipo_instalacion_mano_obra(nodo, tipos_instalacion=None, tipo_instalacion_nodo=None):
+    """
+    Indica si el nodo es de proyecto (tiene tipo de instalación informado) o de modernización.
+
+    Returns:
+        tuple: (es_proyecto, tipo de instalación en mayúsculas o "" si es modernización)
+    """
+    es_proyecto = False
+    tipo_instalacion_detectado = ""
     
-    # ======== CÓDIGO PARA POSTES DE CONCRETO ========    
+    logger.debug("Analizando nodo %s - tipo_instalacion_nodo: %s", nodo, tipo_instalacion_nodo)
+    logger.debug("tipos_instalacion dict: %s", tipos_instalacion)
     
-    # Transporte de postes de concreto 18 metros
-    if "TRANSP.POSTE.CONC.18MT.SITIO SIN INCREME" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto de 18 metros instalados
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and "18" in material_name and nodo in nodos_qty:
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # Aplomada de postes de concreto (8 a 10 metros)
-    if "APLOMADA POSTES DE CONCRETO DE 8 A 10 MTS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 10:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "8M" o "10M"
-                            if "8M" in material_name or "9M" in material_name or "10M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    # Método 1: Usar el parámetro tipo_instalacion_nodo si está disponible
+    if tipo_instalacion_nodo is not None and str(tipo_instalacion_nodo).strip() != "":
+        es_proyecto = True
+        tipo_instalacion_detectado = str(tipo_instalacion_nodo).strip().upper()
+        logger.debug("PROYECTO detectado por parámetro - Nodo: %s, Tipo: %s", nodo, tipo_instalacion_detectado)
     
-    # Aplomada de postes de concreto (11 a 14 metros)
-    if "APLOMADA POSTES DE CONCRETO DE 11 A 14 MTS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 11 <= altura <= 14:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "12M" o "14M"
-                            if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    # Método 2: Usar el diccionario tipos_instalacion si está disponible
+    elif tipos_instalacion is not None and nodo in tipos_instalacion:
+        tipo_from_dict = tipos_instalacion.get(nodo, "")
+        if str(tipo_from_dict).strip() != "":
+            es_proyecto = True
+            tipo_instalacion_detectado = str(tipo_from_dict).strip().upper()
+            logger.debug("PROYECTO detectado por diccionario - Nodo: %s, Tipo: %s", nodo, tipo_instalacion_detectado)
     
-    # Apertura de huecos para postes secundarias (8 a 10 metros)
-    if "APERTURA HUECOS POSTES ANCLAS SECUNDARIAS DE 8 A 10 MTS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 10:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "8M" o "10M"
-                            if "8M" in material_name or "9M" in material_name or "10M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    # Si no es proyecto, es modernización
+    if not es_proyecto:
+        logger.debug("MODERNIZACIÓN detectado - Nodo: %s", nodo)
+
+    return es_proyecto, tipo_instalacion_detectado
+
+
+def evaluar_reglas_mano_obra(plan, ctx):
+    """
+    Aplica las reglas del plan sobre el contexto de una partida y un nodo; la primera regla que
+    devuelve un resultado corta la evaluación.
+
+    Returns:
+        tuple: (cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados)
+    """
+    estadisticas = REGLAS_SOLICITUD.get()
+    if estadisticas is None:
+        # Fuera de medir_reglas_mano_obra las llamadas van directo a los acumulados del proceso
+        with medir_reglas_mano_obra():
+            return evaluar_reglas_mano_obra(plan, ctx)
+
+    for nombre, regla in plan.reglas:
+        inicio = time.perf_counter()
+        resultado = regla(ctx)
+        estadistica = estadisticas[nombre]
+        estadistica['llamadas'] += 1
+        estadistica['segundos'] += time.perf_counter() - inicio
+        if resultado is not None:
+            return resultado
+
+    # Devolver la cantidad de mano de obra y los materiales relacionados
+    return ctx.resultado()
+
+
+def calcular_cantidad_mano_obra(descripcion, materiales_instalados, materiales_retirados, nodo, codigos_n1=None, codigos_n2=None, tipo_suelo=None, bloque_actual=None, tipos_instalacion=None, tipo_instalacion_nodo=None, indice_materiales=None, plan=None):
+    """
+    Calcula la cantidad de mano de obra necesaria para una partida específica en un nodo.
+    Para todas las partidas y nodos de una OT conviene calcular_mano_obra_ot, que comparte el
+    trabajo por OT y por nodo.
     
-    # Apertura de huecos para postes primaria (11 a 14 metros)
-    if "APERTURA HUECOS POSTES ANCLAS PRIMARIA DE 11 A 14 MTS" in descripcion_upper or "APERTURA HUECOS POSTES 11 MT A 14 MT Y ANCLAS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 11 <= altura <= 14:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "12M" o "14M"
-                            if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    Args:
+        descripcion: Descripción de la partida de mano de obra
+        materiales_instalados: Diccionario de materiales instalados
+        materiales_retirados: Diccionario de materiales retirados
+        nodo: Nodo actual
+        codigos_n1: Diccionario de códigos N1 (opcional)
+        codigos_n2: Diccionario de códigos N2 (opcional)
+        indice_materiales: IndiceMaterialesNodo de la OT (opcional, se construye para el nodo si falta)
+        plan: Reglas de la partida ya resueltas (opcional, ver PLANTILLA_MANO_OBRA)
     
-    # Base de concreto para poste 9 mts
-    if "BASE DE CONCRETO PARA POSTE 9 MTS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes cercanos a 9 metros
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 10:  # Considerar postes cercanos a 9 metros
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "9M"
-                            if "8M" in material_name or "9M" in material_name or "10M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    Returns:
+        tuple: (cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados)
+    """    
     
-    # Concretada de poste de concreto de 8 a 12 metros
-    if "CONCRETADA DE POSTE CONCRETO DE 8 A 12 M INCLUYE MATERIALES Y MO" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto en ese rango
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 12:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            pass
-        
-        cantidad_mo += cantidad_total
+    # Verificamos si hay diccionarios válidos para evitar errores
+    if codigos_n1 is None:
+        codigos_n1 = {}
+    if codigos_n2 is None:
+        codigos_n2 = {}
     
-    # Alquiler machine neumático y compresor
-    if "ALQUILER DE EQUIPO \"MACHINE COMPRESOR\"" in descripcion_upper or "ALQUILER MACHINE NEUMATICO Y COMPRESOR" in descripcion_upper:
-        # Determinar si se necesita compresor basado en trabajos en el nodo
-        requiere_compresor = False
-
-        # Buscar instalaciones que típicamente requieren compresor
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                # Postes de concreto típicamente requieren compresor
-                if "POSTE" in material_name and "CONCRETO" in material_name and nodo in nodos_qty:
-                    requiere_compresor = True
-                    materiales_instalados_relacionados.append(material_name)
-                    break
-                
-        # Si se identifica la necesidad de compresor, contabilizar una vez por nodo
-        if requiere_compresor:
-            cantidad_mo = 1
+    es_proyecto, tipo_instalacion_detectado = tipo_instalacion_mano_obra(nodo, tipos_instalacion, tipo_instalacion_nodo)
+
+    if indice_materiales is None:
+        indice_materiales = IndiceMaterialesNodo(materiales_instalados, materiales_retirados, nodos=(nodo,))
+    if plan is None:
+        plan = plan_mano_obra(descripcion)
+
+    ctx = ContextoManoObra(descripcion, materiales_instalados, materiales_retirados, indice_materiales, nodo,
+                           codigos_n1, codigos_n2, tipo_suelo, es_proyecto, tipo_instalacion_detectado)
+    return evaluar_reglas_mano_obra(plan, ctx)
+
+
+# ======== PLANTILLA DE MANO DE OBRA COMPILADA ========
+# Bloques de la hoja de cada OT: (título, textos de las partidas que entran al bloque, textos de
+# los materiales relacionados). "Postes" ya no incluye BOTADO DE ESCOMBROS; "Conexión a tierra"
+# toma RECUPERACION ZONA DURA y "Otros trabajos" el resto de RECUPERACION ZONA.
+BLOQUES_MANO_OBRA = (
+    ('Postes',
+     ('APERTURA', 'APLOMADA', 'CONCRETADA', 'HINCADA', 'ALQUILER'),
+     ('POSTE',)),
+    ('Instalación luminarias',
+     ('INSTALACION LUMINARIAS',),
+     ('LUMINARIA', 'FOTOCELDA', 'GRILLETE', 'BRAZO')),
+    ('Conexión a tierra',
+     ('CONEXIÓN A CABLE A TIERRA', 'INSTALACION KIT SPT', 'INSTALACION DE ATERRIZAJES', 'BOTADO DE ESCOMBROS', 'RECUPERACION ZONA DURA'),
+     ('KIT DE PUESTA A TIERRA', 'CONECT PERF', 'CONECTOR BIME/COM', 'ALAMBRE', 'TUERCA', 'TORNILLO', 'VARILLA')),
+    ('Desmontaje / Transporte',
+     ('DESMONTAJE', 'TRANSPORTE', 'TRANSP.', 'TRANSPORTE COLLARINES'),
+     ('ALAMBRE', 'BRAZO', 'CÓDIGO', 'CABLE', 'ABRAZADERA', 'GRILLETE')),
+    ('Instalación de cables',
+     ('INSTALACION CABLE',),
+     ('CABLE', 'TPX', 'ALAMBRE')),
+    ('Otros trabajos',
+     ('VESTIDA CONJUNTO 1 O 2 PERCHAS', 'VESTIDA CONJUNTO 3 O MAS PERCHAS', 'VESTIDA', 'CAJA', 'PINTADA', 'EXCAVACION', 'RECUPERACION ZONA', 'SOLDADURA', 'INSTALACION TRAMA', 'INSTALACION CORAZA'),
+     ('PERCHA', 'CAJA', 'TUBO', 'TUBERIA', 'CONDUIT')),
+)
+PartidaManoObra = namedtuple('PartidaManoObra', ['descripcion', 'descripcion_upper', 'unidad', 'plan'])
+BloqueManoObra = namedtuple('BloqueManoObra', ['titulo', 'keywords_mo', 'keywords_mat', 'partidas'])
 
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # Hincada de postes de concreto de 14 metros
-    if "HINCADA DE POSTES CONCRETO DE 14 MTS" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Buscar postes de concreto de 14 metros
-        for key in materiales_instalados:
-            if "POSTE" in key.upper() and "CONCRETO" in key.upper() and "14" in key and nodo in materiales_instalados[key]:
-                cantidad_total += materiales_instalados[key][nodo]
-                materiales_instalados_relacionados.append(key.replace("MATERIAL|", ""))
-            # También considerar postes de concreto donde la altura sea exactamente 14
-            elif "POSTE" in key.upper() and "CONCRETO" in key.upper() and nodo in materiales_instalados[key]:
-                altura_match = re.search(r'(\d+)\s*M', key.upper())
-                if altura_match:
-                    try:
-                        altura = int(altura_match.group(1))
-                        if altura == 14:
-                            cantidad_total += materiales_instalados[key][nodo]
-                            materiales_instalados_relacionados.append(key.replace("MATERIAL|", ""))
-                    except:
-                        pass
-        
-        cantidad_mo += cantidad_total
-    
-    # Botado de escombros
-    if "BOTADO DE ESCOMBROS" in descripcion_upper:
-        # Variables para controlar qué tipo de trabajo requiere botado de escombros
-        tiene_kit_puesta_tierra = False
-        tiene_trabajo_con_postes = False
-
-        # 1. Verificar si hay KIT DE PUESTA A TIERRA
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "KIT DE PUESTA A TIERRA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_kit_puesta_tierra = True
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                    break  # Solo necesitamos saber que existe
-
-        # 2. Verificar si hay trabajo con postes (instalados o retirados)
-        # Buscar postes instalados
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    tiene_trabajo_con_postes = True
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                    break
 
-        # Si no hay postes instalados, buscar postes retirados
-        if not tiene_trabajo_con_postes:
-            for key, nodos_qty in materiales_retirados.items():
-                if "|" in key:
-                    material_name = key.split("|")[1].upper()
-                    if "POSTE" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                        tiene_trabajo_con_postes = True
-                        materiales_retirados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
-                        break
-                    
-        # 3. CORRECCIÓN: Asignar botado de escombros si hay kit de puesta a tierra O trabajo con postes
-        if tiene_kit_puesta_tierra or tiene_trabajo_con_postes:
-            cantidad_mo = 1 * 0.1
-            if tiene_kit_puesta_tierra:
-                materiales_instalados_relacionados.append("BOTADO DE ESCOMBROS POR: KIT PUESTA A TIERRA")
-            if tiene_trabajo_con_postes:
-                materiales_instalados_relacionados.append("BOTADO DE ESCOMBROS POR: TRABAJO CON POSTES")
-
-            return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    # ======== CÓDIGO PARA POSTES DE FIBRA ========
-
-    # Transporte de postes metálicos (incluye postes de fibra) de 4 a 12 metros    
-
-    # Aplomada de postes metálicos o fibra (8 a 10 metros)
-    if "APLOMADA POSTES METALICOS Y/O FIBRA VIDRIO 8 A 10" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes de fibra en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                # Detectar postes de fibra o metálicos
-                if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name) and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 10:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "8M" o "10M"
-                            if "8M" in material_name or "9M" in material_name or "10M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Aplomada de postes metálicos o fibra (11 a 14 metros)
-    if "APLOMADA POSTES METALICOS Y/O FIBRA VIDRIO 11 A 14" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes de fibra en ese rango de altura
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                # Detectar postes de fibra o metálicos
-                if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name) and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 11 <= altura <= 14:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene alturas específicas
-                            if "11M" in material_name or "12M" in material_name or "13M" in material_name or "14M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Concretada de poste de fibra de 8 a 12 metros
-    if "CONCRETADA DE POSTE FIBRA 8 A 12 MT INCLUYE MATERIAL" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes de fibra en ese rango
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE FIBRA" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 8 <= altura <= 12:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene dimensiones apropiadas
-                            if "8M" in material_name or "9M" in material_name or "10M" in material_name or "11M" in material_name or "12M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Hincada de poste de fibra de 8M
-    if "HINCADA DE POSTE FIBRA DE 8M" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes de fibra de 8 metros
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE FIBRA" in material_name and "8M" in material_name and nodo in nodos_qty:
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(material_name)
-                elif "POSTE FIBRA" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if altura == 8:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            pass
-                        
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Hincada de poste de fibra de 10 a 12M
-    if "HINCADA DE POSTE FIBRA DE 10 A 12M" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes de fibra de 10 a 12 metros
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "POSTE FIBRA" in material_name and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 10 <= altura <= 12:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "10M" o "12M"
-                            if "10M" in material_name or "11M" in material_name or "12M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Concretada entre poste y caja
-    if "CONCRETADA ENTRE POSTE Y CAJA INCLUYE MATERIALES E INSTALACIÓN" in descripcion_upper:
-        cantidad_total = 0
-
-        # Verificar si hay postes de fibra o metálicos instalados
-        postes_encontrados = False
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if ("POSTE FIBRA" in material_name or "POSTE METALICO" in material_name) and nodo in nodos_qty:
-                    postes_encontrados = True
-                    materiales_instalados_relacionados.append(material_name)
-                    break
-                
-        # Verificar si hay cajas instaladas
-        cajas_encontradas = False
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if "CAJA" in material_name and nodo in nodos_qty:
-                    cajas_encontradas = True
-                    materiales_instalados_relacionados.append(material_name)
-                    break
-                
-        # Si hay ambos elementos, asignar mano de obra
-        if postes_encontrados and cajas_encontradas:
-            cantidad_mo += 1
-
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-
-    # Base para poste metálico tipo Keison
-    if "BASE PARA POSTE METALICO TIPO KEISON DE 10 A 12 MT" in descripcion_upper:
-        cantidad_total = 0
-
-        # Buscar postes metálicos o de fibra en el rango adecuado
-        for key, nodos_qty in materiales_instalados.items():
-            if "|" in key:
-                material_name = key.split("|")[1].upper()
-                if ("POSTE METALICO" in material_name or "POSTE FIBRA" in material_name) and nodo in nodos_qty:
-                    # Extraer altura del nombre del poste
-                    altura_match = re.search(r'(\d+)\s*M', material_name)
-                    if altura_match:
-                        try:
-                            altura = int(altura_match.group(1))
-                            if 10 <= altura <= 12:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
-                        except:
-                            # Si no se puede extraer la altura pero contiene "10M" o "12M"
-                            if "10M" in material_name or "11M" in material_name or "12M" in material_name:
-                                cantidad_total += nodos_qty[nodo]
-                                materiales_instalados_relacionados.append(material_name)
+def partida_mano_obra(item):
+    """PartidaManoObra de una fila de la plantilla (ver cargar_plantilla_mano_obra)."""
+    descripcion = item['DESCRIPCION MANO DE OBRA']
+    return PartidaManoObra(descripcion, descripcion.upper(), item['UNIDAD'], plan_mano_obra(descripcion))
 
-        cantidad_mo += cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
-    
-    # ======== CÓDIGO PARA TUBERÍA CONDUFLEX ========
-    
-    # Caja de AP e instalación relacionada con tubería conduflex
-    if "CAJA DE A.P 0,4X0,4 MT INCLUYE MATERIALES E INSTALACION" in descripcion_upper:
-        cantidad_total = 0
-        
-        # Verificar si hay tubería conduflex en el nodo
-        for key in materiales_instalados:
-            if "TUBERIA CONDUFLEX" in key.upper() and nodo in materiales_instalados[key]:
-                # Contar una caja por nodo donde haya tubería
-                cantidad_total = 1
-                materiales_instalados_relacionados.append(key.replace("MATERIAL|", ""))
-                break
-        
-        cantidad_mo += cantidad_total
-    
-    # ======== CASO ESPECIAL: PINTADA DE NODOS ========
-    if "PINTADA DE NODOS" in descripcion_upper:
-        cantidad_total = 0
 
-        # Buscar PINTADO DE NODO en materiales instalados
-        for material_key, nodos_qty in materiales_instalados.items():
-            if "|" in material_key:
-                material_name = material_key.split("|")[1].upper()
-                if "PINTADO DE NODO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                    cantidad_total += nodos_qty[nodo]
-                    materiales_instalados_relacionados.append(f"{material_name} ({nodos_qty[nodo]})")
+def compilar_bloques_mano_obra(plantilla, bloques):
+    """
+    Agrupa las partidas de la plantilla por bloque, con la descripción en mayúsculas y las
+    reglas ya resueltas (plan_mano_obra). Una partida entra a todos los bloques cuyos textos
+    contiene, en el orden de la plantilla.
+
+    Returns:
+        tuple: BloqueManoObra en el orden de `bloques`
+    """
+    partidas = [partida_mano_obra(item) for item in plantilla]
+    return tuple(
+        BloqueManoObra(titulo, keywords_mo, keywords_mat, tuple(
+            partida for partida in partidas if any(kw in partida.descripcion_upper for kw in keywords_mo)
+        ))
+        for titulo, keywords_mo, keywords_mat in bloques
+    )
+
+
+# Se arma una vez por proceso, al importar el módulo, y todos los consumidores la comparten sin modificarla
+PLANTILLA_MANO_OBRA = compilar_bloques_mano_obra(cargar_plantilla_mano_obra(), BLOQUES_MANO_OBRA)
+
+
+# ======== CACHÉ DE MANO DE OBRA POR HUELLA DE NODO ========
+# Muchos nodos llevan el mismo kit de materiales y los mismos datos, y las reglas dan para ellos
+# el mismo resultado. La huella reúne todo lo que leen las reglas de un nodo, así que el
+# resultado de cada partida se guarda por huella y se reutiliza entre nodos, OTs y solicitudes.
+CACHE_MANO_OBRA = OrderedDict()
+BLOQUEO_CACHE_MANO_OBRA = threading.Lock()
+ESTADISTICAS_CACHE_MANO_OBRA = {'aciertos': 0, 'fallos': 0}
+
+
+def huella_nodo_mano_obra(indice, nodo):
+    """
+    Huella de los materiales instalados y retirados de un nodo, en el orden del índice (el de
+    las listas de materiales relacionados) y con el tipo de la cantidad, que se nota al escribirla.
+    """
+    return (
+        tuple((clave, type(cantidad), cantidad) for clave, _, cantidad in indice.instalados(nodo)),
+        tuple((clave, type(cantidad), cantidad) for clave, _, cantidad in indice.retirados(nodo)),
+    )
+
+
+def datos_nodo_mano_obra(nodo, codigos_n1, codigos_n2, tipo_suelo, es_proyecto, tipo_instalacion):
+    """
+    Valor de cada dato de DATOS_NODO_MANO_OBRA para el nodo. Los códigos N1/N2 van completos
+    porque las reglas los copian en los materiales relacionados.
+    """
+    return {
+        'codigos': (
+            tuple(tuple(valores[nodo]) for valores in codigos_n1.values() if nodo in valores),
+            tuple(tuple(valores[nodo]) for valores in codigos_n2.values() if nodo in valores),
+        ),
+        'tipo_suelo': tipo_suelo,
+        'tipo_instalacion': (es_proyecto, tipo_instalacion),
+    }
+
+
+def resultados_cache_mano_obra(huella):
+    """
+    Diccionario (descripción, datos del nodo que lee la partida) -> (cantidad, instalados,
+    retirados) guardado para la huella; se crea vacío si no existe y se descarta la huella usada hace más tiempo si se pasa del máximo.
+    """
+    if MAX_CACHE_MANO_OBRA <= 0:
+        return {}
+    with BLOQUEO_CACHE_MANO_OBRA:
+        resultados = CACHE_MANO_OBRA.get(huella)
+        if resultados is None:
+            resultados = CACHE_MANO_OBRA[huella] = {}
+            while len(CACHE_MANO_OBRA) > MAX_CACHE_MANO_OBRA:
+                CACHE_MANO_OBRA.popitem(last=False)
+        else:
+            CACHE_MANO_OBRA.move_to_end(huella)
+    return resultados
+
+
+def registrar_uso_cache_mano_obra(aciertos, fallos):
+    with BLOQUEO_CACHE_MANO_OBRA:
+        ESTADISTICAS_CACHE_MANO_OBRA['aciertos'] += aciertos
+        ESTADISTICAS_CACHE_MANO_OBRA['fallos'] += fallos
+
+
+def uso_cache_mano_obra():
+    """Aciertos, fallos, tasa de aciertos y huellas guardadas de la caché de mano de obra."""
+    with BLOQUEO_CACHE_MANO_OBRA:
+        aciertos = ESTADISTICAS_CACHE_MANO_OBRA['aciertos']
+        fallos = ESTADISTICAS_CACHE_MANO_OBRA['fallos']
+        huellas = len(CACHE_MANO_OBRA)
+    return {
+        'aciertos': aciertos,
+        'fallos': fallos,
+        'tasa_aciertos': round(aciertos / (aciertos + fallos), 4) if aciertos + fallos else 0.0,
+        'huellas': huellas,
+        'maximo': MAX_CACHE_MANO_OBRA,
+    }
+
+
+class ManoObraOT:
+    """
+    Mano de obra de todos los nodos de una OT para un conjunto de partidas (ver calcular_mano_obra_ot).
+
+    `cantidades` es una matriz nodo x partida con la cantidad tal como la devuelven las reglas
+    (int o float; 0 si la partida no aplica al nodo) y `relacionados` guarda, por celda
+    (fila, columna), los materiales instalados y retirados relacionados.
+    """
+    __slots__ = ('nodos', 'partidas', 'filas', 'columnas', 'cantidades', 'relacionados')
+
+    def __init__(self, nodos, partidas):
+        unicas = {}
+        for partida in partidas:
+            unicas.setdefault(partida.descripcion, partida)
+        self.nodos = list(dict.fromkeys(nodos))
+        self.partidas = list(unicas.values())
+        self.filas = {nodo: fila for fila, nodo in enumerate(self.nodos)}
+        self.columnas = {partida.descripcion: columna for columna, partida in enumerate(self.partidas)}
+        # dtype object para conservar el tipo de cada cantidad: las hojas la escriben con f"{cantidad}"
+        self.cantidades = np.zeros((len(self.nodos), len(self.partidas)), dtype=object)
+        self.relacionados = {}
+
+    def cantidad(self, nodo, descripcion):
+        return self.cantidades[self.filas[nodo], self.columnas[descripcion]]
+
+    def materiales(self, nodo, descripcion):
+        """(instalados, retirados) relacionados; listas vacías si la celda no se evaluó."""
+        return self.relacionados.get((self.filas[nodo], self.columnas[descripcion]), ([], []))
+
+
+def calcular_mano_obra_ot(info, nodos, partidas, materiales_instalados=None, materiales_retirados=None, indice_materiales=None):
+    """
+    Calcula de una vez la mano de obra de `partidas` (PartidaManoObra) en todos los `nodos` de la
+    OT `info`. El índice de materiales, los tipos de instalación y, por nodo, el tipo de suelo y
+    la detección de proyecto se resuelven una sola vez y se comparten entre todas las partidas.
+
+    Las celdas cuyas reglas no tienen ningún material disparador en el nodo (ver
+    CATEGORIAS_DISPARADORAS) no se evalúan: quedan en 0 y sin materiales relacionados. Las
+    demás se toman de la caché por huella de nodo (ver huella_nodo_mano_obra) cuando otro nodo
+    con la misma huella ya las calculó.
+
+    Args:
+        info: OrdenTrabajo con los códigos y datos por nodo
+        nodos: Nodos de la matriz, en orden
+        partidas: PartidaManoObra de las columnas; las descripciones repetidas se calculan una vez
+        materiales_instalados: Materiales instalados a usar (por defecto los de la OT)
+        materiales_retirados: Materiales retirados a usar (por defecto los de la OT)
+        indice_materiales: IndiceMaterialesNodo de esos materiales (opcional)
+
+    Returns:
+        ManoObraOT
+    """
+    if materiales_instalados is None:
+        materiales_instalados = info.materiales
+    if materiales_retirados is None:
+        materiales_retirados = info.materiales_retirados
+    if indice_materiales is None:
+        indice_materiales = IndiceMaterialesNodo(materiales_instalados, materiales_retirados)
+
+    resultado = ManoObraOT(nodos, partidas)
+    mascara_ot = indice_materiales.mascara_ot()
+    columnas = [
+        (columna, partida) for columna, partida in enumerate(resultado.partidas)
+        if partida.plan.disparadores is None or partida.plan.disparadores & mascara_ot
+    ]
+    tipos_instalacion = info.datos_por_nodo('tipo_instalacion')
+    aciertos = fallos = 0
+
+    for fila, nodo in enumerate(resultado.nodos):
+        es_proyecto, tipo_instalacion = tipo_instalacion_mano_obra(nodo, tipos_instalacion, tipos_instalacion.get(nodo))
+        tipo_suelo = info.dato_nodo(nodo, 'tipo_suelo', "")
+        mascara = indice_materiales.mascara(nodo)
+        guardados = resultados_cache_mano_obra(huella_nodo_mano_obra(indice_materiales, nodo))
+        datos_nodo = datos_nodo_mano_obra(nodo, info.codigos_n1, info.codigos_n2, tipo_suelo, es_proyecto, tipo_instalacion)
+        for columna, partida in columnas:
+            disparadores = partida.plan.disparadores
+            if disparadores is not None and not disparadores & mascara:
+                continue
+            clave = (partida.descripcion, tuple(datos_nodo[dato] for dato in partida.plan.datos_nodo))
+            guardado = guardados.get(clave)
+            if guardado is None:
+                fallos += 1
+                ctx = ContextoManoObra(partida.descripcion, materiales_instalados, materiales_retirados, indice_materiales, nodo,
+                                       info.codigos_n1, info.codigos_n2, tipo_suelo, es_proyecto, tipo_instalacion)
+                cantidad, instalados, retirados = evaluar_reglas_mano_obra(partida.plan, ctx)
+                # Se guardan tuplas para que nadie modifique lo compartido
+                guardados[clave] = (cantidad, tuple(instalados), tuple(retirados))
+            else:
+                aciertos += 1
+                cantidad, instalados, retirados = guardado[0], list(guardado[1]), list(guardado[2])
+            resultado.cantidades[fila, columna] = cantidad
+            resultado.relacionados[fila, columna] = (instalados, retirados)
+
+    registrar_uso_cache_mano_obra(aciertos, fallos)
+    return resultado
+
+
+# ======== ESCRITURA DEL EXCEL (MODO WRITE-ONLY) ========
+# Las hojas se escriben fila por fila con openpyxl en modo write-only: el formato de cada celda,
+# las combinaciones y las alturas se deciden al generar la fila, sin recorrer la hoja después.
+ESTILO_ENCABEZADO_TABLA = {
+    'font': Font(bold=True),
+    'border': Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin')),
+    'alignment': Alignment(horizontal='center', vertical='top'),
+}
+ALINEACION_AJUSTE_TEXTO = Alignment(wrap_text=True, vertical='top')
+ALINEACION_CENTRADA = Alignment(horizontal='center', vertical='center')
+ENCABEZADOS_SECCION_OT = ["MATERIALES INSTALADOS", "MATERIALES RETIRADOS", "OBSERVACIONES POR NODO",
+                          "OBSERVACIONES COMPLETAS", "MANO DE OBRA POR NODO"]
+# Encabezados que cierran las filas de mano de obra de un BLOQUE
+FIN_BLOQUE_OT = ["MATERIALES INSTALADOS", "MATERIALES RETIRADOS", "OBSERVACIONES COMPLETAS", "MANO DE OBRA POR NODO"]
+
+
+@contextmanager
+def libro_solo_escritura(destino):
+    """Libro de openpyxl en modo write-only que se guarda en `destino` al cerrar el bloque."""
+    libro = Workbook(write_only=True)
+    yield libro
+    with etapa('serializar') as volumenes:
+        libro.save(destino)
+        volumenes['bytes'] = destino.tell()
+
+
+def valor_celda_excel(valor):
+    """
+    Convierte un valor al tipo que se escribe en la celda, igual que DataFrame.to_excel.
+
+    Returns:
+        tuple: (valor, formato de número o None)
+    """
+    if valor is None or (isinstance(valor, (float, np.floating)) and np.isnan(valor)) or valor is pd.NaT:
+        return '', None
+    if isinstance(valor, (bool, np.bool_)):
+        return bool(valor), None
+    if isinstance(valor, (int, np.integer)):
+        return int(valor), None
+    if isinstance(valor, (float, np.floating)):
+        if np.isinf(valor):
+            return ('inf' if valor > 0 else '-inf'), None
+        return float(valor), None
+    if isinstance(valor, datetime.datetime):
+        return valor, "YYYY-MM-DD HH:MM:SS"
+    if isinstance(valor, datetime.date):
+        return valor, "YYYY-MM-DD"
+    if isinstance(valor, datetime.timedelta):
+        return valor.total_seconds() / 86400, "0"
+    return str(valor), None
+
+
+def celda_excel(hoja, valor, formato=None, alignment=None, font=None, fill=None, border=None):
+    """Celda write-only con formato; `valor` ya debe venir convertido con valor_celda_excel."""
+    celda = WriteOnlyCell(hoja, valor)
+    if formato:
+        celda.number_format = formato
+    if font is not None:
+        celda.font = font
+    if fill is not None:
+        celda.fill = fill
+    if border is not None:
+        celda.border = border
+    if alignment is not None:
+        celda.alignment = alignment
+    return celda
+
+
+def encabezado_tabla(hoja, columnas):
+    """Fila de encabezados con el formato que aplica pandas (negrita, bordes y centrado)."""
+    fila = []
+    for columna in columnas:
+        valor, formato = valor_celda_excel(columna)
+        alineacion = ESTILO_ENCABEZADO_TABLA['alignment']
+        if isinstance(valor, str) and '\n' in valor:
+            alineacion = ALINEACION_AJUSTE_TEXTO
+        fila.append(celda_excel(hoja, valor, formato, alignment=alineacion, font=ESTILO_ENCABEZADO_TABLA['font'],
+                                border=ESTILO_ENCABEZADO_TABLA['border']))
+    return fila
+
+
+def escribir_hoja_ot(libro, titulo, columnas, filas):
+    """
+    Escribe la hoja de una OT en un libro write-only.
 
-        cantidad_mo = cantidad_total
-        return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
+    Los encabezados de sección se combinan a lo ancho de la tabla y se colorean, las celdas con
+    varias líneas se ajustan y su fila toma 15 puntos por línea, y las filas de mano de obra que
+    siguen a cada "BLOQUE:" se ajustan completas hasta el siguiente encabezado.
+    """
+    hoja = libro.create_sheet(titulo)
+    hoja.append(encabezado_tabla(hoja, columnas))
+    num_columnas = len(columnas)
+    ultima_columna = get_column_letter(num_columnas)
+    en_bloque = False
+
+    for numero_fila, fila in enumerate(filas, start=2):
+        convertidos = [valor_celda_excel(valor) for valor in fila]
+        primero = convertidos[0][0] if convertidos else None
+        es_texto = isinstance(primero, str)
+        es_seccion = primero in ENCABEZADOS_SECCION_OT or (es_texto and primero.startswith("BLOQUE: "))
+
+        # Filas de mano de obra: desde un "BLOQUE:" hasta el próximo encabezado
+        cierra_bloque = bool(primero) and es_texto and ("BLOQUE:" in primero or primero in FIN_BLOQUE_OT)
+        ajustar_fila = en_bloque and not cierra_bloque
+        if cierra_bloque:
+            en_bloque = "BLOQUE:" in primero
+
+        if es_seccion:
+            # El resto de la fila queda vacío dentro de la combinación
+            convertidos = convertidos[:1] + [('', None)] * (len(convertidos) - 1)
+            hoja.merged_cells.add(f"A{numero_fila}:{ultima_columna}{numero_fila}")
+        if ajustar_fila:
+            convertidos += [('', None)] * (num_columnas - len(convertidos))
+
+        max_lineas = 0
+        celdas = []
+        for columna, (valor, formato) in enumerate(convertidos):
+            alineacion = font = fill = None
+            if columna == 0 and es_seccion:
+                alineacion = ALINEACION_CENTRADA
+                if primero == "MANO DE OBRA POR NODO":
+                    font = Font(bold=True, color="FFFFFF")
+                    fill = PatternFill("solid", fgColor="009900")  # Verde
+                elif primero.startswith("BLOQUE: "):
+                    font = Font(bold=True)
+                    fill = PatternFill("solid", fgColor="AAAAAA")  # Gris
+                else:
+                    font = Font(bold=True)
+                    fill = PatternFill("solid", fgColor="DDDDDD")  # Gris claro
+            if isinstance(valor, str) and '\n' in valor:
+                alineacion = ALINEACION_AJUSTE_TEXTO
+                max_lineas = max(max_lineas, valor.count('\n') + 1)
+            if ajustar_fila:
+                alineacion = ALINEACION_AJUSTE_TEXTO
+            if alineacion is None and formato is None:
+                celdas.append(valor)
+            else:
+                celdas.append(celda_excel(hoja, valor, formato, alignment=alineacion, font=font, fill=fill))
 
-    
+        # Calcular altura: 15 puntos por línea, con un mínimo de 15 y un máximo de 409
+        if max_lineas:
+            hoja.row_dimensions[numero_fila].height = max(15, min(15 * max_lineas, 409))
+        hoja.append(celdas)
 
-    # Devolver la cantidad de mano de obra y los materiales relacionados
-    return cantidad_mo, materiales_instalados_relacionados, materiales_retirados_relacionados
 
-def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_combinados):
+def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_combinados, progreso=None):
     output = BytesIO()
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        temp_sheet_name = "PlantillaInicial"
-        writer.book.create_sheet(temp_sheet_name)
+    with libro_solo_escritura(output) as libro:
         sheets_created = False        
         
-        generate_resumen_general(writer, datos_combinados)
+        with etapa('resumen_general') as volumenes:
+            generate_resumen_general(libro, datos_combinados)
+            volumenes['ots'] = len(datos_combinados)
         
-        generate_resumen_tecnicos(writer, datos_combinados, dfs_originales_combinados)  
+        with etapa('resumen_tecnicos') as volumenes:
+            generate_resumen_tecnicos(libro, datos_combinados, dfs_originales_combinados)
+            volumenes['filas'] = sum(len(df) for df in dfs_originales_combinados.values())
         
         # IMPORTANTE: Habilitar la generación de la hoja de asociaciones
         #agregar_hoja_asociaciones(writer, datos_combinados) 
@@ -4315,13 +6163,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
             #    try:
             #        # Verificar si hay códigos N1 o N2 en esta OT
             #        hay_codigos = False
-            #        for _, nodos_valores in info.get('codigos_n1', {}).items():
+            #        for _, nodos_valores in info.codigos_n1.items():
             #            if any(len(codigos) > 0 for codigos in nodos_valores.values()):
             #                hay_codigos = True
             #                break
             #        
             #        if not hay_codigos:
-            #            for _, nodos_valores in info.get('codigos_n2', {}).items():
+            #            for _, nodos_valores in info.codigos_n2.items():
             #                if any(len(codigos) > 0 for codigos in nodos_valores.values()):
             #                    hay_codigos = True
             #                    break
@@ -4336,13 +6184,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
             #    except Exception as e:
             #        print(f"ERROR al generar hoja de mano de obra para OT {ot}: {str(e)}")
             
-            for ot, info in datos_combinados.items():
-                seen = set()
-                nodos_con_fechas = [(nodo, pd.to_datetime(info['fechas_sync'].get(nodo, "01/01/1900 00:00:00"), 
-                   format='%d/%m/%Y %H:%M:%S', errors='coerce')) 
-                   for nodo in info['nodos'] if nodo not in seen and not seen.add(nodo)]
-                nodos_con_fechas.sort(key=lambda x: x[1])  # Sort by timestamp
-                nodos_ordenados = [nodo for nodo, _ in nodos_con_fechas]
+            for ot_numero, (ot, info) in enumerate(datos_combinados.items()):
+                inicio_ot = time.perf_counter()
+                if progreso is not None:
+                    progreso['ots_generadas'] = ot_numero
+                tipos_instalacion = info.datos_por_nodo('tipo_instalacion')
+                nodos_ordenados = info.nodos_por_fecha(incluir_sin_fecha=True)
+                columnas_nodos = info.columnas_nodos()
                 num_nodos = len(nodos_ordenados)
                 # Obtener postes desde la fila "Nodos postes"
                 postes = [nodo.split('_')[0] for nodo in nodos_ordenados]  # Ej: ['1417541', '1417542']
@@ -4363,8 +6211,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 # Agregar fila con fechas de sincronización de cada nodo
                 fechas_fila = ['Fechas Sincronización', '', '', '']
                 for nodo in nodos_ordenados:
-                    fecha = info['fechas_sync'].get(nodo, "Sin fecha")
-                    fechas_fila.append(fecha)
+                    fechas_fila.append(formatear_fecha_sync(info.dato_nodo(nodo, 'fecha_sync')))
                 filas.append(fechas_fila)
                 
                 # ===== PROCESAR CÓDIGOS N1 Y N2 =====
@@ -4377,13 +6224,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         if key not in codigos_agrupados:
                             codigos_agrupados[key] = {
                                 'total': 0,
-                                'por_nodo': {nodo: set() for nodo in nodos_ordenados}
+                                'por_nodo': defaultdict(set)  # Solo los nodos con códigos
                             }
 
                         # Contar códigos por nodo y total
                         for nodo, codigos in nodos_data.items():
                             codigos_agrupados[key]['total'] += len(codigos)
-                            if nodo in nodos_ordenados:
+                            if nodo in columnas_nodos:
                                 codigos_agrupados[key]['por_nodo'][nodo].update(codigos)
 
                     # Ahora, crear las filas con los códigos agrupados
@@ -4392,47 +6239,42 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         # Crear la fila con suficientes elementos vacíos para todos los nodos
                         fila = [key, 'UND', total, ''] + [''] * len(nodos_ordenados)
 
-                        # Agregar códigos por nodo
-                        for i, nodo in enumerate(nodos_ordenados):
-                            # Obtener los códigos para este nodo
-                            codigos = datos['por_nodo'][nodo]
-                            # Si hay códigos, mostrarlos separados por coma
+                        # Agregar los códigos en la columna de cada nodo, separados por coma
+                        for nodo, codigos in datos['por_nodo'].items():
                             if codigos:
-                                fila[4 + i] = ', '.join(sorted(codigos))
+                                fila[columnas_nodos[nodo]] = ', '.join(sorted(codigos))
 
                         filas.append(fila)
 
-                if 'codigos_n1' in info:
-                    agregar_codigos("N1", info['codigos_n1'])
-                if 'codigos_n2' in info:
-                    agregar_codigos("N2", info['codigos_n2'])
+                agregar_codigos("N1", info.codigos_n1)
+                agregar_codigos("N2", info.codigos_n2)
                 
                 # ===== MATERIALES INSTALADOS =====
                 filas.append(['MATERIALES INSTALADOS', '', '', ''] + [''] * num_nodos)
-                for material_key in info['materiales']:
+                for material_key in info.materiales:
                     try:
-                        _, nombre = material_key.split('|', 1)
-                        cantidades = info['materiales'][material_key]
+                        nombre = material_key.etiqueta
+                        cantidades = info.materiales[material_key]
                         total = sum(cantidades.values())
                         # Celda de fecha vacía para materiales instalados
                         fila = [nombre, 'UND', total, ''] + [cantidades.get(n, 0) for n in nodos_ordenados]
                         filas.append(fila)
                     except Exception as e:
-                        logger.error(f"Error procesando material: {str(e)}")
+                        logger.error("Error procesando material: %s", e)
                         continue                                
                 
                 # ===== MATERIALES RETIRADOS =====
                 filas.append(['MATERIALES RETIRADOS', '', '', ''] + [''] * num_nodos)
-                for material_key in info.get('materiales_retirados', {}):
+                for material_key in info.materiales_retirados:
                     try:
-                        _, nombre = material_key.split('|', 1)
-                        cantidades = info['materiales_retirados'][material_key]
+                        nombre = material_key.etiqueta
+                        cantidades = info.materiales_retirados[material_key]
                         total = sum(cantidades.values())
                         # Celda de fecha vacía para materiales retirados
                         fila = [nombre, 'UND', total, ''] + [cantidades.get(n, 0) for n in nodos_ordenados]
                         filas.append(fila)
                     except Exception as e:
-                        logger.error(f"Error procesando material retirado: {str(e)}")
+                        logger.error("Error procesando material retirado: %s", e)
                         continue
                 
                 # ===== OBSERVACIONES COMPLETAS =====
@@ -4444,28 +6286,28 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 # Recopilar todas las observaciones con sus códigos y fechas
                 for nodo in nodos_ordenados:
                     poste = nodo.split('_')[0]
-                    fecha = info['fechas_sync'].get(nodo, "Sin fecha")
+                    fecha = formatear_fecha_sync(info.dato_nodo(nodo, 'fecha_sync'))
                     
                     # Obtener códigos asociados a este nodo específico
                     codigos = set()
-                    for key in info['codigos_n1']:
-                        if nodo in info['codigos_n1'][key]:
-                            codigos.update(info['codigos_n1'][key].get(nodo, set()))
-                    for key in info['codigos_n2']:
-                        if nodo in info['codigos_n2'][key]:
-                            codigos.update(info['codigos_n2'][key].get(nodo, set()))
+                    for key in info.codigos_n1:
+                        if nodo in info.codigos_n1[key]:
+                            codigos.update(info.codigos_n1[key].get(nodo, set()))
+                    for key in info.codigos_n2:
+                        if nodo in info.codigos_n2[key]:
+                            codigos.update(info.codigos_n2[key].get(nodo, set()))
                     
                     if not codigos:
                         codigos.add("Sin código")
                     
                     # Obtener observaciones específicas para este nodo
                     aspectos = set()
-                    for mat_key in info['aspectos_materiales']:
-                        if nodo in info['aspectos_materiales'][mat_key]:
-                            aspectos.update(info['aspectos_materiales'][mat_key].get(nodo, []))
-                    for mat_key in info['aspectos_retirados']:
-                        if nodo in info['aspectos_retirados'][mat_key]:
-                            aspectos.update(info['aspectos_retirados'][mat_key].get(nodo, []))
+                    for mat_key in info.aspectos_materiales:
+                        if nodo in info.aspectos_materiales[mat_key]:
+                            aspectos.update(info.aspectos_materiales[mat_key].get(nodo, []))
+                    for mat_key in info.aspectos_retirados:
+                        if nodo in info.aspectos_retirados[mat_key]:
+                            aspectos.update(info.aspectos_retirados[mat_key].get(nodo, []))
                     
                     if not aspectos:
                         aspectos.add("Sin observaciones")
@@ -4482,16 +6324,17 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 fila_obs_completas = ['Observaciones Completas', 'Obs', '', ''] + [''] * num_nodos
                 
                 # Para cada nodo, formatear sus observaciones completas y colocarlas en la columna correspondiente
-                for i, nodo in enumerate(nodos_ordenados):
+                for nodo, columna in columnas_nodos.items():
                     if observaciones_completas[nodo]:
                         # Separar cada entrada con una línea en blanco
                         texto_obs = '\n\n'.join(observaciones_completas[nodo])
-                        fila_obs_completas[4 + i] = texto_obs
+                        fila_obs_completas[columna] = texto_obs
                 
                 # Agregar la fila de observaciones completas
                 filas.append(fila_obs_completas)
                 
                 # ===== MANO DE OBRA POR NODO =====
+                inicio_mano_obra = time.perf_counter()
                 # Agregar encabezado para la mano de obra
                 filas.append(['MANO DE OBRA POR NODO', '', '', ''] + [''] * num_nodos)
                 
@@ -4500,43 +6343,27 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 materiales_retirados = {}
                 
                 # Extraer materiales instalados
-                for material_key, nodos_qty in info['materiales'].items():
+                for material_key, nodos_qty in info.materiales.items():
                     materiales_instalados[material_key] = {}
                     for nodo, qty in nodos_qty.items():
-                        if nodo in nodos_ordenados and qty > 0:
+                        if nodo in columnas_nodos and qty > 0:
                             materiales_instalados[material_key][nodo] = float(qty)
                 
                 # Extraer materiales retirados
-                for material_key, nodos_qty in info.get('materiales_retirados', {}).items():
+                for material_key, nodos_qty in info.materiales_retirados.items():
                     materiales_retirados[material_key] = {}
                     for nodo, qty in nodos_qty.items():
-                        if nodo in nodos_ordenados and qty > 0:
+                        if nodo in columnas_nodos and qty > 0:
                             materiales_retirados[material_key][nodo] = float(qty)
                 
-                # Cargar la plantilla de mano de obra
-                plantilla = cargar_plantilla_mano_obra()
+                # Matriz nodo x partida de los bloques que se calculan por nodo (luminarias va aparte)
+                bloques_por_nodo = [bloque for bloque in PLANTILLA_MANO_OBRA if bloque.titulo != "Instalación luminarias"]
+                mano_obra_ot = calcular_mano_obra_ot(
+                    info, nodos_ordenados,
+                    (partida for bloque in bloques_por_nodo for partida in bloque.partidas),
+                    materiales_instalados, materiales_retirados
+                )
                 
-                # Agrupar partidas por bloques para mejor visualización
-                bloques = [
-                    ("Postes",
-                    ["APERTURA", "APLOMADA", "CONCRETADA", "HINCADA", "ALQUILER"],  # Removido "BOTADO DE ESCOMBROS"
-                    ["POSTE"]),
-                    ("Instalación luminarias",
-                    ["INSTALACION LUMINARIAS"],
-                    ["LUMINARIA", "FOTOCELDA", "GRILLETE", "BRAZO"]),
-                    ("Conexión a tierra",
-                    ["CONEXIÓN A CABLE A TIERRA", "INSTALACION KIT SPT", "INSTALACION DE ATERRIZAJES", "BOTADO DE ESCOMBROS", "RECUPERACION ZONA DURA"],  # Específico para zona dura
-                    ["KIT DE PUESTA A TIERRA", "CONECT PERF", "CONECTOR BIME/COM", "ALAMBRE", "TUERCA", "TORNILLO", "VARILLA"]),
-                    ("Desmontaje / Transporte",
-                    ["DESMONTAJE", "TRANSPORTE", "TRANSP.", "TRANSPORTE COLLARINES"],
-                    ["ALAMBRE", "BRAZO", "CÓDIGO", "CABLE", "ABRAZADERA", "GRILLETE"]),
-                    ("Instalación de cables",
-                    ["INSTALACION CABLE"],
-                    ["CABLE", "TPX", "ALAMBRE"]),
-                    ("Otros trabajos",
-                    ["VESTIDA CONJUNTO 1 O 2 PERCHAS", "VESTIDA CONJUNTO 3 O MAS PERCHAS", "VESTIDA", "CAJA", "PINTADA", "EXCAVACION", "RECUPERACION ZONA", "SOLDADURA", "INSTALACION TRAMA", "INSTALACION CORAZA"],  # Solo "RECUPERACION ZONA" sin "DURA"
-                    ["PERCHA", "CAJA", "TUBO", "TUBERIA", "CONDUIT"])
-                ]
                 
                 # Pre-procesamiento para unificar los tipos de desmontaje de luminarias
                 partidas_unificadas = []
@@ -4564,7 +6391,6 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 ## Reemplazar la plantilla original con la unificada
                 #plantilla_original = plantilla
                 #plantilla = partidas_unificadas
-                plantilla_original = plantilla
                 # Crear un diccionario para almacenar la mano de obra por nodo
                 mano_obra_por_nodo = {nodo: {} for nodo in nodos_ordenados}
 
@@ -4573,32 +6399,30 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 
                 # MEJORA: Determinar si hay brazos grandes o pequeños en cada nodo
                 for nodo in nodos_ordenados:
-                    tipo_suelo = info['tipos_suelo'].get(nodo, "")    
-                    tipos_instalacion_dict = info.get('tipos_instalacion', {})
-                    es_proyecto = nodo in tipos_instalacion_dict and tipos_instalacion_dict[nodo].strip() != ""
-                    tipo_instalacion_nodo = tipos_instalacion_dict.get(nodo, None)
+                    tipo_suelo = info.dato_nodo(nodo, 'tipo_suelo', "")    
+                    es_proyecto = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
+                    tipo_instalacion_nodo = tipos_instalacion.get(nodo, None)
                     # Verificar si hay LUMINARIA CODIGO/BRAZO en este nodo específico
-                    es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                    es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
     
                     if es_proyecto_nodo:
                         # Para proyectos, NO analizar brazos, usar directamente el tipo de instalación
-                        tipo_instalacion = info['tipos_instalacion'][nodo].upper()
-                        print(f"DEBUG: Procesando PROYECTO - Nodo: {nodo}, Tipo: {tipo_instalacion}")
+                        tipo_instalacion = tipos_instalacion[nodo].upper()
+                        logger.debug("Procesando PROYECTO - Nodo: %s, Tipo: %s", nodo, tipo_instalacion)
 
                         # Verificar si hay LUMINARIA INSTALADA EN [TIPO] en este nodo
                         tiene_luminaria_instalada = False
                         cantidad_luminaria_instalada = 0
 
                         for material_key, nodos_qty in materiales_instalados.items():
-                            if "|" in material_key:
-                                material_name = material_key.split("|")[1].upper()
-                                if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                    tiene_luminaria_instalada = True
-                                    cantidad_luminaria_instalada += nodos_qty[nodo]
+                            material_name = material_key.nombre.upper()
+                            if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                tiene_luminaria_instalada = True
+                                cantidad_luminaria_instalada += nodos_qty[nodo]
 
                         # Si no hay luminarias instaladas directamente, verificar códigos
                         if not tiene_luminaria_instalada:
-                            for _, nodos_valores in info.get('codigos_n1', {}).items():
+                            for _, nodos_valores in info.codigos_n1.items():
                                 if nodo in nodos_valores:
                                     codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                     if codigos_validos:
@@ -4607,7 +6431,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                         break
                                     
                             if not tiene_luminaria_instalada:
-                                for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                for _, nodos_valores in info.codigos_n2.items():
                                     if nodo in nodos_valores:
                                         codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                         if codigos_validos:
@@ -4654,11 +6478,10 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         cantidad_luminaria_codigo_brazo = 0
 
                         for material_key, nodos_qty in materiales_instalados.items():
-                            if "|" in material_key:
-                                material_name = material_key.split("|")[1].upper()
-                                if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                    tiene_luminaria_codigo_brazo = True
-                                    cantidad_luminaria_codigo_brazo += nodos_qty[nodo]
+                            material_name = material_key.nombre.upper()
+                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                tiene_luminaria_codigo_brazo = True
+                                cantidad_luminaria_codigo_brazo += nodos_qty[nodo]
 
                         # Solo verificar brazos si hay LUMINARIA CODIGO/BRAZO
                         usar_canasta = False
@@ -4668,32 +6491,31 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         if tiene_luminaria_codigo_brazo:
                             # Verificar si hay brazos INSTALADOS en este nodo específico y determinar su tamaño
                             for material_key, nodos_qty in materiales_instalados.items():
-                                if "|" in material_key:
-                                    material_name = material_key.split("|")[1].upper()
-                                    if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                        brazo_encontrado = True
-                                        # Intentar extraer la longitud del brazo
-                                        longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                                        if longitud_match:
-                                            try:
-                                                longitud = int(longitud_match.group(1))
-                                                tamano_brazo = longitud
-                                                # Considerar brazos de 3 metros como grandes (para canasta)
-                                                if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
-                                                    usar_canasta = True
-                                                    break
-                                            except:
-                                                pass
-                                        # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
-                                        elif "2 1/2" in material_name or "2.5" in material_name:
-                                            usar_canasta = True
-                                            tamano_brazo = 4  # Asumimos un valor mayor a 3
-                                            break
-                                        # Verificar explícitamente si es un brazo de 3 metros
-                                        elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                            usar_canasta = True
-                                            tamano_brazo = 3
-                                            break
+                                material_name = material_key.nombre.upper()
+                                if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                    brazo_encontrado = True
+                                    # Intentar extraer la longitud del brazo
+                                    longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
+                                    if longitud_match:
+                                        try:
+                                            longitud = int(longitud_match.group(1))
+                                            tamano_brazo = longitud
+                                            # Considerar brazos de 3 metros como grandes (para canasta)
+                                            if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
+                                                usar_canasta = True
+                                                break
+                                        except:
+                                            pass
+                                    # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
+                                    elif "2 1/2" in material_name or "2.5" in material_name:
+                                        usar_canasta = True
+                                        tamano_brazo = 4  # Asumimos un valor mayor a 3
+                                        break
+                                    # Verificar explícitamente si es un brazo de 3 metros
+                                    elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                                        usar_canasta = True
+                                        tamano_brazo = 3
+                                        break
                                         
                         # Guardar la información del tipo de brazo para este nodo
                         info_brazos_por_nodo[nodo] = {
@@ -4755,48 +6577,46 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 
                     # Contar luminarias retiradas
                     for material_key, nodos_qty in materiales_retirados.items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            # Verificar si es una luminaria retirada
-                            es_luminaria_retirada = (
-                                "LUMINARIA" in material_name or 
-                                "LUM" in material_name or
-                                "LED" in material_name or
-                                "LAMP" in material_name or
-                                "FOCO" in material_name or
-                                "RETIRADA" in material_name
-                            )
-                            if es_luminaria_retirada and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                luminarias_retiradas += nodos_qty[nodo]
+                        material_name = material_key.nombre.upper()
+                        # Verificar si es una luminaria retirada
+                        es_luminaria_retirada = (
+                            "LUMINARIA" in material_name or 
+                            "LUM" in material_name or
+                            "LED" in material_name or
+                            "LAMP" in material_name or
+                            "FOCO" in material_name or
+                            "RETIRADA" in material_name
+                        )
+                        if es_luminaria_retirada and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                            luminarias_retiradas += nodos_qty[nodo]
                 
                     # Verificar brazos retirados
                     for material_key, nodos_qty in materiales_retirados.items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                brazo_retirado_encontrado = True
-                                # Intentar extraer la longitud del brazo
-                                longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                                if longitud_match:
-                                    try:
-                                        longitud = int(longitud_match.group(1))
-                                        tamano_brazo_retirado = longitud
-                                        # Considerar brazos de 3 metros como grandes (para canasta)
-                                        if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
-                                            usar_canasta_desmontaje = True
-                                            break
-                                    except:
-                                        pass
-                                # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
-                                elif "2 1/2" in material_name or "2.5" in material_name:
-                                    usar_canasta_desmontaje = True
-                                    tamano_brazo_retirado = 4  # Asumimos un valor mayor a 3
-                                    break
-                                # Verificar explícitamente si es un brazo de 3 metros
-                                elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                    usar_canasta_desmontaje = True
-                                    tamano_brazo_retirado = 3
-                                    break
+                        material_name = material_key.nombre.upper()
+                        if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                            brazo_retirado_encontrado = True
+                            # Intentar extraer la longitud del brazo
+                            longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
+                            if longitud_match:
+                                try:
+                                    longitud = int(longitud_match.group(1))
+                                    tamano_brazo_retirado = longitud
+                                    # Considerar brazos de 3 metros como grandes (para canasta)
+                                    if longitud >= 3:  # Si el brazo es mayor o igual a 3 metros, usar canasta
+                                        usar_canasta_desmontaje = True
+                                        break
+                                except:
+                                    pass
+                            # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
+                            elif "2 1/2" in material_name or "2.5" in material_name:
+                                usar_canasta_desmontaje = True
+                                tamano_brazo_retirado = 4  # Asumimos un valor mayor a 3
+                                break
+                            # Verificar explícitamente si es un brazo de 3 metros
+                            elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                                usar_canasta_desmontaje = True
+                                tamano_brazo_retirado = 3
+                                break
                                 
                     # Guardar la información del desmontaje para este nodo
                     info_desmontaje_por_nodo[nodo] = {
@@ -4830,48 +6650,46 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 
                     # Buscar luminarias retiradas en este nodo
                     for material_key, nodos_qty in materiales_retirados.items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            # Verificar si es una luminaria retirada
-                            es_luminaria_retirada = (
-                                "LUMINARIA" in material_name or 
-                                "LUM" in material_name or
-                                "LED" in material_name or
-                                "LAMP" in material_name or
-                                "FOCO" in material_name or
-                                "RETIRADA" in material_name
-                            )
-                            if es_luminaria_retirada and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                luminarias_retiradas_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                        material_name = material_key.nombre.upper()
+                        # Verificar si es una luminaria retirada
+                        es_luminaria_retirada = (
+                            "LUMINARIA" in material_name or 
+                            "LUM" in material_name or
+                            "LED" in material_name or
+                            "LAMP" in material_name or
+                            "FOCO" in material_name or
+                            "RETIRADA" in material_name
+                        )
+                        if es_luminaria_retirada and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                            luminarias_retiradas_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
                 
                     # Buscar brazos retirados en materiales retirados y clasificarlos por tamaño
                     for material_key, nodos_qty in materiales_retirados.items():
-                        if "|" in material_key:
-                            material_name = material_key.split("|")[1].upper()
-                            if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                # Intentar extraer la longitud del brazo
-                                longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
-                                if longitud_match:
-                                    try:
-                                        longitud = int(longitud_match.group(1))
-                                        if longitud >= 3:  # Si el brazo es mayor a 3 metros, usar canasta
-                                            brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                        else:
-                                            brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                    except:
-                                        # Si no se puede extraer la longitud pero contiene indicación de tamaño
-                                        if "2 1/2" in material_name or "2.5" in material_name:
-                                            brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                        else:
-                                            brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
-                                elif "2 1/2" in material_name or "2.5" in material_name:
-                                    brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                # Verificar explícitamente si es un brazo de 3 metros
-                                elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
-                                    brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                else:
-                                    brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                        material_name = material_key.nombre.upper()
+                        if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                            # Intentar extraer la longitud del brazo
+                            longitud_match = re.search(r'(\d+)\s*M(?:TS?)?', material_name)
+                            if longitud_match:
+                                try:
+                                    longitud = int(longitud_match.group(1))
+                                    if longitud >= 3:  # Si el brazo es mayor a 3 metros, usar canasta
+                                        brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                    else:
+                                        brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                except:
+                                    # Si no se puede extraer la longitud pero contiene indicación de tamaño
+                                    if "2 1/2" in material_name or "2.5" in material_name:
+                                        brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                    else:
+                                        brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                            # Si no se puede extraer la longitud pero contiene indicación de tamaño grande
+                            elif "2 1/2" in material_name or "2.5" in material_name:
+                                brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                            # Verificar explícitamente si es un brazo de 3 metros
+                            elif "3 MT" in material_name or "3 MTS" in material_name or "3M" in material_name:
+                                brazos_grandes_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                            else:
+                                brazos_pequenos_retirados_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
                 
                 # Crear fila para DESMONTAJE DE LUMINARIAS EN CANASTA
                 total_canasta_desmontaje = 0
@@ -5008,44 +6826,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 
                 # Para cada nodo, calcular la mano de obra necesaria
                 for nodo in nodos_ordenados:
-                    # Para cada bloque de partidas
-                    tipo_suelo = info['tipos_suelo'].get(nodo, "")    
-                    tipos_instalacion_dict = info.get('tipos_instalacion', {})
-                    es_proyecto = nodo in tipos_instalacion_dict and tipos_instalacion_dict[nodo].strip() != ""
-                    tipo_instalacion_nodo = tipos_instalacion_dict.get(nodo, None)
-                    
-                    if es_proyecto:
-                        print(f"DEBUG: Nodo {nodo} detectado como PROYECTO con tipo: {tipo_instalacion_nodo}")
-    
-                    for titulo_bloque, keywords_mo, keywords_mat in bloques:
-                        # Si es el bloque de instalación de luminarias, ya lo procesamos antes
-                        if titulo_bloque == "Instalación luminarias":
-                            continue
-                            
-                        # Filtrar partidas del bloque actual
-                        partidas_filtradas = [
-                            item for item in plantilla
-                            if any(kw in item['DESCRIPCION MANO DE OBRA'].upper() for kw in keywords_mo)
-                        ]
-                        
-                        # Para cada partida, calcular la mano de obra necesaria para este nodo
-                        for partida in partidas_filtradas:
-                            descripcion = partida['DESCRIPCION MANO DE OBRA']
-                            unidad = partida['UNIDAD']
-                            
-                            # Caso especial para DESMONTAJE DE LUMINARIAS CANASTA/ESCALERA
-                            cantidad_mo, materiales_inst, materiales_ret = calcular_cantidad_mano_obra(
-                                descripcion,
-                                materiales_instalados,
-                                materiales_retirados,
-                                nodo,
-                                info.get('codigos_n1', {}),
-                                info.get('codigos_n2', {}),
-                                tipo_suelo,
-                                titulo_bloque,
-                                info.get('tipos_instalacion', {}),  
-                                info.get('tipos_instalacion', {}).get(nodo, None)
-                            )
+                    # El bloque de instalación de luminarias ya se procesó antes
+                    for titulo_bloque, _, _, partidas_bloque in bloques_por_nodo:
+                        # Para cada partida del bloque, tomar la cantidad calculada para este nodo
+                        for partida in partidas_bloque:
+                            descripcion = partida.descripcion
+                            unidad = partida.unidad
+                            cantidad_mo = mano_obra_ot.cantidad(nodo, descripcion)
                             
                             # Solo agregar partidas con cantidad > 0
                             if cantidad_mo > 0:
@@ -5072,7 +6859,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                 # IMPORTANTE: Forzar la aparición de instalación de luminarias en al menos un nodo
                 # si hay códigos N1 o N2 en la OT pero no se calculó mano de obra
                 hay_codigos_ot = False
-                for _, nodos_valores in info.get('codigos_n1', {}).items():
+                for _, nodos_valores in info.codigos_n1.items():
                     for nodo, codigos in nodos_valores.items():
                         # Filtrar códigos NO, N/A, NA
                         codigos_validos = [c for c in codigos if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
@@ -5083,7 +6870,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         break
                     
                 if not hay_codigos_ot:
-                    for _, nodos_valores in info.get('codigos_n2', {}).items():
+                    for _, nodos_valores in info.codigos_n2.items():
                         for nodo, codigos in nodos_valores.items():
                             # Filtrar códigos NO, N/A, NA
                             codigos_validos = [c for c in codigos if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
@@ -5116,13 +6903,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                     nodo_con_codigos = None
                     for nodo in nodos_ordenados:
                         tiene_codigos = False
-                        for _, nodos_valores in info.get('codigos_n1', {}).items():
+                        for _, nodos_valores in info.codigos_n1.items():
                             if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
                                 tiene_codigos = True
                                 break
                         
                         if not tiene_codigos:
-                            for _, nodos_valores in info.get('codigos_n2', {}).items():
+                            for _, nodos_valores in info.codigos_n2.items():
                                 if nodo in nodos_valores and len(nodos_valores[nodo]) > 0:
                                     tiene_codigos = True
                                     break
@@ -5146,12 +6933,12 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         
                         # Obtener los códigos para mostrar
                         codigos_texto = []
-                        for key_codigo, nodos_valores in info.get('codigos_n1', {}).items():
+                        for key_codigo, nodos_valores in info.codigos_n1.items():
                             for nodo, codigos in nodos_valores.items():
                                 if codigos:
                                     codigos_texto.append(f"CÓDIGO N1: {', '.join(codigos)}")
                         
-                        for key_codigo, nodos_valores in info.get('codigos_n2', {}).items():
+                        for key_codigo, nodos_valores in info.codigos_n2.items():
                             for nodo, codigos in nodos_valores.items():
                                 if codigos:
                                     codigos_texto.append(f"CÓDIGO N2: {', '.join(codigos)}")
@@ -5169,28 +6956,27 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                         })
                 
                 # Crear filas para cada bloque de mano de obra
-                for titulo_bloque, _, _ in bloques:
+                for titulo_bloque in (bloque.titulo for bloque in PLANTILLA_MANO_OBRA):
                     # FORZAR la aparición del bloque de instalación de luminarias
                     if titulo_bloque == "Instalación luminarias":
                         # Verificar si hay instalación de luminarias (modernización o proyecto)
                         hay_instalacion_luminarias = False
 
                         # Para modernización: verificar LUMINARIA CODIGO/BRAZO
-                        for material_key, nodos_qty in info['materiales'].items():
-                            if "|" in material_key:
-                                material_name = material_key.split("|")[1].upper()
-                                if "LUMINARIA CODIGO/BRAZO" in material_name:
-                                    for nodo, cantidad in nodos_qty.items():
-                                        if cantidad > 0:
-                                            hay_instalacion_luminarias = True
-                                            break
+                        for material_key, nodos_qty in info.materiales.items():
+                            material_name = material_key.nombre.upper()
+                            if "LUMINARIA CODIGO/BRAZO" in material_name:
+                                for nodo, cantidad in nodos_qty.items():
+                                    if cantidad > 0:
+                                        hay_instalacion_luminarias = True
+                                        break
                             if hay_instalacion_luminarias:
                                 break
                             
                         # Para proyectos: verificar códigos N1/N2 o LUMINARIA INSTALADA
                         if not hay_instalacion_luminarias:
                             # Verificar códigos N1
-                            for _, nodos_valores in info.get('codigos_n1', {}).items():
+                            for _, nodos_valores in info.codigos_n1.items():
                                 for nodo, codigos in nodos_valores.items():
                                     codigos_validos = [c for c in codigos if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                     if codigos_validos:
@@ -5201,7 +6987,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 
                             # Verificar códigos N2
                             if not hay_instalacion_luminarias:
-                                for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                for _, nodos_valores in info.codigos_n2.items():
                                     for nodo, codigos in nodos_valores.items():
                                         codigos_validos = [c for c in codigos if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                         if codigos_validos:
@@ -5212,14 +6998,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                     
                             # Verificar LUMINARIA INSTALADA EN [TIPO]
                             if not hay_instalacion_luminarias:
-                                for material_key, nodos_qty in info['materiales'].items():
-                                    if "|" in material_key:
-                                        material_name = material_key.split("|")[1].upper()
-                                        if "LUMINARIA INSTALADA" in material_name:
-                                            for nodo, cantidad in nodos_qty.items():
-                                                if cantidad > 0:
-                                                    hay_instalacion_luminarias = True
-                                                    break
+                                for material_key, nodos_qty in info.materiales.items():
+                                    material_name = material_key.nombre.upper()
+                                    if "LUMINARIA INSTALADA" in material_name:
+                                        for nodo, cantidad in nodos_qty.items():
+                                            if cantidad > 0:
+                                                hay_instalacion_luminarias = True
+                                                break
                                     if hay_instalacion_luminarias:
                                         break
                                     
@@ -5244,71 +7029,68 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 codigos_por_nodo[nodo] = []
             
                                 # CORRECCIÓN: Determinar si es proyecto o modernización para este nodo específico
-                                es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                                es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
             
                                 if es_proyecto_nodo:
                                     # LÓGICA PARA PROYECTOS (sin cambios)
                                     # Contar LUMINARIA INSTALADA EN [TIPO] para este nodo (proyectos)
-                                    for material_key, nodos_qty in info['materiales'].items():
-                                        if "|" in material_key:
-                                            material_name = material_key.split("|")[1].upper()
-                                            if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                                luminarias_instaladas_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                    for material_key, nodos_qty in info.materiales.items():
+                                        material_name = material_key.nombre.upper()
+                                        if "LUMINARIA INSTALADA" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                            luminarias_instaladas_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
             
                                     # Recopilar códigos N1 y N2 para este nodo (proyectos)
-                                    for _, nodos_valores in info.get('codigos_n1', {}).items():
+                                    for _, nodos_valores in info.codigos_n1.items():
                                         if nodo in nodos_valores:
                                             codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                             codigos_por_nodo[nodo].extend([f"N1: {c}" for c in codigos_validos])
             
-                                    for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                    for _, nodos_valores in info.codigos_n2.items():
                                         if nodo in nodos_valores:
                                             codigos_validos = [c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]]
                                             codigos_por_nodo[nodo].extend([f"N2: {c}" for c in codigos_validos])
             
                                 else:
                                     # LÓGICA PARA MODERNIZACIÓN (CORREGIDA)
-                                    print(f"DEBUG: Procesando MODERNIZACIÓN para nodo {nodo}")
+                                    logger.debug("Procesando MODERNIZACIÓN para nodo %s", nodo)
                                     
                                     # Contar LUMINARIA CODIGO/BRAZO para este nodo (modernización)
-                                    for material_key, nodos_qty in info['materiales'].items():
-                                        if "|" in material_key:
-                                            material_name = material_key.split("|")[1].upper()
-                                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                                luminarias_codigo_brazo_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                print(f"DEBUG: Encontrada LUMINARIA CODIGO/BRAZO en nodo {nodo}: {nodos_qty[nodo]}")
+                                    for material_key, nodos_qty in info.materiales.items():
+                                        material_name = material_key.nombre.upper()
+                                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                            luminarias_codigo_brazo_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                            logger.debug("Encontrada LUMINARIA CODIGO/BRAZO en nodo %s: %s", nodo, nodos_qty[nodo])
             
                                     # Buscar brazos en materiales instalados y clasificarlos por tamaño (solo para modernización)
                                     for material_key, nodos_qty in materiales_instalados.items():
-                                        if "|" in material_key:
-                                            material_name = material_key.split("|")[1].upper()
-                                            if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
-                                                print(f"DEBUG: Encontrado brazo en nodo {nodo}: {material_name}")
-                                                # Intentar extraer la longitud del brazo
-                                                longitud_match = re.search(r'(\d+(?:\.\d+)?)\s*M', material_name)
-                                                if longitud_match:
-                                                    try:
-                                                        longitud = float(longitud_match.group(1))
-                                                        # CORRECCIÓN: Solo brazos >= 3 metros son grandes
-                                                        if longitud >= 3.0:
-                                                            brazos_grandes_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                            print(f"DEBUG: Brazo GRANDE clasificado: {material_name} ({longitud}M)")
-                                                        else:
-                                                            brazos_pequenos_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                            print(f"DEBUG: Brazo PEQUEÑO clasificado: {material_name} ({longitud}M)")
-                                                    except:
-                                                        # Si no se puede convertir a número, clasificar como pequeño por defecto
-                                                        brazos_pequenos_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                        print(f"DEBUG: Brazo clasificado como PEQUEÑO (error parsing): {material_name}")
-                                                else:
-                                                    # Si no hay patrón de longitud numérica, verificar patrones específicos
-                                                    if any(pattern in material_name for pattern in ["3 MT", "3 MTS", "3M", "4 MT", "4 MTS", "4M", "5 MT", "5 MTS", "5M", "6 MT", "6 MTS", "6M"]):
+                                        material_name = material_key.nombre.upper()
+                                        if "BRAZO" in material_name and nodo in nodos_qty and nodos_qty[nodo] > 0:
+                                            logger.debug("Encontrado brazo en nodo %s: %s", nodo, material_name)
+                                            # Intentar extraer la longitud del brazo
+                                            longitud_match = re.search(r'(\d+(?:\.\d+)?)\s*M', material_name)
+                                            if longitud_match:
+                                                try:
+                                                    longitud = float(longitud_match.group(1))
+                                                    # CORRECCIÓN: Solo brazos >= 3 metros son grandes
+                                                    if longitud >= 3.0:
                                                         brazos_grandes_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                        print(f"DEBUG: Brazo GRANDE clasificado (patrón): {material_name}")
+                                                        logger.debug("Brazo GRANDE clasificado: %s (%sM)", material_name, longitud)
                                                     else:
-                                                        # Por defecto, clasificar como pequeño
                                                         brazos_pequenos_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
-                                                        print(f"DEBUG: Brazo clasificado como PEQUEÑO (default): {material_name}")
+                                                        logger.debug("Brazo PEQUEÑO clasificado: %s (%sM)", material_name, longitud)
+                                                except:
+                                                    # Si no se puede convertir a número, clasificar como pequeño por defecto
+                                                    brazos_pequenos_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                                    logger.debug("Brazo clasificado como PEQUEÑO (error parsing): %s", material_name)
+                                            else:
+                                                # Si no hay patrón de longitud numérica, verificar patrones específicos
+                                                if any(pattern in material_name for pattern in ["3 MT", "3 MTS", "3M", "4 MT", "4 MTS", "4M", "5 MT", "5 MTS", "5M", "6 MT", "6 MTS", "6M"]):
+                                                    brazos_grandes_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                                    logger.debug("Brazo GRANDE clasificado (patrón): %s", material_name)
+                                                else:
+                                                    # Por defecto, clasificar como pequeño
+                                                    brazos_pequenos_por_nodo[nodo].append(f"{material_name} ({nodos_qty[nodo]})")
+                                                    logger.debug("Brazo clasificado como PEQUEÑO (default): %s", material_name)
             
                             # Crear filas para diferentes tipos de instalación
                             total_canasta = 0
@@ -5318,29 +7100,29 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                             # Procesar cada nodo para determinar qué tipo de instalación necesita
                             for nodo in nodos_ordenados:
                                 # Determinar si es proyecto o modernización
-                                es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                                es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
             
                                 if es_proyecto_nodo:
                                     # LÓGICA PARA PROYECTOS (sin cambios)
-                                    tipo_instalacion = info['tipos_instalacion'][nodo].upper()
+                                    tipo_instalacion = tipos_instalacion[nodo].upper()
             
                                     # CORRECCIÓN: Contar luminarias instaladas de forma unificada
                                     cantidad_luminarias = 0
             
                                     # Primero contar códigos N1 y N2 válidos
                                     codigos_validos = 0
-                                    for _, nodos_valores in info.get('codigos_n1', {}).items():
+                                    for _, nodos_valores in info.codigos_n1.items():
                                         if nodo in nodos_valores:
                                             codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
-                                    for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                    for _, nodos_valores in info.codigos_n2.items():
                                         if nodo in nodos_valores:
                                             codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
                                     # Luego contar luminarias instaladas explícitas
                                     luminarias_explicitas = 0
-                                    for material_key, nodos_qty in info['materiales'].items():
-                                        if "|" in material_key and "LUMINARIA INSTALADA" in material_key.split("|")[1].upper():
+                                    for material_key, nodos_qty in info.materiales.items():
+                                        if "LUMINARIA INSTALADA" in material_key.nombre.upper():
                                             luminarias_explicitas += nodos_qty.get(nodo, 0)
             
                                     # IMPORTANTE: Usar el máximo entre códigos y luminarias explícitas, NO la suma
@@ -5356,33 +7138,32 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                             total_camioneta += cantidad_luminarias
                                 else:
                                     # LÓGICA PARA MODERNIZACIÓN (CORREGIDA)
-                                    print(f"DEBUG: Procesando instalación MODERNIZACIÓN para nodo {nodo}")
+                                    logger.debug("Procesando instalación MODERNIZACIÓN para nodo %s", nodo)
                                     
                                     cantidad_luminarias_codigo_brazo = 0
                                     
-                                    # CORRECCIÓN: Buscar LUMINARIA CODIGO/BRAZO directamente en info['materiales']
-                                    for material_key, nodos_qty in info['materiales'].items():
-                                        if "|" in material_key:
-                                            material_name = material_key.split("|")[1].upper()
-                                            if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
-                                                cantidad_luminarias_codigo_brazo += nodos_qty[nodo]
-                                                print(f"DEBUG: Sumando LUMINARIA CODIGO/BRAZO: {nodos_qty[nodo]} (total: {cantidad_luminarias_codigo_brazo})")
+                                    # CORRECCIÓN: Buscar LUMINARIA CODIGO/BRAZO directamente en info.materiales
+                                    for material_key, nodos_qty in info.materiales.items():
+                                        material_name = material_key.nombre.upper()
+                                        if "LUMINARIA CODIGO/BRAZO" in material_name and nodo in nodos_qty:
+                                            cantidad_luminarias_codigo_brazo += nodos_qty[nodo]
+                                            logger.debug("Sumando LUMINARIA CODIGO/BRAZO: %s (total: %s)", nodos_qty[nodo], cantidad_luminarias_codigo_brazo)
             
                                     if cantidad_luminarias_codigo_brazo > 0:
-                                        print(f"DEBUG: Nodo {nodo} tiene {cantidad_luminarias_codigo_brazo} LUMINARIA CODIGO/BRAZO")
+                                        logger.debug("Nodo %s tiene %s LUMINARIA CODIGO/BRAZO", nodo, cantidad_luminarias_codigo_brazo)
                                         
                                         # Si hay brazos grandes, asignar a CANASTA
                                         if brazos_grandes_por_nodo[nodo]:
                                             total_canasta += cantidad_luminarias_codigo_brazo
-                                            print(f"DEBUG: Asignando {cantidad_luminarias_codigo_brazo} a CANASTA (brazos grandes)")
+                                            logger.debug("Asignando %s a CANASTA (brazos grandes)", cantidad_luminarias_codigo_brazo)
                                         else:
                                             # Si no hay brazos grandes, asignar a CAMIONETA
                                             total_camioneta += cantidad_luminarias_codigo_brazo
-                                            print(f"DEBUG: Asignando {cantidad_luminarias_codigo_brazo} a CAMIONETA (brazos pequeños o sin brazos)")
+                                            logger.debug("Asignando %s a CAMIONETA (brazos pequeños o sin brazos)", cantidad_luminarias_codigo_brazo)
                                     else:
-                                        print(f"DEBUG: Nodo {nodo} NO tiene LUMINARIA CODIGO/BRAZO")
+                                        logger.debug("Nodo %s NO tiene LUMINARIA CODIGO/BRAZO", nodo)
             
-                            print(f"DEBUG: Totales finales - CANASTA: {total_canasta}, ESCALERA: {total_escalera}, CAMIONETA: {total_camioneta}")
+                            logger.debug("Totales finales - CANASTA: %s, ESCALERA: %s, CAMIONETA: %s", total_canasta, total_escalera, total_camioneta)
             
                             # Crear fila para INSTALACION DE LUMINARIAS EN CANASTA si hay cantidad
                             if total_canasta > 0:
@@ -5391,26 +7172,26 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 fila_canasta = [descripcion, unidad, total_canasta, ''] + [''] * num_nodos
             
                                 # Para cada nodo, agregar la cantidad correspondiente
-                                for i, nodo in enumerate(nodos_ordenados):
-                                    es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                                for nodo, columna in columnas_nodos.items():
+                                    es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
                                     cantidad_nodo = 0
             
                                     if es_proyecto_nodo:
-                                        tipo_instalacion = info['tipos_instalacion'][nodo].upper()
+                                        tipo_instalacion = tipos_instalacion[nodo].upper()
                                         if "CANASTA" in tipo_instalacion or "1.CANASTA" in tipo_instalacion:
                                             # CORRECCIÓN: Usar la misma lógica unificada
                                             codigos_validos = 0
-                                            for _, nodos_valores in info.get('codigos_n1', {}).items():
+                                            for _, nodos_valores in info.codigos_n1.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
-                                            for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                            for _, nodos_valores in info.codigos_n2.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
                                             luminarias_explicitas = sum(
-                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info['materiales'].items()
-                                                if "|" in material_key and "LUMINARIA INSTALADA" in material_key.split("|")[1].upper()
+                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info.materiales.items()
+                                                if "LUMINARIA INSTALADA" in material_key.nombre.upper()
                                             )
             
                                             cantidad_nodo = max(codigos_validos, luminarias_explicitas)
@@ -5418,13 +7199,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                         # CORRECCIÓN: Modernización - usar LUMINARIA CODIGO/BRAZO con brazos grandes
                                         if brazos_grandes_por_nodo[nodo]:
                                             cantidad_nodo = sum(
-                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info['materiales'].items()
-                                                if "|" in material_key and "LUMINARIA CODIGO/BRAZO" in material_key.split("|")[1].upper()
+                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info.materiales.items()
+                                                if "LUMINARIA CODIGO/BRAZO" in material_key.nombre.upper()
                                             )
-                                            print(f"DEBUG: CANASTA - Nodo {nodo}: {cantidad_nodo} luminarias")
+                                            logger.debug("CANASTA - Nodo %s: %s luminarias", nodo, cantidad_nodo)
             
                                     if cantidad_nodo > 0:
-                                        fila_canasta[4 + i] = cantidad_nodo
+                                        fila_canasta[columna] = cantidad_nodo
             
                                 filas.append(fila_canasta)
             
@@ -5435,31 +7216,31 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 fila_escalera = [descripcion, unidad, total_escalera, ''] + [''] * num_nodos
             
                                 # Para cada nodo, agregar la cantidad correspondiente
-                                for i, nodo in enumerate(nodos_ordenados):
-                                    es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                                for nodo, columna in columnas_nodos.items():
+                                    es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
                                     cantidad_nodo = 0
             
                                     if es_proyecto_nodo:
-                                        tipo_instalacion = info['tipos_instalacion'][nodo].upper()
+                                        tipo_instalacion = tipos_instalacion[nodo].upper()
                                         if "ESCALERA" in tipo_instalacion or "2.ESCALERA" in tipo_instalacion:
                                             codigos_validos = 0
-                                            for _, nodos_valores in info.get('codigos_n1', {}).items():
+                                            for _, nodos_valores in info.codigos_n1.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
-                                            for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                            for _, nodos_valores in info.codigos_n2.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
                                             luminarias_explicitas = sum(
-                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info['materiales'].items()
-                                                if "|" in material_key and "LUMINARIA INSTALADA" in material_key.split("|")[1].upper()
+                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info.materiales.items()
+                                                if "LUMINARIA INSTALADA" in material_key.nombre.upper()
                                             )
             
                                             cantidad_nodo = max(codigos_validos, luminarias_explicitas)
             
                                     if cantidad_nodo > 0:
-                                        fila_escalera[4 + i] = cantidad_nodo
+                                        fila_escalera[columna] = cantidad_nodo
             
                                 filas.append(fila_escalera)
             
@@ -5470,25 +7251,25 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 fila_camioneta = [descripcion, unidad, total_camioneta, ''] + [''] * num_nodos
             
                                 # Para cada nodo, agregar la cantidad correspondiente
-                                for i, nodo in enumerate(nodos_ordenados):
-                                    es_proyecto_nodo = nodo in info.get('tipos_instalacion', {}) and info['tipos_instalacion'][nodo].strip() != ""
+                                for nodo, columna in columnas_nodos.items():
+                                    es_proyecto_nodo = nodo in tipos_instalacion and tipos_instalacion[nodo].strip() != ""
                                     cantidad_nodo = 0
             
                                     if es_proyecto_nodo:
-                                        tipo_instalacion = info['tipos_instalacion'][nodo].upper()
+                                        tipo_instalacion = tipos_instalacion[nodo].upper()
                                         if "CAMIONETA" in tipo_instalacion or "3.CAMIONETA" in tipo_instalacion:
                                             codigos_validos = 0
-                                            for _, nodos_valores in info.get('codigos_n1', {}).items():
+                                            for _, nodos_valores in info.codigos_n1.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
-                                            for _, nodos_valores in info.get('codigos_n2', {}).items():
+                                            for _, nodos_valores in info.codigos_n2.items():
                                                 if nodo in nodos_valores:
                                                     codigos_validos += len([c for c in nodos_valores[nodo] if c.upper() not in ["NO", "N/A", "NA", "NO APLICA"]])
             
                                             luminarias_explicitas = sum(
-                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info['materiales'].items()
-                                                if "|" in material_key and "LUMINARIA INSTALADA" in material_key.split("|")[1].upper()
+                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info.materiales.items()
+                                                if "LUMINARIA INSTALADA" in material_key.nombre.upper()
                                             )
             
                                             cantidad_nodo = max(codigos_validos, luminarias_explicitas)
@@ -5496,13 +7277,13 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                         # CORRECCIÓN: Modernización - usar LUMINARIA CODIGO/BRAZO con brazos pequeños o sin brazos grandes
                                         if not brazos_grandes_por_nodo[nodo]:
                                             cantidad_nodo = sum(
-                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info['materiales'].items()
-                                                if "|" in material_key and "LUMINARIA CODIGO/BRAZO" in material_key.split("|")[1].upper()
+                                                nodos_qty.get(nodo, 0) for material_key, nodos_qty in info.materiales.items()
+                                                if "LUMINARIA CODIGO/BRAZO" in material_key.nombre.upper()
                                             )
-                                            print(f"DEBUG: CAMIONETA - Nodo {nodo}: {cantidad_nodo} luminarias")
+                                            logger.debug("CAMIONETA - Nodo %s: %s luminarias", nodo, cantidad_nodo)
             
                                     if cantidad_nodo > 0:
-                                        fila_camioneta[4 + i] = cantidad_nodo
+                                        fila_camioneta[columna] = cantidad_nodo
             
                                 filas.append(fila_camioneta)
 
@@ -5547,7 +7328,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                     fila[3] = "\n".join(todos_materiales)
 
                                 # Para cada nodo, agregar la cantidad correspondiente
-                                for i, nodo in enumerate(nodos_ordenados):
+                                for nodo, columna in columnas_nodos.items():
                                     partida_nodo = next((
                                         partida
                                         for partida in mano_obra_por_nodo[nodo].get(titulo_bloque, [])
@@ -5560,7 +7341,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                         if partida_nodo['materiales']:
                                             contenido += f"\n{partida_nodo['materiales']}"
 
-                                        fila[4 + i] = contenido
+                                        fila[columna] = contenido
 
                                 # Agregar la fila a la lista de filas
                                 filas.append(fila)
@@ -5644,7 +7425,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                 fila_mo[3] = "\n".join(todos_materiales)
                             
                             # Para cada nodo, agregar la información de mano de obra
-                            for i, nodo in enumerate(nodos_ordenados):
+                            for nodo, columna in columnas_nodos.items():
                                 # Buscar la partida para este nodo y descripción
                                 partida_nodo = next((
                                     partida
@@ -5668,7 +7449,7 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                                     if partida_nodo['materiales']:
                                         contenido += f"\n{partida_nodo['materiales']}"
                                     
-                                    fila_mo[4 + i] = contenido
+                                    fila_mo[columna] = contenido
                                     
                                     # Imprimir información de depuración para luminarias
                                     #if "LUMINARIA" in descripcion.upper():
@@ -5679,206 +7460,572 @@ def generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_
                             # IMPORTANTE: Agregar la fila a la lista de filas
                             filas.append(fila_mo)
                 
-                # Crear DataFrame a partir de los datos recopilados
-                df = pd.DataFrame(filas, columns=columnas)
-                df.to_excel(writer, sheet_name=f"OT_{ot}", index=False)
-
-                # Acceder a la hoja creada
-                sheet = writer.sheets[f"OT_{ot}"]
-                  
-                # Cargar el archivo con openpyxl para combinar celdas
-                ws = writer.sheets[f"OT_{ot}"]
-
-                # Combinar celdas para encabezados de secciones
-                for row in ws.iter_rows(min_row=2, max_row=ws.max_row):  # Comienza desde la segunda fila
-                    if row[0].value in ["MATERIALES INSTALADOS", "MATERIALES RETIRADOS", "OBSERVACIONES POR NODO", 
-                                       "OBSERVACIONES COMPLETAS", "MANO DE OBRA POR NODO"] or (
-                                       isinstance(row[0].value, str) and row[0].value.startswith("BLOQUE: ")):
-                        start_col = 1
-                        end_col = len(columnas)
-                        row_idx = row[0].row
-                        ws.merge_cells(
-                            start_row=row_idx,
-                            start_column=start_col,
-                            end_row=row_idx,
-                            end_column=end_col
-                        )
-                        # Centrar el texto y aplicar formato
-                        row[0].alignment = Alignment(horizontal='center', vertical='center')
-                        row[0].font = Font(bold=True)
-                        
-                        # Aplicar color de fondo según el tipo de encabezado
-                        if row[0].value == "MANO DE OBRA POR NODO":
-                            row[0].fill = PatternFill("solid", fgColor="009900")  # Verde
-                            row[0].font = Font(bold=True, color="FFFFFF")  # Texto blanco
-                        elif isinstance(row[0].value, str) and row[0].value.startswith("BLOQUE: "):
-                            row[0].fill = PatternFill("solid", fgColor="AAAAAA")  # Gris
-                        else:
-                            row[0].fill = PatternFill("solid", fgColor="DDDDDD")  # Gris claro
-                
-                # Configurar el ajuste de texto para las celdas de observaciones y mano de obra
-                for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-                    row_has_multiline = False
-                    max_lines = 1
-                    
-                    for cell in row:
-                        if isinstance(cell.value, str) and '\n' in cell.value:
-                            cell.alignment = Alignment(wrap_text=True, vertical='top')
-                            row_has_multiline = True
-                            lines_count = cell.value.count('\n') + 1
-                            max_lines = max(max_lines, lines_count)
-                    
-                    # Ajustar altura de fila para acomodar el texto más largo
-                    if row_has_multiline and row[0].row > 1:  # Evitar ajustar la fila de encabezados
-                        # Calcular altura: 15 puntos por línea, con un mínimo de 15 y un máximo de 409
-                        ws.row_dimensions[row[0].row].height = max(15, min(15 * max_lines, 409))
-                
-                # Asegurar que las celdas de mano de obra tengan ajuste de texto
-                for row in ws.iter_rows(min_row=1, max_row=ws.max_row):
-                    if row[0].value and isinstance(row[0].value, str) and "BLOQUE:" in row[0].value:
-                        # Las filas siguientes son de mano de obra hasta el próximo encabezado
-                        current_row = row[0].row + 1
-                        while current_row <= ws.max_row:
-                            mo_row = ws[current_row]
-                            if mo_row[0].value and isinstance(mo_row[0].value, str) and (
-                                "BLOQUE:" in mo_row[0].value or 
-                                mo_row[0].value in ["MATERIALES INSTALADOS", "MATERIALES RETIRADOS", 
-                                                   "OBSERVACIONES COMPLETAS", "MANO DE OBRA POR NODO"]):
-                                break
-                            
-                            # Configurar todas las celdas de esta fila para ajuste de texto
-                            for cell in mo_row:
-                                cell.alignment = Alignment(wrap_text=True, vertical='top')
-                            
-                            current_row += 1
-              
-            # Eliminar hoja temporal si se crearon hojas
-            if sheets_created:
-                writer.book.remove(writer.book[temp_sheet_name])
+                registrar_etapa('mano_obra', time.perf_counter() - inicio_mano_obra, {'ots': 1, 'nodos': num_nodos})
+
+                # Escribir la hoja de la OT fila por fila (formato, combinaciones y alturas incluidas)
+                escribir_hoja_ot(libro, f"OT_{ot}", columnas, filas)
+                registrar_etapa('hoja_ot', time.perf_counter() - inicio_ot, {'ots': 1, 'nodos': num_nodos, 'filas': len(filas)})
         
         
         # Manejo de errores
         if not sheets_created:
-            writer.book.remove(writer.book[temp_sheet_name])
-            df_error = pd.DataFrame({
-                'Error': [
-                    'Datos no válidos - Razones posibles:',
-                    '1. Columnas requeridas faltantes',
-                    '2. Valores "NINGUNO" o 0 en todos los registros',
-                    '3. Formato de archivo incorrecto'
-                ]
-            })
-            df_error.to_excel(writer, sheet_name='Errores', index=False)
+            hoja_error = libro.create_sheet('Errores')
+            hoja_error.append(encabezado_tabla(hoja_error, ['Error']))
+            for texto in [
+                'Datos no válidos - Razones posibles:',
+                '1. Columnas requeridas faltantes',
+                '2. Valores "NINGUNO" o 0 en todos los registros',
+                '3. Formato de archivo incorrecto'
+            ]:
+                hoja_error.append([texto])
 
     output.seek(0)
     return output
 
-@app.post("/upload/")
-async def subir_archivos(
-    files: list[UploadFile] = File(...),
-    tipo_archivo: str = Form(..., description="Tipo de archivo: modernizacion, mantenimiento o proyecto")
-):
+POOL_ARCHIVOS = None
+# El pool se crea y se descarta desde el event loop y desde los hilos de EJECUTOR_TRABAJOS
+BLOQUEO_POOL_ARCHIVOS = threading.Lock()
+# Solicitudes con archivos en cada pool (ver reservar_pool_archivos)
+USOS_POOL_ARCHIVOS = {}
+
+
+def limitar_memoria_proceso():
+    """Inicializador del pool: con MAX_MEMORIA_PROCESO_MB, pasarse da MemoryError en lugar de agotar la memoria del contenedor."""
+    if MAX_MEMORIA_PROCESO_MB > 0:
+        limite = int(MAX_MEMORIA_PROCESO_MB * 2**20)
+        resource.setrlimit(resource.RLIMIT_DATA, (limite, limite))
+
+
+def obtener_pool_archivos():
+    """Pool de procesos compartido para procesar archivos; se crea en la primera solicitud."""
+    global POOL_ARCHIVOS
+    with BLOQUEO_POOL_ARCHIVOS:
+        if POOL_ARCHIVOS is None:
+            POOL_ARCHIVOS = ProcessPoolExecutor(
+                max_workers=max(1, MAX_PROCESOS_ARCHIVOS), initializer=limitar_memoria_proceso
+            )
+        return POOL_ARCHIVOS
+
+
+def reservar_pool_archivos():
+    """Pool en el que una solicitud procesará sus archivos; se libera con liberar_pool_archivos."""
+    pool = obtener_pool_archivos()
+    with BLOQUEO_POOL_ARCHIVOS:
+        USOS_POOL_ARCHIVOS[pool] = USOS_POOL_ARCHIVOS.get(pool, 0) + 1
+    return pool
+
+
+def liberar_pool_archivos(pool):
+    with BLOQUEO_POOL_ARCHIVOS:
+        USOS_POOL_ARCHIVOS[pool] -= 1
+        if not USOS_POOL_ARCHIVOS[pool]:
+            del USOS_POOL_ARCHIVOS[pool]
+
+
+def descartar_pool_archivos(terminar=False, pool=None):
+    """
+    Descarta el pool (por ejemplo, si murió un proceso); el siguiente uso crea uno nuevo.
+    Con `pool`, solo lo descarta si sigue siendo el actual (otra solicitud pudo reemplazarlo ya).
+
+    Con `terminar`, además mata sus procesos para que lo que estaban procesando no siga ocupando
+    el pool; solo se hace si a lo más una solicitud (la que lo pide) tiene archivos en él.
+
+    Returns:
+        bool: True si el pool se descartó
+    """
+    global POOL_ARCHIVOS
+    with BLOQUEO_POOL_ARCHIVOS:
+        if pool is not None and pool is not POOL_ARCHIVOS:
+            return False
+        pool = POOL_ARCHIVOS
+        if pool is None or (terminar and USOS_POOL_ARCHIVOS.get(pool, 0) > 1):
+            return False
+        POOL_ARCHIVOS = None
+    procesos = list((pool._processes or {}).values()) if terminar else []
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proceso in procesos:
+        proceso.terminate()
+    return True
+
+
+def abandonar_archivos(tareas, pool):
+    """
+    Cancela las tareas de archivos de una solicitud que falló. Las que aún esperan en la cola
+    del pool no llegan a empezar; lo que ya corre en un proceso solo se detiene matando el pool,
+    y eso se hace únicamente si ninguna otra solicitud lo está usando.
+    """
+    # wait_for ya cancela la tarea que superó el tiempo límite, aunque su proceso siga corriendo
+    abandonadas = [tarea for tarea in tareas if not tarea.done() or tarea.cancelled()]
+    for tarea in abandonadas:
+        tarea.cancel()
+    if abandonadas and not descartar_pool_archivos(terminar=True, pool=pool):
+        logger.warning("El pool tiene archivos de otras solicitudes: lo que ya empezó de esta termina igual")
+
+
+# Los trabajos de /jobs esperan su turno en la cola interna de este ejecutor
+EJECUTOR_TRABAJOS = ThreadPoolExecutor(max_workers=max(1, MAX_GENERACIONES_EXCEL), thread_name_prefix="trabajos")
+EJECUTOR_EXCEL = ThreadPoolExecutor(max_workers=max(1, MAX_GENERACIONES_EXCEL), thread_name_prefix="generar_excel")
+# Solicitudes admitidas que todavía no terminan (generando o esperando un hilo del ejecutor)
+SOLICITUDES_EXCEL_ACTIVAS = 0
+BLOQUEO_SOLICITUDES_EXCEL = threading.Lock()
+
+
+def reservar_cupo_excel():
+    """Reserva un cupo para generar un Excel; si no hay, responde 503 con Retry-After."""
+    global SOLICITUDES_EXCEL_ACTIVAS
+    with BLOQUEO_SOLICITUDES_EXCEL:
+        # Sin cupo para generar otro Excel: rechazar en lugar de acumular datos en memoria
+        if SOLICITUDES_EXCEL_ACTIVAS >= max(1, MAX_GENERACIONES_EXCEL) + MAX_COLA_EXCEL:
+            logger.warning("Solicitud rechazada: %s reportes en curso", SOLICITUDES_EXCEL_ACTIVAS)
+            raise HTTPException(
+                503,
+                detail="Servidor ocupado generando otros reportes, intente nuevamente más tarde",
+                headers={"Retry-After": str(REINTENTAR_EXCEL_SEGUNDOS)}
+            )
+        SOLICITUDES_EXCEL_ACTIVAS += 1
+
+
+def liberar_cupo_excel():
+    global SOLICITUDES_EXCEL_ACTIVAS
+    with BLOQUEO_SOLICITUDES_EXCEL:
+        SOLICITUDES_EXCEL_ACTIVAS -= 1
+
+
+@app.on_event("shutdown")
+def cerrar_pool_archivos():
+    global POOL_ARCHIVOS
+    with BLOQUEO_POOL_ARCHIVOS:
+        pool = POOL_ARCHIVOS
+        POOL_ARCHIVOS = None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+    EJECUTOR_EXCEL.shutdown(cancel_futures=True)
+    EJECUTOR_TRABAJOS.shutdown(cancel_futures=True)
+
+
+# Aciertos y fallos de la caché de archivos desde que arrancó el servidor; se actualizan desde el
+# event loop y desde el loop propio de cada hilo de EJECUTOR_TRABAJOS
+ESTADISTICAS_CACHE_ARCHIVOS = {'aciertos': 0, 'fallos': 0}
+BLOQUEO_CACHE_ARCHIVOS = threading.Lock()
+# Aciertos y fallos de las cachés de los normalizadores en los procesos del pool
+ESTADISTICAS_NORMALIZADORES = defaultdict(conteos)
+BLOQUEO_NORMALIZADORES = threading.Lock()
+EXTENSION_CACHE_ARCHIVOS = ".pkl.z"
+
+
+def registrar_uso_cache_archivo(acierto):
+    with BLOQUEO_CACHE_ARCHIVOS:
+        ESTADISTICAS_CACHE_ARCHIVOS['aciertos' if acierto else 'fallos'] += 1
+
+
+def clave_cache_archivo(tipo_archivo, digest):
+    """SHA-256 de la versión del procesador, el lector de Excel, el tipo de archivo y el SHA-256 del archivo subido."""
+    h = hashlib.sha256()
+    h.update(f"{VERSION_PROCESADOR_ARCHIVOS}:{lector_excel_activo()}:{tipo_archivo}:{digest}".encode())
+    return h.hexdigest()
+
+
+def ruta_cache_archivo(clave):
+    return os.path.join(DIRECTORIO_CACHE_ARCHIVOS, clave + EXTENSION_CACHE_ARCHIVOS)
+
+
+def entradas_cache_archivos():
+    """Lista (última modificación, tamaño, ruta) de cada archivo de la caché."""
+    entradas = []
     try:
-        datos_combinados = defaultdict(lambda: {
-            'nodos': set(),
-            'codigos_n1': defaultdict(lambda: defaultdict(set)),
-            'codigos_n2': defaultdict(lambda: defaultdict(set)),
-            'materiales': defaultdict(lambda: defaultdict(int)),
-            'materiales_retirados': defaultdict(lambda: defaultdict(int)),
-            'aspectos_materiales': defaultdict(lambda: defaultdict(lambda: set())),
-            'aspectos_retirados': defaultdict(lambda: defaultdict(lambda: set())),
-            'fechas_sync': defaultdict(str),
-            'tipos_suelo': defaultdict(str),
-            'tipos_instalacion': defaultdict(str),
-            'pintado_nodo': defaultdict(str)
-        })
-        
-        datos_por_barrio_combinados = defaultdict(lambda: {
-            'materiales_instalados': defaultdict(lambda: defaultdict(int)),
-            'materiales_retirados': defaultdict(lambda: defaultdict(int)),
-        })
+        with os.scandir(DIRECTORIO_CACHE_ARCHIVOS) as it:
+            for entrada in it:
+                if entrada.name.endswith(EXTENSION_CACHE_ARCHIVOS):
+                    try:
+                        info = entrada.stat()
+                    except FileNotFoundError:
+                        continue
+                    entradas.append((info.st_mtime, info.st_size, entrada.path))
+    except FileNotFoundError:
+        pass
+    return entradas
+
+
+def leer_cache_archivo(clave):
+    """Devuelve el resultado guardado para la clave, o None si no está en la caché."""
+    if MAX_CACHE_ARCHIVOS_MB <= 0:
+        return None
+    ruta = ruta_cache_archivo(clave)
+    try:
+        with open(ruta, 'rb') as f:
+            resultado = pickle.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Entrada de caché %s ilegible, se descarta: %s", clave, e)
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+        return None
+    # La fecha de modificación marca el último uso para el desalojo LRU
+    try:
+        os.utime(ruta)
+    except OSError:
+        pass
+    return resultado
+
+
+def guardar_cache_archivo(clave, resultado):
+    """Guarda el resultado comprimido y desaloja las entradas menos usadas si se pasa del límite."""
+    if MAX_CACHE_ARCHIVOS_MB <= 0:
+        return
+    try:
+        os.makedirs(DIRECTORIO_CACHE_ARCHIVOS, exist_ok=True)
+        ruta = ruta_cache_archivo(clave)
+        # Escribir aparte y renombrar para que nunca se lea un archivo a medias
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(resultado, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(temporal, ruta)
+    except Exception as e:
+        logger.warning("No se pudo guardar la entrada de caché %s: %s", clave, e)
+        return
+
+    entradas = sorted(entradas_cache_archivos())
+    total = sum(tamano for _, tamano, _ in entradas)
+    limite = MAX_CACHE_ARCHIVOS_MB * 2**20
+    for _, tamano, ruta_vieja in entradas:
+        if total <= limite:
+            break
+        try:
+            os.remove(ruta_vieja)
+        except FileNotFoundError:
+            pass
+        total -= tamano
+
+
+class MemoriaInsuficiente(Exception):
+    """El proceso del pool se quedó sin memoria procesando un archivo."""
+
+
+def reiniciar_pico_memoria():
+    """Reinicia el pico de memoria residente (VmHWM) del proceso; solo en Linux."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def pico_memoria_mb():
+    """Pico de memoria residente del proceso en MB desde el último reinicio (o desde que arrancó)."""
+    try:
+        with open('/proc/self/status') as f:
+            for linea in f:
+                if linea.startswith('VmHWM:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def procesar_archivo_en_proceso(tipo_archivo, nombre, ruta, clave_cache=None, id_solicitud="-"):
+    """
+    Procesa un archivo dentro de un proceso del pool.
+
+    Args:
+        tipo_archivo: modernizacion, proyecto o mantenimiento
+        nombre: Nombre del archivo subido
+        ruta: Ruta de la copia del archivo en DIRECTORIO_SUBIDAS
+        clave_cache: Clave con la que se guarda el resultado en la caché de archivos
+        id_solicitud: Id de la solicitud, para los registros del proceso
+
+    Returns:
+        tuple: ((tablas, dfs_originales), métricas), con las tablas largas de tablas_resultado;
+        las métricas son el pico de memoria del proceso en MB, los aciertos y fallos de las
+        cachés de los normalizadores durante el archivo y las etapas medidas, que el proceso
+        principal suma con registrar_etapa
+    """
+    ID_SOLICITUD.set(id_solicitud)
+    reiniciar_pico_memoria()
+    uso_inicial = uso_normalizadores()
+    inicio = time.perf_counter()
+    datos_por_barrio, dfs_originales = materiales_por_barrio(), {}
+    try:
+        with open(ruta, 'rb') as archivo:
+            file = UploadFile(file=archivo, filename=nombre)
+            if tipo_archivo == 'modernizacion':
+                datos, datos_por_barrio, dfs_originales = procesar_archivo_modernizacion(file)
+            elif tipo_archivo == 'proyecto':
+                datos, datos_por_barrio, dfs_originales = procesar_archivo_proyecto(file)
+            elif tipo_archivo == 'mantenimiento':
+                datos = procesar_archivo_mantenimiento(file)
+            else:
+                raise ValueError("Tipo de archivo no válido")
+        resultado = tablas_resultado(datos, datos_por_barrio), dfs_originales
+    except MemoryError:
+        raise MemoriaInsuficiente(nombre) from None
+    except Exception as e:
+        # HTTPException no siempre se puede reconstruir al volver al proceso principal
+        raise RuntimeError(str(e)) from None
+    volumenes = {
+        'filas': sum(len(df) for df in dfs_originales.values()),
+        'ots': resultado[0]['n_ordenes'],
+        'nodos': len(resultado[0]['nodos']),
+    }
+    etapas = [(f'procesar_{tipo_archivo}', time.perf_counter() - inicio, volumenes)]
+    if clave_cache is not None:
+        guardar_cache_archivo(clave_cache, resultado)
+    metricas = {
+        'etapas': etapas,
+        'pico_memoria_mb': pico_memoria_mb(),
+        'normalizadores': {
+            nombre: (aciertos - uso_inicial[nombre][0], fallos - uso_inicial[nombre][1])
+            for nombre, (aciertos, fallos) in uso_normalizadores().items()
+        },
+    }
+    return resultado, metricas
+
+
+async def resultado_archivo(tipo_archivo, archivo, pool):
+    """
+    Devuelve el resultado de la caché si el archivo ya se procesó; si no, lo procesa en `pool`.
+
+    Returns:
+        tuple: (resultado, métricas de procesar_archivo_en_proceso; vacías si salió de la caché)
+    """
+    loop = asyncio.get_running_loop()
+    clave = clave_cache_archivo(tipo_archivo, archivo.digest)
+    resultado = await loop.run_in_executor(None, leer_cache_archivo, clave)
+    if resultado is not None:
+        registrar_uso_cache_archivo(True)
+        logger.info("%s ya procesado antes, resultado tomado de la caché (%s)", archivo.nombre, clave[:12])
+        return resultado, {}
+    registrar_uso_cache_archivo(False)
+    try:
+        return await loop.run_in_executor(
+            pool, procesar_archivo_en_proceso,
+            tipo_archivo, archivo.nombre, archivo.ruta, clave, ID_SOLICITUD.get()
+        )
+    except (MemoriaInsuficiente, BrokenProcessPool) as e:
+        if isinstance(e, BrokenProcessPool):
+            # Un proceso del pool murió (normalmente por falta de memoria): el pool ya no sirve
+            descartar_pool_archivos(pool=pool)
+        logger.error("Memoria insuficiente procesando %s", archivo.nombre)
+        raise HTTPException(413, detail=f"El archivo {archivo.nombre} necesita más memoria de la disponible para procesarlo")
+
+
+# ======== SUBIDA DE ARCHIVOS ========
+TAMANO_BLOQUE_SUBIDA = 2**20
+# Memoria que ocupa procesar un archivo por cada byte descomprimido (medido con exportaciones reales)
+FACTOR_MEMORIA_ARCHIVO = 4
+
+ArchivoSubido = namedtuple('ArchivoSubido', ['nombre', 'ruta', 'digest', 'tamano'])
 
-        dfs_originales_combinados = {}  # Inicializar diccionario para DataFrames originales
 
+def borrar_subidas(archivos):
+    for archivo in archivos:
+        try:
+            os.remove(archivo.ruta)
+        except OSError:
+            pass
+
+
+async def guardar_subidas(files):
+    """
+    Copia los archivos subidos a DIRECTORIO_SUBIDAS por bloques, calculando su SHA-256.
+
+    Responde 413 en cuanto un archivo o el total de la solicitud supera MAX_TAMANO_ARCHIVO_MB
+    o MAX_TAMANO_SOLICITUD_MB, sin terminar de copiarlo.
+
+    Returns:
+        list: ArchivoSubido en el orden de subida
+    """
+    os.makedirs(DIRECTORIO_SUBIDAS, exist_ok=True)
+    inicio = time.perf_counter()
+    archivos = []
+    total = 0
+    try:
         for file in files:
-            try:
-                if tipo_archivo == 'modernizacion':
-                    # Procesar archivo y obtener datos, datos_por_barrio y DataFrames originales
-                    datos, datos_por_barrio, dfs_originales = procesar_archivo_modernizacion(file)
-                    # Combinar DataFrames originales
-                    dfs_originales_combinados.update(dfs_originales)
-                elif tipo_archivo == 'proyecto':
-                    # Procesar archivo de proyecto y obtener datos, datos_por_barrio y DataFrames originales
-                    datos, datos_por_barrio, dfs_originales = procesar_archivo_proyecto(file)
-                    # Combinar DataFrames originales
-                    dfs_originales_combinados.update(dfs_originales)
-                elif tipo_archivo == 'mantenimiento':
-                    datos = procesar_archivo_mantenimiento(file)
-                else:
-                    raise ValueError("Tipo de archivo no válido")
-
-                # Combinar datos por barrio (para modernización y proyecto)
-                if tipo_archivo in ['modernizacion', 'proyecto']:
-                    for barrio, barrio_info in datos_por_barrio.items():
-                        # Materiales instalados
-                        for mat_key, ot_counts in barrio_info['materiales_instalados'].items():
-                            for ot, cantidad in ot_counts.items():
-                                datos_por_barrio_combinados[barrio]['materiales_instalados'][mat_key][ot] += cantidad
-                        # Materiales retirados
-                        for mat_key, ot_counts in barrio_info['materiales_retirados'].items():
-                            for ot, cantidad in ot_counts.items():
-                                datos_por_barrio_combinados[barrio]['materiales_retirados'][mat_key][ot] += cantidad
-
-                # Combinar datos comunes
-                for ot, info in datos.items():
-                    # Actualizar nodos y fechas
-                    datos_combinados[ot]['nodos'].update(info['nodos'])
-                    for nodo, fecha in info.get('fechas_sync', {}).items():
-                        datos_combinados[ot]['fechas_sync'][nodo] = fecha
-                    
-                    # Combinar materiales instalados
-                    for nodo, tipo_instalacion in info.get('tipos_instalacion', {}).items():
-                        datos_combinados[ot]['tipos_instalacion'][nodo] = tipo_instalacion
-                        print(f"DEBUG: Copiando tipo instalación para OT {ot}, nodo {nodo}: {tipo_instalacion}")
-                    
-                    for nodo, tipo_suelo in info.get('tipos_suelo', {}).items():
-                        datos_combinados[ot]['tipos_suelo'][nodo] = tipo_suelo
-                    
-                    for nodo, pintado in info.get('pintado_nodo', {}).items():
-                        datos_combinados[ot]['pintado_nodo'][nodo] = pintado
-                    
-                    # Combinar materiales instalados
-                    for mat_key, cantidades in info.get('materiales', {}).items():
-                        for nodo, cantidad in cantidades.items():
-                            datos_combinados[ot]['materiales'][mat_key][nodo] += cantidad
-                    
-                    # Procesar códigos y materiales retirados para modernización y proyecto
-                    if tipo_archivo in ['modernizacion', 'proyecto']:
-                        # Códigos N1 y N2
-                        for key, nodos_data in info.get('codigos_n1', {}).items():
-                            for nodo, codigos in nodos_data.items():
-                                datos_combinados[ot]['codigos_n1'][key][nodo].update(codigos)
-                        for key, nodos_data in info.get('codigos_n2', {}).items():
-                            for nodo, codigos in nodos_data.items():
-                                datos_combinados[ot]['codigos_n2'][key][nodo].update(codigos)
-                        
-                        # Materiales retirados y aspectos
-                        for mat_key, cantidades in info.get('materiales_retirados', {}).items():
-                            for nodo, cantidad in cantidades.items():
-                                datos_combinados[ot]['materiales_retirados'][mat_key][nodo] += cantidad
-                        for mat_key, nodos_aspectos in info.get('aspectos_materiales', {}).items():
-                            for nodo, aspectos in nodos_aspectos.items():
-                                datos_combinados[ot]['aspectos_materiales'][mat_key][nodo].update(aspectos)
-                        for mat_key, nodos_aspectos in info.get('aspectos_retirados', {}).items():
-                            for nodo, aspectos in nodos_aspectos.items():
-                                datos_combinados[ot]['aspectos_retirados'][mat_key][nodo].update(aspectos)
+            h = hashlib.sha256()
+            tamano = 0
+            with tempfile.NamedTemporaryFile(dir=DIRECTORIO_SUBIDAS, suffix=".subida", delete=False) as destino:
+                archivos.append(ArchivoSubido(file.filename, destino.name, None, 0))
+                while bloque := await file.read(TAMANO_BLOQUE_SUBIDA):
+                    tamano += len(bloque)
+                    total += len(bloque)
+                    if tamano > MAX_TAMANO_ARCHIVO_MB * 2**20:
+                        raise HTTPException(413, detail=f"El archivo {file.filename} supera el máximo de {MAX_TAMANO_ARCHIVO_MB:g} MB")
+                    if total > MAX_TAMANO_SOLICITUD_MB * 2**20:
+                        raise HTTPException(413, detail=f"Los archivos superan el máximo de {MAX_TAMANO_SOLICITUD_MB:g} MB por solicitud")
+                    h.update(bloque)
+                    destino.write(bloque)
+            archivos[-1] = ArchivoSubido(file.filename, destino.name, h.hexdigest(), tamano)
+    except BaseException:
+        borrar_subidas(archivos)
+        raise
+    registrar_etapa('leer_subidas', time.perf_counter() - inicio, {'bytes': total})
+    return archivos
+
+
+def tamano_descomprimido(ruta):
+    """Bytes que ocupa el contenido del archivo descomprimido (xlsx y Parquet) o en disco (CSV)."""
+    cabecera = primeros_bytes(ruta, 4)
+    try:
+        if cabecera == b"PK\x03\x04":
+            with zipfile.ZipFile(ruta) as libro:
+                return sum(info.file_size for info in libro.infolist())
+        if cabecera == b"PAR1" and importlib.util.find_spec("pyarrow") is not None:
+            import pyarrow.parquet as pq
+            metadatos = pq.read_metadata(ruta)
+            return sum(metadatos.row_group(i).total_byte_size for i in range(metadatos.num_row_groups))
+    except Exception:
+        pass
+    return os.path.getsize(ruta)
+
+
+def verificar_memoria_solicitud(archivos):
+    """Estima la memoria que necesita procesar los archivos y responde 413 si supera MAX_MEMORIA_SOLICITUD_MB."""
+    estimada_mb = sum(FACTOR_MEMORIA_ARCHIVO * tamano_descomprimido(archivo.ruta) for archivo in archivos) / 2**20
+    if MAX_MEMORIA_SOLICITUD_MB > 0 and estimada_mb > MAX_MEMORIA_SOLICITUD_MB:
+        logger.warning("Solicitud rechazada: necesitaría unos %.0f MB de memoria", estimada_mb)
+        raise HTTPException(
+            413, detail=f"Los archivos necesitan unos {estimada_mb:.0f} MB de memoria; el máximo por solicitud es {MAX_MEMORIA_SOLICITUD_MB:g} MB"
+        )
+    return estimada_mb
+
+
+async def generar_reporte(archivos, tipo_archivo, progreso=None):
+    """
+    Procesa los archivos subidos y genera el Excel combinado.
+
+    Args:
+        archivos: Lista de ArchivoSubido (ver guardar_subidas)
+        tipo_archivo: modernizacion, proyecto o mantenimiento
+        progreso: Diccionario opcional donde se publican la etapa y los avances
+
+    Returns:
+        BytesIO: Libro de Excel generado
+    """
+    partes = []  # Tablas largas de cada archivo, en el orden de subida
+    dfs_originales_combinados = {}  # Inicializar diccionario para DataFrames originales
+
+    # Los archivos se procesan en paralelo en el pool de procesos (o salen de la caché); los resultados
+    # se combinan en el orden de subida para que las hojas del Excel salgan siempre en el mismo orden
+    loop = asyncio.get_running_loop()
+    pool = reservar_pool_archivos()
+    tareas = [
+        asyncio.ensure_future(resultado_archivo(tipo_archivo, archivo, pool))
+        for archivo in archivos
+    ]
+    pico_memoria = 0
+    limite = loop.time() + TIEMPO_LIMITE_ARCHIVOS
+    if progreso is not None:
+        progreso.update(etapa='procesando_archivos', archivos_total=len(archivos), archivos_procesados=0)
 
+    try:
+        for archivo, tarea in zip(archivos, tareas):
+            nombre_archivo = archivo.nombre
+            try:
+                try:
+                    (tablas, dfs_originales), metricas = await asyncio.wait_for(tarea, max(0, limite - loop.time()))
+                except asyncio.TimeoutError:
+                    logger.error("Tiempo límite de %s s superado procesando %s", TIEMPO_LIMITE_ARCHIVOS, nombre_archivo)
+                    raise HTTPException(504, detail="Tiempo límite superado procesando los archivos")
+                # Los DataFrames originales se combinan ya; las tablas de todos los archivos, al final
+                dfs_originales_combinados.update(dfs_originales)
+                partes.append(tablas)
+                pico_memoria += metricas.get('pico_memoria_mb', 0)
+                for etapa_archivo in metricas.get('etapas', ()):
+                    registrar_etapa(*etapa_archivo)
+                with BLOQUEO_NORMALIZADORES:
+                    for nombre, (aciertos, fallos) in metricas.get('normalizadores', {}).items():
+                        ESTADISTICAS_NORMALIZADORES[nombre]['aciertos'] += aciertos
+                        ESTADISTICAS_NORMALIZADORES[nombre]['fallos'] += fallos
+
+            except HTTPException:
+                raise
             except Exception as e:
-                logger.error(f"Error con {file.filename}: {str(e)}")
+                logger.error("Error con %s: %s", nombre_archivo, e)
                 continue
+            finally:
+                if progreso is not None:
+                    progreso['archivos_procesados'] += 1
+    except BaseException:
+        # La solicitud falla (tiempo límite, 413, cancelación): sus archivos pendientes no deben
+        # seguir en el pool después de liberar las subidas y el cupo
+        abandonar_archivos(tareas, pool)
+        raise
+    finally:
+        liberar_pool_archivos(pool)
+
+    logger.info("Memoria máxima de los procesos del pool para la solicitud: %.0f MB", pico_memoria)
+    # Los hilos del ejecutor no heredan el contexto: se les pasa para conservar el id de la solicitud
+    with etapa('combinar') as volumenes:
+        datos_combinados, datos_por_barrio_combinados = await loop.run_in_executor(
+            None, contextvars.copy_context().run, materializar_tablas, partes
+        )
+        volumenes.update(ots=len(datos_combinados), nodos=sum(len(ot.nodos) for ot in datos_combinados.values()))
+
+    if progreso is not None:
+        progreso.update(etapa='generando_excel', ots_total=len(datos_combinados), ots_generadas=0)
+
+    # Generar el Excel con todos los datos combinados, en un hilo del ejecutor para no bloquear el event loop
+    with medir_reglas_mano_obra() as reglas_solicitud:
+        excel_final = await loop.run_in_executor(
+            EJECUTOR_EXCEL, contextvars.copy_context().run, generar_excel, datos_combinados, datos_por_barrio_combinados, dfs_originales_combinados, progreso
+        )
+    if progreso is not None:
+        progreso['ots_generadas'] = len(datos_combinados)
+    for nombre, valores in estadisticas_reglas_mano_obra(reglas_solicitud).items():
+        logger.debug("Regla de mano de obra %s: %s llamadas, %.3f s", nombre, valores['llamadas'], valores['segundos'])
+    return excel_final
+
+
+@app.middleware("http")
+async def limitar_tamano_subidas(request: Request, call_next):
+    """Rechaza con 413 las subidas cuyo Content-Length ya supera MAX_TAMANO_SOLICITUD_MB, sin leer el cuerpo."""
+    if request.method == "POST" and request.url.path in ("/upload/", "/jobs"):
+        try:
+            tamano = int(request.headers.get("content-length", 0))
+        except ValueError:
+            tamano = 0
+        if tamano > MAX_TAMANO_SOLICITUD_MB * 2**20:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Los archivos superan el máximo de {MAX_TAMANO_SOLICITUD_MB:g} MB por solicitud"},
+            )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def asignar_id_solicitud(request: Request, call_next):
+    """Id de correlación de la solicitud (X-Request-ID si el cliente lo envía) para los registros y la respuesta."""
+    id_solicitud = request.headers.get("x-request-id", "")[:64] or uuid.uuid4().hex[:12]
+    ID_SOLICITUD.set(id_solicitud)
+    respuesta = await call_next(request)
+    respuesta.headers["X-Request-ID"] = id_solicitud
+    return respuesta
 
-        # Generar el Excel con todos los datos combinados
-        excel_final = generar_excel(datos_combinados, datos_por_barrio_combinados, dfs_originales_combinados)
+
+@app.middleware("http")
+async def medir_etapas_solicitud(request: Request, call_next):
+    """Publica en el encabezado Server-Timing cuánto duró cada etapa de la solicitud."""
+    etapas = []
+    ETAPAS_SOLICITUD.set(etapas)
+    inicio = time.perf_counter()
+    respuesta = await call_next(request)
+    respuesta.headers["Server-Timing"] = encabezado_server_timing(etapas, time.perf_counter() - inicio)
+    return respuesta
+
+
+@app.post("/upload/")
+async def subir_archivos(
+    files: list[UploadFile] = File(...),
+    tipo_archivo: str = Form(..., description="Tipo de archivo: modernizacion, mantenimiento o proyecto")
+):
+    reservar_cupo_excel()
+    archivos = []
+    try:
+        archivos = await guardar_subidas(files)
+        verificar_memoria_solicitud(archivos)
+        excel_final = await generar_reporte(archivos, tipo_archivo)
         
         return Response(
             content=excel_final.getvalue(),
@@ -5886,9 +8033,165 @@ async def subir_archivos(
             headers={"Content-Disposition": "attachment; filename=resultado.xlsx"}
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.critical(f"Error global: {str(e)}")
+        logger.critical("Error global: %s", e)
         raise HTTPException(500, detail=str(e))
+    finally:
+        borrar_subidas(archivos)
+        liberar_cupo_excel()
     
       
-    
\ No newline at end of file
+    
+
+
+# ======== TRABAJOS ASÍNCRONOS ========
+# Estado de cada trabajo por id; el mismo diccionario se usa como `progreso` de generar_reporte
+TRABAJOS = {}
+CAMPOS_ESTADO_TRABAJO = (
+    'id', 'estado', 'etapa', 'tipo_archivo', 'archivos_total', 'archivos_procesados',
+    'ots_total', 'ots_generadas', 'error', 'creado', 'finalizado',
+)
+
+
+def purgar_trabajos_vencidos():
+    """Elimina los trabajos terminados hace más de TTL_TRABAJOS_SEGUNDOS y sus archivos."""
+    ahora = time.time()
+    for trabajo_id, trabajo in list(TRABAJOS.items()):
+        if trabajo['finalizado'] is not None and ahora - trabajo['finalizado'] > TTL_TRABAJOS_SEGUNDOS:
+            TRABAJOS.pop(trabajo_id, None)
+            if trabajo.get('ruta') and os.path.exists(trabajo['ruta']):
+                os.remove(trabajo['ruta'])
+    # Resultados que quedaron de ejecuciones anteriores del servidor
+    if os.path.isdir(DIRECTORIO_TRABAJOS):
+        for nombre in os.listdir(DIRECTORIO_TRABAJOS):
+            ruta = os.path.join(DIRECTORIO_TRABAJOS, nombre)
+            if nombre.split('.')[0] not in TRABAJOS and ahora - os.path.getmtime(ruta) > TTL_TRABAJOS_SEGUNDOS:
+                os.remove(ruta)
+
+
+def ejecutar_trabajo(trabajo_id, archivos, tipo_archivo):
+    """Procesa un trabajo en un hilo de EJECUTOR_TRABAJOS y deja el resultado en disco."""
+    trabajo = TRABAJOS[trabajo_id]
+    trabajo['estado'] = 'procesando'
+    # La respuesta de /jobs ya salió: las etapas solo van a /metrics
+    ETAPAS_SOLICITUD.set(None)
+    try:
+        excel_final = asyncio.run(generar_reporte(archivos, tipo_archivo, progreso=trabajo))
+        os.makedirs(DIRECTORIO_TRABAJOS, exist_ok=True)
+        ruta = os.path.join(DIRECTORIO_TRABAJOS, f"{trabajo_id}.xlsx")
+        with open(ruta, 'wb') as archivo:
+            archivo.write(excel_final.getbuffer())
+        trabajo.update(estado='completado', etapa='completado', ruta=ruta)
+    except Exception as e:
+        logger.error("Error en el trabajo %s: %s", trabajo_id, e)
+        trabajo.update(estado='error', error=e.detail if isinstance(e, HTTPException) else str(e))
+    finally:
+        borrar_subidas(archivos)
+        trabajo['finalizado'] = time.time()
+        liberar_cupo_excel()
+
+
+@app.post("/jobs", status_code=202)
+async def crear_trabajo(
+    files: list[UploadFile] = File(...),
+    tipo_archivo: str = Form(..., description="Tipo de archivo: modernizacion, mantenimiento o proyecto")
+):
+    purgar_trabajos_vencidos()
+    reservar_cupo_excel()
+    archivos = []
+    try:
+        archivos = await guardar_subidas(files)
+        verificar_memoria_solicitud(archivos)
+        trabajo_id = uuid.uuid4().hex
+        TRABAJOS[trabajo_id] = {
+            'id': trabajo_id,
+            'estado': 'en_cola',
+            'etapa': 'en_cola',
+            'tipo_archivo': tipo_archivo,
+            'archivos_total': len(archivos),
+            'archivos_procesados': 0,
+            'ots_total': None,
+            'ots_generadas': 0,
+            'error': None,
+            'creado': time.time(),
+            'finalizado': None,
+            'ruta': None,
+        }
+        EJECUTOR_TRABAJOS.submit(contextvars.copy_context().run, ejecutar_trabajo, trabajo_id, archivos, tipo_archivo)
+    except Exception:
+        borrar_subidas(archivos)
+        liberar_cupo_excel()
+        raise
+    return {'id': trabajo_id, 'estado': 'en_cola'}
+
+
+def obtener_trabajo(trabajo_id):
+    purgar_trabajos_vencidos()
+    trabajo = TRABAJOS.get(trabajo_id)
+    if trabajo is None:
+        raise HTTPException(404, detail="Trabajo no encontrado o vencido")
+    return trabajo
+
+
+@app.get("/jobs/{trabajo_id}")
+async def estado_trabajo(trabajo_id: str):
+    trabajo = obtener_trabajo(trabajo_id)
+    return {campo: trabajo.get(campo) for campo in CAMPOS_ESTADO_TRABAJO}
+
+
+@app.get("/jobs/{trabajo_id}/result")
+async def resultado_trabajo(trabajo_id: str):
+    trabajo = obtener_trabajo(trabajo_id)
+    if trabajo['estado'] == 'error':
+        raise HTTPException(409, detail=f"El trabajo terminó con error: {trabajo['error']}")
+    if trabajo['estado'] != 'completado':
+        raise HTTPException(409, detail=f"El trabajo aún no termina (etapa: {trabajo['etapa']})")
+    return FileResponse(
+        trabajo['ruta'],
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename="resultado.xlsx"
+    )
+
+
+@app.get("/cache/archivos")
+async def estado_cache_archivos():
+    entradas = await asyncio.get_running_loop().run_in_executor(None, entradas_cache_archivos)
+    with BLOQUEO_CACHE_ARCHIVOS:
+        estadisticas = dict(ESTADISTICAS_CACHE_ARCHIVOS)
+    return {
+        **estadisticas,
+        'entradas': len(entradas),
+        'bytes': sum(tamano for _, tamano, _ in entradas),
+        'limite_bytes': int(MAX_CACHE_ARCHIVOS_MB * 2**20),
+    }
+
+
+@app.get("/cache/normalizadores")
+async def estado_cache_normalizadores():
+    # Los parsers corren en el pool; la generación del Excel, en este proceso
+    locales = uso_normalizadores()
+    with BLOQUEO_NORMALIZADORES:
+        del_pool = {
+            nombre: (ESTADISTICAS_NORMALIZADORES[nombre]['aciertos'], ESTADISTICAS_NORMALIZADORES[nombre]['fallos'])
+            for nombre in CACHES_NORMALIZADORES
+        }
+    return {
+        nombre: {
+            'aciertos': del_pool[nombre][0] + locales[nombre][0],
+            'fallos': del_pool[nombre][1] + locales[nombre][1],
+            'maximo': funcion.cache_info().maxsize,
+        }
+        for nombre, funcion in CACHES_NORMALIZADORES.items()
+    }
+
+
+@app.get("/cache/mano_obra")
+async def estado_cache_mano_obra():
+    return uso_cache_mano_obra()
+
+
+@app.get("/metrics")
+async def estado_metricas():
+    return Response(content=texto_metricas(), media_type="text/plain; version=0.0.4; charset=utf-8")